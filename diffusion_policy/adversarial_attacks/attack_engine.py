@@ -0,0 +1,523 @@
+"""
+Shared adversarial attack engine for the robomimic image runners.
+
+Every policy family only provides a loss adapter: how to build the clean
+reference target once per env step and how to score a perturbed
+observation against it. The engine owns the FGSM / PGD / noise / patch
+loops and runs them batched over all envs and all attacked views, with a
+single forward/backward per iteration.
+"""
+from typing import Dict, List, Optional
+import torch
+import torch.nn.functional as F
+
+from diffusion_policy.policy.base_image_policy import BaseImagePolicy
+from diffusion_policy.utils.attack_utils import optimize_linear, clip_perturb
+from diffusion_policy.adversarial_attacks.attack_schedule import AttackScheduleReport
+from diffusion_policy.adversarial_attacks.attack_memory import AttackMemoryPlanner
+from diffusion_policy.adversarial_attacks.attack_telemetry import AttackTelemetry
+from diffusion_policy.common.cfg_util import cfg_get
+
+DEFAULT_VIEWS = ('agentview_image', 'robot0_eye_in_hand_image')
+# legacy attack_type names kept for old eval configs
+ATTACK_ALIASES = {'fgsm_alt': 'fgsm'}
+
+
+def get_attack_views(view, both_views=DEFAULT_VIEWS) -> List[str]:
+    """
+    Resolve cfg.view into the list of obs keys to perturb.
+    """
+    if view is None or view == 'None':
+        return []
+    if view == 'both':
+        return list(both_views)
+    if isinstance(view, str):
+        return [view]
+    try:
+        return list(view)
+    except TypeError:
+        raise ValueError("view must be a string or a list of strings")
+
+
+def broadcast_epsilon(epsilon, like: torch.Tensor):
+    """
+    Reshape a per-sample (B,) epsilon tensor to broadcast against like (B, ...).
+    Scalars are returned unchanged.
+    """
+    if isinstance(epsilon, torch.Tensor) and epsilon.ndim == 1:
+        return epsilon.to(device=like.device, dtype=like.dtype).reshape(
+            -1, *([1] * (like.ndim - 1)))
+    return epsilon
+
+
+def _uniform_noise(like: torch.Tensor, bound):
+    return (torch.rand_like(like) * 2 - 1) * broadcast_epsilon(bound, like)
+
+
+def _detach(x):
+    if isinstance(x, torch.Tensor):
+        return x.detach()
+    if isinstance(x, dict):
+        return {k: _detach(v) for k, v in x.items()}
+    return x
+
+
+def _slice(x, sl: slice):
+    if isinstance(x, torch.Tensor):
+        return x[sl]
+    if isinstance(x, dict):
+        return {k: _slice(v, sl) for k, v in x.items()}
+    return x
+
+
+def _cat(xs: list):
+    # inverse of _slice over consecutive chunks
+    if len(xs) == 1:
+        return xs[0]
+    if isinstance(xs[0], torch.Tensor):
+        return torch.cat(xs, dim=0)
+    if isinstance(xs[0], dict):
+        return {k: _cat([x[k] for x in xs]) for k in xs[0].keys()}
+    return xs[0]
+
+
+def _reduce_loss(loss):
+    # BET returns (loss, components), VQ-BeT returns (loss_dict, batch)
+    if isinstance(loss, tuple):
+        loss = loss[0]
+    if isinstance(loss, dict):
+        loss = loss['loss']
+    return loss
+
+
+# ========= loss adapters ============
+class AttackLoss:
+    """
+    Adapter between a policy family and the AttackEngine.
+    first_step() runs the clean forward pass once per env step and returns
+    (clean prediction, attack target, differentiable loss at the clean obs);
+    loss() scores any later iterate against the cached target.
+    The engine ascends the loss w.r.t. the attacked views.
+    """
+    # optional policy-specific PGD, called as pgd(policy, obs_dict, epsilon)
+    pgd = None
+    # whether the envs of a batch can be attacked in separate chunks
+    micro_batching = True
+    # AttackTelemetry of the engine, set by AttackEngine
+    telemetry = None
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+
+    def perturbations(self, like: torch.Tensor) -> torch.Tensor:
+        return torch.as_tensor(list(self.cfg.perturbations),
+            dtype=like.dtype, device=like.device)
+
+    def target(self, policy: BaseImagePolicy, obs_dict: Dict[str, torch.Tensor], clean: Dict):
+        raise NotImplementedError()
+
+    def loss(self, policy: BaseImagePolicy, obs_dict: Dict[str, torch.Tensor], target) -> torch.Tensor:
+        raise NotImplementedError()
+
+    def summary(self) -> Dict[str, float]:
+        # adapter specific metrics merged into the runner's log_data
+        return dict()
+
+    def first_step(self, policy: BaseImagePolicy, obs_dict: Dict[str, torch.Tensor]):
+        # default: clean prediction without grad, then a separate loss forward
+        with torch.no_grad():
+            clean = policy.predict_action(obs_dict)
+            target = self.target(policy, obs_dict, clean)
+        return clean, target, self.loss(policy, obs_dict, target)
+
+
+class ActionMSELoss(AttackLoss):
+    """
+    MSE between the predicted and the target action (vanilla BC).
+    The clean prediction doubles as the first gradient forward.
+    """
+    def target(self, policy, obs_dict, clean):
+        action = clean['action'].detach()
+        if self.cfg.targeted:
+            action = action + self.perturbations(action)
+        return action
+
+    def _loss(self, predicted_action, target):
+        loss = F.mse_loss(predicted_action, target)
+        if self.cfg.targeted:
+            loss = -loss
+        return loss
+
+    def loss(self, policy, obs_dict, target):
+        return self._loss(policy.predict_action(obs_dict)['action'], target)
+
+    def first_step(self, policy, obs_dict):
+        clean = policy.predict_action(obs_dict)
+        target = self.target(policy, obs_dict, clean)
+        return clean, target, self._loss(clean['action'], target)
+
+
+class GMMMeanLoss(AttackLoss):
+    """
+    MSE between the GMM component means of the action distribution (BC-RNN/LSTM-GMM).
+    """
+    # the rnn state of BC-RNN is sized for the full env batch
+    micro_batching = False
+    @staticmethod
+    def _means(policy, obs_dict):
+        return policy.action_dist(obs_dict).component_distribution.base_dist.loc
+
+    def target(self, policy, obs_dict, clean):
+        means = clean['means'].detach()
+        if self.cfg.targeted:
+            means = means + self.perturbations(means).unsqueeze(0)
+        return means
+
+    def _loss(self, means, target):
+        loss = F.mse_loss(means, target)
+        if self.cfg.targeted:
+            loss = -loss
+        return loss
+
+    def loss(self, policy, obs_dict, target):
+        return self._loss(self._means(policy, obs_dict), target)
+
+    def first_step(self, policy, obs_dict):
+        clean = {'means': self._means(policy, obs_dict)}
+        target = self.target(policy, obs_dict, clean)
+        return clean, target, self._loss(clean['means'], target)
+
+
+class IBCEnergyLoss(AttackLoss):
+    """
+    Untargeted: lower the energy of the best action sample.
+    Targeted: the IBC InfoNCE loss with the target action as the positive
+    sample and the clean action planted among the negatives.
+    """
+    def target(self, policy, obs_dict, clean):
+        cfg = self.cfg
+        like = next(iter(obs_dict.values()))
+        B = like.shape[0]
+        clean_actions = clean['action'].detach()
+        if cfg.rand_target:
+            target_actions = torch.rand(B, policy.n_action_steps, cfg.action_space[0],
+                device=like.device)
+        else:
+            target_actions = clean_actions
+            if cfg.targeted:
+                target_actions = target_actions + self.perturbations(target_actions)
+        naction_stats = policy.get_naction_stats()
+        action_samples = torch.distributions.Uniform(
+            low=naction_stats['min'],
+            high=naction_stats['max']
+        ).sample((B, policy.train_n_neg, policy.n_action_steps)).to(device=like.device)
+        action_samples = torch.cat([target_actions.unsqueeze(1), action_samples], dim=1)
+        if cfg.targeted and not cfg.rand_target:
+            action_samples[:, 1] = clean_actions
+        # dummy action at the beginning to get the shape right,
+        # it is not used in the loss computation
+        target_actions = torch.cat([torch.zeros_like(target_actions[:, 0:1]), target_actions], dim=1)
+        return {'action': target_actions, 'action_samples': action_samples}
+
+    def _loss(self, policy, obs_dict, target, energy=None):
+        cfg = self.cfg
+        if cfg.targeted:
+            loss, _, _ = policy.compute_loss_with_grad(
+                obs_dict, target['action'], target['action_samples'])
+        else:
+            if energy is None:
+                energy = policy.predict_action(obs_dict, return_energy=True)['energy']
+            loss = -torch.max(energy, dim=1)[0].sum()
+        if cfg.rand_target or cfg.targeted:
+            loss = -loss
+        return loss
+
+    def loss(self, policy, obs_dict, target):
+        return self._loss(policy, obs_dict, target)
+
+    def first_step(self, policy, obs_dict):
+        # the clean energies are differentiable, the untargeted loss reuses them
+        clean = policy.predict_action(obs_dict, return_energy=True)
+        target = self.target(policy, obs_dict, clean)
+        return clean, target, self._loss(policy, obs_dict, target, energy=clean['energy'])
+
+
+class DenoisingLoss(AttackLoss):
+    """
+    The policy's own training loss on the (optionally shifted) clean action.
+    Used for diffusion policy and (VQ-)BeT, whose compute_loss takes a batch.
+    """
+    def target(self, policy, obs_dict, clean):
+        action = clean['action'].detach()
+        if self.cfg.targeted:
+            action = action + self.perturbations(action).unsqueeze(0)
+        return action
+
+    def loss(self, policy, obs_dict, target):
+        loss = _reduce_loss(policy.compute_loss({'obs': obs_dict, 'action': target}))
+        if self.cfg.targeted:
+            loss = -loss
+        return loss
+
+
+class DiffusionPolicyLoss(DenoisingLoss):
+    """
+    DenoisingLoss for FGSM, PGD attacks every denoising step inside the policy.
+    The encoder features of the clean obs are computed once with grad and
+    shared by the clean sample (the target) and the denoising loss.
+    """
+    def __init__(self, cfg):
+        super().__init__(cfg)
+        self.schedule_report = AttackScheduleReport()
+
+    def pgd(self, policy, obs_dict, epsilon=None):
+        # attack_stats of the call are collected by the engine per attack step
+        return policy.pgd_perturbed_obs(obs_dict, self.cfg, epsilon=epsilon,
+            telemetry=self.telemetry)
+
+    def summary(self):
+        return self.schedule_report.summary()
+
+    def first_step(self, policy, obs_dict):
+        if not policy.obs_as_global_cond:
+            return super().first_step(policy, obs_dict)
+        nobs_features = policy.encode_obs(obs_dict)
+        with torch.no_grad():
+            clean = policy.predict_action(obs_dict, nobs_features=nobs_features.detach())
+            target = self.target(policy, obs_dict, clean)
+        loss = policy.compute_loss({'obs': obs_dict, 'action': target},
+            nobs_features=nobs_features)
+        if self.cfg.targeted:
+            loss = -loss
+        return clean, target, loss
+
+
+# ========= engine ============
+class AttackStep:
+    """
+    Per env step cache of the clean prediction (including encoder features
+    when the policy returns them) and the attack target derived from it.
+    """
+    def __init__(self, obs_dict: Dict[str, torch.Tensor]):
+        self.obs_dict = obs_dict
+        self.clean = None
+        self.target = None
+
+
+class AttackEngine:
+    """
+    Batched FGSM / PGD / noise / patch attacks over all envs and views.
+    epsilon is a float, or a (B,) tensor giving every env its own budget.
+    """
+    def __init__(self, loss_adapter: AttackLoss, cfg, epsilon: Optional[float] = None,
+            views: Optional[List[str]] = None):
+        self.loss_adapter = loss_adapter
+        self.cfg = cfg
+        self.epsilon = None
+        self.views = get_attack_views(cfg.view) if views is None else views
+        self.norm = cfg_get(cfg, 'norm', 'linf')
+        self.clip_min = cfg_get(cfg, 'clip_min', None)
+        self.clip_max = cfg_get(cfg, 'clip_max', None)
+        # patches are added as is unless their own bounds are configured
+        self.patch_clip_min = cfg_get(cfg, 'patch_clip_min', None)
+        self.patch_clip_max = cfg_get(cfg, 'patch_clip_max', None)
+        if (self.patch_clip_min is None) != (self.patch_clip_max is None):
+            raise ValueError("patch_clip_min and patch_clip_max have to be set together")
+        self.num_iter = cfg_get(cfg, 'num_iter', cfg_get(cfg, 'n_iter', 1))
+        self.rand_int = cfg_get(cfg, 'rand_int', False)
+        self.memory = AttackMemoryPlanner.from_cfg(cfg)
+        self.telemetry = AttackTelemetry.from_cfg(cfg)
+        if loss_adapter is not None:
+            # patch only engines have no loss
+            loss_adapter.telemetry = self.telemetry
+        self.set_epsilon(cfg_get(cfg, 'epsilon') if epsilon is None else epsilon)
+
+    def set_epsilon(self, epsilon):
+        """
+        Change the budget, eps_iter and noise_bound follow it unless set in cfg.
+        """
+        self.epsilon = epsilon
+        self.eps_iter = cfg_get(self.cfg, 'eps_iter', None)
+        if self.eps_iter is None:
+            self.eps_iter = epsilon
+        self.noise_bound = cfg_get(self.cfg, 'noise_bound', None)
+        if self.noise_bound is None:
+            self.noise_bound = epsilon
+
+    def _clamp(self, x):
+        if (self.clip_min is None) != (self.clip_max is None):
+            raise ValueError(
+                "One of clip_min and clip_max is None but we don't currently support one-sided clipping")
+        if self.clip_min is None:
+            return x
+        return torch.clamp(x, self.clip_min, self.clip_max)
+
+    def _project(self, adv, clean):
+        eta = clip_perturb(adv - clean, self.norm, broadcast_epsilon(self.epsilon, clean))
+        return self._clamp(clean + eta)
+
+    def prepare(self, policy: BaseImagePolicy, step: AttackStep):
+        """
+        Fill the clean prediction and target of step without taking a gradient.
+        """
+        if step.target is None:
+            with torch.no_grad():
+                clean, step.target, _ = self.loss_adapter.first_step(policy, step.obs_dict)
+            step.clean = _detach(clean)
+        return step
+
+    def _chunks(self, obs_dict):
+        batch_size = next(iter(obs_dict.values())).shape[0]
+        if not self.loss_adapter.micro_batching:
+            return batch_size, [slice(0, batch_size)]
+        return batch_size, self.memory.chunks(batch_size)
+
+    def gradient(self, policy: BaseImagePolicy, obs_dict: Dict[str, torch.Tensor], step: AttackStep):
+        """
+        One forward/backward for all attacked views, per micro batch when
+        the memory planner splits the envs.
+        The first call of an env step also fills the clean prediction and
+        target of step from that same forward pass.
+        Returns the loss and a dict of input gradients per view.
+        """
+        batch_size = next(iter(obs_dict.values())).shape[0]
+        loss, grads = self.memory.run(policy,
+            lambda: self._gradient(policy, obs_dict, step), batch_size,
+            telemetry=self.telemetry)
+        self.telemetry.record('loss', loss)
+        return loss, grads
+
+    def _gradient(self, policy, obs_dict, step):
+        batch_size, chunks = self._chunks(obs_dict)
+        has_target = step.target is not None
+        losses, grads, cleans, targets = list(), list(), list(), list()
+        for sl in chunks:
+            inputs = _slice(dict(obs_dict), sl)
+            for view in self.views:
+                inputs[view] = inputs[view].detach().clone().requires_grad_(True)
+            policy.zero_grad()
+            if has_target:
+                loss = self.loss_adapter.loss(policy, inputs, _slice(step.target, sl))
+            else:
+                clean, target, loss = self.loss_adapter.first_step(policy, inputs)
+                cleans.append(_detach(clean))
+                targets.append(target)
+            # chunk losses add up to the loss of the full batch
+            if len(chunks) > 1:
+                loss = loss * ((sl.stop - sl.start) / batch_size)
+            grads.append(torch.autograd.grad(loss, [inputs[view] for view in self.views]))
+            losses.append(loss.detach())
+        if not has_target:
+            step.clean = _cat(cleans)
+            step.target = _cat(targets)
+        grads = [torch.cat(x, dim=0) if len(x) > 1 else x[0] for x in zip(*grads)]
+        return sum(losses), dict(zip(self.views, grads))
+
+    def ascend(self, policy, adv_obs_dict, step, step_size):
+        """
+        A single signed-gradient step on every attacked view.
+        """
+        _, grads = self.gradient(policy, adv_obs_dict, step)
+        adv_obs_dict = dict(adv_obs_dict)
+        for view in self.views:
+            adv_obs_dict[view] = self._clamp(adv_obs_dict[view].detach() + optimize_linear(
+                grads[view], broadcast_epsilon(step_size, grads[view]), self.norm))
+        return adv_obs_dict
+
+    def fgsm(self, policy, obs_dict, step=None):
+        step = AttackStep(obs_dict) if step is None else step
+        return self.ascend(policy, obs_dict, step, self.epsilon)
+
+    def pgd(self, policy, obs_dict, step=None):
+        """
+        Projected gradient descent from Madry et al. (2017)
+        """
+        if self.loss_adapter.pgd is not None:
+            batch_size = next(iter(obs_dict.values())).shape[0]
+            return self.memory.run(policy,
+                lambda: self._policy_pgd(policy, obs_dict), batch_size,
+                telemetry=self.telemetry)
+        step = AttackStep(obs_dict) if step is None else step
+        adv_obs_dict = dict(obs_dict)
+        if self.rand_int:
+            # the target has to come from the clean obs, not the random start
+            self.prepare(policy, step)
+            for view in self.views:
+                adv_obs_dict[view] = self._clamp(
+                    obs_dict[view] + _uniform_noise(obs_dict[view], self.epsilon))
+        for _ in range(self.num_iter):
+            adv_obs_dict = self.ascend(policy, adv_obs_dict, step, self.eps_iter)
+            for view in self.views:
+                adv_obs_dict[view] = self._project(adv_obs_dict[view], obs_dict[view])
+        return adv_obs_dict
+
+    def _policy_pgd(self, policy, obs_dict):
+        _, chunks = self._chunks(obs_dict)
+        results, chunk_stats = list(), list()
+        for sl in chunks:
+            epsilon = self.epsilon
+            if isinstance(epsilon, torch.Tensor) and epsilon.ndim == 1:
+                epsilon = epsilon[sl]
+            policy.attack_stats = None
+            results.append(self.loss_adapter.pgd(policy, _slice(dict(obs_dict), sl), epsilon))
+            stats = getattr(policy, 'attack_stats', None)
+            if stats is not None:
+                chunk_stats.append((sl.stop - sl.start, stats))
+        # one report entry per attack step, however many micro batches it took
+        report = getattr(self.loss_adapter, 'schedule_report', None)
+        if report is not None:
+            report.add_chunks(chunk_stats)
+        return _cat(results)
+
+    def noise(self, policy, obs_dict, step=None):
+        """
+        Uniform noise baseline.
+        """
+        adv_obs_dict = dict(obs_dict)
+        for view in self.views:
+            adv_obs_dict[view] = self._clamp(
+                obs_dict[view] + _uniform_noise(obs_dict[view], self.noise_bound))
+        return adv_obs_dict
+
+    def patch(self, obs_dict, adversarial_patch):
+        """
+        Add a precomputed (universal) perturbation to every env.
+        """
+        adv_obs_dict = dict(obs_dict)
+        for view in self.views:
+            pert = adversarial_patch[view].to(device=obs_dict[view].device)
+            adv_obs_dict[view] = obs_dict[view] + pert
+            if self.patch_clip_min is not None:
+                adv_obs_dict[view] = torch.clamp(adv_obs_dict[view],
+                    self.patch_clip_min, self.patch_clip_max)
+        return adv_obs_dict
+
+    def attack(self, policy, obs_dict, attack_type=None, step=None):
+        if attack_type is None:
+            attack_type = self.cfg.attack_type
+        if attack_type is None or attack_type == 'None':
+            return obs_dict
+        attack_type = ATTACK_ALIASES.get(attack_type, attack_type)
+        if attack_type not in ('fgsm', 'pgd', 'noise'):
+            raise ValueError("Invalid attack type")
+        return getattr(self, attack_type)(policy, obs_dict, step)
+
+    def attack_step(self, policy, obs_dict, attack_type=None):
+        """
+        Attack one env step. Returns the perturbed obs and the AttackStep
+        holding the cached clean prediction (None for noise and policy-side PGD).
+        """
+        step = AttackStep(obs_dict)
+        adv_obs_dict = self.attack(policy, obs_dict, attack_type=attack_type, step=step)
+        return adv_obs_dict, step
+
+    def predict_action(self, policy, adv_obs_dict, step: AttackStep):
+        """
+        Final action on the perturbed obs. Reuses the cached clean prediction
+        when the attack left the obs untouched.
+        """
+        if adv_obs_dict is step.obs_dict and step.clean is not None \
+                and 'action' in step.clean:
+            return step.clean
+        with torch.no_grad():
+            return policy.predict_action(adv_obs_dict)
@@ -0,0 +1,149 @@
+"""
+Memory strategy for attack gradients.
+
+cfg.attack_memory (optional):
+    mode: 'none'        one backward over all envs (legacy)
+          'checkpoint'  activation checkpointing in the ResNet obs encoders
+          'micro_batch' split the envs into micro_batch_size chunks
+          'auto'        start like 'none'; when the measured memory per env does not
+                        fit the free device memory, or on CUDA out-of-memory, first
+                        turn on checkpointing, then halve the micro batch until it fits
+    micro_batch_size: int
+    memory_fraction: float   share of the free device memory 'auto' plans for, default 0.9
+
+Every env is attacked independently, so micro batching gives the same
+per-env perturbation as one full batch.
+"""
+from typing import Callable, Optional
+import torch
+
+from diffusion_policy.model.vision.encoder_checkpoint import set_activation_checkpointing
+from diffusion_policy.common.cfg_util import cfg_get
+
+MEMORY_MODES = ('none', 'checkpoint', 'micro_batch', 'auto')
+
+
+class AttackMemoryPlanner:
+    def __init__(self, mode: str = 'none', micro_batch_size: Optional[int] = None,
+            memory_fraction: float = 0.9):
+        if mode not in MEMORY_MODES:
+            raise ValueError(f"Unsupported attack memory mode {mode}, expected one of {MEMORY_MODES}")
+        if mode == 'micro_batch' and (micro_batch_size is None or micro_batch_size < 1):
+            raise ValueError("micro_batch attack memory mode requires micro_batch_size >= 1")
+        self.mode = mode
+        self.micro_batch_size = micro_batch_size if mode in ('micro_batch', 'auto') else None
+        self.checkpointing = mode == 'checkpoint'
+        self.memory_fraction = memory_fraction
+        # peak bytes per env of the last run, measured in 'auto' mode
+        self.bytes_per_env = None
+        self._policy = None
+
+    @classmethod
+    def from_cfg(cls, cfg):
+        memory_cfg = cfg_get(cfg, 'attack_memory')
+        return cls(
+            mode=cfg_get(memory_cfg, 'mode', 'none'),
+            micro_batch_size=cfg_get(memory_cfg, 'micro_batch_size'),
+            memory_fraction=cfg_get(memory_cfg, 'memory_fraction', 0.9))
+
+    def setup(self, policy: torch.nn.Module):
+        """
+        Apply the current strategy to policy, cheap to call every env step.
+        """
+        if self._policy is not policy:
+            self._policy = policy
+            if self.checkpointing:
+                n_blocks = set_activation_checkpointing(policy, True)
+                print(f"Attack memory: activation checkpointing on {n_blocks} encoder blocks")
+
+    def chunks(self, batch_size: int):
+        """
+        Batch slices to run the attack gradient on.
+        """
+        size = self.micro_batch_size
+        if size is None or size >= batch_size:
+            return [slice(0, batch_size)]
+        return [slice(start, min(start + size, batch_size))
+            for start in range(0, batch_size, size)]
+
+    def _chunk_size(self, batch_size: int) -> int:
+        if self.micro_batch_size is None:
+            return batch_size
+        return min(self.micro_batch_size, batch_size)
+
+    def _can_degrade(self, batch_size: int) -> bool:
+        return not self.checkpointing or self._chunk_size(batch_size) > 1
+
+    def _degrade(self, policy, batch_size: int, reason: str):
+        # the measurement of the previous strategy does not apply anymore
+        self.bytes_per_env = None
+        if not self.checkpointing:
+            self.checkpointing = True
+            n_blocks = set_activation_checkpointing(policy, True)
+            print(f"Attack memory: {reason}, activation checkpointing on {n_blocks} encoder blocks")
+            if n_blocks > 0:
+                return
+        current = self._chunk_size(batch_size)
+        if current <= 1:
+            raise RuntimeError("Attack gradient does not fit in memory even for a single env")
+        self.micro_batch_size = current // 2
+        print(f"Attack memory: {reason}, micro batch size {self.micro_batch_size}")
+
+    @staticmethod
+    def _cuda_device(policy) -> Optional[torch.device]:
+        try:
+            device = next(iter(policy.parameters())).device
+        except StopIteration:
+            return None
+        if device.type != 'cuda':
+            return None
+        return device
+
+    def _fits(self, device, batch_size: int) -> bool:
+        """
+        Whether the measured peak of one chunk fits the free device memory.
+        """
+        if self.bytes_per_env is None:
+            return True
+        free, _ = torch.cuda.mem_get_info(device)
+        # cached by the allocator but unused
+        free += torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+        return self.bytes_per_env * self._chunk_size(batch_size) <= free * self.memory_fraction
+
+    def run(self, policy: torch.nn.Module, fn: Callable, batch_size: int,
+            telemetry=None):
+        """
+        Call fn(), in 'auto' mode pick a cheaper strategy when the free device
+        memory is too small and retry with one on CUDA OOM.
+        fn reads self.chunks(batch_size) to split its work.
+        telemetry: AttackTelemetry fn records to, rolled back before a retry
+        """
+        self.setup(policy)
+        device = self._cuda_device(policy) if self.mode == 'auto' else None
+        while True:
+            if device is not None:
+                while not self._fits(device, batch_size) and self._can_degrade(batch_size):
+                    self._degrade(policy, batch_size, 'low free memory')
+                torch.cuda.reset_peak_memory_stats(device)
+                base = torch.cuda.memory_allocated(device)
+            snapshot = telemetry.snapshot() if telemetry is not None else None
+            out_of_memory = False
+            try:
+                result = fn()
+            except RuntimeError as e:
+                # torch < 1.13 has no OutOfMemoryError class
+                if self.mode != 'auto' or 'out of memory' not in str(e):
+                    raise
+                out_of_memory = True
+            if out_of_memory:
+                # out of the except block, the traceback no longer holds the
+                # activations of the failed attempt
+                if snapshot is not None:
+                    telemetry.rollback(snapshot)
+                torch.cuda.empty_cache()
+                self._degrade(policy, batch_size, 'out of memory')
+                continue
+            if device is not None:
+                peak = torch.cuda.max_memory_allocated(device) - base
+                self.bytes_per_env = peak / self._chunk_size(batch_size)
+            return result
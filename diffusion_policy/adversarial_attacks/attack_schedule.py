@@ -0,0 +1,131 @@
+"""
+Attack schedules for diffusion policy.
+
+An AttackSchedule decides which denoising steps of
+DiffusionUnetHybridImagePolicy.pgd_perturbed_obs take attack gradients,
+and optionally compresses the inference schedule the attack runs on.
+AttackScheduleReport aggregates the per env step compute/strength stats,
+so the rollout score of a schedule can be compared against its cost.
+
+cfg.attack_schedule (optional, defaults to the legacy behaviour):
+    mode: 'after'      attack every step with t < (1 - cfg.attack_after_timesteps) * num_inference_steps
+          'last_k'     attack the last k denoising steps
+          'strided'    attack every stride-th step, counted back from the last one
+          'compressed' run the attack loop on num_inference_steps steps (e.g. DDIM)
+                       and attack the last k of them (all if k is None)
+    k: int
+    stride: int
+    num_inference_steps: int
+"""
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+
+from diffusion_policy.common.cfg_util import cfg_get
+
+SCHEDULE_MODES = ('after', 'last_k', 'strided', 'compressed')
+
+
+class AttackSchedule:
+    def __init__(self,
+            mode: str = 'after',
+            attack_after_timesteps: float = 0.0,
+            k: Optional[int] = None,
+            stride: Optional[int] = None,
+            num_inference_steps: Optional[int] = None
+        ):
+        if mode not in SCHEDULE_MODES:
+            raise ValueError(f"Unsupported attack schedule mode {mode}, expected one of {SCHEDULE_MODES}")
+        if mode == 'last_k' and k is None:
+            raise ValueError("last_k attack schedule requires k")
+        if mode == 'strided' and (stride is None or stride < 1):
+            raise ValueError("strided attack schedule requires stride >= 1")
+        if mode == 'compressed' and num_inference_steps is None:
+            raise ValueError("compressed attack schedule requires num_inference_steps")
+        self.mode = mode
+        self.attack_after_timesteps = attack_after_timesteps
+        self.k = k
+        self.stride = stride
+        self._num_inference_steps = num_inference_steps
+
+    @classmethod
+    def from_cfg(cls, cfg):
+        schedule_cfg = cfg_get(cfg, 'attack_schedule')
+        return cls(
+            mode=cfg_get(schedule_cfg, 'mode', 'after'),
+            attack_after_timesteps=cfg_get(cfg, 'attack_after_timesteps', 0.0),
+            k=cfg_get(schedule_cfg, 'k'),
+            stride=cfg_get(schedule_cfg, 'stride'),
+            num_inference_steps=cfg_get(schedule_cfg, 'num_inference_steps'))
+
+    def num_inference_steps(self, default: int) -> int:
+        """
+        Number of denoising steps the attack loop runs.
+        """
+        if self.mode == 'compressed':
+            return min(self._num_inference_steps, default)
+        return default
+
+    def attack_mask(self, timesteps, num_inference_steps: int) -> List[bool]:
+        """
+        One bool per entry of scheduler.timesteps, True where gradients are taken.
+        """
+        timesteps = [int(t) for t in timesteps]
+        n = len(timesteps)
+        if self.mode == 'after':
+            bound = (1 - self.attack_after_timesteps) * num_inference_steps
+            return [t < bound for t in timesteps]
+        if self.mode == 'strided':
+            return [(n - 1 - i) % self.stride == 0 for i in range(n)]
+        k = n if self.k is None else min(self.k, n)
+        return [i >= n - k for i in range(n)]
+
+    def __repr__(self):
+        return f"AttackSchedule(mode={self.mode}, k={self.k}, stride={self.stride}, " \
+            f"num_inference_steps={self._num_inference_steps})"
+
+
+class AttackScheduleReport:
+    """
+    Collects the attack_stats dicts written by pgd_perturbed_obs:
+    denoise_steps, attacked_steps, grad_evals, full_grad_evals, final_loss.
+    """
+    def __init__(self):
+        self.stats = list()
+
+    def add(self, stats: Optional[Dict]):
+        if stats is not None:
+            self.stats.append(stats)
+
+    def add_chunks(self, chunk_stats: List[Tuple[int, Dict]]):
+        """
+        Record the (n_envs, stats) of the micro batches of one attack step
+        as a single step, the final loss is averaged over the envs.
+        """
+        if len(chunk_stats) == 0:
+            return
+        stats = dict(chunk_stats[0][1])
+        final_losses = [(n, x['final_loss']) for n, x in chunk_stats]
+        if all(loss is not None for _, loss in final_losses):
+            n_envs = sum(n for n, _ in final_losses)
+            stats['final_loss'] = sum(n * loss for n, loss in final_losses) / n_envs
+        self.add(stats)
+
+    def reset(self):
+        self.stats = list()
+
+    def summary(self, prefix='attack_') -> Dict[str, float]:
+        if len(self.stats) == 0:
+            return dict()
+        grad_evals = np.sum([x['grad_evals'] for x in self.stats])
+        full_grad_evals = np.sum([x['full_grad_evals'] for x in self.stats])
+        final_losses = [x['final_loss'] for x in self.stats if x['final_loss'] is not None]
+        result = {
+            prefix + 'denoise_steps': float(np.mean([x['denoise_steps'] for x in self.stats])),
+            prefix + 'attacked_steps': float(np.mean([x['attacked_steps'] for x in self.stats])),
+            prefix + 'grad_evals_per_step': float(grad_evals / len(self.stats)),
+            # fraction of the gradient evaluations of attacking every full-schedule step
+            prefix + 'compute_fraction': float(grad_evals / max(full_grad_evals, 1)),
+        }
+        if len(final_losses) > 0:
+            result[prefix + 'final_loss'] = float(np.mean([float(x) for x in final_losses]))
+        return result
@@ -0,0 +1,155 @@
+"""
+Grid evaluation of several attack settings on a single loaded policy.
+
+cfg.sweep (optional lists, each defaults to the single value in cfg):
+    epsilons: [0.01, 0.03, 0.0625]
+    attack_types: [fgsm, pgd]
+    views: [agentview_image, both]
+    stack_epsilons: false
+
+Every grid point is run through the same env runner, so all points share
+the env seeds, and one row per point is collected into a results table.
+With stack_epsilons all epsilons of an (attack_type, view) pair run in a
+single rollout, replicated along the env batch, and the runner log is
+split back into one row per epsilon.
+"""
+from typing import Dict, Iterator, List, Tuple
+import copy
+import csv
+import itertools
+import json
+import numbers
+import os
+import numpy as np
+
+from diffusion_policy.adversarial_attacks.attack_engine import ATTACK_ALIASES
+from diffusion_policy.common.cfg_util import cfg_get
+
+SWEEP_KEYS = ('epsilon', 'attack_type', 'view')
+
+
+def stacked_log_prefix(epsilon) -> str:
+    """
+    Key prefix of the metrics of one budget in a stacked-epsilon runner log.
+    """
+    return f'eps_{float(epsilon):g}/'
+
+
+def split_stacked_log(runner_log: Dict, epsilons: List[float]) -> List[Dict]:
+    """
+    Split a stacked-epsilon runner log into one log per epsilon.
+    Keys without an epsilon prefix (e.g. attack stats) are shared by all.
+    """
+    prefixes = [stacked_log_prefix(eps) for eps in epsilons]
+    shared = {key: value for key, value in runner_log.items()
+        if not key.startswith('eps_')}
+    result = list()
+    for prefix in prefixes:
+        this_log = dict(shared)
+        for key, value in runner_log.items():
+            if key.startswith(prefix):
+                this_log[key[len(prefix):]] = value
+        result.append(this_log)
+    return result
+
+
+def _as_list(value, default) -> list:
+    if value is None:
+        return [default]
+    if isinstance(value, (str, numbers.Number)):
+        return [value]
+    return list(value)
+
+
+def _view_name(view) -> str:
+    if isinstance(view, str) or view is None:
+        return str(view)
+    return '+'.join(str(x) for x in view)
+
+
+class AttackSweep:
+    def __init__(self, cfg):
+        sweep_cfg = cfg_get(cfg, 'sweep')
+        self.epsilons = [float(x) for x in _as_list(
+            cfg_get(sweep_cfg, 'epsilons'), cfg.epsilon)]
+        self.attack_types = _as_list(cfg_get(sweep_cfg, 'attack_types'), cfg.attack_type)
+        self.views = [x if isinstance(x, str) else list(x)
+            for x in _as_list(cfg_get(sweep_cfg, 'views'), cfg.view)]
+        self.stack_epsilons = bool(cfg_get(sweep_cfg, 'stack_epsilons', False))
+        for attack_type in self.attack_types:
+            if ATTACK_ALIASES.get(attack_type, attack_type) == 'patch':
+                raise ValueError("patch attacks load a fixed patch and can not be swept, "
+                    "use a separate run per patch_path")
+        self.cfg = cfg
+        self.rows = list()
+
+    def __len__(self):
+        """
+        Number of runner.run calls.
+        """
+        n_eps = 1 if self.stack_epsilons else len(self.epsilons)
+        return n_eps * len(self.attack_types) * len(self.views)
+
+    def __iter__(self) -> Iterator[Tuple[Dict, object]]:
+        """
+        Yields (point, run_cfg), run_cfg is a copy of cfg with the point applied.
+        With stack_epsilons point['epsilon'] is the list of all epsilons.
+        """
+        epsilons = [list(self.epsilons)] if self.stack_epsilons else self.epsilons
+        for attack_type, view, epsilon in itertools.product(
+                self.attack_types, self.views, epsilons):
+            point = dict(epsilon=epsilon, attack_type=attack_type, view=view)
+            yield point, self.make_cfg(point)
+
+    def make_cfg(self, point: Dict):
+        run_cfg = copy.deepcopy(self.cfg)
+        for key in SWEEP_KEYS:
+            run_cfg[key] = point[key]
+        return run_cfg
+
+    def add(self, point: Dict, runner_log: Dict) -> List[Dict]:
+        """
+        Append the table rows of one runner.run call: the grid point and
+        every scalar in runner_log, one row per epsilon.
+        """
+        if isinstance(point['epsilon'], list):
+            rows = list()
+            for epsilon, this_log in zip(point['epsilon'],
+                    split_stacked_log(runner_log, point['epsilon'])):
+                rows.extend(self.add(dict(point, epsilon=epsilon), this_log))
+            return rows
+        row = dict(point)
+        row['view'] = _view_name(point['view'])
+        for key, value in runner_log.items():
+            if isinstance(value, (numbers.Number, np.number)):
+                row[key] = float(value)
+        self.rows.append(row)
+        return [row]
+
+    def columns(self) -> List[str]:
+        columns = list(SWEEP_KEYS)
+        for row in self.rows:
+            for key in row.keys():
+                if key not in columns:
+                    columns.append(key)
+        return columns
+
+    def table(self) -> List[list]:
+        columns = self.columns()
+        return [[row.get(key) for key in columns] for row in self.rows]
+
+    def write(self, output_dir: str, name='sweep_results') -> str:
+        """
+        Writes <name>.csv and <name>.json, returns the csv path.
+        """
+        columns = self.columns()
+        csv_path = os.path.join(output_dir, name + '.csv')
+        with open(csv_path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            for row in self.rows:
+                writer.writerow(row)
+        json_path = os.path.join(output_dir, name + '.json')
+        with open(json_path, 'w') as f:
+            json.dump(self.rows, f, indent=2)
+        return csv_path
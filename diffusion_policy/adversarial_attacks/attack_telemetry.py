@@ -0,0 +1,172 @@
+"""
+Low overhead telemetry of the attack loops.
+
+Losses and perturbation norms are accumulated as device tensors, so the
+inner attack loops never call .item() (a host sync per iteration).
+end_episode() closes the running sums of an episode and every
+flush_every episodes all closed episodes are copied to the host at once
+and written to wandb and/or a JsonLogger file.
+
+cfg.telemetry (optional):
+    sample_every: int   record every n-th value per key (default 1)
+    flush_every: int    episodes per host sync (default 1)
+    json_path: str      JsonLogger file the episode rows are appended to
+"""
+from typing import Dict, Optional
+import collections
+import torch
+import wandb
+
+from diffusion_policy.common.json_logger import JsonLogger
+from diffusion_policy.common.cfg_util import cfg_get
+
+
+class AttackTelemetry:
+    def __init__(self,
+            enabled: bool = True,
+            sample_every: int = 1,
+            flush_every: int = 1,
+            prefix: str = 'attack/',
+            use_wandb: bool = False,
+            json_path: Optional[str] = None
+        ):
+        if sample_every < 1:
+            raise ValueError("sample_every must be >= 1")
+        if flush_every < 1:
+            raise ValueError("flush_every must be >= 1")
+        self.enabled = enabled
+        self.sample_every = sample_every
+        self.flush_every = flush_every
+        self.prefix = prefix
+        self.use_wandb = use_wandb
+        self.json_path = json_path
+        self.n_calls = collections.defaultdict(int)
+        self.reset()
+
+    @classmethod
+    def from_cfg(cls, cfg):
+        telemetry_cfg = cfg_get(cfg, 'telemetry')
+        log = bool(cfg_get(cfg, 'log', False))
+        json_path = cfg_get(telemetry_cfg, 'json_path')
+        return cls(
+            enabled=log or (json_path is not None),
+            sample_every=cfg_get(telemetry_cfg, 'sample_every', 1),
+            flush_every=cfg_get(telemetry_cfg, 'flush_every', 1),
+            use_wandb=log,
+            json_path=json_path)
+
+    def reset(self):
+        # running sums of the open episode, device tensors
+        self.sums = dict()
+        self.maxs = dict()
+        self.counts = dict()
+        # closed episodes waiting for the next flush
+        self.pending = list()
+        self.n_episodes = 0
+        # host side totals over all flushed episodes
+        self.totals = collections.defaultdict(float)
+        self.total_counts = collections.defaultdict(int)
+        self.total_maxs = dict()
+
+    def record(self, key: str, value: torch.Tensor):
+        """
+        Accumulate a scalar or per env (B,) tensor without leaving the device.
+        """
+        if not self.enabled:
+            return
+        n_call = self.n_calls[key]
+        self.n_calls[key] += 1
+        if n_call % self.sample_every != 0:
+            return
+        value = value.detach().float().reshape(-1)
+        if key in self.sums:
+            self.sums[key] = self.sums[key] + value.sum()
+            self.maxs[key] = torch.maximum(self.maxs[key], value.max())
+            self.counts[key] += value.numel()
+        else:
+            self.sums[key] = value.sum()
+            self.maxs[key] = value.max()
+            self.counts[key] = value.numel()
+
+    def record_perturbation(self, name: str, perturbation: torch.Tensor):
+        """
+        Per env L2 and Linf norms of a (B, ...) perturbation.
+        """
+        if not self.enabled:
+            return
+        flat = perturbation.detach().reshape(perturbation.shape[0], -1)
+        self.record(f'{name}_l2', torch.linalg.vector_norm(flat, ord=2, dim=1))
+        self.record(f'{name}_linf', flat.abs().amax(dim=1))
+
+    def snapshot(self):
+        """
+        State of the open episode, for rollback() when an attempt is retried.
+        """
+        return dict(self.sums), dict(self.maxs), dict(self.counts), dict(self.n_calls)
+
+    def rollback(self, snapshot):
+        """
+        Drop what was recorded since snapshot().
+        """
+        sums, maxs, counts, n_calls = snapshot
+        self.sums, self.maxs, self.counts = dict(sums), dict(maxs), dict(counts)
+        self.n_calls = collections.defaultdict(int, n_calls)
+
+    def end_episode(self):
+        if len(self.sums) == 0:
+            return
+        keys = list(self.sums.keys())
+        # one device tensor per episode, synced in flush()
+        values = torch.stack([self.sums[k] for k in keys] + [self.maxs[k] for k in keys])
+        self.pending.append((keys, [self.counts[k] for k in keys], values))
+        self.sums, self.maxs, self.counts = dict(), dict(), dict()
+        if len(self.pending) >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        """
+        Copy the closed episodes to the host in one transfer and log them.
+        """
+        if len(self.pending) == 0:
+            return
+        values = [x[2] for x in self.pending]
+        device = values[0].device
+        lengths = [len(x) for x in values]
+        values = torch.cat([x.to(device) for x in values]).to('cpu').tolist()
+        rows = list()
+        offset = 0
+        for (keys, counts, _), length in zip(self.pending, lengths):
+            episode = values[offset:offset + length]
+            offset += length
+            n_keys = len(keys)
+            row = {'attack_episode': self.n_episodes}
+            for i, key in enumerate(keys):
+                row[self.prefix + key + '_mean'] = episode[i] / max(counts[i], 1)
+                row[self.prefix + key + '_max'] = episode[n_keys + i]
+                self.totals[key] += episode[i]
+                self.total_counts[key] += counts[i]
+                self.total_maxs[key] = max(self.total_maxs.get(key, episode[n_keys + i]),
+                    episode[n_keys + i])
+            rows.append(row)
+            self.n_episodes += 1
+        self.pending = list()
+
+        if self.use_wandb:
+            for row in rows:
+                wandb.log(row)
+        if self.json_path is not None:
+            with JsonLogger(self.json_path) as json_logger:
+                for row in rows:
+                    json_logger.log(row)
+
+    def summary(self) -> Dict[str, float]:
+        """
+        Means and maxima over every recorded value, closes the open episode.
+        """
+        self.end_episode()
+        self.flush()
+        result = dict()
+        for key, total in self.totals.items():
+            result[self.prefix + key + '_mean'] = total / max(self.total_counts[key], 1)
+            result[self.prefix + key + '_max'] = self.total_maxs[key]
+        return result
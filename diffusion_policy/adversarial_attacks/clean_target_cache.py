@@ -0,0 +1,164 @@
+"""
+Precomputed clean targets for universal perturbation training.
+
+The model is frozen while a universal perturbation trains, so the clean
+side of the loss (actions, GMM means, IBC energies) of every dataset
+sample is the same in every epoch. CleanTargetCache computes it once and
+stores it as a .npy memmap keyed by the checkpoint, the dataset config and
+the target kind, so later runs of the same checkpoint (other epsilons,
+targeted/untargeted) only pay for the perturbed forward/backward.
+
+cfg.clean_target_cache (optional, True for the defaults):
+    cache_dir: str     default ~/.cache/diffusion_policy/clean_targets
+    batch_size: int    precompute batch size, default cfg.dataloader.batch_size,
+                       always the training batch size for batch stateful policies
+
+Like the training loop, every batch is full size (the last one is padded
+with samples from the start) and starts from a fresh policy.reset(), so
+the per sample targets of the LSTM-GMM policy do not depend on the order.
+"""
+from typing import Callable, Dict, Optional
+import hashlib
+import json
+import os
+import pathlib
+import numpy as np
+import torch
+import torch.utils.data
+import tqdm
+from omegaconf import OmegaConf
+
+from diffusion_policy.common.init_state_cache import dataset_fingerprint
+from diffusion_policy.common.pytorch_util import dict_apply, to_device_float
+
+DEFAULT_TARGET_CACHE_DIR = '~/.cache/diffusion_policy/clean_targets'
+
+
+def _gmm_means(policy, obs_dict):
+    return policy.action_dist(obs_dict).component_distribution.base_dist.loc
+
+
+def _action(policy, obs_dict):
+    return policy.predict_action(obs_dict)['action']
+
+
+def _energy(policy, obs_dict):
+    return policy.predict_action(obs_dict, return_energy=True)['energy']
+
+
+# clean target of each policy family, computed without grad
+TARGET_FNS: Dict[str, Callable] = {
+    'action': _action,
+    'gmm_means': _gmm_means,
+    'energy': _energy,
+}
+
+
+class IndexedDataset(torch.utils.data.Dataset):
+    """
+    Adds the sample index to every sample, to look up its cached target.
+    """
+    def __init__(self, dataset: torch.utils.data.Dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        data = dict(self.dataset[idx])
+        data['idx'] = torch.tensor(idx, dtype=torch.int64)
+        return data
+
+
+class CleanTargetCache:
+    def __init__(self, checkpoint: str, kind: str, extra: Optional[dict] = None,
+            cache_dir: str = DEFAULT_TARGET_CACHE_DIR):
+        """
+        extra: anything else the targets depend on, e.g. the dataset config
+        """
+        if kind not in TARGET_FNS:
+            raise ValueError(f"Unsupported clean target {kind}, expected one of {tuple(TARGET_FNS.keys())}")
+        self.kind = kind
+        h = hashlib.sha1()
+        h.update(dataset_fingerprint(os.path.expanduser(checkpoint)).encode())
+        h.update(kind.encode())
+        if extra is not None:
+            h.update(json.dumps(extra, sort_keys=True, default=str).encode())
+        self.key = h.hexdigest()[:16]
+        cache_dir = pathlib.Path(os.path.expanduser(cache_dir))
+        cache_dir.mkdir(parents=True, exist_ok=True)
+        self.path = cache_dir.joinpath(f'{self.key}_{kind}.npy')
+        self.targets = None
+
+    @classmethod
+    def from_cfg(cls, cfg, kind: str) -> Optional['CleanTargetCache']:
+        cache_cfg = cfg.get('clean_target_cache', None)
+        if cache_cfg is None or cache_cfg is False:
+            return None
+        cache_dir = DEFAULT_TARGET_CACHE_DIR
+        if hasattr(cache_cfg, 'get'):
+            cache_dir = cache_cfg.get('cache_dir', cache_dir)
+        extra = OmegaConf.to_container(cfg.task.dataset, resolve=True)
+        return cls(cfg.checkpoint, kind, extra=extra, cache_dir=cache_dir)
+
+    def ready(self) -> bool:
+        return self.path.exists()
+
+    def build(self, policy, dataset: torch.utils.data.Dataset, device,
+            batch_size: int = 64, num_workers: int = 0):
+        """
+        Compute the clean target of every sample of dataset, once per key.
+        """
+        if not self.ready():
+            # full batches only, the last one wraps around to the first samples
+            indices = np.arange(len(dataset))
+            indices = np.concatenate([indices, np.resize(indices, -len(dataset) % batch_size)])
+            dataloader = torch.utils.data.DataLoader(IndexedDataset(dataset),
+                batch_sampler=indices.reshape(-1, batch_size).tolist(), num_workers=num_workers)
+            target_fn = TARGET_FNS[self.kind]
+            # written next to the final file and renamed once complete
+            tmp_path = self.path.with_suffix(f'.{os.getpid()}.tmp.npy')
+            targets = None
+            with torch.no_grad():
+                for batch in tqdm.tqdm(dataloader, desc=f"Clean {self.kind} targets", leave=False):
+                    idx = batch['idx'].numpy()
+                    obs = dict_apply(batch['obs'], lambda x: to_device_float(x, device))
+                    if hasattr(policy, 'reset'):
+                        policy.reset()
+                    target = target_fn(policy, obs).detach().float().to('cpu').numpy()
+                    if targets is None:
+                        targets = np.lib.format.open_memmap(str(tmp_path), mode='w+',
+                            dtype=np.float32, shape=(len(dataset),) + target.shape[1:])
+                    targets[idx] = target
+            targets.flush()
+            del targets
+            os.replace(tmp_path, self.path)
+        self.targets = np.load(self.path, mmap_mode='r')
+        return self
+
+    def get(self, idx: torch.Tensor, device) -> torch.Tensor:
+        """
+        Cached targets of the samples idx, on device.
+        """
+        idx = idx.to('cpu').numpy()
+        # sorted reads are sequential in the memmap
+        order = np.argsort(idx)
+        targets = np.empty((len(idx),) + self.targets.shape[1:], dtype=np.float32)
+        targets[order] = self.targets[idx[order]]
+        return torch.from_numpy(targets).to(device, non_blocking=True)
+
+
+def build_clean_targets(policy, cfg, dataset: torch.utils.data.Dataset,
+        kind: str) -> Optional[CleanTargetCache]:
+    """
+    The loaded (built on the first run) cache when cfg.clean_target_cache is set.
+    """
+    cache = CleanTargetCache.from_cfg(cfg, kind)
+    if cache is None:
+        return None
+    cache_cfg = cfg.clean_target_cache
+    batch_size = cfg.dataloader.batch_size
+    if hasattr(cache_cfg, 'get') and not getattr(policy, 'batch_stateful', False):
+        batch_size = cache_cfg.get('batch_size', batch_size)
+    return cache.build(policy, dataset, cfg.training.device, batch_size=batch_size,
+        num_workers=cfg.dataloader.get('num_workers', 0))
@@ -0,0 +1,314 @@
+"""
+Versioned store of universal perturbations.
+
+The UAP workspaces used to pickle every rollout snapshot next to the
+checkpoint, with the score only in the file name. PerturbationStore writes
+the tensors in the safetensors layout (8 byte header size, JSON header,
+raw little endian data), so they load as read only memmaps without
+unpickling, and names every payload by the sha256 of its content. An
+append only index.jsonl records checkpoint, epsilon, view, norm, targeted
+flag, epoch and rollout score of every saved snapshot, which answers
+queries like "best perturbation of checkpoint X at epsilon Y".
+
+cfg.perturbation_store (optional):
+    root: str    store directory, default <checkpoint dir>/perturbations
+"""
+from typing import Dict, List, Optional, Tuple, Union
+import hashlib
+import json
+import math
+import os
+import pathlib
+import pickle
+import re
+import struct
+import time
+import numpy as np
+import torch
+from filelock import FileLock
+
+from diffusion_policy.common.init_state_cache import dataset_fingerprint
+
+# safetensors dtype names
+DTYPES = {
+    'F64': np.float64,
+    'F32': np.float32,
+    'F16': np.float16,
+    'I64': np.int64,
+    'I32': np.int32,
+    'I16': np.int16,
+    'I8': np.int8,
+    'U8': np.uint8,
+    'BOOL': np.bool_,
+}
+DTYPE_NAMES = {np.dtype(v): k for k, v in DTYPES.items()}
+
+LEGACY_NAME = re.compile(
+    r'(?P<targeted>tar|untar)_pert_(?P<epsilon>[0-9.e-]+)_epoch_(?P<epoch>\d+)'
+    r'_mean_score_(?P<score>[0-9.e-]+)_(?P<view>.+?)\.pkl$')
+
+
+def _to_numpy(value: torch.Tensor) -> np.ndarray:
+    value = value.detach().to('cpu')
+    if value.dtype == torch.bfloat16:
+        # no numpy bfloat16, stored as F32
+        value = value.float()
+    return np.ascontiguousarray(value.numpy())
+
+
+def tensor_hash(tensors: Dict[str, torch.Tensor]) -> str:
+    """
+    sha256 over names, dtypes, shapes and data, independent of the device.
+    """
+    h = hashlib.sha256()
+    for name in sorted(tensors.keys()):
+        array = _to_numpy(tensors[name])
+        h.update(json.dumps([name, DTYPE_NAMES[array.dtype], list(array.shape)]).encode())
+        h.update(array.astype(array.dtype.newbyteorder('<'), copy=False).tobytes())
+    return h.hexdigest()
+
+
+def save_tensors(path: str, tensors: Dict[str, torch.Tensor],
+        metadata: Optional[Dict[str, str]] = None):
+    """
+    Write tensors in the safetensors layout, readable by safetensors.torch.load_file.
+    """
+    arrays = {name: _to_numpy(value) for name, value in tensors.items()}
+    header = dict()
+    if metadata is not None:
+        header['__metadata__'] = {str(k): str(v) for k, v in metadata.items()}
+    offset = 0
+    for name in sorted(arrays.keys()):
+        array = arrays[name]
+        header[name] = {
+            'dtype': DTYPE_NAMES[array.dtype],
+            'shape': list(array.shape),
+            'data_offsets': [offset, offset + array.nbytes]
+        }
+        offset += array.nbytes
+    header = json.dumps(header, separators=(',', ':')).encode()
+    # data starts 8 byte aligned
+    header += b' ' * (-len(header) % 8)
+
+    path = pathlib.Path(path)
+    tmp_path = path.with_suffix(f'.{os.getpid()}.tmp')
+    with tmp_path.open('wb') as f:
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        for name in sorted(arrays.keys()):
+            array = arrays[name]
+            f.write(array.astype(array.dtype.newbyteorder('<'), copy=False).tobytes())
+    os.replace(tmp_path, path)
+
+
+def load_tensors(path: str, device='cpu', mmap: bool = True
+        ) -> Tuple[Dict[str, torch.Tensor], Dict[str, str]]:
+    """
+    Tensors and metadata of a safetensors file, memmapped when on cpu.
+    """
+    with open(path, 'rb') as f:
+        header_size = struct.unpack('<Q', f.read(8))[0]
+        header = json.loads(f.read(header_size))
+    metadata = header.pop('__metadata__', dict())
+    data_start = 8 + header_size
+    tensors = dict()
+    for name, info in header.items():
+        dtype = np.dtype(DTYPES[info['dtype']]).newbyteorder('<')
+        start, end = info['data_offsets']
+        shape = tuple(info['shape'])
+        if mmap and end > start:
+            # copy on write, torch does not accept read only arrays
+            array = np.memmap(path, dtype=dtype, mode='c',
+                offset=data_start + start, shape=shape)
+        else:
+            with open(path, 'rb') as f:
+                f.seek(data_start + start)
+                array = np.frombuffer(f.read(end - start), dtype=dtype).reshape(shape)
+            array = array.copy()
+        tensors[name] = torch.from_numpy(array.astype(array.dtype.newbyteorder('='), copy=False)
+            ).to(device)
+    return tensors, metadata
+
+
+class PerturbationStore:
+    def __init__(self, root: str):
+        self.root = pathlib.Path(os.path.expanduser(root))
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.root.joinpath('index.jsonl')
+        self.lock = FileLock(str(self.index_path) + '.lock')
+
+    @classmethod
+    def from_cfg(cls, cfg) -> 'PerturbationStore':
+        store_cfg = cfg.get('perturbation_store', None)
+        root = None
+        if isinstance(store_cfg, str):
+            root = store_cfg
+        elif store_cfg is not None:
+            root = store_cfg.get('root', None)
+        if root is None:
+            root = os.path.join(os.path.dirname(os.path.expanduser(cfg.checkpoint)), 'perturbations')
+        return cls(root)
+
+    @staticmethod
+    def checkpoint_key(checkpoint: str) -> str:
+        """
+        Content fingerprint of the checkpoint, stable when runs are moved.
+        """
+        checkpoint = os.path.expanduser(str(checkpoint))
+        if os.path.isfile(checkpoint):
+            return dataset_fingerprint(checkpoint)
+        return os.path.abspath(checkpoint)
+
+    def path(self, artifact_id: str) -> pathlib.Path:
+        return self.root.joinpath(f'{artifact_id}.safetensors')
+
+    def records(self, checkpoint: Optional[str] = None, **filters) -> List[dict]:
+        """
+        Index records in save order, matching every given field.
+        """
+        if not self.index_path.exists():
+            return list()
+        if checkpoint is not None:
+            filters['checkpoint_key'] = self.checkpoint_key(checkpoint)
+        result = list()
+        with self.index_path.open('r') as f:
+            for line in f:
+                line = line.strip()
+                if len(line) == 0:
+                    continue
+                record = json.loads(line)
+                if all(self._match(record.get(k, None), v) for k, v in filters.items()):
+                    result.append(record)
+        return result
+
+    @staticmethod
+    def _match(value, query) -> bool:
+        if query is None:
+            return True
+        if isinstance(query, float) and isinstance(value, (int, float)):
+            return math.isclose(value, query, rel_tol=1e-6)
+        return value == query
+
+    def best(self, checkpoint: str, epsilon: Optional[float] = None,
+            lower_is_better: bool = True, **filters) -> Optional[dict]:
+        """
+        Record with the best rollout score, the lowest task success by default.
+        """
+        if epsilon is not None:
+            epsilon = float(epsilon)
+        records = [r for r in self.records(checkpoint=checkpoint, epsilon=epsilon, **filters)
+            if r.get('score', None) is not None]
+        if len(records) == 0:
+            return None
+        sign = 1 if lower_is_better else -1
+        # ties go to the latest version
+        return min(reversed(records), key=lambda r: sign * r['score'])
+
+    def save(self, perturbation: Dict[str, torch.Tensor], checkpoint: str,
+            epsilon: float, view: str, norm: str = 'linf', targeted: bool = False,
+            score: Optional[float] = None, epoch: Optional[int] = None, **extra) -> dict:
+        """
+        Store perturbation once per content hash and append its index record.
+        """
+        artifact_id = tensor_hash(perturbation)[:32]
+        path = self.path(artifact_id)
+        if not path.exists():
+            save_tensors(path, perturbation, metadata={'format': 'pt'})
+        record = {
+            'id': artifact_id,
+            'file': path.name,
+            'checkpoint': os.path.abspath(os.path.expanduser(str(checkpoint))),
+            'checkpoint_key': self.checkpoint_key(checkpoint),
+            'epsilon': float(epsilon),
+            'view': str(view),
+            'norm': str(norm),
+            'targeted': bool(targeted),
+            'score': None if score is None else float(score),
+            'epoch': None if epoch is None else int(epoch),
+            'created': time.time(),
+        }
+        record.update(extra)
+        with self.lock:
+            # version counts the snapshots of the same attack setting
+            record['version'] = len(self.records(checkpoint_key=record['checkpoint_key'],
+                epsilon=record['epsilon'], view=record['view'], norm=record['norm'],
+                targeted=record['targeted'])) + 1
+            with self.index_path.open('a') as f:
+                f.write(json.dumps(record, default=str) + '\n')
+        return record
+
+    def load(self, record: Union[dict, str], device='cpu', mmap: bool = True,
+            verify: bool = False) -> Dict[str, torch.Tensor]:
+        """
+        Perturbation of a record or artifact id.
+        """
+        artifact_id = record['id'] if isinstance(record, dict) else record
+        path = self.path(artifact_id)
+        if not path.exists():
+            raise RuntimeError(f"Perturbation {artifact_id} not found in {self.root}")
+        tensors, _ = load_tensors(str(path), device=device, mmap=mmap)
+        if verify and tensor_hash(tensors)[:32] != artifact_id:
+            raise RuntimeError(f"Perturbation {artifact_id} does not match its content hash")
+        return tensors
+
+    def import_legacy(self, path: str, checkpoint: str, norm: str = 'linf', **extra) -> dict:
+        """
+        Add a pickled perturbation, the attack settings are parsed from its file name.
+        """
+        match = LEGACY_NAME.search(os.path.basename(path))
+        if match is None:
+            raise ValueError(f"Cannot parse perturbation settings from {path}")
+        with open(path, 'rb') as f:
+            perturbation = pickle.load(f)
+        if torch.is_tensor(perturbation):
+            perturbation = {match['view']: perturbation}
+        return self.save(perturbation, checkpoint,
+            epsilon=float(match['epsilon']), view=match['view'], norm=norm,
+            targeted=match['targeted'] == 'tar', score=float(match['score']),
+            epoch=int(match['epoch']), legacy_path=os.path.abspath(path), **extra)
+
+
+def save_universal_perturbation(cfg, univ_pert: Dict[str, torch.Tensor],
+        epoch: int, score: float, **extra) -> dict:
+    """
+    Save a UAP snapshot of a workspace run with the attack settings of cfg.
+    """
+    store = PerturbationStore.from_cfg(cfg)
+    norm = 'linf'
+    trainer_cfg = cfg.get('uap_trainer', None)
+    if trainer_cfg is not None:
+        norm = trainer_cfg.get('norm', norm)
+    record = store.save(univ_pert, cfg.checkpoint, epsilon=cfg.epsilon, view=cfg.view,
+        norm=norm, targeted=bool(cfg.targeted), score=score, epoch=epoch,
+        exp_name=cfg.get('exp_name', None), **extra)
+    print(f"Saved perturbation {record['id']} version {record['version']} to {store.root}")
+    return record
+
+
+def load_perturbation(cfg, patch_path: Optional[str] = None, device='cpu'):
+    """
+    Perturbation named by patch_path (default cfg.patch_path): a .safetensors
+    file, a legacy .pkl file, an artifact id of the store of cfg, or 'best'
+    for the best stored perturbation of cfg.checkpoint at cfg.epsilon.
+    """
+    if patch_path is None:
+        patch_path = cfg.patch_path
+    patch_path = str(patch_path)
+    if patch_path.endswith('.pkl'):
+        with open(patch_path, 'rb') as f:
+            return pickle.load(f)
+    if patch_path.endswith('.safetensors'):
+        return load_tensors(patch_path, device=device)[0]
+    store = PerturbationStore.from_cfg(cfg)
+    if patch_path == 'best':
+        filters = dict()
+        if cfg.get('targeted', None) is not None:
+            filters['targeted'] = bool(cfg.targeted)
+        if cfg.get('view', None) is not None:
+            filters['view'] = cfg.view
+        record = store.best(cfg.checkpoint, epsilon=cfg.epsilon, **filters)
+        if record is None:
+            raise RuntimeError(f"No scored perturbation of {cfg.checkpoint} at epsilon {cfg.epsilon} in {store.root}")
+        print(f"Loading perturbation {record['id']} of epoch {record['epoch']} with score {record['score']}")
+        patch_path = record['id']
+    return store.load(patch_path, device=device)
@@ -0,0 +1,124 @@
+"""
+Optimizer based universal adversarial perturbation (UAP) training.
+
+The UAP workspaces sum the input gradients of a whole epoch and take one
+signed step per epoch. UAPTrainer holds the perturbation of every view as
+an nn.Parameter and updates it after every minibatch with signed SGD,
+Adam or momentum MI-FGSM (Dong et al. 2018), followed by the projection
+onto the epsilon ball and an LR schedule step. The workspaces keep
+computing the input gradient of their own policy loss and pass it to
+step(), so the trainer does not depend on the policy family.
+
+cfg.uap_trainer (optional, the workspaces keep the per epoch update without it):
+    optimizer: 'sign_sgd' | 'adam' | 'mi_fgsm'
+    lr: float              default cfg.epsilon_step
+    momentum: float        MI-FGSM decay factor, default 1.0
+    norm: 'linf' | 'l2'    projection, default 'linf'
+    lr_scheduler: str      name for model.common.lr_scheduler.get_scheduler, default 'constant'
+    lr_warmup_steps: int   default 0
+"""
+from typing import Dict, Optional
+import torch
+import torch.nn as nn
+
+from diffusion_policy.utils.attack_utils import clip_perturb
+from diffusion_policy.model.common.lr_scheduler import get_scheduler
+
+UAP_OPTIMIZERS = ('sign_sgd', 'adam', 'mi_fgsm')
+
+
+class UAPTrainer:
+    def __init__(self,
+            perturbation: Dict[str, torch.Tensor],
+            epsilon: float,
+            optimizer: str = 'sign_sgd',
+            lr: float = 1 / 255,
+            momentum: float = 1.0,
+            norm: str = 'linf',
+            lr_scheduler: str = 'constant',
+            lr_warmup_steps: int = 0,
+            num_training_steps: Optional[int] = None
+        ):
+        """
+        perturbation: initial perturbation per view, copied into the parameters
+        num_training_steps: optimizer steps of the whole run, for decaying schedules
+        """
+        if optimizer not in UAP_OPTIMIZERS:
+            raise ValueError(f"Unsupported UAP optimizer {optimizer}, expected one of {UAP_OPTIMIZERS}")
+        self.epsilon = epsilon
+        self.optimizer_name = optimizer
+        self.momentum = momentum
+        self.norm = norm
+        self.params = {view: nn.Parameter(pert.detach().clone().float())
+            for view, pert in perturbation.items()}
+        # MI-FGSM accumulated gradient
+        self.velocity = {view: torch.zeros_like(p) for view, p in self.params.items()}
+        params = list(self.params.values())
+        if optimizer == 'adam':
+            self.optimizer = torch.optim.Adam(params, lr=lr)
+        else:
+            # the sign is taken in step(), SGD only scales it by the scheduled lr
+            self.optimizer = torch.optim.SGD(params, lr=lr)
+        self.lr_scheduler = get_scheduler(lr_scheduler, optimizer=self.optimizer,
+            num_warmup_steps=lr_warmup_steps, num_training_steps=num_training_steps)
+        self.n_steps = 0
+        self.project()
+
+    @classmethod
+    def from_cfg(cls, cfg, perturbation: Dict[str, torch.Tensor],
+            num_training_steps: Optional[int] = None) -> Optional['UAPTrainer']:
+        trainer_cfg = cfg.get('uap_trainer', None)
+        if trainer_cfg is None:
+            return None
+        return cls(perturbation,
+            epsilon=cfg.epsilon,
+            optimizer=trainer_cfg.get('optimizer', 'sign_sgd'),
+            lr=trainer_cfg.get('lr', cfg.epsilon_step),
+            momentum=trainer_cfg.get('momentum', 1.0),
+            norm=trainer_cfg.get('norm', 'linf'),
+            lr_scheduler=trainer_cfg.get('lr_scheduler', 'constant'),
+            lr_warmup_steps=trainer_cfg.get('lr_warmup_steps', 0),
+            num_training_steps=num_training_steps)
+
+    @property
+    def perturbation(self) -> Dict[str, torch.Tensor]:
+        """
+        Detached views of the parameters, they follow every update in place.
+        """
+        return {view: p.detach() for view, p in self.params.items()}
+
+    def get_last_lr(self) -> float:
+        return self.lr_scheduler.get_last_lr()[0]
+
+    @staticmethod
+    def _reduce(grad: torch.Tensor, like: torch.Tensor) -> torch.Tensor:
+        # the perturbation is broadcast over batch (and obs step) dims
+        while grad.ndim > like.ndim:
+            grad = grad.sum(dim=0)
+        return grad
+
+    @torch.no_grad()
+    def project(self):
+        for p in self.params.values():
+            p.copy_(clip_perturb(p.unsqueeze(0), self.norm, self.epsilon)[0])
+
+    def step(self, grads: Dict[str, torch.Tensor]):
+        """
+        One update from the gradients of the attack loss w.r.t. the perturbed
+        inputs (or the perturbation), the attack loss is ascended.
+        """
+        for view, p in self.params.items():
+            grad = self._reduce(grads[view].detach(), p).to(dtype=p.dtype)
+            if self.optimizer_name == 'mi_fgsm':
+                velocity = self.velocity[view]
+                velocity.mul_(self.momentum).add_(grad / grad.abs().mean().clamp_min(1e-12))
+                grad = torch.sign(velocity)
+            elif self.optimizer_name == 'sign_sgd':
+                grad = torch.sign(grad)
+            # the optimizers minimize
+            p.grad = -grad
+        self.optimizer.step()
+        self.optimizer.zero_grad(set_to_none=True)
+        self.lr_scheduler.step()
+        self.project()
+        self.n_steps += 1
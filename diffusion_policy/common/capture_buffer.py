@@ -0,0 +1,117 @@
+"""
+Fixed memory budget capture of observation frames for visualization.
+
+CaptureBuffer preallocates a uint8 ring of max_frames frames (or as many
+as fit in max_bytes) on the first add and overwrites the oldest frames
+afterwards, so long evals do not grow host or device memory. Torch
+tensors are quantized to uint8 on their device before the transfer.
+storage='disk' backs the ring with a memmap file instead of host memory.
+"""
+from typing import Optional
+import os
+import tempfile
+import numpy as np
+import torch
+
+CAPTURE_STORAGES = ('cpu', 'disk')
+
+
+def _to_uint8_hwc(frames) -> np.ndarray:
+    """
+    (N,C,H,W) or (N,H,W,C) float in [0, 1] or uint8 -> (N,H,W,C) uint8.
+    """
+    if torch.is_tensor(frames):
+        # quantize on the device, 4x less to transfer
+        frames = frames.detach()
+        if frames.is_floating_point():
+            frames = (frames.clamp(0, 1) * 255).round()
+        frames = frames.to(dtype=torch.uint8).to('cpu').numpy()
+    frames = np.asarray(frames)
+    if frames.dtype != np.uint8:
+        frames = (np.clip(frames, 0, 1) * 255).round().astype(np.uint8)
+    if frames.shape[1] in (1, 3) and frames.shape[-1] not in (1, 3):
+        frames = np.moveaxis(frames, 1, -1)
+    return frames
+
+
+class CaptureBuffer:
+    def __init__(self, max_frames: Optional[int] = 1024, max_bytes: Optional[int] = None,
+            stride: int = 1, storage: str = 'cpu', path: Optional[str] = None):
+        """
+        max_frames: steps kept, each step holds one frame per captured stream
+        max_bytes: alternative budget, the number of frames follows from the frame size
+        stride: keep every stride-th add()
+        storage: 'cpu' or 'disk' (a memmap at path, a temporary file if None)
+        """
+        if storage not in CAPTURE_STORAGES:
+            raise ValueError(f"Unsupported capture storage {storage}, expected one of {CAPTURE_STORAGES}")
+        if max_frames is None and max_bytes is None:
+            raise ValueError("CaptureBuffer needs max_frames or max_bytes")
+        if stride < 1:
+            raise ValueError("stride must be >= 1")
+        self.max_frames = max_frames
+        self.max_bytes = max_bytes
+        self.stride = stride
+        self.storage = storage
+        self.path = path
+        self.buffer = None
+        self.n_seen = 0
+        self.n_frames = 0
+
+    def _allocate(self, frame_shape):
+        frame_bytes = int(np.prod(frame_shape))
+        max_frames = self.max_frames
+        if self.max_bytes is not None:
+            budget_frames = max(self.max_bytes // frame_bytes, 1)
+            max_frames = budget_frames if max_frames is None else min(max_frames, budget_frames)
+        self.max_frames = max_frames
+        shape = (max_frames,) + tuple(frame_shape)
+        if self.storage == 'disk':
+            if self.path is None:
+                fd, self.path = tempfile.mkstemp(suffix='.capture')
+                os.close(fd)
+            self.buffer = np.memmap(self.path, dtype=np.uint8, mode='w+', shape=shape)
+        else:
+            self.buffer = np.empty(shape, dtype=np.uint8)
+
+    def add(self, frames):
+        """
+        Capture one step, frames: (n_streams, C, H, W) or (n_streams, H, W, C),
+        numpy or torch, float in [0, 1] or uint8.
+        """
+        take = (self.n_seen % self.stride) == 0
+        self.n_seen += 1
+        if not take:
+            return
+        frames = _to_uint8_hwc(frames)
+        if self.buffer is None:
+            self._allocate(frames.shape)
+        self.buffer[self.n_frames % self.max_frames] = frames
+        self.n_frames += 1
+
+    def __len__(self):
+        if self.buffer is None:
+            return 0
+        return min(self.n_frames, self.max_frames)
+
+    def frames(self) -> np.ndarray:
+        """
+        Captured steps, oldest first: (T, n_streams, H, W, C) uint8.
+        """
+        if self.buffer is None:
+            return np.zeros((0,), dtype=np.uint8)
+        if self.n_frames <= self.max_frames:
+            return self.buffer[:self.n_frames]
+        start = self.n_frames % self.max_frames
+        return np.concatenate([self.buffer[start:], self.buffer[:start]], axis=0)
+
+    def stream(self, idx: int) -> np.ndarray:
+        """
+        Captured frames of one stream, oldest first: (T, H, W, C) uint8.
+        """
+        return np.ascontiguousarray(self.frames()[:, idx])
+
+    def close(self):
+        self.buffer = None
+        if self.storage == 'disk' and self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,10 @@
+def cfg_get(cfg, key, default=None):
+    """
+    cfg.get(key, default) for OmegaConf DictConfigs, dicts and plain
+    namespaces, default when cfg is None.
+    """
+    if cfg is None:
+        return default
+    if hasattr(cfg, 'get'):
+        return cfg.get(key, default)
+    return getattr(cfg, key, default)
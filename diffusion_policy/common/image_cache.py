@@ -0,0 +1,74 @@
+"""
+Decoded uint8 image cache of a zarr ReplayBuffer.
+
+The robomimic image datasets keep their frames Jpeg2k compressed, so every
+__getitem__ decodes a chunk again. decoded_image_cache() decodes each rgb
+key once into a uint8 .npy file and returns a numpy backed ReplayBuffer
+whose rgb arrays are read-only memmaps. The pages live in the OS page
+cache, so all DataLoader workers (and later runs) share one decoded copy.
+"""
+from typing import Optional, Sequence
+import hashlib
+import os
+import pathlib
+import numpy as np
+from filelock import FileLock
+
+from diffusion_policy.common.replay_buffer import ReplayBuffer
+from diffusion_policy.common.init_state_cache import dataset_fingerprint
+
+
+def _cache_path(cache_dir: pathlib.Path, key: str, arr,
+        fingerprint: Optional[str] = None) -> pathlib.Path:
+    h = hashlib.sha1()
+    h.update(f'{key}_{arr.shape}_{arr.dtype}'.encode())
+    if fingerprint is not None:
+        h.update(fingerprint.encode())
+    return cache_dir.joinpath(f'{key}_{h.hexdigest()[:8]}.npy')
+
+
+def _decode_to_memmap(arr, path: pathlib.Path) -> np.ndarray:
+    # written next to the final file and renamed once complete
+    tmp_path = path.with_suffix(f'.{os.getpid()}.tmp.npy')
+    out = np.lib.format.open_memmap(str(tmp_path), mode='w+',
+        dtype=arr.dtype, shape=arr.shape)
+    step = arr.chunks[0] if hasattr(arr, 'chunks') else len(arr)
+    for start in range(0, arr.shape[0], step):
+        # one compressed chunk at a time
+        out[start:start + step] = arr[start:start + step]
+    out.flush()
+    del out
+    os.replace(tmp_path, path)
+    return np.load(path, mmap_mode='r')
+
+
+def decoded_image_cache(replay_buffer: ReplayBuffer, rgb_keys: Sequence[str],
+        cache_dir: str, dataset_path: Optional[str] = None) -> ReplayBuffer:
+    """
+    Numpy backed copy of replay_buffer, rgb_keys are uint8 memmaps in
+    cache_dir (decoded on the first call), the other keys are loaded into memory.
+    dataset_path: source file of replay_buffer, its content fingerprint is part
+        of the cache key so a regenerated dataset is decoded again
+    """
+    cache_dir = pathlib.Path(os.path.expanduser(cache_dir))
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    fingerprint = None
+    if dataset_path is not None:
+        fingerprint = dataset_fingerprint(os.path.expanduser(dataset_path))
+    data = dict()
+    for key, arr in replay_buffer.items():
+        if key not in rgb_keys:
+            data[key] = arr[:]
+            continue
+        path = _cache_path(cache_dir, key, arr, fingerprint)
+        with FileLock(str(path) + '.lock'):
+            if path.exists():
+                data[key] = np.load(path, mmap_mode='r')
+            else:
+                print(f'Decoding {key} into {path}')
+                data[key] = _decode_to_memmap(arr, path)
+    root = {
+        'data': data,
+        'meta': {'episode_ends': replay_buffer.episode_ends[:]}
+    }
+    return ReplayBuffer(root=root)
@@ -0,0 +1,93 @@
+from typing import Dict, Iterable, Optional
+import hashlib
+import json
+import os
+import pathlib
+import h5py
+import numpy as np
+
+DEFAULT_CACHE_DIR = '~/.cache/diffusion_policy/init_states'
+
+
+def dataset_fingerprint(dataset_path: str, env_meta: Optional[dict] = None,
+        chunk_size: int = 1 << 20) -> str:
+    """
+    Cheap content hash of a (multi GB) hdf5 dataset: size plus the first and
+    last chunk_size bytes, combined with the env config the states depend on.
+    """
+    h = hashlib.sha1()
+    size = os.path.getsize(dataset_path)
+    h.update(str(size).encode())
+    with open(dataset_path, 'rb') as f:
+        h.update(f.read(chunk_size))
+        f.seek(max(size - chunk_size, 0))
+        h.update(f.read(chunk_size))
+    if env_meta is not None:
+        h.update(json.dumps(env_meta, sort_keys=True, default=str).encode())
+    return h.hexdigest()[:16]
+
+
+class InitStateCache:
+    """
+    On-disk cache of robosuite sim states, one npz per dataset fingerprint:
+    train_<idx>: the first state of demo idx in the hdf5 dataset
+    seed_<seed>: the state robosuite resets to under np.random.seed(seed)
+    Each state is a few hundred floats, so the whole file is read at construction.
+    cache_dir=None keeps the states in memory only.
+    """
+    def __init__(self, dataset_path: str, env_meta: Optional[dict] = None,
+            cache_dir: Optional[str] = DEFAULT_CACHE_DIR):
+        self.dataset_path = dataset_path
+        self.path = None
+        if cache_dir is not None:
+            cache_dir = pathlib.Path(os.path.expanduser(cache_dir))
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            self.path = cache_dir.joinpath(dataset_fingerprint(dataset_path, env_meta) + '.npz')
+        self.states = self._load()
+        self.dirty = False
+
+    def _load(self) -> Dict[str, np.ndarray]:
+        if self.path is None or not self.path.exists():
+            return dict()
+        try:
+            with np.load(self.path) as data:
+                return {key: data[key] for key in data.files}
+        except (OSError, ValueError):
+            # a corrupt cache is rebuilt
+            return dict()
+
+    def train_states(self, train_idxs: Iterable[int]) -> Dict[int, np.ndarray]:
+        """
+        First state of each train demo, the dataset is only opened for misses.
+        """
+        train_idxs = list(train_idxs)
+        missing = [idx for idx in train_idxs if f'train_{idx}' not in self.states]
+        if len(missing) > 0:
+            with h5py.File(self.dataset_path, 'r') as f:
+                for idx in missing:
+                    self.states[f'train_{idx}'] = f[f'data/demo_{idx}/states'][0]
+            self.dirty = True
+        return {idx: self.states[f'train_{idx}'] for idx in train_idxs}
+
+    def seed_states(self) -> Dict[int, np.ndarray]:
+        return {int(key[len('seed_'):]): value
+            for key, value in self.states.items() if key.startswith('seed_')}
+
+    def add_seed_states(self, seed_state_map: Dict[int, np.ndarray]):
+        for seed, state in seed_state_map.items():
+            key = f'seed_{seed}'
+            if key not in self.states:
+                self.states[key] = np.asarray(state)
+                self.dirty = True
+
+    def save(self):
+        if self.path is None or not self.dirty:
+            return
+        # merge with states other processes saved in the meantime
+        states = self._load()
+        states.update(self.states)
+        self.states = states
+        tmp_path = self.path.with_suffix(f'.{os.getpid()}.tmp.npz')
+        np.savez(tmp_path, **states)
+        os.replace(tmp_path, self.path)
+        self.dirty = False
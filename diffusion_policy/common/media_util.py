@@ -0,0 +1,149 @@
+"""
+Streaming writer of animated gif, webp and mp4 files from numpy frames.
+
+Frames are converted to uint8 and written as they come, instead of one
+matplotlib artist per frame. Several images passed to write() are laid
+out side by side (e.g. clean | perturbed), stride keeps every n-th frame.
+"""
+from typing import Iterable, Optional
+import os
+import numpy as np
+
+MEDIA_SUFFIXES = ('.gif', '.webp', '.mp4')
+
+
+def to_uint8_image(img) -> np.ndarray:
+    """
+    HWC uint8 image from a numpy array or torch tensor, CHW or HWC,
+    float in [0, 1] or uint8.
+    """
+    if hasattr(img, 'detach'):
+        img = img.detach().to('cpu').numpy()
+    img = np.asarray(img)
+    if img.ndim == 2:
+        img = img[..., None]
+    if img.ndim != 3:
+        raise ValueError(f"Expected a single image, got shape {img.shape}")
+    if img.shape[0] in (1, 3) and img.shape[-1] not in (1, 3):
+        img = np.moveaxis(img, 0, -1)
+    if img.dtype != np.uint8:
+        img = (np.clip(img, 0, 1) * 255).round().astype(np.uint8)
+    if img.shape[-1] == 1:
+        img = np.repeat(img, 3, axis=-1)
+    return img
+
+
+def side_by_side(*images, gap: int = 0) -> np.ndarray:
+    """
+    Images of the same height next to each other, gap black pixels apart.
+    """
+    images = [to_uint8_image(x) for x in images]
+    if len(images) == 1:
+        return images[0]
+    height = images[0].shape[0]
+    for img in images:
+        if img.shape[0] != height:
+            raise ValueError("side_by_side needs images of the same height")
+    panels = list()
+    for i, img in enumerate(images):
+        if i > 0 and gap > 0:
+            panels.append(np.zeros((height, gap, 3), dtype=np.uint8))
+        panels.append(img)
+    return np.concatenate(panels, axis=1)
+
+
+class MediaWriter:
+    def __init__(self, file_path: str, fps: float = 10, stride: int = 1,
+            gap: int = 0, loop: int = 0):
+        """
+        file_path: .gif and .mp4 are streamed to disk, .webp frames are kept
+            as uint8 until close() since animated webp is written at once
+        stride: keep every stride-th frame passed to write()
+        """
+        suffix = os.path.splitext(file_path)[1].lower()
+        if suffix not in MEDIA_SUFFIXES:
+            raise ValueError(f"Unsupported media type {suffix}, expected one of {MEDIA_SUFFIXES}")
+        if stride < 1:
+            raise ValueError("stride must be >= 1")
+        dirname = os.path.dirname(file_path)
+        if dirname:
+            os.makedirs(dirname, exist_ok=True)
+        self.file_path = file_path
+        self.suffix = suffix
+        self.fps = fps
+        self.stride = stride
+        self.gap = gap
+        self.loop = loop
+        self.n_seen = 0
+        self.n_written = 0
+        self.frames = list()
+        self.writer = None
+        self.closed = False
+
+    def _open(self):
+        import imageio
+        if self.suffix == '.gif':
+            return imageio.get_writer(self.file_path, mode='I',
+                duration=1 / self.fps, loop=self.loop)
+        # even macro blocks keep the frame size for yuv420p
+        return imageio.get_writer(self.file_path, fps=self.fps, macro_block_size=2)
+
+    def write(self, *images):
+        """
+        Append one frame, several images are laid out side by side.
+        """
+        if self.closed:
+            raise RuntimeError("MediaWriter is closed")
+        take = (self.n_seen % self.stride) == 0
+        self.n_seen += 1
+        if not take:
+            return
+        frame = side_by_side(*images, gap=self.gap)
+        if self.suffix == '.webp':
+            self.frames.append(frame)
+        else:
+            if self.writer is None:
+                self.writer = self._open()
+            self.writer.append_data(frame)
+        self.n_written += 1
+
+    def write_all(self, frames: Iterable):
+        for frame in frames:
+            if isinstance(frame, (tuple, list)):
+                self.write(*frame)
+            else:
+                self.write(frame)
+
+    def close(self) -> Optional[str]:
+        """
+        Finish the file, returns its path or None when no frame was written.
+        """
+        if self.closed:
+            return self.file_path if self.n_written > 0 else None
+        self.closed = True
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.suffix == '.webp' and len(self.frames) > 0:
+            from PIL import Image
+            images = [Image.fromarray(x) for x in self.frames]
+            images[0].save(self.file_path, save_all=True, append_images=images[1:],
+                duration=int(1000 / self.fps), loop=self.loop)
+            self.frames = list()
+        return self.file_path if self.n_written > 0 else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def write_media(file_path: str, frames: Iterable, fps: float = 10, stride: int = 1,
+        gap: int = 0) -> Optional[str]:
+    """
+    Write frames (images, or tuples of images laid out side by side).
+    """
+    with MediaWriter(file_path, fps=fps, stride=stride, gap=gap) as writer:
+        writer.write_all(frames)
+    return writer.close()
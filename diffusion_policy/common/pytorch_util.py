@@ -80,3 +80,13 @@ def optimizer_to(optimizer, device):
             if isinstance(v, torch.Tensor):
                 state[k] = v.to(device=device)
     return optimizer
+
+def to_device_float(x: torch.Tensor, device) -> torch.Tensor:
+    """
+    Device transfer, uint8 images are cast to float in [0, 1] after the
+    transfer so the host only moves a quarter of the bytes.
+    """
+    x = x.to(device, non_blocking=True)
+    if x.dtype == torch.uint8:
+        x = x.float() / 255.
+    return x
@@ -20,6 +20,7 @@ from diffusion_policy.model.common.normalizer import LinearNormalizer, SingleFie
 from diffusion_policy.model.common.rotation_transformer import RotationTransformer
 from diffusion_policy.codecs.imagecodecs_numcodecs import register_codecs, Jpeg2k
 from diffusion_policy.common.replay_buffer import ReplayBuffer
+from diffusion_policy.common.image_cache import decoded_image_cache
 from diffusion_policy.common.sampler import SequenceSampler, get_val_mask
 from diffusion_policy.common.normalize_util import (
     robomimic_abs_action_only_normalizer_from_stat,
@@ -44,8 +45,18 @@ class RobomimicReplayImageDataset(BaseImageDataset):
             use_legacy_normalizer=False,
             use_cache=False,
             seed=42,
-            val_ratio=0.0
+            val_ratio=0.0,
+            image_cache=False,
+            image_cache_dir=None,
+            uint8_images=False
         ):
+        """
+        image_cache: decode the rgb keys once into uint8 memmaps (see
+            diffusion_policy.common.image_cache), shared by DataLoader workers
+        image_cache_dir: defaults to dataset_path + '.images'
+        uint8_images: return rgb obs as uint8 (T,C,H,W), cast to float
+            on the device with pytorch_util.to_device_float
+        """
         print(f"Checking dataset path inside RobomimicReplayImageDataset for robomimic BEFORE conversion {dataset_path}")
         rotation_transformer = RotationTransformer(
             from_rep='axis_angle', to_rep=rotation_rep)
@@ -102,6 +113,12 @@ class RobomimicReplayImageDataset(BaseImageDataset):
         # for key in rgb_keys:
         #     replay_buffer[key].compressor.numthreads=1
 
+        if image_cache:
+            if image_cache_dir is None:
+                image_cache_dir = dataset_path + '.images'
+            replay_buffer = decoded_image_cache(replay_buffer, rgb_keys, image_cache_dir,
+                dataset_path=dataset_path)
+
         key_first_k = dict()
         if n_obs_steps is not None:
             # only take first k obs from images
@@ -133,6 +150,7 @@ class RobomimicReplayImageDataset(BaseImageDataset):
         self.pad_before = pad_before
         self.pad_after = pad_after
         self.use_legacy_normalizer = use_legacy_normalizer
+        self.uint8_images = uint8_images
 
     def get_validation_dataset(self):
         val_set = copy.copy(self)
@@ -209,8 +227,12 @@ class RobomimicReplayImageDataset(BaseImageDataset):
             # move channel last to channel first
             # T,H,W,C
             # convert uint8 image to float32
-            obs_dict[key] = np.moveaxis(data[key][T_slice],-1,1
-                ).astype(np.float32) / 255.
+            if self.uint8_images:
+                obs_dict[key] = np.ascontiguousarray(
+                    np.moveaxis(data[key][T_slice],-1,1))
+            else:
+                obs_dict[key] = np.moveaxis(data[key][T_slice],-1,1
+                    ).astype(np.float32) / 255.
             # T,C,H,W
             del data[key]
         for key in self.lowdim_keys:
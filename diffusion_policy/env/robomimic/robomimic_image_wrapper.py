@@ -12,12 +12,14 @@ class RobomimicImageWrapper(gym.Env):
         shape_meta: dict,
         init_state: Optional[np.ndarray]=None,
         render_obs_key='agentview_image',
+        seed_state_map: Optional[dict]=None,
         ):
 
         self.env = env
         self.render_obs_key = render_obs_key
         self.init_state = init_state
-        self.seed_state_map = dict()
+        # seed -> sim state, can be preloaded from an InitStateCache
+        self.seed_state_map = dict() if seed_state_map is None else dict(seed_state_map)
         self._seed = None
         self.shape_meta = shape_meta
         self.render_cache = None
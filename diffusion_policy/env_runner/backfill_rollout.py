@@ -0,0 +1,181 @@
+"""
+Rollout loop that drops finished envs from the batch and back-fills them.
+
+An env leaves the active batch as soon as its episode is done or has
+succeeded (robosuite envs only report done at max_steps, success shows
+up as a reward of 1). Its video and rewards are collected right away and
+its worker restarts with the next pending init condition, so the policy
+and the attack only ever run on live episodes.
+
+With the runners' max aggregated reward, stopping at the first success
+leaves the score of every episode unchanged.
+
+BackfillRollout steps the live envs together, WorkStealingRollout lets
+every env step on its own and hands out init conditions as soon as any
+worker finishes. Neither pads the env batch, results are kept per slot.
+"""
+from typing import Callable, List, Optional, Sequence, Tuple
+import collections
+import numpy as np
+
+from diffusion_policy.env_runner.pipelined_rollout import take_obs
+
+
+def put_obs(buffer, indices, obs, n_envs: int):
+    """
+    Write the batched obs of the envs in indices into buffer, a batch of
+    all n_envs envs that is allocated on first use.
+    """
+    if isinstance(obs, dict):
+        if buffer is None:
+            buffer = type(obs)((key, None) for key in obs.keys())
+        for key, value in obs.items():
+            buffer[key] = put_obs(buffer[key], indices, value, n_envs)
+        return buffer
+    if buffer is None:
+        buffer = np.zeros((n_envs,) + obs.shape[1:], dtype=obs.dtype)
+    buffer[indices] = obs
+    return buffer
+
+
+class BackfillRollout:
+    def __init__(self, env, success_reward: Optional[float] = 1.0,
+            video_fn: Optional[Callable] = None):
+        """
+        env: AsyncVectorEnv or RemoteVectorEnv of MultiStepWrapper envs
+        success_reward: an env with this (aggregated) reward is finished,
+            None only stops at done
+        video_fn: maps what env.render() returns to the stored video path,
+            e.g. to queue a DeferredVideo on the encoder as soon as it is done
+        """
+        self.env = env
+        self.success_reward = success_reward
+        self.video_fn = video_fn
+
+    def _finished(self, reward, done) -> np.ndarray:
+        finished = np.asarray(done, dtype=bool)
+        if self.success_reward is not None:
+            finished = finished | (np.asarray(reward) >= self.success_reward)
+        return finished
+
+    def _reset_state(self, init_fn_dills):
+        n_slots = len(init_fn_dills)
+        self.init_fn_dills = init_fn_dills
+        self.video_paths = [None] * n_slots
+        self.rewards = [None] * n_slots
+        self.pending = collections.deque(range(n_slots))
+        self.env_slots = np.full(self.env.num_envs, -1, dtype=np.int64)
+        self.buffer = None
+
+    def _start(self, env_indices):
+        """
+        Start the next pending slots on the idle envs in env_indices.
+        """
+        for i in env_indices:
+            self.env_slots[i] = self.pending.popleft()
+        self.env.call_each('run_dill_function',
+            args_list=[(self.init_fn_dills[self.env_slots[i]],) for i in env_indices],
+            indices=env_indices)
+        obs = self.env.reset_each(env_indices)
+        self.buffer = put_obs(self.buffer, env_indices, obs, self.env.num_envs)
+
+    def _step_done(self, env_indices, obs, reward, done, progress_fn=None) -> List[int]:
+        """
+        Store the obs of a finished step, collect and back-fill the
+        finished envs, returns the envs that are live again.
+        """
+        self.buffer = put_obs(self.buffer, env_indices, obs, self.env.num_envs)
+        finished = [i for i, x in zip(env_indices, self._finished(reward, done)) if x]
+        if len(finished) == 0:
+            return list(env_indices)
+        # collect results, rendering closes the video file
+        this_video_paths = self.env.call_each('render', indices=finished)
+        this_rewards = self.env.call_each('get_attr',
+            args_list=[('reward',)] * len(finished), indices=finished)
+        for i, video_path, reward_list in zip(finished, this_video_paths, this_rewards):
+            if self.video_fn is not None:
+                video_path = self.video_fn(video_path)
+            self.video_paths[self.env_slots[i]] = video_path
+            self.rewards[self.env_slots[i]] = reward_list
+            self.env_slots[i] = -1
+        if progress_fn is not None:
+            progress_fn(len(finished))
+
+        # back-fill the freed workers
+        refill = finished[:len(self.pending)]
+        if len(refill) > 0:
+            self._start(refill)
+        return sorted(set(env_indices).difference(finished).union(refill))
+
+    def run(self, init_fn_dills: Sequence[bytes], infer_fn: Callable,
+            progress_fn: Optional[Callable] = None) -> Tuple[List, List]:
+        """
+        init_fn_dills: one dill'ed init function (see run_dill_function) per episode
+        infer_fn(env_indices, slot_indices, obs) -> env actions of the envs in
+            env_indices, slot_indices are the episodes they are running
+        progress_fn(n) is called with the number of newly finished episodes
+        Returns the video path and the reward list of every episode.
+        """
+        env = self.env
+        self._reset_state(init_fn_dills)
+        live = list(range(min(env.num_envs, len(init_fn_dills))))
+        if len(live) > 0:
+            self._start(live)
+        while len(live) > 0:
+            env_action = infer_fn(np.array(live), self.env_slots[live],
+                take_obs(self.buffer, live))
+            env.step_each_async(env_action, live)
+            obs, reward, done, info = env.step_each_wait(live)
+            live = self._step_done(live, obs, reward, done, progress_fn)
+        return self.video_paths, self.rewards
+
+
+class WorkStealingRollout(BackfillRollout):
+    """
+    Back-filling without a common step: every env steps on its own and
+    the policy runs on whichever envs have finished their step, so no env
+    waits for the slowest one and inference overlaps env stepping.
+    """
+    def __init__(self, env, success_reward: Optional[float] = 1.0,
+            video_fn: Optional[Callable] = None, min_batch: int = 1):
+        """
+        min_batch: envs to wait for before running the policy (fewer when
+            fewer are stepping), trades GPU batch size against env idle time
+        """
+        super().__init__(env, success_reward=success_reward, video_fn=video_fn)
+        self.min_batch = max(1, min_batch)
+
+    def run(self, init_fn_dills: Sequence[bytes], infer_fn: Callable,
+            progress_fn: Optional[Callable] = None) -> Tuple[List, List]:
+        env = self.env
+        self._reset_state(init_fn_dills)
+        ready = list(range(min(env.num_envs, len(init_fn_dills))))
+        if len(ready) > 0:
+            self._start(ready)
+        stepping = set()
+        try:
+            while len(ready) > 0 or len(stepping) > 0:
+                if len(ready) > 0:
+                    env_action = infer_fn(np.array(ready), self.env_slots[ready],
+                        take_obs(self.buffer, ready))
+                    env.step_each_async(env_action, ready)
+                    stepping.update(ready)
+                    ready = list()
+
+                # wait until min_batch envs (or all that are stepping) can run again
+                while len(stepping) > 0 and len(ready) < self.min_batch:
+                    this_steps = env.step_each_ready()
+                    obs, reward, done, info = env.step_each_wait(this_steps)
+                    stepping.difference_update(this_steps)
+                    ready.extend(self._step_done(
+                        this_steps, obs, reward, done, progress_fn))
+                ready = sorted(ready)
+        except BaseException:
+            # collect the envs still stepping, so the env can be reused
+            if len(stepping) > 0:
+                try:
+                    env.step_each_wait(sorted(stepping))
+                except Exception:
+                    pass
+            raise
+        return self.video_paths, self.rewards
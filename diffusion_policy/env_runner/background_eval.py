@@ -0,0 +1,180 @@
+"""
+Rollout evaluation of universal perturbations in a background process.
+
+The UAP workspaces used to block on env_runner.run every rollout_every
+epochs. BackgroundEvaluator starts one spawned process that loads the
+frozen checkpoint and builds its own env runner (and env pool); submit()
+hands it a CPU snapshot of the current perturbation and returns right
+away, poll() returns the finished (epoch, perturbation, runner_log)
+results, so the scores are attached to the epoch they were computed for.
+The eval process applies the normalizer the workspace fit on its dataset,
+so background scores match synchronous rollouts.
+
+cfg.background_eval (optional, synchronous rollouts without it):
+    device: str        device of the eval process, default cfg.training.device
+    max_pending: int   submitted snapshots before submit() waits, default 2
+"""
+from typing import Callable, Dict, List, Optional, Tuple
+import multiprocessing as mp
+import queue
+import traceback
+import dill
+import hydra
+import torch
+import torch.nn as nn
+import wandb
+from omegaconf import OmegaConf
+from diffusion_policy.model.common.normalizer import LinearNormalizer
+from diffusion_policy.adversarial_attacks.perturbation_store import save_universal_perturbation
+
+EvalResult = Tuple[int, Dict[str, torch.Tensor], Dict]
+
+
+def _loggable(runner_log: dict) -> dict:
+    # wandb media objects are replaced by their file path
+    result = dict()
+    for key, value in runner_log.items():
+        if hasattr(value, '_path'):
+            result[key] = value._path
+        else:
+            result[key] = value
+    return result
+
+
+def log_uap_rollout(cfg, epoch, univ_pert, runner_log, **extra):
+    """
+    Print and log the rollout score of univ_pert and save it to the perturbation store.
+    """
+    test_mean_score = runner_log['test/mean_score']
+    print(f"Test mean score of epoch {epoch}: {test_mean_score}")
+    if cfg.log:
+        wandb.log({"test_mean_score": test_mean_score, "epoch": epoch})
+    save_universal_perturbation(cfg, univ_pert, epoch, test_mean_score, **extra)
+
+
+def _eval_worker(cfg_container: dict, output_dir: str, device: str,
+        normalizer_state: Optional[dict], job_queue, result_queue):
+    OmegaConf.register_new_resolver("eval", eval, replace=True)
+    cfg = OmegaConf.create(cfg_container)
+
+    # same frozen model as the training workspace
+    payload = torch.load(open(cfg.checkpoint, 'rb'), pickle_module=dill)
+    cfg_loaded = payload['cfg']
+    cls = hydra.utils.get_class(cfg_loaded._target_)
+    workspace = cls(cfg_loaded, output_dir=output_dir)
+    workspace.load_payload(payload, exclude_keys=None, include_keys=None)
+    try:
+        model = workspace.model
+    except AttributeError:
+        model = workspace.policy
+    if normalizer_state is not None:
+        # fit on cfg.task.dataset by the workspace, not stored in the checkpoint
+        normalizer = LinearNormalizer()
+        normalizer.load_state_dict(normalizer_state)
+        model.set_normalizer(normalizer)
+    model.to(torch.device(device))
+    model.eval()
+    env_runner = hydra.utils.instantiate(cfg.task.env_runner, output_dir=output_dir)
+
+    while True:
+        job = job_queue.get()
+        if job is None:
+            break
+        epoch, univ_pert = job
+        univ_pert = {key: value.to(device) for key, value in univ_pert.items()}
+        try:
+            runner_log = _loggable(env_runner.run(model, adversarial_patch=univ_pert, cfg=cfg))
+            result_queue.put((epoch, runner_log, None))
+        except Exception:
+            result_queue.put((epoch, None, traceback.format_exc()))
+    if hasattr(env_runner, 'close'):
+        env_runner.close()
+
+
+class BackgroundEvaluator:
+    def __init__(self, cfg, output_dir: str, device: Optional[str] = None,
+            normalizer: Optional[nn.Module] = None, max_pending: int = 2,
+            context: str = 'spawn', worker: Callable = _eval_worker):
+        """
+        cfg: the workspace cfg, resolved and copied to the eval process once
+        normalizer: the LinearNormalizer the workspace set on its model
+        worker: process target, called with (cfg_container, output_dir, device,
+            normalizer_state, job_queue, result_queue)
+        """
+        if max_pending < 1:
+            raise ValueError("max_pending must be >= 1")
+        if device is None:
+            device = cfg.training.device
+        self.max_pending = max_pending
+        normalizer_state = None
+        if normalizer is not None:
+            normalizer_state = {key: value.detach().to('cpu')
+                for key, value in normalizer.state_dict().items()}
+        ctx = mp.get_context(context)
+        self.job_queue = ctx.Queue()
+        self.result_queue = ctx.Queue()
+        self.process = ctx.Process(target=worker,
+            args=(OmegaConf.to_container(cfg, resolve=True), output_dir, device,
+                normalizer_state, self.job_queue, self.result_queue), daemon=True)
+        self.process.start()
+        # snapshots by epoch until their result arrives
+        self.pending = dict()
+        self.done = list()
+
+    @classmethod
+    def from_cfg(cls, cfg, output_dir: str, normalizer: Optional[nn.Module] = None
+            ) -> Optional['BackgroundEvaluator']:
+        eval_cfg = cfg.get('background_eval', None)
+        if eval_cfg is None or eval_cfg is False:
+            return None
+        device, max_pending = None, 2
+        if hasattr(eval_cfg, 'get'):
+            device = eval_cfg.get('device', None)
+            max_pending = eval_cfg.get('max_pending', 2)
+        return cls(cfg, output_dir, device=device, normalizer=normalizer,
+            max_pending=max_pending)
+
+    def _collect(self, timeout: Optional[float]) -> bool:
+        """
+        Move one result to self.done, False on timeout.
+        """
+        try:
+            epoch, runner_log, error = self.result_queue.get(timeout=timeout)
+        except queue.Empty:
+            if not self.process.is_alive():
+                raise RuntimeError(f"Background eval process exited with code {self.process.exitcode}")
+            return False
+        univ_pert = self.pending.pop(epoch)
+        if error is not None:
+            raise RuntimeError(f"Background eval of epoch {epoch} failed:\n{error}")
+        self.done.append((epoch, univ_pert, runner_log))
+        return True
+
+    def submit(self, epoch: int, univ_pert: Dict[str, torch.Tensor]):
+        """
+        Queue a snapshot of univ_pert, waits while max_pending are in flight.
+        """
+        while len(self.pending) >= self.max_pending:
+            self._collect(timeout=10.0)
+        snapshot = {key: value.detach().to('cpu').clone() for key, value in univ_pert.items()}
+        self.pending[epoch] = snapshot
+        self.job_queue.put((epoch, snapshot))
+
+    def poll(self) -> List[EvalResult]:
+        """
+        Finished results in submission order, without waiting.
+        """
+        while len(self.pending) > 0 and self._collect(timeout=0):
+            pass
+        done, self.done = self.done, list()
+        return done
+
+    def wait(self) -> List[EvalResult]:
+        while len(self.pending) > 0:
+            self._collect(timeout=10.0)
+        return self.poll()
+
+    def close(self):
+        if self.process.is_alive():
+            self.job_queue.put(None)
+            self.process.join()
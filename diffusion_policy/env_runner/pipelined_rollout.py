@@ -0,0 +1,78 @@
+"""
+Rollout loop that overlaps env stepping with policy inference.
+
+The envs of an AsyncVectorEnv are split into groups (two half-batches by
+default). While one group steps in its worker processes, the policy and
+attack run on the device for the next group, which hides most of the
+robosuite simulation time behind the attack compute.
+
+Each group stops stepping once all of its envs are done. MultiStepWrapper
+ignores steps after done, so this matches the serial loop that steps all
+envs until every env is done.
+"""
+from typing import Callable, List, Optional
+import collections
+import numpy as np
+
+
+def split_env_groups(n_envs: int, n_groups: int = 2) -> List[np.ndarray]:
+    """
+    Contiguous, non empty groups of env indices.
+    """
+    n_groups = max(1, min(n_groups, n_envs))
+    return [x for x in np.array_split(np.arange(n_envs), n_groups) if len(x) > 0]
+
+
+def take_obs(obs, indices):
+    """
+    Batched obs of the envs in indices.
+    """
+    if isinstance(obs, dict):
+        return type(obs)((key, value[indices]) for key, value in obs.items())
+    return obs[indices]
+
+
+class PipelinedRollout:
+    def __init__(self, env, n_groups: int = 2):
+        """
+        env: AsyncVectorEnv or RemoteVectorEnv, needs step_each_async/step_each_wait
+        """
+        self.env = env
+        self.groups = split_env_groups(env.num_envs, n_groups)
+
+    def run(self, obs, infer_fn: Callable, step_callback: Optional[Callable] = None):
+        """
+        obs: batched obs of all envs, as returned by env.reset()
+        infer_fn(group_idx, indices, obs) -> env actions of the envs in indices
+        step_callback(group_idx, indices, obs, reward, done, info) is called
+        after every group step.
+        """
+        env = self.env
+        queue = collections.deque()
+        try:
+            # prime, the first group steps while the second one infers
+            for group_idx, indices in enumerate(self.groups):
+                env_action = infer_fn(group_idx, indices, take_obs(obs, indices))
+                env.step_each_async(env_action, indices)
+                queue.append(group_idx)
+
+            while len(queue) > 0:
+                group_idx = queue[0]
+                indices = self.groups[group_idx]
+                obs, reward, done, info = env.step_each_wait(indices)
+                queue.popleft()
+                if step_callback is not None:
+                    step_callback(group_idx, indices, obs, reward, done, info)
+                if np.all(done):
+                    continue
+                env_action = infer_fn(group_idx, indices, obs)
+                env.step_each_async(env_action, indices)
+                queue.append(group_idx)
+        except BaseException:
+            # collect the groups still in flight, so the env can be reused
+            for group_idx in queue:
+                try:
+                    env.step_each_wait(self.groups[group_idx])
+                except Exception:
+                    pass
+            raise
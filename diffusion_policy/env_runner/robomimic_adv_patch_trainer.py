@@ -11,6 +11,7 @@ import dill
 from torch.utils.data import Dataset
 import wandb.sdk.data_types.video as wv
 from diffusion_policy.gym_util.async_vector_env import AsyncVectorEnv
+from diffusion_policy.gym_util.env_pool import make_vector_env, env_pool_key
 from diffusion_policy.gym_util.sync_vector_env import SyncVectorEnv
 from diffusion_policy.gym_util.multistep_wrapper import MultiStepWrapper
 from diffusion_policy.gym_util.video_recording_wrapper import VideoRecordingWrapper, VideoRecorder
@@ -77,7 +78,8 @@ class AdvPatchRobomimicImageRunner(BaseImageRunner):
             past_action=False,
             abs_action=False,
             tqdm_interval_sec=5.0,
-            n_envs=None
+            n_envs=None,
+            env_pool=None
         ):
         super().__init__(output_dir)
 
@@ -229,7 +231,11 @@ class AdvPatchRobomimicImageRunner(BaseImageRunner):
             env_prefixs.append('test/')
             env_init_fn_dills.append(dill.dumps(init_fn))
 
-        env = AsyncVectorEnv(env_fns, dummy_env_fn=dummy_env_fn)
+        # env_pool: socket path of a shared EnvPoolServer, see gym_util/env_pool.py
+        env = make_vector_env(env_fns, dummy_env_fn=dummy_env_fn, env_pool=env_pool,
+            key=env_pool_key(runner='AdvPatchRobomimicImageRunner', env_meta=env_meta, shape_meta=shape_meta,
+                n_envs=n_envs, render_obs_key=render_obs_key, fps=fps, crf=crf,
+                n_obs_steps=n_obs_steps, n_action_steps=n_action_steps, max_steps=max_steps))
         # env = SyncVectorEnv(env_fns)
         self.single_env = env_fns[0]()
 
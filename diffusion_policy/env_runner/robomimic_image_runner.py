@@ -10,15 +10,27 @@ import math
 import dill
 import wandb.sdk.data_types.video as wv
 from diffusion_policy.gym_util.async_vector_env import AsyncVectorEnv
+from diffusion_policy.gym_util.env_pool import make_vector_env, env_pool_key
+from diffusion_policy.gym_util.shared_obs import make_obs_transport
+from diffusion_policy.gym_util.deferred_video import (
+    DeferredVideo, VideoEncoderProcess, cleanup_stale_frames)
+from diffusion_policy.common.init_state_cache import InitStateCache, DEFAULT_CACHE_DIR
 from diffusion_policy.gym_util.sync_vector_env import SyncVectorEnv
 from diffusion_policy.gym_util.multistep_wrapper import MultiStepWrapper
 from diffusion_policy.gym_util.video_recording_wrapper import VideoRecordingWrapper, VideoRecorder
 from diffusion_policy.model.common.rotation_transformer import RotationTransformer
 from diffusion_policy.utils.attack_utils import optimize_linear, clip_perturb
+from diffusion_policy.adversarial_attacks.attack_sweep import stacked_log_prefix
+from diffusion_policy.adversarial_attacks.attack_engine import AttackEngine, ActionMSELoss, \
+    GMMMeanLoss, IBCEnergyLoss, DenoisingLoss, DiffusionPolicyLoss, get_attack_views
 
 from diffusion_policy.policy.base_image_policy import BaseImagePolicy
 from diffusion_policy.common.pytorch_util import dict_apply
+from diffusion_policy.common.media_util import MediaWriter
+from diffusion_policy.common.capture_buffer import CaptureBuffer
 from diffusion_policy.env_runner.base_image_runner import BaseImageRunner
+from diffusion_policy.env_runner.pipelined_rollout import PipelinedRollout
+from diffusion_policy.env_runner.backfill_rollout import BackfillRollout, WorkStealingRollout
 from diffusion_policy.env.robomimic.robomimic_image_wrapper import RobomimicImageWrapper
 import robomimic.utils.file_utils as FileUtils
 import robomimic.utils.env_utils as EnvUtils
@@ -84,6 +96,14 @@ class RobomimicImageRunner(BaseImageRunner):
                  abs_action=False,
                  tqdm_interval_sec=5.0,
                  n_envs=None,
+                 env_pool=None,
+                 init_state_cache_dir=DEFAULT_CACHE_DIR,
+                 pipeline_groups=1,
+                 early_exit=False,
+                 work_stealing=False,
+                 zero_copy_obs=False,
+                 deferred_video=False,
+                 log_videos=True,
                  ):
         super().__init__(output_dir)
 
@@ -114,6 +134,12 @@ class RobomimicImageRunner(BaseImageRunner):
             env_meta['env_kwargs']['controller_configs']['control_delta'] = False
             rotation_transformer = RotationTransformer('axis_angle', 'rotation_6d')
 
+        # train init states and test seed states persisted across runs,
+        # init_state_cache_dir=None keeps them in memory only
+        init_state_cache = InitStateCache(dataset_path, env_meta=env_meta,
+            cache_dir=init_state_cache_dir)
+        seed_state_map = init_state_cache.seed_states()
+
         def env_fn():
             robomimic_env = create_env(
                 env_meta=env_meta,
@@ -129,7 +155,8 @@ class RobomimicImageRunner(BaseImageRunner):
                         env=robomimic_env,
                         shape_meta=shape_meta,
                         init_state=None,
-                        render_obs_key=render_obs_key
+                        render_obs_key=render_obs_key,
+                        seed_state_map=seed_state_map
                     ),
                     video_recoder=VideoRecorder.create_h264(
                         fps=fps,
@@ -140,7 +167,9 @@ class RobomimicImageRunner(BaseImageRunner):
                         thread_count=1
                     ),
                     file_path=None,
-                    steps_per_render=steps_per_render
+                    steps_per_render=steps_per_render,
+                    deferred=deferred_video,
+                    max_frames=max_steps // steps_per_render + 2
                 ),
                 n_obs_steps=n_obs_steps,
                 n_action_steps=n_action_steps,
@@ -187,33 +216,34 @@ class RobomimicImageRunner(BaseImageRunner):
         env_init_fn_dills = list()
 
         # train
-        with h5py.File(dataset_path, 'r') as f:
-            for i in range(n_train):
-                train_idx = train_start_idx + i
-                enable_render = i < n_train_vis
-                init_state = f[f'data/demo_{train_idx}/states'][0]
-
-                def init_fn(env, init_state=init_state,
-                            enable_render=enable_render):
-                    # setup rendering
-                    # video_wrapper
-                    assert isinstance(env.env, VideoRecordingWrapper)
-                    env.env.video_recoder.stop()
-                    env.env.file_path = None
-                    if enable_render:
-                        filename = pathlib.Path(output_dir).joinpath(
-                            'media', wv.util.generate_id() + ".mp4")
-                        filename.parent.mkdir(parents=False, exist_ok=True)
-                        filename = str(filename)
-                        env.env.file_path = filename
-
-                    # switch to init_state reset
-                    assert isinstance(env.env.env, RobomimicImageWrapper)
-                    env.env.env.init_state = init_state
-
-                env_seeds.append(train_idx)
-                env_prefixs.append('train/')
-                env_init_fn_dills.append(dill.dumps(init_fn))
+        train_init_states = init_state_cache.train_states(
+            range(train_start_idx, train_start_idx + n_train))
+        for i in range(n_train):
+            train_idx = train_start_idx + i
+            enable_render = i < n_train_vis
+            init_state = train_init_states[train_idx]
+
+            def init_fn(env, init_state=init_state,
+                        enable_render=enable_render):
+                # setup rendering
+                # video_wrapper
+                assert isinstance(env.env, VideoRecordingWrapper)
+                env.env.video_recoder.stop()
+                env.env.file_path = None
+                if enable_render:
+                    filename = pathlib.Path(output_dir).joinpath(
+                        'media', wv.util.generate_id() + ".mp4")
+                    filename.parent.mkdir(parents=False, exist_ok=True)
+                    filename = str(filename)
+                    env.env.file_path = filename
+
+                # switch to init_state reset
+                assert isinstance(env.env.env, RobomimicImageWrapper)
+                env.env.env.init_state = init_state
+
+            env_seeds.append(train_idx)
+            env_prefixs.append('train/')
+            env_init_fn_dills.append(dill.dumps(init_fn))
 
         # test
         for i in range(n_test):
@@ -243,7 +273,13 @@ class RobomimicImageRunner(BaseImageRunner):
             env_prefixs.append('test/')
             env_init_fn_dills.append(dill.dumps(init_fn))
 
-        env = AsyncVectorEnv(env_fns, dummy_env_fn=dummy_env_fn)
+        # env_pool: socket path of a shared EnvPoolServer, see gym_util/env_pool.py
+        env = make_vector_env(env_fns, dummy_env_fn=dummy_env_fn, env_pool=env_pool,
+            copy=not zero_copy_obs, key=env_pool_key(runner='RobomimicImageRunner', env_meta=env_meta, shape_meta=shape_meta,
+                n_envs=n_envs, render_obs_key=render_obs_key, fps=fps, crf=crf,
+                n_obs_steps=n_obs_steps, n_action_steps=n_action_steps, max_steps=max_steps,
+                deferred_video=deferred_video))
+        init_state_cache.save()
         # env = SyncVectorEnv(env_fns)
 
         self.env_meta = env_meta
@@ -261,6 +297,83 @@ class RobomimicImageRunner(BaseImageRunner):
         self.rotation_transformer = rotation_transformer
         self.abs_action = abs_action
         self.tqdm_interval_sec = tqdm_interval_sec
+        self.init_state_cache = init_state_cache
+        # >1: step env groups while the policy runs on the others, see pipelined_rollout.py
+        self.pipeline_groups = pipeline_groups
+        # drop finished envs from the batch and back-fill them, see backfill_rollout.py
+        self.early_exit = early_exit
+        # envs step on their own and pick up the next init as soon as they finish,
+        # the policy waits for 1/pipeline_groups of the envs
+        self.work_stealing = work_stealing
+        # read obs as torch views of the shared worker buffer, see shared_obs.py
+        self.zero_copy_obs = zero_copy_obs
+        self.obs_transport = None
+        # encode videos in a background process, log_videos=False drops them
+        self.log_videos = log_videos
+        self.video_encoder = None
+
+    def update_init_state_cache(self):
+        """
+        Persist the seed states the env workers computed during a rollout.
+        """
+        for seed_state_map in self.env.call('get_attr', 'seed_state_map'):
+            self.init_state_cache.add_seed_states(seed_state_map)
+        self.init_state_cache.save()
+
+    def get_video_encoder(self) -> VideoEncoderProcess:
+        if self.video_encoder is None:
+            # frames left behind by crashed runs
+            cleanup_stale_frames()
+            self.video_encoder = VideoEncoderProcess()
+        return self.video_encoder
+
+    def submit_video(self, video):
+        """
+        Video path of a rendered episode, deferred videos are queued on the
+        encoder process (see wait_videos), None when videos are not logged.
+        """
+        if isinstance(video, DeferredVideo):
+            return self.get_video_encoder().submit(video, encode=self.log_videos)
+        return video if self.log_videos else None
+
+    def discard_videos(self, videos):
+        for video in videos:
+            if isinstance(video, DeferredVideo):
+                video.discard()
+
+    def wait_videos(self):
+        if self.video_encoder is not None:
+            self.video_encoder.wait()
+
+    def close(self):
+        """
+        Encode the queued videos, then stop the encoder and the env workers,
+        which free the frame rings of unfinished episodes.
+        """
+        if self.video_encoder is not None:
+            self.video_encoder.close()
+            self.video_encoder = None
+        if self.obs_transport is not None:
+            self.obs_transport.close()
+            self.obs_transport = None
+        self.env.close()
+        cleanup_stale_frames()
+
+    def get_obs_transport(self, device):
+        """
+        SharedObsTransport of self.env when zero_copy_obs is on and the env
+        buffer is local, else None.
+        """
+        if not self.zero_copy_obs:
+            return None
+        if self.obs_transport is None or self.obs_transport.device != torch.device(device):
+            if self.obs_transport is not None:
+                self.obs_transport.close()
+            self.obs_transport = make_obs_transport(self.env, device)
+            if self.obs_transport is None:
+                print("zero_copy_obs needs a local AsyncVectorEnv, obs are copied")
+                self.zero_copy_obs = False
+        return self.obs_transport
 
     def run(self, policy: BaseImagePolicy, save_pkl=False,adversarial_patch=None, cfg=None):
         print(cfg)
@@ -277,1598 +390,25 @@ class RobomimicImageRunner(BaseImageRunner):
         # allocate data
         all_video_paths = [None] * n_inits
         all_rewards = [None] * n_inits
-        observations = []
+        # bounded uint8 capture of the visualized envs
+        observations = CaptureBuffer(
+            max_frames=cfg.get('capture_max_frames', 1024),
+            max_bytes=cfg.get('capture_max_bytes', None),
+            stride=cfg.get('capture_stride', 1),
+            storage=cfg.get('capture_storage', 'cpu'))
         # randomly select envs to visualize from the n_envs
         '''Uncommenting for TH'''
         vis_envs = np.random.choice(n_envs, cfg.n_vis, replace=False)
         # try:
         #     obs_encoder = policy.nets['policy'].nets['encoder'].nets['obs']
-        # except:
-        #     obs_encoder = policy.obs_encoder
-        # image_encoder = obs_encoder.obs_nets['robot0_eye_in_hand_image']
-        policy.eval()
-        # set_seed(1024)
-
-        for chunk_idx in range(n_chunks):
-            start = chunk_idx * n_envs
-            end = min(n_inits, start + n_envs)
-            this_global_slice = slice(start, end)
-            this_n_active_envs = end - start
-            this_local_slice = slice(0, this_n_active_envs)
-
-            this_init_fns = self.env_init_fn_dills[this_global_slice]
-            n_diff = n_envs - len(this_init_fns)
-            if n_diff > 0:
-                this_init_fns.extend([self.env_init_fn_dills[0]] * n_diff)
-            assert len(this_init_fns) == n_envs
-
-            # init envs
-            env.call_each('run_dill_function',
-                          args_list=[(x,) for x in this_init_fns])
-
-            # start rollout
-            obs = env.reset()
-            past_action = None
-            policy.reset()
-
-            env_name = self.env_meta['env_name']
-            pbar = tqdm.tqdm(total=self.max_steps, desc=f"Eval {env_name}Image {chunk_idx + 1}/{n_chunks}",
-                             leave=False, mininterval=self.tqdm_interval_sec)
-            if cfg.view == 'both':
-                views = ['agentview_image', 'robot0_eye_in_hand_image']
-            elif cfg.view == 'None':
-                views = []
-            else:
-                views = [cfg.view]
-            # if save_pkl:
-            #     obs_ls=[]
-            done = False
-            while not done:
-                # create obs dict
-                np_obs_dict = dict(obs)
-                if self.past_action and (past_action is not None):
-                    # TODO: not tested
-                    np_obs_dict['past_action'] = past_action[
-                                                 :, -(self.n_obs_steps - 1):].astype(np.float32)
-
-                # device transfer
-                obs_dict = dict_apply(np_obs_dict,
-                                      lambda x: torch.from_numpy(x).to(
-                                          device=device))
-                # print(f"Min and Max of obs_dict: {torch.min(obs_dict['robot0_eye_in_hand_image'])}, {torch.max(obs_dict['robot0_eye_in_hand_image'])}")
-                clean_obs_dict = obs_dict.copy()
-                random_obs_dict = obs_dict.copy()
-                if adversarial_patch is not None:
-                    for view in views:
-                        obs_dict[view] = obs_dict[view] + adversarial_patch[view].to(device)
-                        obs_dict[view] = torch.clamp(obs_dict[view], cfg.clip_min, cfg.clip_max)
-                    # maximum_perturbation = torch.max(torch.abs(adversarial_patch))
-                    # random_perturbation = torch.rand_like(obs_dict[cfg.view]) * 2 * maximum_perturbation - maximum_perturbation
-                    # random_obs_dict[cfg.view] = random_obs_dict[cfg.view] + random_perturbation
-                obs_dict = dict_apply(obs_dict, lambda x: x.to(device=device))
-                # run policy
-                with torch.no_grad():
-                    # calculate the l2 distance clean and obs_dict
-                    clean_action_dict = policy.predict_action(clean_obs_dict)
-                    action_dict = policy.predict_action(obs_dict)
-                    # clean_output = policy.predict_action(clean_obs_dict, return_latent=True)['output']
-                    # output = policy.predict_action(obs_dict, return_latent=True)['output']
-                    # latents = policy.predict_action(obs_dict, return_latent=True)
-                    # clean_latents = policy.predict_action(clean_obs_dict, return_latent=True)
-                    # # print("L2 distance between clean and adversarial output: ", torch.norm(clean_output - output, p=2) / output.shape[0])
-                    # print(latents['latent'])
-                    # print(clean_latents['latent'])
-                    # print("L2 distance between clean and adversarial latents: ", torch.norm(clean_latents['latent'][0].float() - latents['latent'][0].float(), p=2) / latents['latent'][0].shape[0])
-                    # random_action_dict = policy.predict_action(random_obs_dict)
-                '''uncommenting for TH'''
-                observations.append(obs_dict['robot0_eye_in_hand_image'][vis_envs].detach().cpu().numpy())
-                # print(f"observations appending has shape {observations[0].shape}")
-                # device_transfer
-                try:
-                    np_action_dict = dict_apply(action_dict,
-                                                lambda x: x.detach().to('cpu').numpy())
-                    # np_clean_action_dict = dict_apply(clean_action_dict,
-                    #     lambda x: x.detach().to('cpu').numpy())
-                    # np_random_action_dict = dict_apply(random_action_dict,
-                    #     lambda x: x.detach().to('cpu').numpy())
-                    action = np_action_dict['action']
-                    # clean_actions = np_clean_action_dict['action']
-                    # random_actions = np_random_action_dict['action']
-                except AttributeError:
-                    action = action_dict['action'].detach().to('cpu').numpy()
-                # l1 distance between actions and clean actions before perturbation
-                # for i in range(action.shape[-1]):
-                #     print(f"l1_distance_{i}: {torch.norm(action_dict['action'][:,:,i] - clean_action_dict['action'][:,:,i], p=1) / action.shape[0]}")
-                if cfg.targeted and cfg.log:
-                    pass
-                    #COMMENTED FOR IBC
-                    # try:
-                    #     # log the l1 distance between the predicted action and the target action per environment
-                    #     target_action = clean_action_dict['action'].to('cpu') + adversarial_patch['perturbations'].to(
-                    #         'cpu')
-                    #     for i in range(target_action.shape[-1]):
-                    #         wandb.log({f"l1_distance_{i}": torch.norm(
-                    #             action_dict['action'][:, :, i].to('cpu') - target_action[:, :, i], p=1) /
-                    #                                        target_action.shape[0]})
-                    # except KeyError:
-                    #     pass
-                # features = np_action_dict['features']
-                # clean_features = np_clean_action_dict['features']
-                # random_features = np_random_action_dict['features']
-                # features = np.mean(features, axis=0)
-                # actions = np.mean(action, axis=0)
-                # clean_actions = np.mean(clean_actions, axis=0)
-                # clean_features = np.mean(clean_features, axis=0)
-                # random_features = np.mean(random_features, axis=0)
-                # random_actions = np.mean(random_actions, axis=0)
-                # l2 distance between features
-                # diff = np.linalg.norm(features - clean_features)
-                # diff_actions = np.linalg.norm(actions - clean_actions)
-                # diff_random = np.linalg.norm(random_features - clean_features)
-                # diff_random_actions = np.linalg.norm(random_actions - clean_actions)
-                # print(f"Diff: {diff}, Random Diff: {diff_random}")
-                # print(f"Diff Actions: {diff_actions}, Random Diff Actions: {diff_random_actions}")
-                # if cfg.log:
-                #     wandb.log({"Diff": diff, "Random Diff": diff_random,
-                #                 "Diff Actions": diff_actions, "Random Diff Actions": diff_random_actions})
-                if not np.all(np.isfinite(action)):
-                    print(action)
-                    raise RuntimeError("Nan or Inf action")
-
-                # step env
-                env_action = action
-                if self.abs_action:
-                    env_action = self.undo_transform_action(action)
-
-
-                obs, reward, done, info = env.step(env_action)
-                # obs_ls.append(obs)
-                done = np.all(done)
-                past_action = action
-                # update pbar
-                pbar.update(action.shape[1])
-            pbar.close()
-
-            # collect data for this round
-            all_video_paths[this_global_slice] = env.render()[this_local_slice]
-            all_rewards[this_global_slice] = env.call('get_attr', 'reward')[this_local_slice]
-        # clear out video buffer
-        _ = env.reset()
-        # log
-        max_rewards = collections.defaultdict(list)
-        log_data = dict()
-        # visualize the video and save to wandb
-        if cfg.save_video and cfg.log:
-            for i in range(cfg.n_vis):
-                ims = []
-                fig, ax = plt.subplots()
-                for j in range(len(observations)):
-                    try:
-                        print(observations[j][i][1].shape)
-                        im = observations[j][i][1].transpose(1, 2, 0)
-                    except IndexError:
-                        im = observations[j][i][0].transpose(1, 2, 0)
-                    ims.append([ax.imshow(im)])
-                save_path = Path(cfg.patch_path).parent
-                save_path = save_path.joinpath(f'{cfg.exp_name}_vis_{i}.gif')
-                print(f"Saving video to {save_path}")
-
-                if os.path.exists(save_path):
-                    os.remove(save_path)
-
-                ani = ArtistAnimation(fig, ims, interval=100, blit=True, repeat_delay=1000)
-                ani.save(str(save_path), writer='pillow')
-                plt.close(fig)
-                #
-                wandb.log({f'{cfg.exp_name}_vis_{i}': wandb.Image(str(save_path))})
-
-        # results reported in the paper are generated using the commented out line below
-        # which will only report and average metrics from first n_envs initial condition and seeds
-        # fortunately this won't invalidate our conclusion since
-        # 1. This bug only affects the variance of metrics, not their mean
-        # 2. All baseline methods are evaluated using the same code
-        # to completely reproduce reported numbers, uncomment this line:
-        # for i in range(len(self.env_fns)):
-        # # and comment out this line
-        for i in range(n_inits):
-            seed = self.env_seeds[i]
-            prefix = self.env_prefixs[i]
-            max_reward = np.max(all_rewards[i])
-            max_rewards[prefix].append(max_reward)
-            log_data[prefix + f'sim_max_reward_{seed}'] = max_reward
-
-        #     # visualize sim
-        #     video_path = all_video_paths[i]
-        #     if video_path is not None:
-        #         sim_video = wandb.Video(video_path)
-        #         log_data[prefix+f'sim_video_{seed}'] = sim_video
-
-        # log aggregate metrics
-        for prefix, value in max_rewards.items():
-            name = prefix + 'mean_score'
-            value = np.mean(value)
-            log_data[name] = value
-        # save_pkl_dir='/home/ak/Documents/Adversarial_diffusion_policy/pre_trained_checkpoints/square/'
-        # pickle.dump(obs_ls, save_pkl_dir.joinpath('square_obs.pkl').open('wb'))
-
-        return log_data
-
-    def undo_transform_action(self, action):
-        raw_shape = action.shape
-        if raw_shape[-1] == 20:
-            # dual arm
-            action = action.reshape(-1, 2, 10)
-
-        d_rot = action.shape[-1] - 4
-        pos = action[..., :3]
-        rot = action[..., 3:3 + d_rot]
-        gripper = action[..., [-1]]
-        rot = self.rotation_transformer.inverse(rot)
-        uaction = np.concatenate([
-            pos, rot, gripper
-        ], axis=-1)
-
-        if raw_shape[-1] == 20:
-            # dual arm
-            uaction = uaction.reshape(*raw_shape[:-1], 14)
-
-        return uaction
-
-
-class AdversarialRobomimicImageRunner(RobomimicImageRunner):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-
-    def apply_fgsm_attack(self, obs_dict, policy: BaseImagePolicy,\
-                          cfg, action):
-        view = cfg.view
-        clip_min = cfg.clip_min
-        clip_max = cfg.clip_max
-
-        if view == 'both':
-            views = ['agentview_image', 'robot0_eye_in_hand_image']
-        elif isinstance(view, list):
-            views = view
-        elif isinstance(view, str):
-            views = [view]
-        else:
-            raise ValueError("view must be a string or a list of strings")
-
-        # check if the input tensors are within the clip range
-        for view in views:
-            assert torch.all(obs_dict[view] >= clip_min) and torch.all(obs_dict[view] <= clip_max), \
-                "Input tensor is not within the clip range"
-
-        # create a copy of the original obs_dict that requires grad for backward pass
-        obs_dict = dict_apply(obs_dict, lambda x: x.clone().detach().requires_grad_(True))
-        policy.zero_grad()
-
-        predicted_action = policy.predict_action(obs_dict)['action']
-        # print("ACtion dist: ", action_dist)
-        # predicted_scales = predicted_action_dist.component_distribution.base_dist.scale
-        # print(predicted_means, predicted_scales, means)
-        # print(predicted_action.grad_fn, action.grad_fn)
-        mse_loss = torch.nn.MSELoss()
-        if cfg.targeted:
-            action = action + torch.tensor(cfg.perturbations).to(policy.device)
-            loss = mse_loss(predicted_action, action)
-            loss = -loss
-        else:
-            loss = mse_loss(predicted_action, action)
-            # apply loss for the first two dimensions of the action
-            # loss = mse_loss(predicted_action[:,:, :2], action[:,:, :2])
-        loss.backward()
-        if cfg.log:
-            wandb.log({"Loss": loss.item()})
-            # log per dimension mse loss for predicted_action and action
-            for i in range(7):
-                wandb.log({f"Loss{i}d": mse_loss(predicted_action[:, :, i], action[:, :, i])})
-        for view in views:
-            # assert obs_dict_copy[view].grad_fn is not None, "Input tensor does not have a grad_fn"
-            grad = torch.sign(obs_dict[view].grad)
-            obs_dict[view] = obs_dict[view] + optimize_linear(grad, cfg.eps_iter, cfg.norm)
-            obs_dict[view] = torch.clamp(obs_dict[view], clip_min, clip_max)
-        # obs_dict['agentview_image'].requires_grad = False
-        return obs_dict
-
-    def apply_pgd_attack(self, obs_dict, policy: BaseImagePolicy, cfg, action):
-        """
-        Apply projected gradient descent attack from Madry et al. (2017)
-        """
-        view = cfg.view
-        n_iter = cfg.n_iter
-        clip_min = cfg.clip_min
-        clip_max = cfg.clip_max
-        eps_iter = cfg.eps_iter
-        norm = cfg.norm
-        rand_int = cfg.rand_int
-        # check if the input tensors are within the clip range
-        if view == 'both':
-            # make a list of views in the rgb space
-            views = ['agentview_image', 'robot0_eye_in_hand_image']
-            assert torch.all(obs_dict[views[0]] >= clip_min) and torch.all(obs_dict[views[0]] <= clip_max), \
-                "Input tensor is not within the clip range"
-            assert torch.all(obs_dict[views[1]] >= clip_min) and torch.all(obs_dict[views[1]] <= clip_max), \
-                "Input tensor is not within the clip range"
-        else:
-            views = list(str(view))
-            assert torch.all(obs_dict[view] >= clip_min) and torch.all(obs_dict[view] <= clip_max), \
-                "Input tensor is not within the clip range"
-        if rand_int:
-            # randomly initialize the perturbation from a uniform distribution within the epsilon bound
-            for view in views:
-                perturbation = torch.FloatTensor(obs_dict[view].shape).uniform_(-self.epsilon, self.epsilon).to(
-                    policy.device)
-                perturbation = torch.clamp(perturbation, -eps_iter, eps_iter)
-                perturbation = torch.clamp(obs_dict[view] + perturbation, clip_min, clip_max) - obs_dict[view]
-                adv_obs_dict[view] = obs_dict[view] + perturbation
-        adv_obs_dict = obs_dict.copy()
-        for i in range(n_iter):
-            policy.zero_grad()
-            adv_obs_dict = self.apply_fgsm_attack(adv_obs_dict, policy, cfg, action)
-            for view in views:
-                perturbation = adv_obs_dict[view] - obs_dict[view]
-                if norm == 'l2':
-                    perturbation = perturbation * self.epsilon / torch.norm(perturbation, p=2)
-                elif norm == 'linf':
-                    perturbation = torch.clamp(perturbation, -self.epsilon, self.epsilon)
-                adv_obs_dict[view] = obs_dict[view] + perturbation
-                adv_obs_dict[view] = torch.clamp(adv_obs_dict[view], clip_min, clip_max)
-        return adv_obs_dict
-
-    def run(self, policy: BaseImagePolicy, epsilon: float, cfg):
-        self.epsilon = epsilon
-        device = policy.device
-        dtype = policy.dtype
-        env = self.env
-        attack_type = cfg.attack_type
-
-        # plan for rollout
-        n_envs = len(self.env_fns)
-        n_inits = len(self.env_init_fn_dills)
-        n_chunks = math.ceil(n_inits / n_envs)
-
-        if cfg.view == 'both':
-            views = ['agentview_image', 'robot0_eye_in_hand_image']
-        elif isinstance(cfg.view, list):
-            views = cfg.view
-        elif isinstance(cfg.view, str):
-            views = [cfg.view]
-
-        # allocate data
-        all_video_paths = [None] * n_inits
-        all_rewards = [None] * n_inits
-
-        for chunk_idx in range(n_chunks):
-            start = chunk_idx * n_envs
-            end = min(n_inits, start + n_envs)
-            this_global_slice = slice(start, end)
-            this_n_active_envs = end - start
-            this_local_slice = slice(0, this_n_active_envs)
-
-            this_init_fns = self.env_init_fn_dills[this_global_slice]
-            n_diff = n_envs - len(this_init_fns)
-            if n_diff > 0:
-                this_init_fns.extend([self.env_init_fn_dills[0]] * n_diff)
-            assert len(this_init_fns) == n_envs
-
-            # init envs
-            env.call_each('run_dill_function',
-                          args_list=[(x,) for x in this_init_fns])
-
-            # start rollout
-            obs = env.reset()
-            past_action = None
-            policy.reset()
-
-            env_name = self.env_meta['env_name']
-            pbar = tqdm.tqdm(total=self.max_steps, desc=f"Eval {env_name}Image {chunk_idx + 1}/{n_chunks}",
-                             leave=False, mininterval=self.tqdm_interval_sec)
-
-            done = False
-            while not done:
-                # create obs dict
-                np_obs_dict = dict(obs)
-                if self.past_action and (past_action is not None):
-                    # TODO: not tested
-                    np_obs_dict['past_action'] = past_action[
-                                                 :, -(self.n_obs_steps - 1):].astype(np.float32)
-
-                # device transfer
-                obs_dict = dict_apply(np_obs_dict,
-                                      lambda x: torch.from_numpy(x).to(
-                                          device=device))
-                # device transfer and enable gradients
-                # obs_dict = dict_apply(np_obs_dict,
-                #    lambda x: torch.from_numpy(x).to(device=device).requires_grad_(True))
-                prev_obs_dict = obs_dict
-                # apply attack
-                with torch.no_grad():
-                    action = policy.predict_action(obs_dict)['action']
-                if attack_type == 'fgsm':
-                    obs_dict = self.apply_fgsm_attack(obs_dict, policy, \
-                                                      cfg, action)
-                    for view in views:
-                        perturbation = abs(obs_dict[view] - prev_obs_dict[view])
-                        perturbation = perturbation.view(perturbation.shape[0], -1)
-                        # log the maximum perturbation across the batch
-                        perturbation_max = torch.sum(perturbation, dim=1)
-                elif attack_type == 'pgd':
-                    obs_dict = self.apply_pgd_attack(obs_dict, policy, cfg, action)
-                elif attack_type == 'noise':
-                    obs_dict = self.apply_noise_attack(obs_dict, policy, cfg)
-                elif attack_type == None:
-                    pass
-                else:
-                    raise ValueError("Invalid attack type")
-                # run policy
-                with torch.no_grad():
-                    action_dict = policy.predict_action(obs_dict)
-
-                # device_transfer
-                np_action_dict = dict_apply(action_dict,
-                                            lambda x: x.detach().to('cpu').numpy())
-
-                action = np_action_dict['action']
-                if not np.all(np.isfinite(action)):
-                    print(action)
-                    raise RuntimeError("Nan or Inf action")
-
-                # step env
-                env_action = action
-                if self.abs_action:
-                    env_action = self.undo_transform_action(action)
-
-                obs, reward, done, info = env.step(env_action)
-                done = np.all(done)
-                past_action = action
-                # if cfg.log == True:
-                # log the perturbation for each environment separately
-                # for i in range(len(perturbation_norm)):
-                #     wandb.log({f'perturbation_{view}_{i}': perturbation_norm[i]})
-                # for i in range(len(perturbation_max)):
-                #     wandb.log({f'max_perturbation_{view}_{i}': perturbation_max[i]})
-                # update pbar
-                pbar.update(action.shape[1])
-            pbar.close()
-
-            # collect data for this round
-            all_video_paths[this_global_slice] = env.render()[this_local_slice]
-            all_rewards[this_global_slice] = env.call('get_attr', 'reward')[this_local_slice]
-        # clear out video buffer
-        _ = env.reset()
-
-        # log
-        max_rewards = collections.defaultdict(list)
-        log_data = dict()
-        # results reported in the paper are generated using the commented out line below
-        # which will only report and average metrics from first n_envs initial condition and seeds
-        # fortunately this won't invalidate our conclusion since
-        # 1. This bug only affects the variance of metrics, not their mean
-        # 2. All baseline methods are evaluated using the same code
-        # to completely reproduce reported numbers, uncomment this line:
-        # for i in range(len(self.env_fns)):
-        # and comment out this line
-        for i in range(n_inits):
-            seed = self.env_seeds[i]
-            prefix = self.env_prefixs[i]
-            max_reward = np.max(all_rewards[i])
-            max_rewards[prefix].append(max_reward)
-            log_data[prefix + f'sim_max_reward_{seed}'] = max_reward
-
-            # visualize sim
-            video_path = all_video_paths[i]
-            if video_path is not None:
-                sim_video = wandb.Video(video_path)
-                log_data[prefix + f'sim_video_{seed}'] = sim_video
-
-        # log aggregate metrics
-        for prefix, value in max_rewards.items():
-            name = prefix + 'mean_score'
-            value = np.mean(value)
-            log_data[name] = value
-
-        return log_data
-
-
-class AdversarialRobomimicImageRunnerLSTM(RobomimicImageRunner):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-
-    def apply_fgsm_attack(self, obs_dict, policy: BaseImagePolicy, \
-                          cfg, target_means=None):
-        view = cfg.view
-        clip_min = cfg.clip_min
-        clip_max = cfg.clip_max
-
-        if view == 'both':
-            views = ['agentview_image', 'robot0_eye_in_hand_image']
-        elif isinstance(view, list):
-            views = view
-        elif isinstance(view, str):
-            views = [view]
-        else:
-            raise ValueError("view must be a string or a list of strings")
-
-        # check if the input tensors are within the clip range
-        for view in views:
-            assert torch.all(obs_dict[view] >= clip_min) and torch.all(obs_dict[view] <= clip_max), \
-                "Input tensor is not within the clip range"
-
-        # create a copy of the original obs_dict that requires grad for backward pass
-        obs_dict = dict_apply(obs_dict, lambda x: x.clone().detach().requires_grad_(True))
-        policy.zero_grad()
-
-        # create a model prediction as ground truth
-        with torch.no_grad():
-            # action_dict = policy.predict_action(obs_dict)
-            # action = action_dict['action']
-            action_dist = policy.action_dist(obs_dict)
-            means = action_dist.component_distribution.base_dist.loc
-
-        # predicted_action = policy.predict_action(obs_dict)['action']
-        predicted_action_dist = policy.action_dist(obs_dict)
-        # print("ACtion dist: ", action_dist)
-        predicted_means = predicted_action_dist.component_distribution.base_dist.loc
-        # predicted_scales = predicted_action_dist.component_distribution.base_dist.scale
-        # print(predicted_means, predicted_scales, means)
-        # print(predicted_action.grad_fn, action.grad_fn)
-        mse_loss = torch.nn.MSELoss()
-        if not cfg.targeted:
-            loss = mse_loss(predicted_means, target_means)
-            loss.backward()
-        else:
-            loss = mse_loss(predicted_means, target_means)
-            loss = -loss
-            loss.backward()
-        if cfg.log:
-            wandb.log({"Loss": loss.item()})
-        for view in views:
-            # assert obs_dict_copy[view].grad_fn is not None, "Input tensor does not have a grad_fn"
-            grad = torch.sign(obs_dict[view].grad)
-            if target_means is None:
-                obs_dict[view] = obs_dict[view] + optimize_linear(grad, self.epsilon, cfg.norm)
-            else:
-                obs_dict[view] = obs_dict[view] + optimize_linear(grad, cfg.eps_iter, cfg.norm)
-            obs_dict[view] = torch.clamp(obs_dict[view], clip_min, clip_max)
-        # obs_dict['agentview_image'].requires_grad = False
-        return obs_dict
-
-    def apply_pgd_attack(self, obs_dict, policy: BaseImagePolicy, cfg):
-        """
-        Apply projected gradient descent attack from Madry et al. (2017)
-        """
-        view = cfg.view
-        n_iter = cfg.n_iter
-        clip_min = cfg.clip_min
-        clip_max = cfg.clip_max
-        eps_iter = cfg.eps_iter
-        norm = cfg.norm
-        rand_int = cfg.rand_int
-        # check if the input tensors are within the clip range
-        if view == 'both':
-            # make a list of views in the rgb space
-            views = ['agentview_image', 'robot0_eye_in_hand_image']
-            assert torch.all(obs_dict[views[0]] >= clip_min) and torch.all(obs_dict[views[0]] <= clip_max), \
-                "Input tensor is not within the clip range"
-            assert torch.all(obs_dict[views[1]] >= clip_min) and torch.all(obs_dict[views[1]] <= clip_max), \
-                "Input tensor is not within the clip range"
-        else:
-            views = list(str(view))
-            assert torch.all(obs_dict[view] >= clip_min) and torch.all(obs_dict[view] <= clip_max), \
-                "Input tensor is not within the clip range"
-        if rand_int:
-            # randomly initialize the perturbation from a uniform distribution within the epsilon bound
-            for view in views:
-                perturbation = torch.FloatTensor(obs_dict[view].shape).uniform_(-self.epsilon, self.epsilon).to(
-                    policy.device)
-                perturbation = torch.clamp(perturbation, -eps_iter, eps_iter)
-                perturbation = torch.clamp(obs_dict[view] + perturbation, clip_min, clip_max) - obs_dict[view]
-                adv_obs_dict[view] = obs_dict[view] + perturbation
-        with torch.no_grad():
-            clean_action_dist = policy.action_dist(obs_dict)
-            clean_action_means = clean_action_dist.component_distribution.base_dist.loc
-            if cfg.targeted:
-                target_means = clean_action_means.clone().detach() + torch.tensor(cfg.perturbations).unsqueeze(0).to(
-                    policy.device)
-            else:
-                target_means = clean_action_means
-        adv_obs_dict = obs_dict.copy()
-        for i in range(n_iter):
-            policy.zero_grad()
-            adv_obs_dict = self.apply_fgsm_attack(adv_obs_dict, policy, cfg, target_means)
-            for view in views:
-                perturbation = adv_obs_dict[view] - obs_dict[view]
-                if norm == 'l2':
-                    perturbation = perturbation * self.epsilon / torch.norm(perturbation, p=2)
-                elif norm == 'linf':
-                    perturbation = torch.clamp(perturbation, -self.epsilon, self.epsilon)
-                adv_obs_dict[view] = obs_dict[view] + perturbation
-                adv_obs_dict[view] = torch.clamp(adv_obs_dict[view], clip_min, clip_max)
-        return adv_obs_dict
-
-    def apply_noise_attack(self, obs_dict, policy: BaseImagePolicy, cfg):
-        """
-        Applies noise attack to the input image.
-        A basic type of attack to serve as a baseline.
-        """
-        view = cfg.view
-        clip_min = cfg.clip_min
-        clip_max = cfg.clip_max
-        noise_bound = cfg.noise_bound
-        if view == 'both':
-            views = ['agentview_image', 'robot0_eye_in_hand_image']
-        elif isinstance(view, list):
-            views = view
-        elif isinstance(view, str):
-            views = [view]
-        else:
-            raise ValueError("view must be a string or a list of strings")
-        for view in views:
-            noise = torch.FloatTensor(obs_dict[view].shape).uniform_(-noise_bound, noise_bound).to(
-                obs_dict[view].device)
-            obs_dict[view] = obs_dict[view] + noise
-            obs_dict[view] = torch.clamp(obs_dict[view], clip_min, clip_max)
-        return obs_dict
-
-    def run(self, policy: BaseImagePolicy, epsilon: float, cfg):
-        self.epsilon = epsilon
-        device = policy.device
-        dtype = policy.dtype
-        env = self.env
-        attack_type = cfg.attack_type
-
-        # plan for rollout
-        n_envs = len(self.env_fns)
-        n_inits = len(self.env_init_fn_dills)
-        n_chunks = math.ceil(n_inits / n_envs)
-
-        if cfg.view == 'both':
-            views = ['agentview_image', 'robot0_eye_in_hand_image']
-        elif isinstance(cfg.view, list):
-            views = cfg.view
-        elif isinstance(cfg.view, str):
-            views = [cfg.view]
-
-        # allocate data
-        all_video_paths = [None] * n_inits
-        all_rewards = [None] * n_inits
-
-        for chunk_idx in range(n_chunks):
-            start = chunk_idx * n_envs
-            end = min(n_inits, start + n_envs)
-            this_global_slice = slice(start, end)
-            this_n_active_envs = end - start
-            this_local_slice = slice(0, this_n_active_envs)
-
-            this_init_fns = self.env_init_fn_dills[this_global_slice]
-            n_diff = n_envs - len(this_init_fns)
-            if n_diff > 0:
-                this_init_fns.extend([self.env_init_fn_dills[0]] * n_diff)
-            assert len(this_init_fns) == n_envs
-
-            # init envs
-            env.call_each('run_dill_function',
-                          args_list=[(x,) for x in this_init_fns])
-
-            # start rollout
-            obs = env.reset()
-            past_action = None
-            policy.reset()
-
-            env_name = self.env_meta['env_name']
-            pbar = tqdm.tqdm(total=self.max_steps, desc=f"Eval {env_name}Image {chunk_idx + 1}/{n_chunks}",
-                             leave=False, mininterval=self.tqdm_interval_sec)
-
-            done = False
-            while not done:
-                # create obs dict
-                np_obs_dict = dict(obs)
-                if self.past_action and (past_action is not None):
-                    # TODO: not tested
-                    np_obs_dict['past_action'] = past_action[
-                                                 :, -(self.n_obs_steps - 1):].astype(np.float32)
-
-                # device transfer
-                obs_dict = dict_apply(np_obs_dict,
-                                      lambda x: torch.from_numpy(x).to(
-                                          device=device))
-                # device transfer and enable gradients
-                # obs_dict = dict_apply(np_obs_dict,
-                #    lambda x: torch.from_numpy(x).to(device=device).requires_grad_(True))
-                prev_obs_dict = obs_dict
-                with torch.no_grad():
-                    clean_action_dist = policy.action_dist(obs_dict)
-                    clean_action_means = clean_action_dist.component_distribution.base_dist.loc
-                    target_means = clean_action_means
-
-                # apply attack
-                if attack_type == 'fgsm':
-                    obs_dict = self.apply_fgsm_attack(obs_dict, policy, \
-                                                      cfg, target_means)
-                    for view in views:
-                        perturbation = abs(obs_dict[view] - prev_obs_dict[view])
-                        perturbation = perturbation.view(perturbation.shape[0], -1)
-                        # log the maximum perturbation across the batch
-                        perturbation_max = torch.sum(perturbation, dim=1)
-                elif attack_type == 'pgd':
-                    obs_dict = self.apply_pgd_attack(obs_dict, policy, cfg)
-                elif attack_type == 'noise':
-                    obs_dict = self.apply_noise_attack(obs_dict, policy, cfg)
-                elif attack_type == None:
-                    pass
-                else:
-                    raise ValueError("Invalid attack type")
-                # run policy
-                with torch.no_grad():
-                    action_dict = policy.predict_action(obs_dict)
-
-                # device_transfer
-                np_action_dict = dict_apply(action_dict,
-                                            lambda x: x.detach().to('cpu').numpy())
-
-                action = np_action_dict['action']
-                if not np.all(np.isfinite(action)):
-                    print(action)
-                    raise RuntimeError("Nan or Inf action")
-
-                # step env
-                env_action = action
-                if self.abs_action:
-                    env_action = self.undo_transform_action(action)
-
-                obs, reward, done, info = env.step(env_action)
-                done = np.all(done)
-                past_action = action
-                # if cfg.log == True:
-                # log the perturbation for each environment separately
-                # for i in range(len(perturbation_norm)):
-                #     wandb.log({f'perturbation_{view}_{i}': perturbation_norm[i]})
-                # for i in range(len(perturbation_max)):
-                #     wandb.log({f'max_perturbation_{view}_{i}': perturbation_max[i]})
-                # update pbar
-                pbar.update(action.shape[1])
-            pbar.close()
-
-            # collect data for this round
-            all_video_paths[this_global_slice] = env.render()[this_local_slice]
-            all_rewards[this_global_slice] = env.call('get_attr', 'reward')[this_local_slice]
-        # clear out video buffer
-        _ = env.reset()
-
-        # log
-        max_rewards = collections.defaultdict(list)
-        log_data = dict()
-        # results reported in the paper are generated using the commented out line below
-        # which will only report and average metrics from first n_envs initial condition and seeds
-        # fortunately this won't invalidate our conclusion since
-        # 1. This bug only affects the variance of metrics, not their mean
-        # 2. All baseline methods are evaluated using the same code
-        # to completely reproduce reported numbers, uncomment this line:
-        # for i in range(len(self.env_fns)):
-        # and comment out this line
-        for i in range(n_inits):
-            seed = self.env_seeds[i]
-            prefix = self.env_prefixs[i]
-            max_reward = np.max(all_rewards[i])
-            max_rewards[prefix].append(max_reward)
-            log_data[prefix + f'sim_max_reward_{seed}'] = max_reward
-
-            # visualize sim
-            video_path = all_video_paths[i]
-            if video_path is not None:
-                sim_video = wandb.Video(video_path)
-                log_data[prefix + f'sim_video_{seed}'] = sim_video
-
-        # log aggregate metrics
-        for prefix, value in max_rewards.items():
-            name = prefix + 'mean_score'
-            value = np.mean(value)
-            log_data[name] = value
-
-        return log_data
-
-
-class AdversarialRobomimicImageRunnerIBC(RobomimicImageRunner):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.lipschitz_consts = []
-        self.episodes_lipschitz_consts = []
-        self.loss_per_iteration = []
-        self.loss_per_episode = []
-        self.perturbation_per_episode = []
-
-    def apply_fgsm_attack_loss_of_ibc(self, obs_dict_cp, policy: BaseImagePolicy, cfg, actions=None, \
-                                      action_samples=None, clean_actions=None):
-        # use the same loss as the policy
-        view = cfg.view
-        if view == 'both':
-            views = ['agentview_image', 'robot0_eye_in_hand_image']
-        elif isinstance(view, list):
-            views = view
-        elif isinstance(view, str):
-            views = [view]
-        else:
-            raise ValueError("view must be a string or a list of strings")
-
-        # create a copy of the original obs_dict that requires grad for backward pass
-        obs_dict_copy = dict_apply(obs_dict_cp, lambda x: x.clone().detach().requires_grad_(True))
-        # retain the grad on the non-leaf tensor, i.e. the input tensor
-        # for view in views:
-        #     obs_dict_copy[view].retain_grad()
-        policy.zero_grad()
-
-        assert actions is not None, "Actions must be provided for IBC loss"
-        # create a model prediction as ground truth
-        # batch = {}
-        # batch['obs'] = obs_dict_copy
-        # batch['action'] = actions
-        if cfg.targeted:
-            if action_samples is not None:
-                loss, obs_dict_copy, obs_features = policy.compute_loss_with_grad(obs_dict_copy, actions,
-                                                                                  action_samples)
-            else:
-                loss, obs_dict_copy, obs_features = policy.compute_loss_with_grad(obs_dict_copy, actions)
-        else:
-            actions = policy.predict_action(obs_dict_copy, return_energy=True)
-            action = actions['action']
-            energy = actions['energy']
-            loss = -torch.max(energy, dim=1)[0]
-            loss = loss.sum()
-
-        # print(loss.item())
-        self.loss_per_iteration.append(loss.item())
-        # for view in views:
-        #     print("Obs dict copy is leaf? ", obs_dict_copy[view].is_leaf)
-        # print("Loss: ", loss)
-        if cfg.rand_target or cfg.targeted:
-            loss = -loss
-        if cfg.log:
-            wandb.log({"FGSM_Loss": loss.item()})
-        loss.backward()
-        # print("Observation features and its grad ", obs_features, obs_features.grad)
-        prev_obs_dict = obs_dict_cp
-        for view in views:
-            # check if the grad is not None
-            assert obs_dict_copy[view].grad is not None, "Input tensor does not have a grad"
-            # calculate the average value of the grad and store in wandb
-            grad = torch.sign(obs_dict_copy[view].grad)
-            # if obs_dict_copy[view].grad is not None:
-            #     obs_dict_copy[view].grad.zero_()  # Clear gradients for obs_dict to save memory
-            # log the lipschitz constant for the input tensor
-            lip_grad = obs_dict_copy[view].grad.view(obs_dict_copy[view].shape[0], -1)
-            # calculate seperate lipschitz constant for each env in the batch
-            lip_const = torch.norm(lip_grad, p=2, dim=1)
-            if cfg.log:
-                wandb.log({"Lipschitz": lip_const})
-            #  for i in range(len(lip_grad)):
-            #     if cfg.log:
-            #         wandb.log({f'Lipschitz_{view}_{i}': lip_const[i]})
-            # self.lipschitz_consts.append((view, lip_const))
-            # print("Grad: ", grad)
-            # if cfg.attack_type != 'pgd':
-            #     if cfg.rand_target:
-            #         obs_dict_copy[view] = obs_dict_copy[view] - self.epsilon * grad
-            #     else:
-            #         obs_dict_copy[view] = obs_dict_copy[view] + self.epsilon * grad
-            # elif cfg.attack_type == 'pgd':
-            #     if cfg.rand_target:
-            #         obs_dict_copy[view] = obs_dict_copy[view] - cfg.eps_iter * grad
-            #     else:
-            #         obs_dict_copy[view] = obs_dict_copy[view] + cfg.eps_iter * grad
-            # else:
-            #     raise ValueError("Only PGD and FGSM attacks are supported")
-
-            if cfg.attack_type == 'pgd':
-                obs_dict_copy[view] = obs_dict_copy[view] + optimize_linear(grad, cfg.eps_iter, cfg.norm)
-            elif cfg.attack_type == 'fgsm':
-                obs_dict_copy[view] = obs_dict_copy[view] + optimize_linear(grad, self.epsilon, cfg.norm)
-            else:
-                raise ValueError("Only PGD and FGSM attacks are supported")
-            old_obs_dict = obs_dict_copy[view]
-            # print("Grad: ", grad)
-            if (cfg.clip_min is not None) or (cfg.clip_max is not None):
-                if cfg.clip_min is None or cfg.clip_max is None:
-                    raise ValueError(
-                        "One of clip_min and clip_max is None but we don't currently support one-sided clipping"
-                    )
-                obs_dict_copy[view] = torch.clamp(obs_dict_copy[view], cfg.clip_min, cfg.clip_max)
-                # if torch.any(old_obs_dict != obs_dict_copy[view]):
-                # print("Clipping applied")
-            # diff = abs(obs_dict_copy[view] - prev_obs_dict[view])
-            # diff = diff.view(diff.shape[0], -1)
-            # grad = grad.view(grad.shape[0], -1)
-            # log the maximum perturbation across the batch
-            # diff_max = torch.max(diff, dim=1)
-            # grad_max = torch.max(grad, dim=1)
-            # diff_sum = torch.sum(diff, dim=1)
-            # if cfg.log:
-            #    wandb.log({"Sum_Perturbation": diff_sum})
-        return obs_dict_copy
-
-    def apply_fgsm_attack(self, obs_dict, policy: BaseImagePolicy, cfg):
-        view = cfg.view
-        if view == 'both':
-            views = ['agentview_image', 'robot0_eye_in_hand_image']
-        elif isinstance(view, list):
-            views = view
-        elif isinstance(view, str):
-            views = [view]
-        else:
-            raise ValueError("view must be a string or a list of strings")
-        # create a copy of the original obs_dict that requires grad for backward pass
-        obs_dict = dict_apply(obs_dict, lambda x: x.clone().detach().requires_grad_(True))
-        policy.zero_grad()
-
-        # create a model prediction as ground truth
-        with torch.no_grad():
-            # action_dict = policy.predict_action(obs_dict)
-            # action = action_dict['action']
-            action_dist = policy.action_dist(obs_dict)
-            # print("action_dist: ", action_dist.grad_fn)
-            # print("The shape of action dist: ", action_dist.shape)
-            # means = action_dist.component_distribution.base_dist.loc
-
-        # predicted_action = policy.predict_action(obs_dict)['action']
-        predicted_action_dist = policy.action_dist(obs_dict)
-        # print("predicted_action_dist: ", predicted_action_dist)
-        # print("ACtion dist: ", action_dist)
-        # predicted_means = predicted_action_dist.component_distribution.base_dist.loc
-        # predicted_scales = predicted_action_dist.component_distribution.base_dist.scale
-        # print(predicted_means, predicted_scales, means)
-        # print(predicted_action.grad_fn, action.grad_fn)
-        cross_entropy_loss = torch.nn.CrossEntropyLoss()
-        loss = cross_entropy_loss(predicted_action_dist, action_dist)
-        if loss == 0:
-            return obs_dict
-        loss.backward()
-        for view in views:
-            print("Grad: ", obs_dict[view].grad)
-            # check if all the values of the grad are zeros
-            assert torch.all(obs_dict[view].grad == 0), "Input tensor grad are all zeros"
-            grad = torch.sign(obs_dict[view].grad)
-            obs_dict[view] = obs_dict[view] + self.epsilon * grad
-            obs_dict[view] = torch.clamp(obs_dict[view], 0, 1)
-            if obs_dict[view].grad is not None:
-                obs_dict[view].grad.zero_()  # Clear gradients for obs_dict
-        torch.cuda.empty_cache()
-        return obs_dict
-
-    def apply_pgd_attack(self, obs_dict, policy: BaseImagePolicy,
-                         cfg, clean_actions=None):
-        """
-        Apply projected gradient descent attack from Madry et al. (2017)
-        """
-        # self.lipschitz_consts = []
-        self.loss_per_iteration = []
-        self.pertubation_per_iteration = []
-        view = cfg.view
-        num_iter = cfg.num_iter
-        clip_min = cfg.clip_min
-        clip_max = cfg.clip_max
-        norm = cfg.norm
-        rand_int = cfg.rand_int
-        adv_obs_dict = obs_dict
-        B = obs_dict['agentview_image'].shape[0]
-        T_neg = policy.train_n_neg
-        T_a = policy.n_action_steps
-        naction_stats = policy.get_naction_stats()
-        action_samples = torch.distributions.Uniform(
-            low=naction_stats['min'],
-            high=naction_stats['max']
-        ).sample((B, T_neg, T_a)).to(device=obs_dict['agentview_image'].device)
-        # check if the input tensors are within the clip range
-        if view == 'both':
-            # make a list of views in the rgb space
-            views = ['agentview_image', 'robot0_eye_in_hand_image']
-            assert torch.all(obs_dict[views[0]] >= clip_min) and torch.all(obs_dict[views[0]] <= clip_max), \
-                "Input tensor is not within the clip range"
-            assert torch.all(obs_dict[views[1]] >= clip_min) and torch.all(obs_dict[views[1]] <= clip_max), \
-                "Input tensor is not within the clip range"
-        else:
-            views = list(str(view))
-            assert torch.all(obs_dict[view] >= clip_min) and torch.all(obs_dict[view] <= clip_max), \
-                "Input tensor is not within the clip range"
-        # if rand_int:
-        #     # randomly initialize the perturbation from a uniform distribution within the epsilon bound
-        #     for view in views:
-        #         perturbation = torch.FloatTensor(obs_dict[view].shape).uniform_(-self.epsilon, self.epsilon).to(obs_dict[view].device)
-        #         perturbation = torch.clamp(perturbation, -cfg.eps_iter, cfg.eps_iter)
-        #         perturbation = torch.clamp(obs_dict[view] + perturbation, clip_min, clip_max) - obs_dict[view]
-        #         obs_dict[view] = obs_dict[view] + perturbation
-        if cfg.rand_target:
-            target_actions = torch.FloatTensor(obs_dict['agentview_image'].shape[0], \
-                                               self.n_action_steps, cfg.action_space[0]).uniform_(0, 1).to(
-                obs_dict['agentview_image'].device)
-        else:
-            target_actions = policy.predict_action(obs_dict)['action']
-            if clean_actions is None:
-                clean_actions = target_actions
-            if cfg.targeted:
-                # print("Target Action before Perturbation: ", target_actions)
-                target_actions = target_actions + torch.tensor(cfg.perturbations).to(obs_dict['agentview_image'].device)
-            else:
-                target_actions = target_actions
-                # print("Target Action after Perturbation: ", target_actions)
-        # add a dummy action at the beginning to get the shape right while
-        # computing loss but it won't be used in the loss computation
-        action_samples = torch.cat([target_actions.unsqueeze(1), action_samples], dim=1)
-        # replace one of the action with the clean action
-        if cfg.targeted:
-            action_samples[:, 1] = clean_actions
-        target_actions = torch.cat([torch.zeros_like(target_actions[:, 0:1]), target_actions], dim=1)
-        # print("First obs dict: ", adv_obs_dict['agentview_image'])
-        for i in range(num_iter):
-            policy.zero_grad()
-            adv_obs_dict = self.apply_fgsm_attack_loss_of_ibc(adv_obs_dict, policy, cfg, target_actions, action_samples,
-                                                              clean_actions)
-            for view in views:
-                perturbation = adv_obs_dict[view] - obs_dict[view]
-                if norm == 'l2':
-                    perturbation = perturbation * self.epsilon / torch.norm(perturbation, p=2)
-                elif norm == 'linf':
-                    perturbation = torch.clamp(perturbation, -self.epsilon, self.epsilon)
-                adv_obs_dict[view] = obs_dict[view] + perturbation
-                adv_obs_dict[view] = torch.clamp(adv_obs_dict[view], clip_min, clip_max)
-                if cfg.log:
-                    wandb.log({f"L2_norm_{view}": torch.norm(perturbation, p=2)})
-                # if view == 'agentview_image':
-                # perturbation_wrt_original = torch.sum(abs(adv_obs_dict[view].view(adv_obs_dict[view].shape[0], -1).float() - obs_dict[view].view(obs_dict[view].shape[0], -1).float()), dim=1)
-                # print("Perturbation wrt original: ", perturbation_wrt_original)
-                # self.pertubation_per_iteration.append(perturbation_wrt_original)
-            # print mean perturbation
-            # print("Mean perturbation: ", torch.mean(perturbation))
-        return adv_obs_dict
-
-    def apply_noise_attack(self, obs_dict, policy: BaseImagePolicy, cfg):
-        """
-        Applies noise attack to the input image.
-        A basic type of attack to serve as a baseline.
-        """
-        view = cfg.view
-        clip_min = cfg.clip_min
-        clip_max = cfg.clip_max
-        noise_bound = cfg.noise_bound
-        if view == 'both':
-            views = ['agentview_image', 'robot0_eye_in_hand_image']
-        elif isinstance(view, list):
-            views = view
-        elif isinstance(view, str):
-            views = [view]
-        else:
-            raise ValueError("view must be a string or a list of strings")
-        for view in views:
-            noise = torch.FloatTensor(obs_dict[view].shape).uniform_(-noise_bound, noise_bound).to(
-                obs_dict[view].device)
-            obs_dict[view] = obs_dict[view] + noise
-            obs_dict[view] = torch.clamp(obs_dict[view], clip_min, clip_max)
-        return obs_dict
-
-    def run(self, policy: BaseImagePolicy, epsilon: float, cfg):
-        self.epsilon = epsilon
-        device = policy.device
-        dtype = policy.dtype
-        env = self.env
-
-        # plan for rollout
-        n_envs = len(self.env_fns)
-        n_inits = len(self.env_init_fn_dills)
-        n_chunks = math.ceil(n_inits / n_envs)
-        if cfg.view == 'both':
-            views = ['agentview_image', 'robot0_eye_in_hand_image']
-        elif isinstance(cfg.view, list):
-            views = cfg.view
-        elif isinstance(cfg.view, str):
-            views = [cfg.view]
-
-        # allocate data
-        all_video_paths = [None] * n_inits
-        all_rewards = [None] * n_inits
-
-        for chunk_idx in range(n_chunks):
-            start = chunk_idx * n_envs
-            end = min(n_inits, start + n_envs)
-            this_global_slice = slice(start, end)
-            this_n_active_envs = end - start
-            this_local_slice = slice(0, this_n_active_envs)
-
-            this_init_fns = self.env_init_fn_dills[this_global_slice]
-            n_diff = n_envs - len(this_init_fns)
-            if n_diff > 0:
-                this_init_fns.extend([self.env_init_fn_dills[0]] * n_diff)
-            assert len(this_init_fns) == n_envs
-
-            # init envs
-            env.call_each('run_dill_function',
-                          args_list=[(x,) for x in this_init_fns])
-
-            # start rollout
-            obs = env.reset()
-            past_action = None
-            policy.reset()
-
-            env_name = self.env_meta['env_name']
-            pbar = tqdm.tqdm(total=self.max_steps, desc=f"Eval {env_name}Image {chunk_idx + 1}/{n_chunks}",
-                             leave=False, mininterval=self.tqdm_interval_sec)
-
-            done = False
-            average_perturbation = 0
-            perturbed_obs_dicts = []
-            timestep = 0
-            # clean_obs_dicts = []
-
-            while not done:
-                # create obs dict
-                np_obs_dict = dict(obs)
-                if self.past_action and (past_action is not None):
-                    # TODO: not tested
-                    np_obs_dict['past_action'] = past_action[
-                                                 :, -(self.n_obs_steps - 1):].astype(np.float32)
-
-                # device transfer
-                obs_dict = dict_apply(np_obs_dict,
-                                      lambda x: torch.from_numpy(x).to(
-                                          device=device))
-                clean_obs_dict = obs_dict.copy()
-                print(type(obs_dict), obs_dict['agentview_image'].shape)
-
-                # clean_obs_dicts.append(obs_dict)
-                if cfg.rand_target:
-                    target_actions = torch.FloatTensor(obs_dict['agentview_image'].shape[0], \
-                                                       self.n_action_steps, cfg.action_space[0]).uniform_(0, 1).to(
-                        obs_dict['agentview_image'].device)
-                else:
-                    target_actions = policy.predict_action(np_obs_dict)['action']
-                # add a dummy action at the beginning to get the shape right while
-                # computing loss but it won't be used in the loss computation
-                target_actions = torch.cat([torch.zeros_like(target_actions[:, 0:1]), target_actions], dim=1)
-                # print("Target actions: ", target_actions)
-
-                # device transfer and enable gradients
-                # obs_dict = dict_apply(np_obs_dict,
-                #    lambda x: torch.from_numpy(x).to(device=device).requires_grad_(True))
-                # apply attack
-                if cfg.attack_type == 'fgsm':
-                    prev_obs_dict = obs_dict
-                    obs_dict = self.apply_fgsm_attack(obs_dict, policy, cfg)
-                    # log the l2 norm of the perturbation for fgsm attack
-                    for view in views:
-                        perturbation = obs_dict[view] - prev_obs_dict[view]
-                        perturbation = perturbation.view(perturbation.shape[0], -1)
-                        perturbation_norm = torch.norm(perturbation, p=2, dim=1)
-                elif cfg.attack_type == 'fgsm_alt':
-                    prev_obs_dict = obs_dict
-                    obs_dict = self.apply_fgsm_attack_loss_of_ibc(obs_dict, policy, cfg, target_actions)
-                    # log the l2 norm of the perturbation for fgsm attack
-                    for view in views:
-                        perturbation = abs(obs_dict[view] - prev_obs_dict[view])
-                        perturbation = perturbation.view(perturbation.shape[0], -1)
-                        # log the maximum perturbation across the batch
-                        perturbation_max = torch.max(perturbation, dim=1)
-                        perturbation_sum = torch.sum(perturbation, dim=1)
-                elif cfg.attack_type == 'pgd':
-                    prev_obs_dict = obs_dict
-                    clean_action = policy.predict_action(obs_dict, return_energy=True)
-                    clean_actions = clean_action['action']
-                    clean_energy = clean_action['energy']
-                    for _ in range(cfg.num_epochs):
-                        obs_dict = self.apply_pgd_attack(obs_dict, policy, cfg, clean_actions=clean_actions)
-                    # self.episodes_lipschitz_consts.append(self.lipschitz_consts)
-                    # self.loss_per_episode.append(self.loss_per_iteration)
-                    # self.perturbation_per_episode.append(self.pertubation_per_iteration)
-                    # log the l2 norm of the perturbation for pgd attack
-                    # for view in views:
-                    #     perturbation = abs(obs_dict[view] - prev_obs_dict[view])
-                    #     perturbation = perturbation.view(perturbation.shape[0], -1)
-                    #     perturbation_max = torch.max(perturbation, dim=1)
-                    #     perturbation_sum = torch.sum(perturbation, dim=1)
-                elif cfg.attack_type == 'noise':
-                    prev_obs_dict = obs_dict
-                    obs_dict = self.apply_noise_attack(obs_dict, policy, cfg)
-                    # log the l2 norm of the perturbation for noise attack
-                    for view in views:
-                        perturbation = obs_dict[view] - prev_obs_dict[view]
-                        perturbation = perturbation.view(perturbation.shape[0], -1)
-                        perturbation_norm = torch.norm(perturbation, p=2, dim=1)
-                        # take the mean of the perturbation norm
-                elif cfg.attack_type == None:
-                    pass
-                else:
-                    raise ValueError("Invalid attack type")
-
-                # average_perturbation += perturbation_max
-                # if cfg.log == True:
-                # log the perturbation for each environment separately
-                # for i in range(len(perturbation_norm)):
-                #     wandb.log({f'perturbation_{view}_{i}': perturbation_norm[i]})
-                # get the energy of the clean and perturbed images
-                # energy_clean = policy.predict_action(prev_obs_dict, return_energy=True)
-                # energy_perturbed = policy.predict_action(obs_dict, return_energy=True)
-                # print("Energy clean: ", energy_clean['energy'])
-                # print("Shape, Max, min and median of clean energy: ", energy_clean['energy'].shape, torch.max(energy_clean['energy']), torch.min(energy_clean['energy']), torch.median(energy_clean['energy']))
-                # print("Energy perturbed: ", energy_perturbed['energy'])
-                # print("Shape, Max, min and median of perturbed energy: ", energy_clean['energy'].shape, torch.max(energy_perturbed['energy']), torch.min(energy_perturbed['energy']), torch.median(energy_perturbed['energy']))
-                # save the max, min, median, mean and std, and number of actions within max-5
-                # for i in range(len(energy_clean['energy'])):
-                #     wandb.log({f'Energy_clean_max_{i}': torch.max(energy_clean['energy'][i]), \
-                #                 f'Energy_clean_min_{i}': torch.min(energy_clean['energy'][i]), \
-                #                 f'Energy_clean_median_{i}': torch.median(energy_clean['energy'][i]), \
-                #                 f'Energy_clean_mean_{i}': torch.mean(energy_clean['energy'][i]), \
-                #                 f'Energy_clean_std_{i}': torch.std(energy_clean['energy'][i]), \
-                #                 f'Energy_clean_max-5_{i}': torch.sum(energy_clean['energy'][i] > torch.max(energy_clean['energy'][i]) - 5), \
-                #                 f'Energy_perturbed_max_{i}': torch.max(energy_perturbed['energy'][i]), \
-                #                 f'Energy_perturbed_min_{i}': torch.min(energy_perturbed['energy'][i]), \
-                #                 f'Energy_perturbed_median_{i}': torch.median(energy_perturbed['energy'][i]), \
-                #                 f'Energy_perturbed_mean_{i}': torch.mean(energy_perturbed['energy'][i]), \
-                #                 f'Energy_perturbed_std_{i}': torch.std(energy_perturbed['energy'][i]), \
-                #                 f'Energy_perturbed_max-5_{i}': torch.sum(energy_perturbed['energy'][i] > torch.max(energy_perturbed['energy'][i]) - 5)})
-                # for i in range(len(perturbation_max)):
-                #     wandb.log({f'max_perturbation_{view}_{i}': perturbation_max[i], \
-                #                 f'sum_perturbation_{view}_{i}': perturbation_sum[i]})
-
-                # run policy
-                # random_noise_dict = clean_obs_dict.copy()
-                # for view in views:
-                #     random_noise = torch.FloatTensor(obs_dict[view].shape).uniform_(-self.epsilon, self.epsilon).to(obs_dict[view].device)
-                #     random_noise_dict[view] = random_noise_dict[view] + random_noise
-                #     random_noise_dict[view] = torch.clamp(random_noise_dict[view], 0, 1)
-                energy_save_path = f"/teamspace/studios/this_studio/bc_attacks/diffusion_policy/plots/pkl_files/"
-                pickle.dump(obs_dict,
-                            open(f"{energy_save_path}ibc_perturbed_obs_dict_{self.epsilon}_timestep_{timestep}.pkl",
-                                 "wb"))
-                pickle.dump(clean_obs_dict,
-                            open(f"{energy_save_path}ibc_clean_obs_dict_{self.epsilon}_timestep_{timestep}.pkl", "wb"))
-                with torch.no_grad():
-                    action_dict = policy.predict_action(obs_dict, return_energy=True)
-                    clean_dict = policy.predict_action(clean_obs_dict, return_energy=True)
-                    perturbed_energy = action_dict['energy'].detach().to('cpu').numpy()
-                    clean_energy = clean_dict['energy'].detach().to('cpu').numpy()
-                    # random_dict = policy.predict_action(random_noise_dict, return_energy=True)
-                    # print(f"Clean energy {torch.max(clean_energy)}")
-                    # print(f"Perturbed energy {torch.max(action_dict['energy'])}")
-                    # print(f"Random energy {torch.max(random_dict['energy'])}")
-                # perturbed_obs_dicts.append(obs_dict)
-                pickle.dump(clean_energy,
-                            open(f"{energy_save_path}ibc_clean_energy_{self.epsilon}_timestep_{timestep}.pkl", "wb"))
-                pickfle.dump(perturbed_energy,
-                            open(f"{energy_save_path}ibc_perturbed_energy_{self.epsilon}_timestep_{timestep}.pkl",
-                                 "wb"))
-
-                # device_transfer
-                np_action_dict = dict_apply(action_dict,
-                                            lambda x: x.detach().to('cpu').numpy())
-                clean_action_dict = dict_apply(clean_dict,
-                                               lambda x: x.detach().to('cpu').numpy())
-                # random_dict = dict_apply(random_dict,
-                #     lambda x: x.detach().to('cpu').numpy())
-                action = np_action_dict['action']
-                clean_action = clean_action_dict['action']
-                # print('action: ', action)
-                # print('clean_action: ', clean_action)
-                # print('difference: ', action - clean_action)
-                # print('difference random: ', action - random_dict['action'])
-                if cfg.log:
-                    wandb.log({'L2_norm_actions': torch.norm(torch.tensor(action) - torch.tensor(clean_action), p=2)})
-
-                if not np.all(np.isfinite(action)):
-                    print(action)
-                    raise RuntimeError("Nan or Inf action")
-
-                # step env
-                env_action = action
-                if self.abs_action:
-                    env_action = self.undo_transform_action(action)
-
-                obs, reward, done, info = env.step(env_action)
-                done = np.all(done)
-                past_action = action
-                timestep += 1
-
-                # update pbar
-                pbar.update(action.shape[1])
-            pbar.close()
-            # if cfg.log == True:
-            # log the average perturbation for the whole step for
-            # each environment
-            # average_perturbation = average_perturbation / self.max_steps
-            # for i in range(len(average_perturbation)):
-            #    wandb.log({f'average_perturbation_{view}_{i}': average_perturbation[i]})
-            # collect data for this round
-            all_video_paths[this_global_slice] = env.render()[this_local_slice]
-            all_rewards[this_global_slice] = env.call('get_attr', 'reward')[this_local_slice]
-        # clear out video buffer
-        _ = env.reset()
-        # save the obs_dicts as a pickle file
-        # pickle.dump(clean_obs_dicts, open(f"/teamspace/studios/this_studio/bc_attacks/diffusion_policy/plots/clean_obs_dicts_{self.epsilon}_randtar_{cfg.rand_target}_{cfg.norm}.pkl", "wb"))
-        # pickle.dump(perturbed_obs_dicts, open(f"/teamspace/studios/this_studio/bc_attacks/diffusion_policy/plots/pkl_files/target_perturbations/perturbed_obs_dicts_{self.epsilon}_tar_{cfg.target_perturbations}_perturb_{cfg.perturbations[0]}_{cfg.norm}.pkl", "wb"))
-
-        # save the episode  lipschitz constants
-        # pickle.dump(self.episodes_lipschitz_consts, open(f"/teamspace/studios/this_studio/bc_attacks/diffusion_policy/plots/lipschitz_consts_{self.epsilon}_randtar_{cfg.rand_target}_{cfg.norm}.pkl", "wb"))
-        # pickle.dump(self.loss_per_episode, open(f"/teamspace/studios/this_studio/bc_attacks/diffusion_policy/plots/pkl_files/loss_per_episode_{self.epsilon}_tar_{cfg.target_perturbations}_{cfg.norm}_perturb_{cfg.perturbations[0]}_same_action_samples.pkl", "wb"))
-        # pickle.dump(self.perturbation_per_episode, open(f"/teamspace/studios/this_studio/bc_attacks/diffusion_policy/plots/perturbation_per_episode_{self.epsilon}_randtar_{cfg.rand_target}_{cfg.norm}_lr_{cfg.eps_iter}.pkl", "wb"))
-        # log
-        max_rewards = collections.defaultdict(list)
-        log_data = dict()
-        # results reported in the paper are generated using the commented out line below
-        # which will only report and average metrics from first n_envs initial condition and seeds
-        # fortunately this won't invalidate our conclusion since
-        # 1. This bug only affects the variance of metrics, not their mean
-        # 2. All baseline methods are evaluated using the same code
-        # to completely reproduce reported numbers, uncomment this line:
-        # for i in range(len(self.env_fns)):
-        # and comment out this line
-        for i in range(n_inits):
-            seed = self.env_seeds[i]
-            prefix = self.env_prefixs[i]
-            max_reward = np.max(all_rewards[i])
-            max_rewards[prefix].append(max_reward)
-            log_data[prefix + f'sim_max_reward_{seed}'] = max_reward
-
-            # visualize sim
-            video_path = all_video_paths[i]
-            if video_path is not None:
-                sim_video = wandb.Video(video_path)
-                log_data[prefix + f'sim_video_{seed}'] = sim_video
-
-        # log aggregate metrics
-        for prefix, value in max_rewards.items():
-            name = prefix + 'mean_score'
-            value = np.mean(value)
-            log_data[name] = value
-
-        return log_data
-
-
-class AdversarialRobomimicImageRunnerBET(RobomimicImageRunner):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        """
-        The runner class for the adversarial attacks on the BET Policy
-        """
-
-    def apply_fgsm_attack(self, obs_dict, policy: BaseImagePolicy, cfg, target_action=None):
-        """
-        Applys the FGSM attack to the input image
-        """
-        view = cfg.view
-        if view == 'both':
-            views = ['agentview_image', 'robot0_eye_in_hand_image']
-        elif isinstance(view, list):
-            views = view
-        elif isinstance(view, str):
-            views = [view]
-        else:
-            raise ValueError("view must be a string or a list of strings")
-        # create a copy of the original obs_dict that requires grad for backward pass
-        obs_dict = dict_apply(obs_dict, lambda x: x.clone().detach().requires_grad_(True))
-        policy.zero_grad()
-
-        # create a model prediction as ground truth
-        with torch.no_grad():
-            predicted_action = policy.predict_action(obs_dict)['action']
-        # target latent
-        # print(f"Shape of predicted action: {predicted_action.shape} and perturbations: {torch.tensor(cfg.perturbations).shape}")
-        if target_action is None:
-            target_action = predicted_action + torch.tensor(cfg.perturbations).unsqueeze(0).to(
-                obs_dict['agentview_image'].device)
-        # print(f"Prediction Action: {predicted_action} and Target Action: {target_action}")
-        batch = {}
-        batch['obs'] = obs_dict
-        batch['action'] = target_action
-        loss, _ = policy.compute_loss(batch)
-        loss = -loss
-        print("Loss: ", loss.item())
-        loss.backward()
-        for view in views:
-            grad = torch.sign(obs_dict[view].grad)
-            if cfg.attack_type == 'fgsm':
-                obs_dict[view] = obs_dict[view] + self.epsilon * grad
-            elif cfg.attack_type == 'pgd':
-                obs_dict[view] = obs_dict[view] + cfg.eps_iter * grad
-            else:
-                raise ValueError("Only PGD and FGSM attacks are supported")
-            obs_dict[view] = torch.clamp(obs_dict[view], cfg.clip_min, cfg.clip_max)
-            if obs_dict[view].grad is not None:
-                obs_dict[view].grad.zero_()
-
-        return obs_dict
-
-    def apply_pgd_attack(self, obs_dict, policy: BaseImagePolicy, cfg):
-        """
-        Apply projected gradient descent attack from Madry et al. (2017)
-        """
-        view = cfg.view
-        if view == 'both':
-            views = ['agentview_image', 'robot0_eye_in_hand_image']
-        elif isinstance(view, list):
-            views = view
-        elif isinstance(view, str):
-            views = [view]
-        else:
-            raise ValueError("view must be a string or a list of strings")
-        num_iter = cfg.num_iter
-        clip_min = cfg.clip_min
-        clip_max = cfg.clip_max
-        norm = cfg.norm
-
-        adv_obs_dict = obs_dict.copy()
-        with torch.no_grad():
-            predicted_action = policy.predict_action(obs_dict)['action']
-        target_action = predicted_action + torch.tensor(cfg.perturbations).to(obs_dict['agentview_image'].device)
-        for i in range(num_iter):
-            policy.zero_grad()
-            adv_obs_dict = self.apply_fgsm_attack(adv_obs_dict, policy, cfg, target_action)
-            for view in views:
-                perturbation = adv_obs_dict[view] - obs_dict[view]
-                if norm == 'l2':
-                    perturbation = perturbation * self.epsilon / torch.norm(perturbation, p=2)
-                elif norm == 'linf':
-                    perturbation = torch.clamp(perturbation, -self.epsilon, self.epsilon)
-                adv_obs_dict[view] = obs_dict[view] + perturbation
-                adv_obs_dict[view] = torch.clamp(adv_obs_dict[view], clip_min, clip_max)
-        return adv_obs_dict
-
-    def run(self, policy: BaseImagePolicy, epsilon: float, cfg):
-        self.epsilon = epsilon
-        device = policy.device
-        dtype = policy.dtype
-        env = self.env
-
-        # plan for rollout
-        n_envs = len(self.env_fns)
-        n_inits = len(self.env_init_fn_dills)
-        n_chunks = math.ceil(n_inits / n_envs)
-        if cfg.view == 'both':
-            views = ['agentview_image', 'robot0_eye_in_hand_image']
-        elif isinstance(cfg.view, list):
-            views = cfg.view
-        elif isinstance(cfg.view, str):
-            views = [cfg.view]
-
-        # allocate data
-        all_video_paths = [None] * n_inits
-        all_rewards = [None] * n_inits
-
-        for chunk_idx in range(n_chunks):
-            start = chunk_idx * n_envs
-            end = min(n_inits, start + n_envs)
-            this_global_slice = slice(start, end)
-            this_n_active_envs = end - start
-            this_local_slice = slice(0, this_n_active_envs)
-
-            this_init_fns = self.env_init_fn_dills[this_global_slice]
-            n_diff = n_envs - len(this_init_fns)
-            if n_diff > 0:
-                this_init_fns.extend([self.env_init_fn_dills[0]] * n_diff)
-            assert len(this_init_fns) == n_envs
-
-            # init envs
-            env.call_each('run_dill_function',
-                          args_list=[(x,) for x in this_init_fns])
-
-            # start rollout
-            obs = env.reset()
-            past_action = None
-            policy.reset()
-
-            env_name = self.env_meta['env_name']
-            pbar = tqdm.tqdm(total=self.max_steps, desc=f"Eval {env_name}Image {chunk_idx + 1}/{n_chunks}",
-                             leave=False, mininterval=self.tqdm_interval_sec)
-
-            done = False
-            self.step = 0
-            while not done:
-                print(f"Step: {self.step}")
-                # create obs dict
-                np_obs_dict = dict(obs)
-                if self.past_action and (past_action is not None):
-                    # TODO: not tested
-                    np_obs_dict['past_action'] = past_action[
-                                                 :, -(self.n_obs_steps - 1):].astype(np.float32)
-
-                # device transfer
-                obs_dict = dict_apply(np_obs_dict,
-                                      lambda x: torch.from_numpy(x).to(
-                                          device=device))
-                # print(type(obs_dict), obs_dict['agentview_image'].shape)
-
-                # apply attack
-                if cfg.attack_type == 'fgsm':
-                    obs_dict = self.apply_fgsm_attack(obs_dict, policy, cfg)
-                elif cfg.attack_type == 'pgd':
-                    obs_dict = self.apply_pgd_attack(obs_dict, policy, cfg)
-                elif cfg.attack_type == 'noise':
-                    obs_dict = self.apply_noise_attack(obs_dict, policy, cfg)
-                elif cfg.attack_type == None:
-                    pass
-                else:
-                    raise ValueError("Invalid attack type")
-                self.step += 1
-
-
-class AdversarialRobomimicImageRunnerDP(RobomimicImageRunner):
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        """
-        The runner class for the adversarial attacks on the Diffusion Policy
-        """
-
-    def apply_fgsm_attack(self, obs_dict, policy: BaseImagePolicy, cfg, target_action=None):
-        """
-        Applys the FGSM attack to the input image
-        """
-        view = cfg.view
-        if view == 'both':
-            views = ['agentview_image', 'robot0_eye_in_hand_image']
-        elif isinstance(view, list):
-            views = view
-        elif isinstance(view, str):
-            views = [view]
-        else:
-            raise ValueError("view must be a string or a list of strings")
-        # create a copy of the original obs_dict that requires grad for backward pass
-        obs_dict = dict_apply(obs_dict, lambda x: x.clone().detach().requires_grad_(True))
-        policy.zero_grad()
-
-        # create a model prediction as ground truth
-        with torch.no_grad():
-            predicted_action = policy.predict_action(obs_dict)['action']
-        # print(f'Predicted Action shape: {predicted_action.shape}')
-
-        if target_action is None:
-            target_action = predicted_action + torch.tensor(cfg.perturbations).unsqueeze(0).to(
-                obs_dict['agentview_image'].device)
-        batch = {}
-        batch['obs'] = obs_dict
-        batch['action'] = target_action
-        loss = policy.compute_loss(batch)
-        loss = -loss
-        print("Loss: ", loss.item())
-        if cfg.log:
-            wandb.log({"loss": loss.item()})
-        loss.backward()
-        for view in views:
-            grad = torch.sign(obs_dict[view].grad)
-            if cfg.attack_type == 'fgsm':
-                obs_dict[view] = obs_dict[view] + self.epsilon * grad
-            elif cfg.attack_type == 'pgd':
-                obs_dict[view] = obs_dict[view] + cfg.eps_iter * grad
-            else:
-                raise ValueError("Only PGD and FGSM attacks are supported")
-            obs_dict[view] = torch.clamp(obs_dict[view], cfg.clip_min, cfg.clip_max)
-            if obs_dict[view].grad is not None:
-                obs_dict[view].grad.zero_()
-        return obs_dict
-
-    def apply_pgd_attack(self, obs_dict, policy: BaseImagePolicy, cfg):
-        """
-        Apply projected gradient descent attack from Madry et al. (2017)
-        """
-        return policy.pgd_perturbed_obs(obs_dict, cfg)
-
-    def run(self, policy: BaseImagePolicy, epsilon: float, cfg):
-        self.epsilon = epsilon
-        device = policy.device
-        dtype = policy.dtype
-        env = self.env
-
-        # plan for rollout
-        n_envs = len(self.env_fns)
-        n_inits = len(self.env_init_fn_dills)
-        n_chunks = math.ceil(n_inits / n_envs)
-        if cfg.view == 'both':
-            views = ['agentview_image', 'robot0_eye_in_hand_image']
-        elif isinstance(cfg.view, list):
-            views = cfg.view
-        elif isinstance(cfg.view, str):
-            views = [cfg.view]
-
-        # self.observations = []
-        # allocate data
-        all_video_paths = [None] * n_inits
-        all_rewards = [None] * n_inits
-        perturbed_agentview_images = []
-        perturbed_robot0_eye_in_hand_images = []
+        # except:
+        #     obs_encoder = policy.obs_encoder
+        # image_encoder = obs_encoder.obs_nets['robot0_eye_in_hand_image']
+        policy.eval()
+        # set_seed(1024)
+        # one engine for all chunks, adds adversarial_patch to the attacked views
+        views = get_attack_views(cfg.view, both_views=('agentview_image', 'robot0_eye_in_hand_image'))
+        patch_engine = AttackEngine(None, cfg, views=views)
 
         for chunk_idx in range(n_chunks):
             start = chunk_idx * n_envs
@@ -1895,11 +435,10 @@ class AdversarialRobomimicImageRunnerDP(RobomimicImageRunner):
             env_name = self.env_meta['env_name']
             pbar = tqdm.tqdm(total=self.max_steps, desc=f"Eval {env_name}Image {chunk_idx + 1}/{n_chunks}",
                              leave=False, mininterval=self.tqdm_interval_sec)
-
+            # if save_pkl:
+            #     obs_ls=[]
             done = False
-            self.step = 0
             while not done:
-                print(f"Step: {self.step}")
                 # create obs dict
                 np_obs_dict = dict(obs)
                 if self.past_action and (past_action is not None):
@@ -1911,86 +450,137 @@ class AdversarialRobomimicImageRunnerDP(RobomimicImageRunner):
                 obs_dict = dict_apply(np_obs_dict,
                                       lambda x: torch.from_numpy(x).to(
                                           device=device))
-                # self.observations.append(obs_dict)
-                # print(type(obs_dict), obs_dict['agentview_image'].shape)
-                # apply attack
-                prev_obs_dict = obs_dict.copy()
-                if cfg.attack_type == 'fgsm':
-                    obs_dict = self.apply_fgsm_attack(obs_dict, policy, cfg)
-                elif cfg.attack_type == 'pgd':
-                    obs_dict = self.apply_pgd_attack(obs_dict, policy, cfg)
-                elif cfg.attack_type == 'noise':
-                    obs_dict = self.apply_noise_attack(obs_dict, policy, cfg)
-                elif cfg.attack_type == None:
-                    pass
-                else:
-                    raise ValueError("Invalid attack type")
-                self.step += 1
-                # calculate the linf and l2 norm of the perturbation
-                for view in views:
-                    perturbation = abs(obs_dict[view] - prev_obs_dict[view])
-                    if cfg.log:
-                        wandb.log({f'perturbation_{view}_l2': torch.norm(perturbation, p=2), \
-                                   f'perturbation_{view}_linf': torch.norm(perturbation, p=float('inf'))})
-                    # print(f"Norm of perturbation_{view}: ", torch.norm(perturbation, p=2), torch.norm(perturbation, p=float('inf')))
-                perturbed_agentview_images.append(obs_dict['agentview_image'][1][1])
-                perturbed_robot0_eye_in_hand_images.append(obs_dict['robot0_eye_in_hand_image'][1][1])
+                # print(f"Min and Max of obs_dict: {torch.min(obs_dict['robot0_eye_in_hand_image'])}, {torch.max(obs_dict['robot0_eye_in_hand_image'])}")
+                clean_obs_dict = obs_dict.copy()
+                random_obs_dict = obs_dict.copy()
+                if adversarial_patch is not None:
+                    obs_dict = patch_engine.patch(obs_dict, adversarial_patch)
+                    # maximum_perturbation = torch.max(torch.abs(adversarial_patch))
+                    # random_perturbation = torch.rand_like(obs_dict[cfg.view]) * 2 * maximum_perturbation - maximum_perturbation
+                    # random_obs_dict[cfg.view] = random_obs_dict[cfg.view] + random_perturbation
+                obs_dict = dict_apply(obs_dict, lambda x: x.to(device=device))
+                # run policy
                 with torch.no_grad():
-                    action = policy.predict_action(obs_dict)['action']
-                # device transfer
-                np_action = action.detach().to('cpu').numpy()
+                    # calculate the l2 distance clean and obs_dict
+                    clean_action_dict = policy.predict_action(clean_obs_dict)
+                    action_dict = policy.predict_action(obs_dict)
+                    # clean_output = policy.predict_action(clean_obs_dict, return_latent=True)['output']
+                    # output = policy.predict_action(obs_dict, return_latent=True)['output']
+                    # latents = policy.predict_action(obs_dict, return_latent=True)
+                    # clean_latents = policy.predict_action(clean_obs_dict, return_latent=True)
+                    # # print("L2 distance between clean and adversarial output: ", torch.norm(clean_output - output, p=2) / output.shape[0])
+                    # print(latents['latent'])
+                    # print(clean_latents['latent'])
+                    # print("L2 distance between clean and adversarial latents: ", torch.norm(clean_latents['latent'][0].float() - latents['latent'][0].float(), p=2) / latents['latent'][0].shape[0])
+                    # random_action_dict = policy.predict_action(random_obs_dict)
+                '''uncommenting for TH'''
+                observations.add(obs_dict['robot0_eye_in_hand_image'][vis_envs][:, -1])
+                # device_transfer
+                try:
+                    np_action_dict = dict_apply(action_dict,
+                                                lambda x: x.detach().to('cpu').numpy())
+                    # np_clean_action_dict = dict_apply(clean_action_dict,
+                    #     lambda x: x.detach().to('cpu').numpy())
+                    # np_random_action_dict = dict_apply(random_action_dict,
+                    #     lambda x: x.detach().to('cpu').numpy())
+                    action = np_action_dict['action']
+                    # clean_actions = np_clean_action_dict['action']
+                    # random_actions = np_random_action_dict['action']
+                except AttributeError:
+                    action = action_dict['action'].detach().to('cpu').numpy()
+                # l1 distance between actions and clean actions before perturbation
+                # for i in range(action.shape[-1]):
+                #     print(f"l1_distance_{i}: {torch.norm(action_dict['action'][:,:,i] - clean_action_dict['action'][:,:,i], p=1) / action.shape[0]}")
+                if cfg.targeted and cfg.log:
+                    pass
+                    #COMMENTED FOR IBC
+                    # try:
+                    #     # log the l1 distance between the predicted action and the target action per environment
+                    #     target_action = clean_action_dict['action'].to('cpu') + adversarial_patch['perturbations'].to(
+                    #         'cpu')
+                    #     for i in range(target_action.shape[-1]):
+                    #         wandb.log({f"l1_distance_{i}": torch.norm(
+                    #             action_dict['action'][:, :, i].to('cpu') - target_action[:, :, i], p=1) /
+                    #                                        target_action.shape[0]})
+                    # except KeyError:
+                    #     pass
+                # features = np_action_dict['features']
+                # clean_features = np_clean_action_dict['features']
+                # random_features = np_random_action_dict['features']
+                # features = np.mean(features, axis=0)
+                # actions = np.mean(action, axis=0)
+                # clean_actions = np.mean(clean_actions, axis=0)
+                # clean_features = np.mean(clean_features, axis=0)
+                # random_features = np.mean(random_features, axis=0)
+                # random_actions = np.mean(random_actions, axis=0)
+                # l2 distance between features
+                # diff = np.linalg.norm(features - clean_features)
+                # diff_actions = np.linalg.norm(actions - clean_actions)
+                # diff_random = np.linalg.norm(random_features - clean_features)
+                # diff_random_actions = np.linalg.norm(random_actions - clean_actions)
+                # print(f"Diff: {diff}, Random Diff: {diff_random}")
+                # print(f"Diff Actions: {diff_actions}, Random Diff Actions: {diff_random_actions}")
+                # if cfg.log:
+                #     wandb.log({"Diff": diff, "Random Diff": diff_random,
+                #                 "Diff Actions": diff_actions, "Random Diff Actions": diff_random_actions})
+                if not np.all(np.isfinite(action)):
+                    print(action)
+                    raise RuntimeError("Nan or Inf action")
+
                 # step env
-                env_action = np_action
+                env_action = action
                 if self.abs_action:
-                    env_action = self.undo_transform_action(np_action)
+                    env_action = self.undo_transform_action(action)
+
+
                 obs, reward, done, info = env.step(env_action)
+                # obs_ls.append(obs)
                 done = np.all(done)
-                past_action = np_action
-
+                past_action = action
                 # update pbar
                 pbar.update(action.shape[1])
-            # collect data for this round
-            all_video_paths[this_global_slice] = env.render()[this_local_slice]
-            all_rewards[this_global_slice] = env.call('get_attr', 'reward')[this_local_slice]
             pbar.close()
-            # log the
-
-        def visualize(observations1, observations2, file_name, every_frame=2):
-            # only get alternate frames to reduce the processing time
-            print(f"Shape of observations1: {observations1[0].shape}")
-            print(f"Shape of observations2: {observations2[0].shape}")
-            observations1 = observations1[::every_frame]
-            observations2 = observations2[::every_frame]
-            im = []
-            for i in range(len(observations1)):
-                agentview_image1 = observations1[i].cpu().detach().numpy()
-                agentview_image1 = np.transpose(agentview_image1, (1, 2, 0))
-
-                agentview_image2 = observations2[i].cpu().detach().numpy()
-                agentview_image2 = np.transpose(agentview_image2, (1, 2, 0))
-
-                combined_image = np.hstack((agentview_image1, agentview_image2))
-                im.append(combined_image)
-
-            fig, ax = plt.subplots()
-            ims = []
-            for i in range(len(im)):
-                im_obj = ax.imshow(im[i], animated=True)
-                ims.append([im_obj])
-                ax.axis('off')
-
-            ani = ArtistAnimation(fig, ims, interval=100, blit=True)
-            ani.save(file_name, writer='pillow', fps=10)
-
-        # visualize the perturbed images
-        filename = "//home/ak/Documents/Adversarial_diffusion_policy/diffusion_policy/plots/videos/diffusion_policy_perturbations/pgd_perturbations.gif"
-        visualize(perturbed_agentview_images, perturbed_robot0_eye_in_hand_images, filename, every_frame=2)
 
+            # collect data for this round, padding envs are dropped
+            videos = env.render()
+            all_video_paths[this_global_slice] = [
+                self.submit_video(x) for x in videos[this_local_slice]]
+            self.discard_videos(videos[this_n_active_envs:])
+            all_rewards[this_global_slice] = env.call('get_attr', 'reward')[this_local_slice]
         # clear out video buffer
         _ = env.reset()
+        self.update_init_state_cache()
+        self.wait_videos()
+        # log
         max_rewards = collections.defaultdict(list)
         log_data = dict()
-        print("All rewards: ", all_rewards)
+        # visualize the video and save to wandb
+        if cfg.save_video and cfg.log:
+            # gifs are encoded in the background encoder process
+            vis_paths = list()
+            for i in range(cfg.n_vis):
+                frames = observations.stream(i)
+                save_path = Path(cfg.patch_path).parent
+                save_path = save_path.joinpath(f'{cfg.exp_name}_vis_{i}.gif')
+                print(f"Saving video to {save_path}")
+
+                if os.path.exists(save_path):
+                    os.remove(save_path)
+                vis_paths.append(self.get_video_encoder().submit_frames(
+                    str(save_path), frames, fps=10))
+            self.wait_videos()
+            for i, save_path in enumerate(vis_paths):
+                wandb.log({f'{cfg.exp_name}_vis_{i}': wandb.Image(save_path)})
+        observations.close()
+
+        # results reported in the paper are generated using the commented out line below
+        # which will only report and average metrics from first n_envs initial condition and seeds
+        # fortunately this won't invalidate our conclusion since
+        # 1. This bug only affects the variance of metrics, not their mean
+        # 2. All baseline methods are evaluated using the same code
+        # to completely reproduce reported numbers, uncomment this line:
+        # for i in range(len(self.env_fns)):
+        # # and comment out this line
         for i in range(n_inits):
             seed = self.env_seeds[i]
             prefix = self.env_prefixs[i]
@@ -1998,144 +588,183 @@ class AdversarialRobomimicImageRunnerDP(RobomimicImageRunner):
             max_rewards[prefix].append(max_reward)
             log_data[prefix + f'sim_max_reward_{seed}'] = max_reward
 
-            # visualize sim
-            video_path = all_video_paths[i]
-            if video_path is not None:
-                sim_video = wandb.Video(video_path)
-                log_data[prefix + f'sim_video_{seed}'] = sim_video
+        #     # visualize sim
+        #     video_path = all_video_paths[i]
+        #     if video_path is not None:
+        #         sim_video = wandb.Video(video_path)
+        #         log_data[prefix+f'sim_video_{seed}'] = sim_video
 
         # log aggregate metrics
         for prefix, value in max_rewards.items():
             name = prefix + 'mean_score'
             value = np.mean(value)
             log_data[name] = value
-        # save the observation dicts as a pickle file
-        # pickle.dump(self.observations, open(f"/teamspace/studios/this_studio/bc_attacks/diffusion_policy/plots/pkl_files/diffusion_policy_observed_dicts.pkl", "wb"))
+        # save_pkl_dir='/home/ak/Documents/Adversarial_diffusion_policy/pre_trained_checkpoints/square/'
+        # pickle.dump(obs_ls, save_pkl_dir.joinpath('square_obs.pkl').open('wb'))
+
         return log_data
 
+    def undo_transform_action(self, action):
+        raw_shape = action.shape
+        if raw_shape[-1] == 20:
+            # dual arm
+            action = action.reshape(-1, 2, 10)
+
+        d_rot = action.shape[-1] - 4
+        pos = action[..., :3]
+        rot = action[..., 3:3 + d_rot]
+        gripper = action[..., [-1]]
+        rot = self.rotation_transformer.inverse(rot)
+        uaction = np.concatenate([
+            pos, rot, gripper
+        ], axis=-1)
+
+        if raw_shape[-1] == 20:
+            # dual arm
+            uaction = uaction.reshape(*raw_shape[:-1], 14)
+
+        return uaction
+
+
+class AdversarialRobomimicImageRunner(RobomimicImageRunner):
+    """
+    Rollouts under a per-step adversarial attack on the image observations.
+    Subclasses only choose the loss adapter of their policy family, the
+    attacks themselves live in diffusion_policy.adversarial_attacks.attack_engine.
+    """
+    loss_adapter_cls = ActionMSELoss
 
-class AdversarialRobomimicImageRunnerBET(RobomimicImageRunner):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+
+    def get_attack_engine(self, cfg, epsilon=None):
+        return AttackEngine(self.loss_adapter_cls(cfg), cfg, epsilon=epsilon)
+
+    def infer(self, policy: BaseImagePolicy, engine: AttackEngine, obs, cfg, past_action=None,
+            vis_fn=None):
         """
-        The runner class for the adversarial attacks on the BET Policy
+        Attack and policy on a batch of env obs (numpy, or torch tensors
+        already on the device), returns (action, env_action).
+        vis_fn(clean_obs_dict, obs_dict) sees the obs before and after the attack.
         """
-
-    def apply_fgsm_attack(self, obs_dict, policy: BaseImagePolicy, cfg, predicted_action=None):
+        device = policy.device
+        # create obs dict
+        np_obs_dict = dict(obs)
+        if self.past_action and (past_action is not None):
+            # TODO: not tested
+            np_obs_dict['past_action'] = past_action[
+                                         :, -(self.n_obs_steps - 1):].astype(np.float32)
+
+        # device transfer
+        obs_dict = dict_apply(np_obs_dict,
+                              lambda x: x if torch.is_tensor(x) else torch.from_numpy(x).to(
+                                  device=device))
+
+        # apply attack, batched over all envs and views
+        clean_obs_dict = obs_dict
+        obs_dict, attack_step = engine.attack_step(policy, obs_dict)
+        if vis_fn is not None:
+            vis_fn(clean_obs_dict, obs_dict)
+
+        # run policy, the clean prediction is reused when the obs is unchanged
+        action = engine.predict_action(policy, obs_dict, attack_step)['action']
+        telemetry = engine.telemetry
+        if telemetry.enabled:
+            for view in engine.views:
+                telemetry.record_perturbation(f'perturbation_{view}',
+                    obs_dict[view] - clean_obs_dict[view])
+            if attack_step.clean is not None and 'action' in attack_step.clean:
+                action_diff = action - attack_step.clean['action']
+                telemetry.record('action_l2', torch.linalg.vector_norm(
+                    action_diff.reshape(action_diff.shape[0], -1), ord=2, dim=1))
+
+        # device_transfer
+        action = action.detach().to('cpu').numpy()
+        if not np.all(np.isfinite(action)):
+            print(action)
+            raise RuntimeError("Nan or Inf action")
+
+        env_action = action
+        if self.abs_action:
+            env_action = self.undo_transform_action(action)
+        return action, env_action
+
+    def perturbation_writer(self, engine: AttackEngine, epsilons, cfg):
         """
-        Applies the FGSM attack to the input image
+        Streams clean | perturbed views of the first env when cfg.save_video,
+        every cfg.video_stride-th step.
         """
-        view = cfg.view
-        if view == 'both':
-            views = ['agentview_image', 'robot0_eye_in_hand_image']
-        elif isinstance(view, list):
-            views = view
-        elif isinstance(view, str):
-            views = [view]
-        else:
-            raise ValueError("view must be a string or a list of strings")
-        # create a copy of the original dict that requires grad for backward pass
-        obs_dict = dict_apply(obs_dict, lambda x: x.clone().detach().requires_grad_(True))
-        policy.zero_grad()
-        if predicted_action == None:
-            with torch.no_grad():
-                predicted_action = policy.predict_action(obs_dict)['action']
-        batch = {}
-        batch['obs'] = obs_dict
-        batch['action'] = predicted_action
-        loss, _ = policy.compute_loss(batch)
-        if cfg.targeted:
-            loss = -loss
-        loss.backward()
-        if cfg.log:
-            wandb.log({"loss": loss.item()})
-        for view in views:
-            grad = torch.sign(obs_dict[view].grad)
-            # log the gradient norm for each view
-            if cfg.log:
-                wandb.log({f'grad_{view}': torch.norm(obs_dict[view].grad, p=2)})
-            if cfg.eps_iter != 'None':
-                obs_dict[view] = obs_dict[view] + cfg.eps_iter * grad
-            else:
-                obs_dict[view] = obs_dict[view] + cfg.epsilon * grad
-            obs_dict[view] = torch.clamp(obs_dict[view], cfg.clip_min, cfg.clip_max)
-            if obs_dict[view].grad is not None:
-                obs_dict[view].grad.zero_()
-        return obs_dict
-
-    def apply_pgd_attack(self, obs_dict, policy: BaseImagePolicy, cfg):
+        if not cfg.get('save_video', False):
+            return None, None
+        eps_name = '_'.join(f'{float(x):g}' for x in epsilons)
+        file_path = os.path.join(self.output_dir, 'media',
+            f"perturbations_{cfg.get('attack_type', 'attack')}_eps_{eps_name}.{cfg.get('video_format', 'gif')}")
+        writer = MediaWriter(file_path, fps=self.fps, stride=cfg.get('video_stride', 2), gap=2)
+        def vis_fn(clean_obs_dict, obs_dict):
+            images = list()
+            for view in engine.views:
+                # latest obs step of env 0
+                images.extend([clean_obs_dict[view][0, -1], obs_dict[view][0, -1]])
+            writer.write(*images)
+        return writer, vis_fn
+
+    def run_backfill(self, policy: BaseImagePolicy, engine: AttackEngine, slots, epsilons, cfg,
+            rollout: BackfillRollout):
         """
-        Apply projected gradient descent attack from Madry et al. (2017)
+        Finished envs leave the batch and take over the next pending slot.
         """
-        view = cfg.view
-        if view == 'both':
-            views = ['agentview_image', 'robot0_eye_in_hand_image']
-        elif isinstance(view, list):
-            views = view
-        elif isinstance(view, str):
-            views = [view]
-        else:
-            raise ValueError("view must be a string or a list of strings")
-        num_iter = cfg.num_iter
-        clip_min = cfg.clip_min
-        clip_max = cfg.clip_max
-        norm = cfg.norm
-
-        adv_obs_dict = obs_dict.copy()
-        with torch.no_grad():
-            predicted_action = policy.predict_action(obs_dict)['action']
-            if cfg.targeted:
-                predicted_action = predicted_action + torch.tensor(cfg.perturbations).to(
-                    obs_dict['agentview_image'].device)
-        for i in range(num_iter):
-            policy.zero_grad()
-            adv_obs_dict = self.apply_fgsm_attack(adv_obs_dict, policy, cfg, predicted_action)
-            for view in views:
-                perturbation = adv_obs_dict[view] - obs_dict[view]
-                if norm == 'l2':
-                    perturbation = perturbation * self.epsilon / torch.norm(perturbation, p=2)
-                elif norm == 'linf':
-                    perturbation = torch.clamp(perturbation, -self.epsilon, self.epsilon)
-                adv_obs_dict[view] = obs_dict[view] + perturbation
-                adv_obs_dict[view] = torch.clamp(adv_obs_dict[view], clip_min, clip_max)
-        return adv_obs_dict
-
-    def run(self, policy: BaseImagePolicy, epsilon: float, cfg):
-        self.epsilon = epsilon
+        stacked = len(epsilons) > 1
+        slot_epsilons = torch.tensor([epsilons[k] for _, k in slots], device=policy.device)
+        def infer(env_indices, slot_indices, obs):
+            if stacked:
+                engine.set_epsilon(slot_epsilons[slot_indices])
+            return self.infer(policy, engine, obs, cfg)[1]
+
+        policy.reset()
+        env_name = self.env_meta['env_name']
+        pbar = tqdm.tqdm(total=len(slots), desc=f"Eval {env_name}Image",
+                         leave=False, mininterval=self.tqdm_interval_sec)
+        all_video_paths, all_rewards = rollout.run(
+            [self.env_init_fn_dills[i] for i, _ in slots], infer, progress_fn=pbar.update)
+        pbar.close()
+        return all_video_paths, all_rewards
+
+    def run_chunks(self, policy: BaseImagePolicy, engine: AttackEngine, slots, epsilons, cfg,
+            rollout: PipelinedRollout = None):
+        """
+        Slots run in chunks of n_envs, the last chunk is padded.
+        """
+        stacked = len(epsilons) > 1
         device = policy.device
-        dtype = policy.dtype
         env = self.env
-
-        # plan for rollout
         n_envs = len(self.env_fns)
-        n_inits = len(self.env_init_fn_dills)
-        n_chunks = math.ceil(n_inits / n_envs)
-        if cfg.view == 'both':
-            views = ['agentview_image', 'robot0_eye_in_hand_image']
-        elif isinstance(cfg.view, list):
-            views = cfg.view
-        elif isinstance(cfg.view, str):
-            views = [cfg.view]
-
-        # self.observations = []
+        n_slots = len(slots)
+        n_chunks = math.ceil(n_slots / n_envs)
+        env_name = self.env_meta['env_name']
+        obs_transport = self.get_obs_transport(device)
+        vis_writer, vis_fn = self.perturbation_writer(engine, epsilons, cfg)
+
         # allocate data
-        all_video_paths = [None] * n_inits
-        all_rewards = [None] * n_inits
-        perturbed_agentview_images = []
-        perturbed_robot0_eye_in_hand_images = []
+        all_video_paths = [None] * n_slots
+        all_rewards = [None] * n_slots
 
         for chunk_idx in range(n_chunks):
             start = chunk_idx * n_envs
-            end = min(n_inits, start + n_envs)
+            end = min(n_slots, start + n_envs)
             this_global_slice = slice(start, end)
             this_n_active_envs = end - start
             this_local_slice = slice(0, this_n_active_envs)
 
-            this_init_fns = self.env_init_fn_dills[this_global_slice]
+            this_slots = slots[this_global_slice]
+            this_init_fns = [self.env_init_fn_dills[i] for i, _ in this_slots]
             n_diff = n_envs - len(this_init_fns)
             if n_diff > 0:
                 this_init_fns.extend([self.env_init_fn_dills[0]] * n_diff)
             assert len(this_init_fns) == n_envs
+            if stacked:
+                # padding envs reuse the first budget, their results are dropped
+                this_epsilons = [epsilons[k] for _, k in this_slots] + [epsilons[0]] * n_diff
+                epsilon_tensor = torch.tensor(this_epsilons, device=device)
 
             # init envs
             env.call_each('run_dill_function',
@@ -2143,93 +772,109 @@ class AdversarialRobomimicImageRunnerBET(RobomimicImageRunner):
 
             # start rollout
             obs = env.reset()
-            past_action = None
             policy.reset()
 
-            env_name = self.env_meta['env_name']
             pbar = tqdm.tqdm(total=self.max_steps, desc=f"Eval {env_name}Image {chunk_idx + 1}/{n_chunks}",
                              leave=False, mininterval=self.tqdm_interval_sec)
 
-            done = False
-            self.step = 0
-            while not done:
-                # create obs dict
-                np_obs_dict = dict(obs)
-                if self.past_action and (past_action is not None):
-                    # TODO: not tested
-                    np_obs_dict['past_action'] = past_action[
-                                                 :, -(self.n_obs_steps - 1):].astype(np.float32)
+            past_actions = dict()
+            def infer(group_idx, indices, obs):
+                if obs_transport is not None:
+                    obs = obs_transport(indices)
+                if stacked:
+                    engine.set_epsilon(epsilon_tensor[indices])
+                this_vis_fn = vis_fn if (chunk_idx == 0 and indices[0] == 0) else None
+                action, env_action = self.infer(policy, engine, obs, cfg,
+                    past_action=past_actions.get(group_idx), vis_fn=this_vis_fn)
+                past_actions[group_idx] = action
+                # update pbar
+                if group_idx == 0:
+                    pbar.update(action.shape[1])
+                return env_action
 
-                # device transfer
-                obs_dict = dict_apply(np_obs_dict,
-                                      lambda x: torch.from_numpy(x).to(
-                                          device=device))
-                # self.observations.append(obs_dict)
-                # print(type(obs_dict), obs_dict['agentview_image'].shape)
-                # apply attack
-                prev_obs_dict = obs_dict.copy()
-                if cfg.attack_type == 'fgsm':
-                    if cfg.targeted:
-                        with torch.no_grad():
-                            predicted_action = policy.predict_action(obs_dict)['action']
-                            predicted_action = predicted_action + torch.tensor(cfg.perturbations).to(
-                                obs_dict['agentview_image'].device)
-                        obs_dict = self.apply_fgsm_attack(obs_dict, policy, cfg, predicted_action)
-                    else:
-                        obs_dict = self.apply_fgsm_attack(obs_dict, policy, cfg)
-                elif cfg.attack_type == 'pgd':
-                    obs_dict = self.apply_pgd_attack(obs_dict, policy, cfg)
-                elif cfg.attack_type == 'noise':
-                    obs_dict = self.apply_noise_attack(obs_dict, policy, cfg)
-                elif cfg.attack_type == None:
-                    pass
-                else:
-                    raise ValueError("Invalid attack type")
-                self.step += 1
-                # calculate the linf and l2 norm of the perturbation
-                for view in views:
-                    perturbation = abs(obs_dict[view] - prev_obs_dict[view])
-                    if cfg.log:
-                        wandb.log({f'perturbation_{view}_l2': torch.norm(perturbation, p=2), \
-                                   f'perturbation_{view}_linf': torch.norm(perturbation, p=float('inf'))})
-                    # print(f"Norm of perturbation_{view}: ", torch.norm(perturbation, p=2), torch.norm(perturbation, p=float('inf')))
-                # perturbed_agentview_images.append(obs_dict['agentview_image'][1][0])
-                # perturbed_robot0_eye_in_hand_images.append(obs_dict['robot0_eye_in_hand_image'][1][1])
-                with torch.no_grad():
-                    action = policy.predict_action(obs_dict)['action']
-                # device transfer
-                np_action = action.detach().to('cpu').numpy()
-                # step env
-                env_action = np_action
-                if self.abs_action:
-                    env_action = self.undo_transform_action(np_action)
-                obs, reward, done, info = env.step(env_action)
-                done = np.all(done)
-                past_action = np_action
+            if rollout is not None:
+                rollout.run(obs, infer)
+            else:
+                all_envs = np.arange(n_envs)
+                done = False
+                while not done:
+                    # step env
+                    obs, reward, done, info = env.step(infer(0, all_envs, obs))
+                    done = np.all(done)
+            pbar.close()
 
-                # update pbar
-                pbar.update(action.shape[1])
-            # collect data for this round
-            all_video_paths[this_global_slice] = env.render()[this_local_slice]
+            # collect data for this round, padding envs are dropped
+            videos = env.render()
+            all_video_paths[this_global_slice] = [
+                self.submit_video(x) for x in videos[this_local_slice]]
+            self.discard_videos(videos[this_n_active_envs:])
             all_rewards[this_global_slice] = env.call('get_attr', 'reward')[this_local_slice]
-            pbar.close()
+            engine.telemetry.end_episode()
+            if chunk_idx == 0 and vis_writer is not None:
+                self.perturbation_video = vis_writer.close()
+        return all_video_paths, all_rewards
+
+    def run(self, policy: BaseImagePolicy, epsilon, cfg):
+        """
+        epsilon: a float, or a list of K budgets. With K budgets every init
+        state is replicated K times inside the env batch, each replica is
+        attacked with its own budget, and the metrics of budget e are
+        returned under stacked_log_prefix(e).
+        """
+        stacked = hasattr(epsilon, '__len__')
+        epsilons = [float(x) for x in epsilon] if stacked else [epsilon]
+        self.epsilon = epsilon
+        self.perturbation_video = None
+        env = self.env
+        engine = self.get_attack_engine(cfg, epsilons[0])
 
+        # plan for rollout, one slot per (init state, epsilon)
+        n_inits = len(self.env_init_fn_dills)
+        slots = [(i, k) for i in range(n_inits) for k in range(len(epsilons))]
+
+        # batch stateful policies need the whole env batch in every call,
+        # so they can neither be pipelined nor run on the live envs only
+        scheduled = self.early_exit or self.work_stealing
+        if (scheduled or self.pipeline_groups > 1) and policy.batch_stateful:
+            print(f"{type(policy).__name__} keeps per env state, rollout runs on the full env batch")
+        if scheduled and not policy.batch_stateful:
+            if self.past_action:
+                raise ValueError("early_exit and work_stealing do not support past_action")
+            success_reward = 1.0 if self.early_exit else None
+            if self.work_stealing:
+                rollout = WorkStealingRollout(env, success_reward=success_reward,
+                    video_fn=self.submit_video,
+                    min_batch=math.ceil(len(self.env_fns) / self.pipeline_groups))
+            else:
+                rollout = BackfillRollout(env, success_reward=success_reward,
+                    video_fn=self.submit_video)
+            all_video_paths, all_rewards = self.run_backfill(
+                policy, engine, slots, epsilons, cfg, rollout)
+        else:
+            rollout = None
+            if self.pipeline_groups > 1 and not policy.batch_stateful:
+                rollout = PipelinedRollout(env, self.pipeline_groups)
+            all_video_paths, all_rewards = self.run_chunks(
+                policy, engine, slots, epsilons, cfg, rollout=rollout)
         # clear out video buffer
         _ = env.reset()
+        self.update_init_state_cache()
+        self.wait_videos()
 
-        # log
+        # log, split per epsilon when stacked
         max_rewards = collections.defaultdict(list)
         log_data = dict()
-
-        for i in range(n_inits):
+        for slot_idx, (i, k) in enumerate(slots):
             seed = self.env_seeds[i]
             prefix = self.env_prefixs[i]
-            max_reward = np.max(all_rewards[i])
+            if stacked:
+                prefix = stacked_log_prefix(epsilons[k]) + prefix
+            max_reward = np.max(all_rewards[slot_idx])
             max_rewards[prefix].append(max_reward)
             log_data[prefix + f'sim_max_reward_{seed}'] = max_reward
 
             # visualize sim
-            video_path = all_video_paths[i]
+            video_path = all_video_paths[slot_idx]
             if video_path is not None:
                 sim_video = wandb.Video(video_path)
                 log_data[prefix + f'sim_video_{seed}'] = sim_video
@@ -2240,8 +885,43 @@ class AdversarialRobomimicImageRunnerBET(RobomimicImageRunner):
             value = np.mean(value)
             log_data[name] = value
 
+        # attack cost/strength stats, e.g. of the DP attack schedule
+        log_data.update(engine.loss_adapter.summary())
+        # flushes the telemetry still on the device
+        log_data.update(engine.telemetry.summary())
+        if self.perturbation_video is not None:
+            log_data['perturbation_video'] = wandb.Video(self.perturbation_video)
         return log_data
 
+
+class AdversarialRobomimicImageRunnerLSTM(AdversarialRobomimicImageRunner):
+    """
+    Attacks the GMM component means of BC-RNN (LSTM-GMM) policies.
+    """
+    loss_adapter_cls = GMMMeanLoss
+
+
+class AdversarialRobomimicImageRunnerIBC(AdversarialRobomimicImageRunner):
+    """
+    Attacks the energy landscape of IBC policies.
+    """
+    loss_adapter_cls = IBCEnergyLoss
+
+
+class AdversarialRobomimicImageRunnerDP(AdversarialRobomimicImageRunner):
+    """
+    The runner class for the adversarial attacks on the Diffusion Policy
+    """
+    loss_adapter_cls = DiffusionPolicyLoss
+
+
+class AdversarialRobomimicImageRunnerBET(AdversarialRobomimicImageRunner):
+    """
+    The runner class for the adversarial attacks on the (VQ-)BeT Policy
+    """
+    loss_adapter_cls = DenoisingLoss
+
+
 class RobomimicImageRunner_TH(BaseImageRunner):
     """
     Robomimic envs already enforces number of steps.
@@ -2267,6 +947,14 @@ class RobomimicImageRunner_TH(BaseImageRunner):
                  abs_action=False,
                  tqdm_interval_sec=5.0,
                  n_envs=None,
+                 env_pool=None,
+                 init_state_cache_dir=DEFAULT_CACHE_DIR,
+                 pipeline_groups=1,
+                 early_exit=False,
+                 work_stealing=False,
+                 zero_copy_obs=False,
+                 deferred_video=False,
+                 log_videos=True,
                  ):
         super().__init__(output_dir)
 
@@ -2297,6 +985,12 @@ class RobomimicImageRunner_TH(BaseImageRunner):
             env_meta['env_kwargs']['controller_configs']['control_delta'] = False
             rotation_transformer = RotationTransformer('axis_angle', 'rotation_6d')
 
+        # train init states and test seed states persisted across runs,
+        # init_state_cache_dir=None keeps them in memory only
+        init_state_cache = InitStateCache(dataset_path, env_meta=env_meta,
+            cache_dir=init_state_cache_dir)
+        seed_state_map = init_state_cache.seed_states()
+
         def env_fn():
             robomimic_env = create_env(
                 env_meta=env_meta,
@@ -2312,7 +1006,8 @@ class RobomimicImageRunner_TH(BaseImageRunner):
                         env=robomimic_env,
                         shape_meta=shape_meta,
                         init_state=None,
-                        render_obs_key=render_obs_key
+                        render_obs_key=render_obs_key,
+                        seed_state_map=seed_state_map
                     ),
                     video_recoder=VideoRecorder.create_h264(
                         fps=fps,
@@ -2323,7 +1018,9 @@ class RobomimicImageRunner_TH(BaseImageRunner):
                         thread_count=1
                     ),
                     file_path=None,
-                    steps_per_render=steps_per_render
+                    steps_per_render=steps_per_render,
+                    deferred=deferred_video,
+                    max_frames=max_steps // steps_per_render + 2
                 ),
                 n_obs_steps=n_obs_steps,
                 n_action_steps=n_action_steps,
@@ -2370,33 +1067,34 @@ class RobomimicImageRunner_TH(BaseImageRunner):
         env_init_fn_dills = list()
 
         # train
-        with h5py.File(dataset_path, 'r') as f:
-            for i in range(n_train):
-                train_idx = train_start_idx + i
-                enable_render = i < n_train_vis
-                init_state = f[f'data/demo_{train_idx}/states'][0]
-
-                def init_fn(env, init_state=init_state,
-                            enable_render=enable_render):
-                    # setup rendering
-                    # video_wrapper
-                    assert isinstance(env.env, VideoRecordingWrapper)
-                    env.env.video_recoder.stop()
-                    env.env.file_path = None
-                    if enable_render:
-                        filename = pathlib.Path(output_dir).joinpath(
-                            'media', wv.util.generate_id() + ".mp4")
-                        filename.parent.mkdir(parents=False, exist_ok=True)
-                        filename = str(filename)
-                        env.env.file_path = filename
-
-                    # switch to init_state reset
-                    assert isinstance(env.env.env, RobomimicImageWrapper)
-                    env.env.env.init_state = init_state
-
-                env_seeds.append(train_idx)
-                env_prefixs.append('train/')
-                env_init_fn_dills.append(dill.dumps(init_fn))
+        train_init_states = init_state_cache.train_states(
+            range(train_start_idx, train_start_idx + n_train))
+        for i in range(n_train):
+            train_idx = train_start_idx + i
+            enable_render = i < n_train_vis
+            init_state = train_init_states[train_idx]
+
+            def init_fn(env, init_state=init_state,
+                        enable_render=enable_render):
+                # setup rendering
+                # video_wrapper
+                assert isinstance(env.env, VideoRecordingWrapper)
+                env.env.video_recoder.stop()
+                env.env.file_path = None
+                if enable_render:
+                    filename = pathlib.Path(output_dir).joinpath(
+                        'media', wv.util.generate_id() + ".mp4")
+                    filename.parent.mkdir(parents=False, exist_ok=True)
+                    filename = str(filename)
+                    env.env.file_path = filename
+
+                # switch to init_state reset
+                assert isinstance(env.env.env, RobomimicImageWrapper)
+                env.env.env.init_state = init_state
+
+            env_seeds.append(train_idx)
+            env_prefixs.append('train/')
+            env_init_fn_dills.append(dill.dumps(init_fn))
 
         # test
         for i in range(n_test):
@@ -2426,7 +1124,13 @@ class RobomimicImageRunner_TH(BaseImageRunner):
             env_prefixs.append('test/')
             env_init_fn_dills.append(dill.dumps(init_fn))
 
-        env = AsyncVectorEnv(env_fns, dummy_env_fn=dummy_env_fn)
+        # env_pool: socket path of a shared EnvPoolServer, see gym_util/env_pool.py
+        env = make_vector_env(env_fns, dummy_env_fn=dummy_env_fn, env_pool=env_pool,
+            copy=not zero_copy_obs, key=env_pool_key(runner='RobomimicImageRunner_TH', env_meta=env_meta, shape_meta=shape_meta,
+                n_envs=n_envs, render_obs_key=render_obs_key, fps=fps, crf=crf,
+                n_obs_steps=n_obs_steps, n_action_steps=n_action_steps, max_steps=max_steps,
+                deferred_video=deferred_video))
+        init_state_cache.save()
         # env = SyncVectorEnv(env_fns)
 
         self.env_meta = env_meta
@@ -2444,6 +1148,67 @@ class RobomimicImageRunner_TH(BaseImageRunner):
         self.rotation_transformer = rotation_transformer
         self.abs_action = abs_action
         self.tqdm_interval_sec = tqdm_interval_sec
+        self.init_state_cache = init_state_cache
+        # >1: step env groups while the policy runs on the others, see pipelined_rollout.py
+        self.pipeline_groups = pipeline_groups
+        # drop finished envs from the batch and back-fill them, see backfill_rollout.py
+        self.early_exit = early_exit
+        # envs step on their own and pick up the next init as soon as they finish,
+        # the policy waits for 1/pipeline_groups of the envs
+        self.work_stealing = work_stealing
+        # read obs as torch views of the shared worker buffer, see shared_obs.py
+        self.zero_copy_obs = zero_copy_obs
+        self.obs_transport = None
+        # encode videos in a background process, log_videos=False drops them
+        self.log_videos = log_videos
+        self.video_encoder = None
+
+    def update_init_state_cache(self):
+        """
+        Persist the seed states the env workers computed during a rollout.
+        """
+        for seed_state_map in self.env.call('get_attr', 'seed_state_map'):
+            self.init_state_cache.add_seed_states(seed_state_map)
+        self.init_state_cache.save()
+
+    def get_video_encoder(self) -> VideoEncoderProcess:
+        if self.video_encoder is None:
+            # frames left behind by crashed runs
+            cleanup_stale_frames()
+            self.video_encoder = VideoEncoderProcess()
+        return self.video_encoder
+
+    def submit_video(self, video):
+        """
+        Video path of a rendered episode, deferred videos are queued on the
+        encoder process (see wait_videos), None when videos are not logged.
+        """
+        if isinstance(video, DeferredVideo):
+            return self.get_video_encoder().submit(video, encode=self.log_videos)
+        return video if self.log_videos else None
+
+    def discard_videos(self, videos):
+        for video in videos:
+            if isinstance(video, DeferredVideo):
+                video.discard()
+
+    def wait_videos(self):
+        if self.video_encoder is not None:
+            self.video_encoder.wait()
+
+    def close(self):
+        """
+        Encode the queued videos, then stop the encoder and the env workers,
+        which free the frame rings of unfinished episodes.
+        """
+        if self.video_encoder is not None:
+            self.video_encoder.close()
+            self.video_encoder = None
+        if self.obs_transport is not None:
+            self.obs_transport.close()
+            self.obs_transport = None
+        self.env.close()
+        cleanup_stale_frames()
 
     def run(self, policy: BaseImagePolicy, save_pkl=False,adversarial_patch=None, cfg=None):
         print(cfg)
@@ -2460,7 +1225,12 @@ class RobomimicImageRunner_TH(BaseImageRunner):
         # allocate data
         all_video_paths = [None] * n_inits
         all_rewards = [None] * n_inits
-        observations = []
+        # bounded uint8 capture of the visualized envs
+        observations = CaptureBuffer(
+            max_frames=cfg.get('capture_max_frames', 1024),
+            max_bytes=cfg.get('capture_max_bytes', None),
+            stride=cfg.get('capture_stride', 1),
+            storage=cfg.get('capture_storage', 'cpu'))
         # randomly select envs to visualize from the n_envs
         '''Uncommenting for TH'''
         vis_envs = np.random.choice(n_envs, cfg.n_vis, replace=False)
@@ -2471,6 +1241,9 @@ class RobomimicImageRunner_TH(BaseImageRunner):
         # image_encoder = obs_encoder.obs_nets['robot0_eye_in_hand_image']
         policy.eval()
         # set_seed(1024)
+        # one engine for all chunks, adds adversarial_patch to the attacked views
+        views = get_attack_views(cfg.view, both_views=('sideview_image', 'robot0_eye_in_hand_image'))
+        patch_engine = AttackEngine(None, cfg, views=views)
 
         for chunk_idx in range(n_chunks):
             start = chunk_idx * n_envs
@@ -2497,12 +1270,6 @@ class RobomimicImageRunner_TH(BaseImageRunner):
             env_name = self.env_meta['env_name']
             pbar = tqdm.tqdm(total=self.max_steps, desc=f"Eval {env_name}Image {chunk_idx + 1}/{n_chunks}",
                              leave=False, mininterval=self.tqdm_interval_sec)
-            if cfg.view == 'both':
-                views = ['sideview_image', 'robot0_eye_in_hand_image']
-            elif cfg.view == 'None':
-                views = []
-            else:
-                views = [cfg.view]
             # if save_pkl:
             #     obs_ls=[]
             done = False
@@ -2522,9 +1289,7 @@ class RobomimicImageRunner_TH(BaseImageRunner):
                 clean_obs_dict = obs_dict.copy()
                 random_obs_dict = obs_dict.copy()
                 if adversarial_patch is not None:
-                    for view in views:
-                        obs_dict[view] = obs_dict[view] + adversarial_patch[view].to(device)
-                        obs_dict[view] = torch.clamp(obs_dict[view], cfg.clip_min, cfg.clip_max)
+                    obs_dict = patch_engine.patch(obs_dict, adversarial_patch)
                     # maximum_perturbation = torch.max(torch.abs(adversarial_patch))
                     # random_perturbation = torch.rand_like(obs_dict[cfg.view]) * 2 * maximum_perturbation - maximum_perturbation
                     # random_obs_dict[cfg.view] = random_obs_dict[cfg.view] + random_perturbation
@@ -2544,8 +1309,7 @@ class RobomimicImageRunner_TH(BaseImageRunner):
                     # print("L2 distance between clean and adversarial latents: ", torch.norm(clean_latents['latent'][0].float() - latents['latent'][0].float(), p=2) / latents['latent'][0].shape[0])
                     # random_action_dict = policy.predict_action(random_obs_dict)
                 '''uncommenting for TH'''
-                observations.append(obs_dict['robot0_eye_in_hand_image'][vis_envs].detach().cpu().numpy())
-                # print(f"observations appending has shape {observations[0].shape}")
+                observations.add(obs_dict['robot0_eye_in_hand_image'][vis_envs][:, -1])
                 # device_transfer
                 try:
                     np_action_dict = dict_apply(action_dict,
@@ -2612,38 +1376,37 @@ class RobomimicImageRunner_TH(BaseImageRunner):
                 pbar.update(action.shape[1])
             pbar.close()
 
-            # collect data for this round
-            all_video_paths[this_global_slice] = env.render()[this_local_slice]
+            # collect data for this round, padding envs are dropped
+            videos = env.render()
+            all_video_paths[this_global_slice] = [
+                self.submit_video(x) for x in videos[this_local_slice]]
+            self.discard_videos(videos[this_n_active_envs:])
             all_rewards[this_global_slice] = env.call('get_attr', 'reward')[this_local_slice]
         # clear out video buffer
         _ = env.reset()
+        self.update_init_state_cache()
+        self.wait_videos()
         # log
         max_rewards = collections.defaultdict(list)
         log_data = dict()
         # visualize the video and save to wandb
         if cfg.save_video and cfg.log:
+            # gifs are encoded in the background encoder process
+            vis_paths = list()
             for i in range(cfg.n_vis):
-                ims = []
-                fig, ax = plt.subplots()
-                for j in range(len(observations)):
-                    try:
-                        print(observations[j][i][1].shape)
-                        im = observations[j][i][1].transpose(1, 2, 0)
-                    except IndexError:
-                        im = observations[j][i][0].transpose(1, 2, 0)
-                    ims.append([ax.imshow(im)])
+                frames = observations.stream(i)
                 save_path = Path(cfg.patch_path).parent
                 save_path = save_path.joinpath(f'{cfg.exp_name}_vis_{i}.gif')
                 print(f"Saving video to {save_path}")
 
                 if os.path.exists(save_path):
                     os.remove(save_path)
-
-                ani = ArtistAnimation(fig, ims, interval=100, blit=True, repeat_delay=1000)
-                ani.save(str(save_path), writer='pillow')
-                plt.close(fig)
-                #
-                wandb.log({f'{cfg.exp_name}_vis_{i}': wandb.Image(str(save_path))})
+                vis_paths.append(self.get_video_encoder().submit_frames(
+                    str(save_path), frames, fps=10))
+            self.wait_videos()
+            for i, save_path in enumerate(vis_paths):
+                wandb.log({f'{cfg.exp_name}_vis_{i}': wandb.Image(save_path)})
+        observations.close()
 
         # results reported in the paper are generated using the commented out line below
         # which will only report and average metrics from first n_envs initial condition and seeds
@@ -18,6 +18,8 @@ from diffusion_policy.utils.attack_utils import optimize_linear, clip_perturb
 
 from diffusion_policy.policy.base_image_policy import BaseImagePolicy
 from diffusion_policy.common.pytorch_util import dict_apply
+from diffusion_policy.common.media_util import write_media
+from diffusion_policy.model.diffusion.trajectory_recorder import TrajectoryRecorder
 from diffusion_policy.env_runner.base_image_runner import BaseImageRunner
 from diffusion_policy.env.robomimic.robomimic_image_wrapper import RobomimicImageWrapper
 import robomimic.utils.file_utils as FileUtils
@@ -161,15 +163,8 @@ class RobomimicSingleImageRunner(BaseImageRunner):
                 break
         self.env.close()
         # create a video from the observations
-        observations = np.array(observations)
-        ims = []
-        fig, ax = plt.subplots()
-        ax.axis('off')
-        for i in range(len(observations)):
-            im = ax.imshow(observations[i][0, :, :, :].transpose(1, 2, 0))
-            ims.append([im])
-        ani = animation.ArtistAnimation(fig, ims, interval=50, blit=True, repeat_delay=1000)
-        ani.save(f'/teamspace/studios/this_studio/bc_attacks/diffusion_policy/plots/videos/diffusion_policy_perturbations/perturb_4567_{perturbation}.gif', writer='imagemagick', fps=4)
+        write_media(f'/teamspace/studios/this_studio/bc_attacks/diffusion_policy/plots/videos/diffusion_policy_perturbations/perturb_4567_{perturbation}.gif',
+            [x[0] for x in observations], fps=4)
     
     def plot_trajectories(self, trajectories: list, filename, perturbed_trajectories=None, cfg=None):
         # convert trajectories to tensor
@@ -258,6 +253,19 @@ class RobomimicSingleImageRunner(BaseImageRunner):
 
 
 
+    def record_trajectories(self, policy:BaseImagePolicy, obs_dict):
+        """
+        Intermediate denoising steps of a single predict_action call,
+        recorded on the cpu through an explicitly attached TrajectoryRecorder.
+        """
+        recorder = policy.set_trajectory_recorder(TrajectoryRecorder(offload='cpu'))
+        try:
+            with torch.no_grad():
+                policy.predict_action(obs_dict)
+        finally:
+            policy.set_trajectory_recorder(None)
+        return recorder.trajectories
+
     def create_trajectory_evolution(self, policy:BaseImagePolicy, cfg=None):
         self.env.seed(cfg.seed)
         # init fn
@@ -271,7 +279,7 @@ class RobomimicSingleImageRunner(BaseImageRunner):
         np_obs_dict = dict(obs)
         obs_dict = dict_apply(np_obs_dict, lambda x: torch.from_numpy(x).to(policy.device))
         obs_dict = dict_apply(obs_dict, lambda x: x.unsqueeze(0))
-        trajectories = policy.predict_action(obs_dict)['trajectories']
+        trajectories = self.record_trajectories(policy, obs_dict)
         filename = '/teamspace/studios/this_studio/bc_attacks/diffusion_policy/plots/videos/trajectory_evolution_3D.gif'
         self.plot_trajectories(trajectories, filename)
 
@@ -369,15 +377,8 @@ class RobomimicSingleImageRunner(BaseImageRunner):
                 break
         self.env.close()
         # create a video from the observations
-        observations = np.array(observations)
-        ims = []
-        fig, ax = plt.subplots()
-        ax.axis('off')
-        for i in range(len(observations)):
-            im = ax.imshow(observations[i][0, :, :, :].transpose(1, 2, 0))
-            ims.append([im])
-        ani = animation.ArtistAnimation(fig, ims, interval=50, blit=True, repeat_delay=1000)
-        ani.save(f'/teamspace/studios/this_studio/bc_attacks/diffusion_policy/plots/videos/lstm_patch_attack.gif', writer='imagemagick', fps=4)
+        write_media(f'/teamspace/studios/this_studio/bc_attacks/diffusion_policy/plots/videos/lstm_patch_attack.gif',
+            [x[0] for x in observations], fps=4)
         # run the attack with the same patch
         self.env.seed(cfg.seed)
         obs = self.env.reset()
@@ -404,15 +405,8 @@ class RobomimicSingleImageRunner(BaseImageRunner):
                 break
         self.env.close()
         # create a video from the observations
-        observations = np.array(observations)
-        ims = []
-        fig, ax = plt.subplots()
-        ax.axis('off')
-        for i in range(len(observations)):
-            im = ax.imshow(observations[i][0, :, :, :].transpose(1, 2, 0))
-            ims.append([im])
-        ani = animation.ArtistAnimation(fig, ims, interval=50, blit=True, repeat_delay=1000)
-        ani.save(f'/teamspace/studios/this_studio/bc_attacks/diffusion_policy/plots/videos/lstm_patch_attack_perturbed.gif', writer='imagemagick', fps=4)
+        write_media(f'/teamspace/studios/this_studio/bc_attacks/diffusion_policy/plots/videos/lstm_patch_attack_perturbed.gif',
+            [x[0] for x in observations], fps=4)
         return patch, mask
 
     def attack_single_image(self, policy, cfg):
@@ -477,8 +471,8 @@ class RobomimicSingleImageRunner(BaseImageRunner):
         # print(f"Difference between perturbed and clean observation: {torch.norm(perturbed_obs_dict['robot0_eye_in_hand_image'] - obs_dict['robot0_eye_in_hand_image'])}")
         # get the trajectory for the perturbed observation
         with torch.no_grad():
-            trajectories = policy.predict_action(obs_dict)['trajectories']
-            perturbed_trajectories = policy.predict_action(perturbed_obs_dict)['trajectories']
+            trajectories = self.record_trajectories(policy, obs_dict)
+            perturbed_trajectories = self.record_trajectories(policy, perturbed_obs_dict)
             # print(f'Perturbed trajectories: {perturbed_trajectories[-1]}')
             # print(f'Clean trajectories: {trajectories[-1]}')
         filename = f'/teamspace/studios/this_studio/bc_attacks/diffusion_policy/plots/videos/diffusion_trajectory_clean_input_evolution_perturbed_3D_{cfg.perturbations}_eps_{cfg.epsilon}_timesteps{cfg.attack_after_timesteps}_niters_{cfg.num_iter}.gif'
@@ -622,15 +616,8 @@ class RobomimicSingleImageRunner(BaseImageRunner):
                 break
         self.env.close()
         # create a video from the observations
-        observations = np.array(observations)
-        ims = []
-        fig, ax = plt.subplots()
-        ax.axis('off')
-        for i in range(len(observations)):
-            im = ax.imshow(observations[i][0, :, :, :].transpose(1, 2, 0))
-            ims.append([im])
-        ani = animation.ArtistAnimation(fig, ims, interval=50, blit=True, repeat_delay=1000)
-        ani.save(f'/teamspace/studios/this_studio/bc_attacks/diffusion_policy/plots/videos/lstm_gmm_pgd_{cfg.perturbations}.gif', writer='imagemagick', fps=4)
+        write_media(f'/teamspace/studios/this_studio/bc_attacks/diffusion_policy/plots/videos/lstm_gmm_pgd_{cfg.perturbations}.gif',
+            [x[0] for x in observations], fps=4)
 
 
     def run(self, policy:BaseImagePolicy, epsilon=0.1, cfg=None):
@@ -974,13 +961,6 @@ class RobomimicSingleImageRunner(BaseImageRunner):
                 break
         self.env.close()
         # create a video from the observations
-        observations = np.array(observations)
-        ims = []
-        fig, ax = plt.subplots()
-        ax.axis('off')
-        for i in range(len(observations)):
-            im = ax.imshow(observations[i][0, :, :, :].transpose(1, 2, 0))
-            ims.append([im])
-        ani = animation.ArtistAnimation(fig, ims, interval=50, blit=True, repeat_delay=1000)
-        ani.save(f'/teamspace/studios/this_studio/bc_attacks/diffusion_policy/plots/videos/target_perturbations_/multiple_samples/perturb_{cfg.perturbations[0]}_epsilon_{cfg.epsilon}_strength_{cfg.num_iter}.gif', writer='imagemagick', fps=4)
+        write_media(f'/teamspace/studios/this_studio/bc_attacks/diffusion_policy/plots/videos/target_perturbations_/multiple_samples/perturb_{cfg.perturbations[0]}_epsilon_{cfg.epsilon}_strength_{cfg.num_iter}.gif',
+            [x[0] for x in observations], fps=4)
 
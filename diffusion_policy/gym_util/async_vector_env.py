@@ -2,11 +2,16 @@
 Back ported methods: call, set_attr from v0.26
 Disabled auto-reset after done
 Added render method.
+Added step_each_async/step_each_wait to step disjoint groups of envs independently.
+Added reset_each and the indices argument of call_each to address a subset of envs,
+they may run on idle envs while other envs are stepping (step_each_async).
+Added step_each_ready to find the envs whose step finished.
 """
 
 
 import numpy as np
 import multiprocessing as mp
+import multiprocessing.connection
 import time
 import sys
 from enum import Enum
@@ -38,6 +43,7 @@ class AsyncState(Enum):
     WAITING_RESET = "reset"
     WAITING_STEP = "step"
     WAITING_CALL = "call"
+    WAITING_STEP_EACH = "step_each"
 
 
 class AsyncVectorEnv(VectorEnv):
@@ -164,6 +170,8 @@ class AsyncVectorEnv(VectorEnv):
                 child_pipe.close()
 
         self._state = AsyncState.DEFAULT
+        # envs with a step_each_async call in flight
+        self._pending_steps = set()
         self._check_observation_spaces()
 
     def seed(self, seeds=None):
@@ -236,6 +244,38 @@ class AsyncVectorEnv(VectorEnv):
 
         return deepcopy(self.observations) if self.copy else self.observations
 
+    def reset_each(self, indices, timeout=None):
+        """
+        Reset only the envs in indices.
+        Returns
+        -------
+        observations of the envs in indices, in the order of indices.
+        """
+        indices = [int(i) for i in indices]
+        self._assert_is_idle("reset_each", indices)
+        pipes = [self.parent_pipes[i] for i in indices]
+        for pipe in pipes:
+            pipe.send(("reset", None))
+
+        if not self._poll(timeout, pipes=pipes):
+            raise mp.TimeoutError(
+                "The call to `reset_each` has timed out after "
+                "{0} second{1}.".format(timeout, "s" if timeout > 1 else "")
+            )
+
+        results, successes = zip(*[pipe.recv() for pipe in pipes])
+        self._raise_if_errors(successes)
+
+        if self.shared_memory:
+            return _take(self.observations, indices)
+        return concatenate(
+            results,
+            create_empty_array(
+                self.single_observation_space, n=len(indices), fn=np.zeros
+            ),
+            self.single_observation_space,
+        )
+
     def step_async(self, actions):
         """
         Parameters
@@ -304,6 +344,119 @@ class AsyncVectorEnv(VectorEnv):
             infos,
         )
 
+    def step_each_async(self, actions, indices):
+        """
+        Step only the envs in indices, without waiting for them. Several
+        disjoint groups of envs can be in flight at once, each collected
+        with step_each_wait; all other calls wait until every group is collected.
+        Parameters
+        ----------
+        actions : iterable of samples from `action_space`
+            One action per env in indices.
+        indices : iterable of int
+            Envs to step.
+        """
+        self._assert_is_running()
+        if self._state not in (AsyncState.DEFAULT, AsyncState.WAITING_STEP_EACH):
+            raise AlreadyPendingCallError(
+                "Calling `step_each_async` while waiting "
+                "for a pending call to `{0}` to complete.".format(self._state.value),
+                self._state.value,
+            )
+        indices = [int(i) for i in indices]
+        if len(actions) != len(indices):
+            raise ValueError(
+                "Got {0} actions for {1} envs.".format(len(actions), len(indices))
+            )
+        busy = self._pending_steps.intersection(indices)
+        if len(busy) > 0:
+            raise AlreadyPendingCallError(
+                "Calling `step_each_async` on envs {0} which are "
+                "still stepping.".format(sorted(busy)),
+                self._state.value,
+            )
+
+        for i, action in zip(indices, actions):
+            self.parent_pipes[i].send(("step", action))
+        self._pending_steps.update(indices)
+        self._state = AsyncState.WAITING_STEP_EACH
+
+    def step_each_ready(self, timeout=None):
+        """
+        Envs of step_each_async calls whose step has finished, blocks
+        until there is at least one (or timeout seconds passed).
+        """
+        self._assert_is_running()
+        if self._state != AsyncState.WAITING_STEP_EACH:
+            raise NoAsyncCallError(
+                "Calling `step_each_ready` without any prior call "
+                "to `step_each_async`.",
+                AsyncState.WAITING_STEP_EACH.value,
+            )
+        pending = sorted(self._pending_steps)
+        ready = mp.connection.wait(
+            [self.parent_pipes[i] for i in pending], timeout=timeout)
+        ready = set(id(pipe) for pipe in ready)
+        return [i for i in pending if id(self.parent_pipes[i]) in ready]
+
+    def step_each_wait(self, indices=None, timeout=None):
+        """
+        Parameters
+        ----------
+        indices : iterable of int, optional
+            Envs to collect, all envs in flight if `None`.
+        timeout : int or float, optional
+            Number of seconds before the call to `step_each_wait` times out.
+        Returns
+        -------
+        observations, rewards, dones, infos of the envs in indices, in the
+        order of indices, like `step_wait`.
+        """
+        self._assert_is_running()
+        if indices is None:
+            indices = sorted(self._pending_steps)
+        indices = [int(i) for i in indices]
+        if (self._state != AsyncState.WAITING_STEP_EACH) \
+                or (not self._pending_steps.issuperset(indices)):
+            raise NoAsyncCallError(
+                "Calling `step_each_wait` without any prior call "
+                "to `step_each_async` on the same envs.",
+                AsyncState.WAITING_STEP_EACH.value,
+            )
+
+        pipes = [self.parent_pipes[i] for i in indices]
+        if not self._poll(timeout, pipes=pipes):
+            raise mp.TimeoutError(
+                "The call to `step_each_wait` has timed out after "
+                "{0} second{1}.".format(timeout, "s" if timeout > 1 else "")
+            )
+
+        results, successes = zip(*[pipe.recv() for pipe in pipes])
+        self._pending_steps.difference_update(indices)
+        if len(self._pending_steps) == 0:
+            self._state = AsyncState.DEFAULT
+        self._raise_if_errors(successes)
+        observations_list, rewards, dones, infos = zip(*results)
+
+        if self.shared_memory:
+            # the workers of indices are idle, their slots are not written to
+            observations = _take(self.observations, indices)
+        else:
+            observations = concatenate(
+                observations_list,
+                create_empty_array(
+                    self.single_observation_space, n=len(indices), fn=np.zeros
+                ),
+                self.single_observation_space,
+            )
+
+        return (
+            observations,
+            np.array(rewards),
+            np.array(dones, dtype=np.bool_),
+            infos,
+        )
+
     def close_extras(self, timeout=None, terminate=False):
         """
         Parameters
@@ -324,7 +477,7 @@ class AsyncVectorEnv(VectorEnv):
                     "call to `{0}` to complete.".format(self._state.value)
                 )
                 function = getattr(self, "{0}_wait".format(self._state.value))
-                function(timeout)
+                function(timeout=timeout)
         except mp.TimeoutError:
             terminate = True
 
@@ -346,13 +499,13 @@ class AsyncVectorEnv(VectorEnv):
         for process in self.processes:
             process.join()
 
-    def _poll(self, timeout=None):
+    def _poll(self, timeout=None, pipes=None):
         self._assert_is_running()
         if timeout is None:
             return True
         end_time = time.perf_counter() + timeout
         delta = None
-        for pipe in self.parent_pipes:
+        for pipe in (self.parent_pipes if pipes is None else pipes):
             delta = max(end_time - time.perf_counter(), 0)
             if pipe is None:
                 return False
@@ -374,6 +527,23 @@ class AsyncVectorEnv(VectorEnv):
                 "equal.".format(self.single_observation_space)
             )
 
+    def _assert_is_idle(self, name, indices):
+        """
+        A call on indices is allowed when no call is pending, or only
+        step_each_async calls on other envs.
+        """
+        self._assert_is_running()
+        if self._state == AsyncState.DEFAULT:
+            return
+        if self._state == AsyncState.WAITING_STEP_EACH \
+                and self._pending_steps.isdisjoint(indices):
+            return
+        raise AlreadyPendingCallError(
+            "Calling `{0}` while waiting "
+            "for a pending call to `{1}` to complete.".format(name, self._state.value),
+            self._state.value,
+        )
+
     def _assert_is_running(self):
         if self.closed:
             raise ClosedEnvironmentError(
@@ -385,7 +555,7 @@ class AsyncVectorEnv(VectorEnv):
         if all(successes):
             return
 
-        num_errors = self.num_envs - sum(successes)
+        num_errors = len(successes) - sum(successes)
         assert num_errors > 0
         for _ in range(num_errors):
             index, exctype, value = self.error_queue.get()
@@ -475,8 +645,17 @@ class AsyncVectorEnv(VectorEnv):
     def call_each(self, name: str, 
             args_list: list=None, 
             kwargs_list: list=None, 
-            timeout = None):
-        n_envs = len(self.parent_pipes)
+            timeout = None,
+            indices: list=None):
+        """
+        Call name on every env with its own args and kwargs, or only on
+        the envs in indices (args_list and kwargs_list follow indices).
+        """
+        subset = indices is not None
+        if indices is None:
+            indices = range(len(self.parent_pipes))
+        pipes = [self.parent_pipes[i] for i in indices]
+        n_envs = len(pipes)
         if args_list is None:
             args_list = [[]] * n_envs
         assert len(args_list) == n_envs
@@ -485,6 +664,18 @@ class AsyncVectorEnv(VectorEnv):
             kwargs_list = [dict()] * n_envs
         assert len(kwargs_list) == n_envs
 
+        if subset:
+            self._assert_is_idle("call_each", indices)
+            for i, pipe in enumerate(pipes):
+                pipe.send(("_call", (name, args_list[i], kwargs_list[i])))
+            if not self._poll(timeout, pipes=pipes):
+                raise mp.TimeoutError(
+                    f"The call to `call_each` has timed out after {timeout} second(s)."
+                )
+            results, successes = zip(*[pipe.recv() for pipe in pipes])
+            self._raise_if_errors(successes)
+            return results
+
         # send
         self._assert_is_running()
         if self._state != AsyncState.DEFAULT:
@@ -494,7 +685,7 @@ class AsyncVectorEnv(VectorEnv):
                 self._state.value,
             )
 
-        for i, pipe in enumerate(self.parent_pipes):
+        for i, pipe in enumerate(pipes):
             pipe.send(("_call", (name, args_list[i], kwargs_list[i])))
         self._state = AsyncState.WAITING_CALL
 
@@ -506,13 +697,13 @@ class AsyncVectorEnv(VectorEnv):
                 AsyncState.WAITING_CALL.value,
             )
 
-        if not self._poll(timeout):
+        if not self._poll(timeout, pipes=pipes):
             self._state = AsyncState.DEFAULT
             raise mp.TimeoutError(
                 f"The call to `call_wait` has timed out after {timeout} second(s)."
             )
 
-        results, successes = zip(*[pipe.recv() for pipe in self.parent_pipes])
+        results, successes = zip(*[pipe.recv() for pipe in pipes])
         self._raise_if_errors(successes)
         self._state = AsyncState.DEFAULT
 
@@ -559,6 +750,19 @@ class AsyncVectorEnv(VectorEnv):
 
 
 
+def _take(observations, indices):
+    """
+    Copy of the batched observations of the envs in indices.
+    """
+    if isinstance(observations, dict):
+        return type(observations)(
+            (key, _take(value, indices)) for key, value in observations.items()
+        )
+    if isinstance(observations, tuple):
+        return tuple(_take(value, indices) for value in observations)
+    return observations[indices]
+
+
 def _worker(index, env_fn, pipe, parent_pipe, shared_memory, error_queue):
     assert shared_memory is None
     env = env_fn()
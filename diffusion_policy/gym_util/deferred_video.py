@@ -0,0 +1,288 @@
+"""
+Deferred video encoding for env workers.
+
+With VideoRecordingWrapper(deferred=True) an env worker only copies its
+rendered uint8 frames into a FrameRing, a bounded ring of frames in a
+shared memory block, and render() returns a DeferredVideo handle instead
+of a finished file. The runner hands the handles to a VideoEncoderProcess,
+which encodes mp4 (H.264) or gif files in the background and frees the
+shared memory, so env stepping never waits on the encoder.
+
+The blocks are named dp_frames_<pid>_<id> after the process that created
+them. A process unlinks the rings it still owns at exit, and
+cleanup_stale_frames() removes the blocks of processes that died (e.g. a
+crashed run) before handing them to the encoder.
+"""
+from typing import Optional, Sequence
+import atexit
+import multiprocessing as mp
+import os
+import queue
+import uuid
+from multiprocessing import shared_memory, resource_tracker
+import numpy as np
+
+from diffusion_policy.common.media_util import write_media
+
+SHM_PREFIX = 'dp_frames_'
+SHM_DIR = '/dev/shm'
+
+# rings created by this process and not handed over yet
+_live_rings = dict()
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def cleanup_stale_frames(shm_dir: str = SHM_DIR) -> int:
+    """
+    Unlink the frame blocks whose creating process is gone, returns their count.
+    """
+    if not os.path.isdir(shm_dir):
+        return 0
+    n_removed = 0
+    for name in os.listdir(shm_dir):
+        if not name.startswith(SHM_PREFIX):
+            continue
+        pid = name[len(SHM_PREFIX):].split('_')[0]
+        if not pid.isdigit() or _pid_alive(int(pid)):
+            continue
+        try:
+            os.unlink(os.path.join(shm_dir, name))
+            n_removed += 1
+        except FileNotFoundError:
+            pass
+    return n_removed
+
+
+@atexit.register
+def discard_live_rings():
+    """
+    Free the rings of this process that were never detached.
+    """
+    for ring in list(_live_rings.values()):
+        ring.discard()
+
+
+class DeferredVideo:
+    """
+    Picklable handle of the frames of one episode in shared memory.
+    """
+    def __init__(self, file_path: str, shm_name: str, shape: tuple,
+            max_frames: int, n_frames: int, fps: float, recorder=None):
+        self.file_path = file_path
+        self.shm_name = shm_name
+        self.shape = tuple(shape)
+        self.max_frames = max_frames
+        self.n_frames = n_frames
+        self.fps = fps
+        # VideoRecorder with the codec settings, not started
+        self.recorder = recorder
+
+    def frames(self, buffer: np.ndarray) -> np.ndarray:
+        """
+        Frames in recording order from the ring buffer.
+        """
+        if self.n_frames <= self.max_frames:
+            return buffer[:self.n_frames]
+        start = self.n_frames % self.max_frames
+        return np.concatenate([buffer[start:], buffer[:start]], axis=0)
+
+    def attach(self):
+        shm = shared_memory.SharedMemory(name=self.shm_name)
+        buffer = np.ndarray((self.max_frames,) + self.shape, dtype=np.uint8, buffer=shm.buf)
+        return shm, buffer
+
+    def discard(self):
+        """
+        Free the frames without encoding them.
+        """
+        try:
+            shm = shared_memory.SharedMemory(name=self.shm_name)
+        except FileNotFoundError:
+            return
+        shm.close()
+        shm.unlink()
+
+
+class FrameRing:
+    """
+    Keeps the last max_frames frames of an episode in shared memory.
+    """
+    def __init__(self, shape: tuple, max_frames: int):
+        self.shape = tuple(shape)
+        self.max_frames = max_frames
+        size = int(np.prod(self.shape)) * max_frames
+        self.shm = shared_memory.SharedMemory(
+            name=f'{SHM_PREFIX}{os.getpid()}_{uuid.uuid4().hex[:8]}', create=True, size=size)
+        # the encoder process unlinks the block, not this worker,
+        # leftovers of dead workers are freed by cleanup_stale_frames
+        resource_tracker.unregister(self.shm._name, 'shared_memory')
+        _live_rings[self.shm.name] = self
+        self.buffer = np.ndarray((max_frames,) + self.shape, dtype=np.uint8, buffer=self.shm.buf)
+        self.n_frames = 0
+
+    def append(self, frame: np.ndarray):
+        self.buffer[self.n_frames % self.max_frames] = frame
+        self.n_frames += 1
+
+    def detach(self, file_path: str, fps: float, recorder=None) -> DeferredVideo:
+        """
+        Hand the frames over, the ring can not be written afterwards.
+        """
+        video = DeferredVideo(file_path=file_path, shm_name=self.shm.name,
+            shape=self.shape, max_frames=self.max_frames, n_frames=self.n_frames,
+            fps=fps, recorder=recorder)
+        _live_rings.pop(self.shm.name, None)
+        self.buffer = None
+        self.shm.close()
+        return video
+
+    def discard(self):
+        if _live_rings.pop(self.shm.name, None) is None:
+            # detached or discarded already
+            return
+        self.buffer = None
+        self.shm.close()
+        try:
+            self.shm.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def write_video(file_path: str, frames: np.ndarray, fps: float, recorder=None):
+    """
+    Encode uint8 (T,H,W,C) frames, gif and webp by file suffix, else with
+    recorder (a VideoRecorder, H.264 by default).
+    """
+    if file_path.endswith(('.gif', '.webp')):
+        write_media(file_path, frames, fps=fps)
+        return
+    if recorder is None:
+        from diffusion_policy.real_world.video_recorder import VideoRecorder
+        recorder = VideoRecorder.create_h264(fps=fps, codec='h264',
+            input_pix_fmt='rgb24', crf=22, thread_type='FRAME', thread_count=1)
+    recorder.start(file_path)
+    for frame in frames:
+        recorder.write_frame(frame)
+    recorder.stop()
+
+
+def _encoder_worker(job_queue, result_queue):
+    while True:
+        video = job_queue.get()
+        if video is None:
+            break
+        error = None
+        try:
+            shm, buffer = video.attach()
+            try:
+                write_video(video.file_path, video.frames(buffer),
+                    fps=video.fps, recorder=video.recorder)
+            finally:
+                del buffer
+                shm.close()
+                shm.unlink()
+        except Exception as e:
+            error = repr(e)
+        result_queue.put((video.shm_name, error))
+
+
+class VideoEncoderProcess:
+    """
+    Background process that encodes DeferredVideos to their file_path.
+    """
+    def __init__(self, context: str = 'spawn'):
+        ctx = mp.get_context(context)
+        self.job_queue = ctx.Queue()
+        self.result_queue = ctx.Queue()
+        self.process = ctx.Process(target=_encoder_worker,
+            args=(self.job_queue, self.result_queue), daemon=True)
+        self.process.start()
+        # shm name -> DeferredVideo queued and not written yet
+        self.pending = dict()
+
+    def submit(self, video, encode: bool = True) -> Optional[str]:
+        """
+        Queue a DeferredVideo and return its file path (written once
+        wait() returns). Other values (paths written inline, None) are
+        returned as is. encode=False frees the frames and returns None.
+        """
+        if not isinstance(video, DeferredVideo):
+            return video
+        if not encode:
+            video.discard()
+            return None
+        self.job_queue.put(video)
+        self.pending[video.shm_name] = video
+        return video.file_path
+
+    def submit_frames(self, file_path: str, frames: Sequence[np.ndarray], fps: float) -> str:
+        """
+        Queue frames produced in this process, e.g. policy obs.
+        """
+        frames = np.asarray(frames, dtype=np.uint8)
+        ring = FrameRing(frames.shape[1:], max_frames=max(len(frames), 1))
+        for frame in frames:
+            ring.append(frame)
+        return self.submit(ring.detach(file_path, fps=fps))
+
+    @property
+    def n_pending(self) -> int:
+        return len(self.pending)
+
+    def _drain(self) -> list:
+        """
+        Collect the results of the pending videos while the encoder is alive,
+        returns the errors.
+        """
+        errors = list()
+        while len(self.pending) > 0:
+            try:
+                shm_name, error = self.result_queue.get(timeout=1.0)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    break
+                continue
+            video = self.pending.pop(shm_name)
+            if error is not None:
+                errors.append(f'{video.file_path}: {error}')
+        return errors
+
+    def wait(self):
+        """
+        Block until every submitted video is written.
+        """
+        errors = self._drain()
+        if len(self.pending) > 0:
+            errors.extend(f'{video.file_path}: encoder process exited'
+                for video in self.pending.values())
+            self.discard_pending()
+        if len(errors) > 0:
+            raise RuntimeError("Video encoding failed:\n" + '\n'.join(errors))
+
+    def discard_pending(self):
+        """
+        Free the frames of the videos the encoder did not get to.
+        """
+        for video in self.pending.values():
+            video.discard()
+        self.pending = dict()
+
+    def close(self):
+        """
+        Encode the queued videos and stop the encoder, frames it could not
+        encode are freed.
+        """
+        self._drain()
+        self.discard_pending()
+        if self.process.is_alive():
+            self.job_queue.put(None)
+            self.process.join()
@@ -0,0 +1,265 @@
+"""
+Long-lived pool of warmed AsyncVectorEnvs shared across eval invocations.
+
+A server process keeps vector envs keyed by their construction parameters
+(env_meta, shape_meta, wrappers, n_envs) and leases them to runners over a
+Unix socket. A runner that finds a matching idle env skips the per-env
+MuJoCo compilation and offscreen renderer setup. Runners always re-run
+their init fns and reset before a rollout, so a leased env carries no
+state over from its previous user.
+
+Start the server once per machine:
+    python diffusion_policy/gym_util/env_pool.py --socket ~/.cache/diffusion_policy/env_pool.sock
+and pass env_pool=<socket path> to the runner (see make_vector_env).
+"""
+if __name__ == "__main__":
+    import sys
+    import os
+    import pathlib
+
+    ROOT_DIR = str(pathlib.Path(__file__).parent.parent.parent)
+    sys.path.append(ROOT_DIR)
+
+from typing import Callable, List, Optional
+import collections
+import hashlib
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from multiprocessing.connection import Client, Listener
+
+import click
+import dill
+
+from diffusion_policy.gym_util.async_vector_env import AsyncVectorEnv
+
+DEFAULT_SOCKET = os.path.expanduser('~/.cache/diffusion_policy/env_pool.sock')
+DEFAULT_AUTHKEY = b'diffusion_policy_env_pool'
+# methods of the leased vector env a client may call
+REMOTE_METHODS = ('reset', 'step', 'step_async', 'step_wait', 'reset_async', 'reset_wait',
+    'step_each_async', 'step_each_wait', 'step_each_ready', 'reset_each',
+    'call', 'call_each', 'call_async', 'call_wait', 'set_attr', 'render', 'seed')
+
+
+def env_pool_key(**kwargs) -> str:
+    """
+    Stable key of the construction parameters of a vector env.
+    """
+    text = json.dumps(kwargs, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+# ========= server ============
+class EnvPoolServer:
+    def __init__(self, socket_path: str = DEFAULT_SOCKET, authkey: bytes = DEFAULT_AUTHKEY,
+            max_envs: int = 4):
+        self.socket_path = socket_path
+        self.authkey = authkey
+        self.max_envs = max_envs
+        # key -> list of idle AsyncVectorEnv, least recently used first
+        self.idle = collections.OrderedDict()
+        self.n_leased = 0
+        self.lock = threading.Lock()
+        self.build_lock = threading.Lock()
+
+    def _n_idle(self):
+        return sum(len(x) for x in self.idle.values())
+
+    def _evict(self):
+        # close least recently used idle envs beyond capacity
+        while self._n_idle() + self.n_leased > self.max_envs and self._n_idle() > 0:
+            key = next(iter(self.idle.keys()))
+            env = self.idle[key].pop(0)
+            if len(self.idle[key]) == 0:
+                del self.idle[key]
+            env.close()
+
+    def acquire(self, key: str, env_fns_dill: bytes, dummy_env_fn_dill: Optional[bytes]):
+        with self.lock:
+            envs = self.idle.get(key)
+            if envs:
+                env = envs.pop()
+                if len(envs) == 0:
+                    del self.idle[key]
+                self.n_leased += 1
+                return env, True
+        env_fns = dill.loads(env_fns_dill)
+        dummy_env_fn = None if dummy_env_fn_dill is None else dill.loads(dummy_env_fn_dill)
+        # fork env workers one vector env at a time
+        with self.build_lock:
+            env = AsyncVectorEnv(env_fns, dummy_env_fn=dummy_env_fn)
+            # warm up the renderers
+            env.reset()
+        with self.lock:
+            self.n_leased += 1
+            self._evict()
+        return env, False
+
+    def release(self, key: str, env, failed: bool = False):
+        with self.lock:
+            self.n_leased -= 1
+            if not failed:
+                self.idle.setdefault(key, list()).append(env)
+                self.idle.move_to_end(key)
+            self._evict()
+        if failed:
+            # an env that raised may be stuck mid call, do not lease it again
+            env.close(terminate=True)
+
+    def handle(self, conn):
+        key, env, failed = None, None, False
+        try:
+            while True:
+                try:
+                    cmd, args, kwargs = conn.recv()
+                except EOFError:
+                    break
+                try:
+                    if cmd == 'acquire':
+                        if env is not None:
+                            raise RuntimeError("connection already holds an env")
+                        key = args[0]
+                        env, reused = self.acquire(*args, **kwargs)
+                        result = dict(reused=reused, num_envs=env.num_envs,
+                            observation_space=env.single_observation_space,
+                            action_space=env.single_action_space,
+                            metadata=env.metadata)
+                    elif cmd == 'release':
+                        conn.send(('ok', None))
+                        break
+                    elif cmd in REMOTE_METHODS:
+                        if env is None:
+                            raise RuntimeError("acquire an env first")
+                        result = getattr(env, cmd)(*args, **kwargs)
+                    else:
+                        raise ValueError(f"Unknown env pool command {cmd}")
+                    conn.send(('ok', result))
+                except Exception:
+                    failed = env is not None
+                    conn.send(('error', traceback.format_exc()))
+        except (OSError, BrokenPipeError):
+            pass
+        finally:
+            # envs of dropped clients go back to the pool as well
+            if env is not None:
+                self.release(key, env, failed=failed)
+            conn.close()
+
+    def serve_forever(self):
+        pathlib.Path(self.socket_path).parent.mkdir(parents=True, exist_ok=True)
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        listener = Listener(self.socket_path, family='AF_UNIX', authkey=self.authkey)
+        print(f"Env pool serving on {self.socket_path}")
+        try:
+            while True:
+                conn = listener.accept()
+                threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+        finally:
+            listener.close()
+            for envs in self.idle.values():
+                for env in envs:
+                    env.close()
+
+
+# ========= client ============
+class RemoteVectorEnv:
+    """
+    Client side of a vector env leased from the EnvPoolServer. Supports the
+    AsyncVectorEnv methods used by the runners; close() returns the env to
+    the pool instead of shutting its workers down.
+    """
+    def __init__(self, socket_path: str, key: str, env_fns: List[Callable],
+            dummy_env_fn: Optional[Callable] = None, authkey: bytes = DEFAULT_AUTHKEY):
+        self.conn = Client(socket_path, family='AF_UNIX', authkey=authkey)
+        info = self._request('acquire', key, dill.dumps(env_fns),
+            None if dummy_env_fn is None else dill.dumps(dummy_env_fn))
+        self.reused = info['reused']
+        self.num_envs = info['num_envs']
+        self.single_observation_space = info['observation_space']
+        self.single_action_space = info['action_space']
+        self.metadata = info['metadata']
+        self.closed = False
+
+    def _request(self, cmd, *args, **kwargs):
+        self.conn.send((cmd, args, kwargs))
+        status, result = self.conn.recv()
+        if status != 'ok':
+            raise RuntimeError(f"Env pool call {cmd} failed:\n{result}")
+        return result
+
+    def __getattr__(self, name):
+        if name in REMOTE_METHODS:
+            return lambda *args, **kwargs: self._request(name, *args, **kwargs)
+        raise AttributeError(name)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            try:
+                self._request('release')
+            finally:
+                self.conn.close()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+def ensure_env_pool(socket_path: str = DEFAULT_SOCKET, timeout: float = 30.0):
+    """
+    Spawn a detached EnvPoolServer at socket_path unless one is running.
+    """
+    try:
+        Client(socket_path, family='AF_UNIX', authkey=DEFAULT_AUTHKEY).close()
+        return
+    except (FileNotFoundError, ConnectionRefusedError):
+        pass
+    subprocess.Popen([sys.executable, os.path.abspath(__file__), '--socket', socket_path],
+        start_new_session=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            Client(socket_path, family='AF_UNIX', authkey=DEFAULT_AUTHKEY).close()
+            return
+        except (FileNotFoundError, ConnectionRefusedError):
+            time.sleep(0.2)
+    raise RuntimeError(f"Env pool server did not start at {socket_path}")
+
+
+def make_vector_env(env_fns: List[Callable], dummy_env_fn: Optional[Callable] = None,
+        env_pool: Optional[str] = None, key: Optional[str] = None, copy: bool = True):
+    """
+    A local AsyncVectorEnv, or one leased from the env pool at socket path
+    env_pool (True selects DEFAULT_SOCKET, the server is started on demand).
+    key identifies interchangeable envs, see env_pool_key.
+    copy=False returns views of the shared obs buffer (local envs only).
+    """
+    if not env_pool:
+        return AsyncVectorEnv(env_fns, dummy_env_fn=dummy_env_fn, copy=copy)
+    if key is None:
+        raise ValueError("env_pool requires a key")
+    socket_path = DEFAULT_SOCKET if env_pool is True else os.path.expanduser(env_pool)
+    ensure_env_pool(socket_path)
+    env = RemoteVectorEnv(socket_path, key, env_fns, dummy_env_fn=dummy_env_fn)
+    print(f"Env pool: {'reused' if env.reused else 'created'} {env.num_envs} envs")
+    return env
+
+
+@click.command()
+@click.option('--socket', '-s', default=DEFAULT_SOCKET)
+@click.option('--max_envs', '-m', default=4, type=int,
+    help='vector envs (idle + leased) kept alive')
+def main(socket, max_envs):
+    EnvPoolServer(socket_path=os.path.expanduser(socket), max_envs=max_envs).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Zero-copy path from the AsyncVectorEnv observation buffer to the policy.
+
+With shared_memory the workers write their obs straight into one buffer
+per key, env.observations holds numpy views of it. SharedObsTransport
+wraps those views as torch tensors (no copy), registers them as pinned
+host memory when the policy is on a GPU, and moves a batch to the device
+with a single non_blocking copy per key.
+
+The tensors alias the buffer: a batch is only valid until the next step
+of its envs. The runners read actions back to the CPU before stepping,
+which also waits for the pending copies.
+"""
+from typing import Dict, Optional
+import numpy as np
+import torch
+
+
+def _is_contiguous_range(indices) -> bool:
+    indices = np.asarray(indices)
+    return len(indices) > 0 and np.all(np.diff(indices) == 1)
+
+
+class SharedObsTransport:
+    def __init__(self, env, device: torch.device, pin_memory: bool = True):
+        """
+        env: a local AsyncVectorEnv with a dict observation space
+        """
+        self.device = torch.device(device)
+        self.host = {key: torch.from_numpy(value)
+            for key, value in env.observations.items()}
+        self.registered = list()
+        if pin_memory and self.device.type == 'cuda':
+            cudart = torch.cuda.cudart()
+            for key, value in self.host.items():
+                # the buffer is owned by multiprocessing, register it in place
+                ptr, size = value.data_ptr(), value.numel() * value.element_size()
+                status = cudart.cudaHostRegister(ptr, size, 0)
+                if int(status) != 0:
+                    print(f"SharedObsTransport: could not pin {key}, copies are synchronous")
+                    continue
+                self.registered.append(ptr)
+
+    def __call__(self, indices=None) -> Dict[str, torch.Tensor]:
+        """
+        Obs of the envs in indices (all envs if None) on the device.
+        """
+        if indices is None:
+            host = self.host
+        elif _is_contiguous_range(indices):
+            # a slice stays a view of the pinned buffer
+            this_slice = slice(int(indices[0]), int(indices[-1]) + 1)
+            host = {key: value[this_slice] for key, value in self.host.items()}
+        else:
+            index = torch.as_tensor(np.asarray(indices), dtype=torch.long)
+            host = {key: value.index_select(0, index) for key, value in self.host.items()}
+        return {key: value.to(device=self.device, non_blocking=True)
+            for key, value in host.items()}
+
+    def close(self):
+        if len(self.registered) > 0:
+            cudart = torch.cuda.cudart()
+            for ptr in self.registered:
+                cudart.cudaHostUnregister(ptr)
+            self.registered = list()
+
+    def __del__(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+
+
+def make_obs_transport(env, device, pin_memory: bool = True) -> Optional[SharedObsTransport]:
+    """
+    SharedObsTransport of a local AsyncVectorEnv, None for envs whose
+    buffer lives in another process (env pool) or is not a dict of arrays.
+    """
+    observations = getattr(env, 'observations', None)
+    if not isinstance(observations, dict):
+        return None
+    return SharedObsTransport(env, device, pin_memory=pin_memory)
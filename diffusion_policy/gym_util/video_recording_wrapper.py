@@ -1,6 +1,7 @@
 import gym
 import numpy as np
 from diffusion_policy.real_world.video_recorder import VideoRecorder
+from diffusion_policy.gym_util.deferred_video import FrameRing
 
 class VideoRecordingWrapper(gym.Wrapper):
     def __init__(self, 
@@ -9,10 +10,14 @@ class VideoRecordingWrapper(gym.Wrapper):
             mode='rgb_array',
             file_path=None,
             steps_per_render=1,
+            deferred=False,
+            max_frames=1024,
             **kwargs
         ):
         """
         When file_path is None, don't record.
+        deferred: keep the last max_frames frames in a shared memory FrameRing,
+        render() returns a DeferredVideo for a VideoEncoderProcess to encode.
         """
         super().__init__(env)
         
@@ -21,6 +26,9 @@ class VideoRecordingWrapper(gym.Wrapper):
         self.steps_per_render = steps_per_render
         self.file_path = file_path
         self.video_recoder = video_recoder
+        self.deferred = deferred
+        self.max_frames = max_frames
+        self.frame_ring = None
 
         self.step_count = 0
 
@@ -29,6 +37,10 @@ class VideoRecordingWrapper(gym.Wrapper):
         self.frames = list()
         self.step_count = 1
         self.video_recoder.stop()
+        if self.frame_ring is not None:
+            # episode ended without render
+            self.frame_ring.discard()
+            self.frame_ring = None
         return obs
     
     def step(self, action):
@@ -36,6 +48,14 @@ class VideoRecordingWrapper(gym.Wrapper):
         self.step_count += 1
         if self.file_path is not None \
             and ((self.step_count % self.steps_per_render) == 0):
+            if self.deferred:
+                frame = self.env.render(
+                    mode=self.mode, **self.render_kwargs)
+                assert frame.dtype == np.uint8
+                if self.frame_ring is None:
+                    self.frame_ring = FrameRing(frame.shape, self.max_frames)
+                self.frame_ring.append(frame)
+                return result
             if not self.video_recoder.is_ready():
                 self.video_recoder.start(self.file_path)
 
@@ -46,6 +66,17 @@ class VideoRecordingWrapper(gym.Wrapper):
         return result
     
     def render(self, mode='rgb_array', **kwargs):
+        if self.frame_ring is not None:
+            video = self.frame_ring.detach(self.file_path,
+                fps=self.video_recoder.fps, recorder=self.video_recoder)
+            self.frame_ring = None
+            return video
         if self.video_recoder.is_ready():
             self.video_recoder.stop()
         return self.file_path
+
+    def close(self):
+        if self.frame_ring is not None:
+            self.frame_ring.discard()
+            self.frame_ring = None
+        return super().close()
@@ -0,0 +1,60 @@
+import copy
+import importlib
+import diffusers
+from packaging import version
+
+# samplers that can replace the training scheduler at inference time
+INFERENCE_SCHEDULERS = {
+    'ddpm': 'diffusers.schedulers.scheduling_ddpm.DDPMScheduler',
+    'ddim': 'diffusers.schedulers.scheduling_ddim.DDIMScheduler',
+    'dpm_solver': 'diffusers.schedulers.scheduling_dpmsolver_multistep.DPMSolverMultistepScheduler',
+    'dpm_solver_sde': 'diffusers.schedulers.scheduling_dpmsolver_sde.DPMSolverSDEScheduler',
+    'unipc': 'diffusers.schedulers.scheduling_unipc_multistep.UniPCMultistepScheduler',
+}
+# samplers newer than the pinned diffusers 0.11.1
+MIN_DIFFUSERS_VERSIONS = {
+    'dpm_solver_sde': '0.15.0',
+    'unipc': '0.13.0',
+}
+
+
+def get_inference_scheduler(noise_scheduler, name: str, **kwargs):
+    """
+    Build an inference sampler that shares the noise schedule
+    (betas, prediction_type, clip_sample, ...) of the training noise_scheduler,
+    so a checkpoint trained with DDPM can be sampled with DDIM/DPM-Solver in
+    10-16 steps without retraining. kwargs override the inherited config.
+    name: key of INFERENCE_SCHEDULERS or a full class path.
+    """
+    target = INFERENCE_SCHEDULERS.get(name, name)
+    if '.' not in target:
+        raise ValueError(f"Unknown inference scheduler {name}, "
+            f"expected one of {list(INFERENCE_SCHEDULERS.keys())} or a class path")
+    min_version = MIN_DIFFUSERS_VERSIONS.get(name, None)
+    if min_version is not None and version.parse(diffusers.__version__) < version.parse(min_version):
+        raise ValueError(f"Inference scheduler {name} requires diffusers>={min_version}, "
+            f"installed {diffusers.__version__}")
+    module_name, cls_name = target.rsplit('.', 1)
+    cls = getattr(importlib.import_module(module_name), cls_name)
+    config = dict(noise_scheduler.config)
+    config.update(kwargs)
+    return cls.from_config(config)
+
+
+def is_multistep(scheduler) -> bool:
+    """
+    Multistep solvers (DPM-Solver++, UniPC) keep the previous model outputs
+    in the scheduler and advance them on every step() call.
+    """
+    return hasattr(scheduler, 'model_outputs')
+
+
+def fork_scheduler(scheduler):
+    """
+    Scheduler for extra step() calls at the current timestep that must not
+    change the sampling trajectory: a copy of a multistep solver, the
+    scheduler itself when step() is stateless.
+    """
+    if is_multistep(scheduler):
+        return copy.deepcopy(scheduler)
+    return scheduler
@@ -0,0 +1,70 @@
+from typing import List, Optional
+import collections
+import torch
+
+
+class TrajectoryRecorder:
+    """
+    Opt-in hook that records the intermediate denoising steps of a diffusion
+    policy. Attach with policy.set_trajectory_recorder(recorder); without a
+    recorder the policy keeps nothing but the final sample.
+
+    max_steps: keep only the last max_steps records (ring buffer), None keeps all
+    every: record every n-th denoising step, the final step is always kept
+    offload: 'cpu' copies each step to host memory, None keeps it on device
+
+    Device to host copies are asynchronous, trajectories waits for them.
+    """
+    def __init__(self,
+            max_steps: Optional[int] = None,
+            every: int = 1,
+            offload: Optional[str] = 'cpu'
+        ):
+        if max_steps is not None and max_steps < 1:
+            raise ValueError("max_steps must be >= 1 or None")
+        if every < 1:
+            raise ValueError("every must be >= 1")
+        self.max_steps = max_steps
+        self.every = every
+        self.offload = offload
+        self.buffer = collections.deque(maxlen=max_steps)
+        self.timesteps = collections.deque(maxlen=max_steps)
+        # recorded after the last asynchronous copy
+        self.copy_event = None
+
+    def reset(self):
+        """
+        Called by the policy at the start of every sampling loop.
+        """
+        self.buffer.clear()
+        self.timesteps.clear()
+        self.copy_event = None
+
+    def __call__(self, step_idx: int, n_steps: int, t, trajectory: torch.Tensor):
+        if (step_idx % self.every != 0) and (step_idx != n_steps - 1):
+            return
+        x = trajectory.detach()
+        if self.offload is not None:
+            # copy=True, the sample is updated in place when it is already there
+            x = x.to(self.offload, non_blocking=True, copy=True)
+            if trajectory.is_cuda and not x.is_cuda:
+                self.copy_event = torch.cuda.Event()
+                self.copy_event.record()
+        else:
+            x = x.clone()
+        self.buffer.append(x)
+        self.timesteps.append(int(t))
+
+    @property
+    def trajectories(self) -> List[torch.Tensor]:
+        """
+        Recorded (B,T,D) tensors, oldest first.
+        """
+        if self.copy_event is not None:
+            # copies run in stream order, the last one finishes last
+            self.copy_event.synchronize()
+            self.copy_event = None
+        return list(self.buffer)
+
+    def __len__(self):
+        return len(self.buffer)
@@ -0,0 +1,38 @@
+import functools
+import torch
+import torch.nn as nn
+import torch.utils.checkpoint
+from torchvision.models.resnet import BasicBlock, Bottleneck
+
+# blocks whose internal activations are recomputed in backward instead of stored
+CHECKPOINT_BLOCK_TYPES = (BasicBlock, Bottleneck)
+
+
+def _checkpointed_forward(module, x):
+    if torch.is_grad_enabled():
+        return torch.utils.checkpoint.checkpoint(
+            module._unchecked_forward, x, use_reentrant=False)
+    return module._unchecked_forward(x)
+
+
+def set_activation_checkpointing(module: nn.Module, enabled: bool = True) -> int:
+    """
+    Toggle activation checkpointing on every ResNet block inside module
+    (MultiImageObsEncoder and robomimic VisualCore backbones alike).
+    Only forward is swapped, parameters and state_dict keys are unchanged,
+    and no_grad inference runs the plain forward.
+    Returns the number of blocks found.
+    """
+    n_blocks = 0
+    for block in module.modules():
+        if not isinstance(block, CHECKPOINT_BLOCK_TYPES):
+            continue
+        n_blocks += 1
+        is_enabled = '_unchecked_forward' in block.__dict__
+        if enabled and not is_enabled:
+            block._unchecked_forward = block.forward
+            block.forward = functools.partial(_checkpointed_forward, block)
+        elif not enabled and is_enabled:
+            del block.forward
+            del block._unchecked_forward
+    return n_blocks
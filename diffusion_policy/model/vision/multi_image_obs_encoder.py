@@ -177,7 +177,27 @@ class MultiImageObsEncoder(ModuleAttrMixin):
         # concatenate all features
         result = torch.cat(features, dim=-1)
         return result
-    
+
+    def forward_keys(self, obs_dict, keys):
+        """
+        Per-key features, concatenating them in rgb_keys + low_dim_keys
+        order reproduces forward(obs_dict).
+        """
+        features = dict()
+        for key in keys:
+            data = obs_dict[key]
+            if key in self.rgb_keys:
+                assert data.shape[1:] == self.key_shape_map[key]
+                img = self.key_transform_map[key](data)
+                if self.share_rgb_model:
+                    features[key] = self.key_model_map['rgb'](img)
+                else:
+                    features[key] = self.key_model_map[key](img)
+            else:
+                assert data.shape[1:] == self.key_shape_map[key]
+                features[key] = data
+        return features
+
     @torch.no_grad()
     def output_shape(self):
         example_obs_dict = dict()
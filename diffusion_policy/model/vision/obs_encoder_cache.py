@@ -0,0 +1,70 @@
+from typing import Dict, List
+import torch
+import torch.nn as nn
+
+
+def get_obs_encoder_keys(obs_encoder: nn.Module) -> List[str]:
+    """
+    Keys in the order their features are concatenated by obs_encoder.
+    Supports MultiImageObsEncoder and robomimic's ObservationEncoder.
+    """
+    if hasattr(obs_encoder, 'rgb_keys'):
+        return list(obs_encoder.rgb_keys) + list(obs_encoder.low_dim_keys)
+    return list(obs_encoder.obs_shapes.keys())
+
+
+def encode_obs_keys(obs_encoder: nn.Module, this_nobs: Dict[str, torch.Tensor],
+        keys: List[str]) -> Dict[str, torch.Tensor]:
+    """
+    Per-key features of obs_encoder for flattened (B*To, ...) obs.
+    torch.cat([result[k] for k in get_obs_encoder_keys(obs_encoder)], dim=-1)
+    equals obs_encoder(this_nobs) in eval mode.
+    """
+    if hasattr(obs_encoder, 'forward_keys'):
+        return obs_encoder.forward_keys(this_nobs, keys)
+
+    # robomimic ObservationEncoder
+    features = dict()
+    for key in keys:
+        x = this_nobs[key]
+        randomizers = obs_encoder.obs_randomizers[key]
+        if not isinstance(randomizers, nn.ModuleList):
+            randomizers = [randomizers]
+        for rand in randomizers:
+            if rand is not None:
+                x = rand.forward_in(x)
+        if obs_encoder.obs_nets[key] is not None:
+            x = obs_encoder.obs_nets[key](x)
+            if obs_encoder.activation is not None:
+                x = obs_encoder.activation(x)
+        for rand in reversed(randomizers):
+            if rand is not None:
+                x = rand.forward_out(x)
+        features[key] = torch.flatten(x, start_dim=1)
+    return features
+
+
+class ObsFeatureCache:
+    """
+    Encodes every obs key once and caches the features of the keys that
+    are not attacked, so each attack iteration only re-runs the encoder
+    branches of the perturbed views.
+    """
+    def __init__(self, obs_encoder: nn.Module, this_nobs: Dict[str, torch.Tensor],
+            attacked_keys: List[str]):
+        self.obs_encoder = obs_encoder
+        self.keys = get_obs_encoder_keys(obs_encoder)
+        self.attacked_keys = [key for key in self.keys if key in attacked_keys]
+        with torch.no_grad():
+            self.features = encode_obs_keys(obs_encoder, this_nobs, self.keys)
+
+    def clean_features(self) -> torch.Tensor:
+        return torch.cat([self.features[key] for key in self.keys], dim=-1)
+
+    def __call__(self, this_nobs: Dict[str, torch.Tensor]) -> torch.Tensor:
+        """
+        this_nobs only needs to contain the attacked keys.
+        """
+        attacked = encode_obs_keys(self.obs_encoder, this_nobs, self.attacked_keys)
+        return torch.cat([attacked[key] if key in attacked else self.features[key]
+            for key in self.keys], dim=-1)
@@ -1,12 +1,60 @@
 from typing import Dict
+import copy
+import functools
 import torch
 import torch.nn as nn
 from diffusion_policy.model.common.module_attr_mixin import ModuleAttrMixin
 from diffusion_policy.model.common.normalizer import LinearNormalizer
 
+# autocast dtype of each precision mode, None runs in fp32
+PRECISIONS = {
+    'fp32': None,
+    'bf16': torch.bfloat16,
+    'fp16': torch.float16,
+}
+
+
+def _to_fp32(x):
+    if isinstance(x, torch.Tensor):
+        if x.dtype in (torch.bfloat16, torch.float16):
+            return x.float()
+        return x
+    if isinstance(x, torch.distributions.Distribution):
+        # parameters (and nested distributions) live in the instance dict
+        x = copy.copy(x)
+        for k, v in list(vars(x).items()):
+            if isinstance(v, (torch.Tensor, torch.distributions.Distribution)):
+                x.__dict__[k] = _to_fp32(v)
+        return x
+    if isinstance(x, dict):
+        return type(x)((k, _to_fp32(v)) for k, v in x.items())
+    if isinstance(x, (tuple, list)):
+        return type(x)(_to_fp32(v) for v in x)
+    return x
+
+
+def autocast_method(fn):
+    """
+    Run a policy method under self.autocast(). Only the network forwards
+    drop to reduced precision: normalizer math is elementwise and stays in
+    fp32 under autocast, and reduced precision outputs are cast back to fp32.
+    """
+    @functools.wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        if PRECISIONS[self.precision] is None:
+            return fn(self, *args, **kwargs)
+        with self.autocast():
+            result = fn(self, *args, **kwargs)
+        return _to_fp32(result)
+    return wrapper
+
+
 class BaseImagePolicy(ModuleAttrMixin):
     # init accepts keyword argument shape_meta, see config/task/*_image.yaml
 
+    # precision mode of predict_action/compute_loss, see set_precision
+    precision = 'fp32'
+
     def predict_action(self, obs_dict: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
         """
         obs_dict:
@@ -19,6 +67,25 @@ class BaseImagePolicy(ModuleAttrMixin):
     def reset(self):
         pass
 
+    # True when the reset state holds one entry per env of the batch
+    # (e.g. RNN hidden states), such policies always see the full env batch
+    batch_stateful = False
+
+    # ========== precision ===========
+    def set_precision(self, precision: str):
+        """
+        precision: 'fp32', 'bf16' (CPU or GPU) or 'fp16' (GPU)
+        """
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unsupported precision {precision}, expected one of {list(PRECISIONS.keys())}")
+        self.precision = precision
+
+    def autocast(self):
+        dtype = PRECISIONS[self.precision]
+        return torch.autocast(device_type=self.device.type,
+            dtype=torch.bfloat16 if dtype is None else dtype,
+            enabled=dtype is not None)
+
     # ========== training ===========
     # no standard training interface except setting normalizer
     def set_normalizer(self, normalizer: LinearNormalizer):
@@ -1,4 +1,4 @@
-from typing import Dict
+from typing import Dict, Optional
 import math
 import torch
 import torch.nn as nn
@@ -8,9 +8,11 @@ from einops import rearrange, reduce
 from diffusers.schedulers.scheduling_ddpm import DDPMScheduler
 
 from diffusion_policy.model.common.normalizer import LinearNormalizer
-from diffusion_policy.policy.base_image_policy import BaseImagePolicy
+from diffusion_policy.policy.base_image_policy import BaseImagePolicy, autocast_method
 from diffusion_policy.model.diffusion.conditional_unet1d import ConditionalUnet1D
 from diffusion_policy.model.diffusion.mask_generator import LowdimMaskGenerator
+from diffusion_policy.model.diffusion.inference_scheduler import get_inference_scheduler, fork_scheduler
+from diffusion_policy.model.diffusion.trajectory_recorder import TrajectoryRecorder
 from diffusion_policy.common.robomimic_config_util import get_robomimic_config
 from robomimic.algo import algo_factory
 from robomimic.algo.algo import PolicyAlgo
@@ -18,6 +20,9 @@ import robomimic.utils.obs_utils as ObsUtils
 import robomimic.models.base_nets as rmbn
 import diffusion_policy.model.vision.crop_randomizer as dmvc
 from diffusion_policy.common.pytorch_util import dict_apply, replace_submodules
+from diffusion_policy.model.vision.obs_encoder_cache import ObsFeatureCache
+from diffusion_policy.adversarial_attacks.attack_schedule import AttackSchedule
+from diffusion_policy.adversarial_attacks.attack_engine import broadcast_epsilon
 
 
 class DiffusionUnetHybridImagePolicy(BaseImagePolicy):
@@ -168,9 +173,49 @@ class DiffusionUnetHybridImagePolicy(BaseImagePolicy):
         if num_inference_steps is None:
             num_inference_steps = noise_scheduler.config.num_train_timesteps
         self.num_inference_steps = num_inference_steps
+        # optional sampler swapped in at load time, see set_inference_scheduler
+        self.inference_scheduler = None
+        self.inference_step_kwargs = dict()
+        # opt-in hook for intermediate denoising steps, see set_trajectory_recorder
+        self.trajectory_recorder = None
 
         print("Diffusion params: %e" % sum(p.numel() for p in self.model.parameters()))
         print("Vision params: %e" % sum(p.numel() for p in self.obs_encoder.parameters()))
+
+    def set_inference_scheduler(self, name=None, num_inference_steps=None,
+            step_kwargs=None, **scheduler_kwargs):
+        """
+        Sample with a different scheduler (e.g. name='ddim', num_inference_steps=16)
+        without retraining. name=None restores the training scheduler.
+        compute_loss always uses noise_scheduler.
+        """
+        if name is None:
+            self.inference_scheduler = None
+            self.inference_step_kwargs = dict()
+        else:
+            self.inference_scheduler = get_inference_scheduler(
+                self.noise_scheduler, name, **scheduler_kwargs)
+            self.inference_step_kwargs = dict() if step_kwargs is None else dict(step_kwargs)
+        if num_inference_steps is not None:
+            self.num_inference_steps = num_inference_steps
+        print(f"Inference scheduler: {type(self.get_sampling_scheduler()[0]).__name__}, "
+            f"{self.num_inference_steps} steps")
+
+    def set_trajectory_recorder(self, recorder: Optional[TrajectoryRecorder]):
+        """
+        Attach a TrajectoryRecorder to receive every denoising step of
+        conditional_sample and pgd_perturbed_obs, None detaches it.
+        """
+        self.trajectory_recorder = recorder
+        return recorder
+
+    def get_sampling_scheduler(self):
+        """
+        Scheduler and scheduler.step kwargs used for sampling.
+        """
+        if self.inference_scheduler is None:
+            return self.noise_scheduler, self.kwargs
+        return self.inference_scheduler, self.inference_step_kwargs
     
     # ========= inference  ============
     def conditional_sample(self, 
@@ -181,7 +226,11 @@ class DiffusionUnetHybridImagePolicy(BaseImagePolicy):
             **kwargs
             ):
         model = self.model
-        scheduler = self.noise_scheduler
+        scheduler, step_kwargs = self.get_sampling_scheduler()
+        if self.inference_scheduler is None:
+            step_kwargs = kwargs
+        if generator is not None:
+            step_kwargs = dict(step_kwargs, generator=generator)
 
         trajectory = torch.randn(
             size=condition_data.shape, 
@@ -191,9 +240,12 @@ class DiffusionUnetHybridImagePolicy(BaseImagePolicy):
     
         # set step values
         scheduler.set_timesteps(self.num_inference_steps)
-        self.trajectories = []
+        recorder = self.trajectory_recorder
+        if recorder is not None:
+            recorder.reset()
 
-        for t in scheduler.timesteps:
+        n_steps = len(scheduler.timesteps)
+        for i, t in enumerate(scheduler.timesteps):
             # 1. apply conditioning
             trajectory[condition_mask] = condition_data[condition_mask]
 
@@ -204,10 +256,10 @@ class DiffusionUnetHybridImagePolicy(BaseImagePolicy):
             # 3. compute previous image: x_t -> x_t-1
             trajectory = scheduler.step(
                 model_output, t, trajectory, 
-                generator=generator,
-                **kwargs
+                **step_kwargs
                 ).prev_sample
-            self.trajectories.append(trajectory)
+            if recorder is not None:
+                recorder(i, n_steps, t, trajectory)
         
         # finally make sure conditioning is enforced
         trajectory[condition_mask] = condition_data[condition_mask]
@@ -215,9 +267,24 @@ class DiffusionUnetHybridImagePolicy(BaseImagePolicy):
         return trajectory
 
 
-    def predict_action(self, obs_dict: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+    @autocast_method
+    def encode_obs(self, obs_dict: Dict[str, torch.Tensor]) -> torch.Tensor:
+        """
+        Normalize and encode the first n_obs_steps of obs_dict.
+        result: (B, To, Do) observation features
+        """
+        nobs = self.normalizer.normalize(obs_dict)
+        B = next(iter(nobs.values())).shape[0]
+        To = self.n_obs_steps
+        this_nobs = dict_apply(nobs, lambda x: x[:,:To,...].reshape(-1,*x.shape[2:]).to(self.device))
+        nobs_features = self.obs_encoder(this_nobs)
+        return nobs_features.reshape(B, To, -1)
+
+    @autocast_method
+    def predict_action(self, obs_dict: Dict[str, torch.Tensor], nobs_features=None) -> Dict[str, torch.Tensor]:
         """
         obs_dict: must include "obs" key
+        nobs_features: optional (B, To, Do) output of encode_obs(obs_dict), skips the encoder
         result: must include "action" key
         """
         assert 'past_action' not in obs_dict # not implemented yet
@@ -243,12 +310,8 @@ class DiffusionUnetHybridImagePolicy(BaseImagePolicy):
         global_cond = None
         if self.obs_as_global_cond:
             # condition through global feature
-            for key in nobs.keys():
-                print(f"Key: {key} and shape: {nobs[key].shape}")
-            this_nobs = dict_apply(nobs, lambda x: x[:,:To,...].reshape(-1,*x.shape[2:]))
-            this_nobs = dict_apply(this_nobs, lambda x: x.to(device))
-            print("This nobs shape: ", this_nobs['agentview_image'].shape)
-            nobs_features = self.obs_encoder(this_nobs)
+            if nobs_features is None:
+                nobs_features = self.encode_obs(obs_dict)
             # reshape back to B, Do
             global_cond = nobs_features.reshape(B, -1)
             # empty data for action
@@ -256,10 +319,8 @@ class DiffusionUnetHybridImagePolicy(BaseImagePolicy):
             cond_mask = torch.zeros_like(cond_data, dtype=torch.bool)
         else:
             # condition through impainting
-            this_nobs = dict_apply(nobs, lambda x: x[:,:To,...].reshape(-1,*x.shape[2:]))
-            nobs_features = self.obs_encoder(this_nobs)
-            # reshape back to B, To, Do
-            nobs_features = nobs_features.reshape(B, To, -1)
+            if nobs_features is None:
+                nobs_features = self.encode_obs(obs_dict)
             cond_data = torch.zeros(size=(B, T, Da+Do), device=device, dtype=dtype)
             cond_mask = torch.zeros_like(cond_data, dtype=torch.bool)
             cond_data[:,:To,Da:] = nobs_features
@@ -285,11 +346,13 @@ class DiffusionUnetHybridImagePolicy(BaseImagePolicy):
         result = {
             'action': action,
             'action_pred': action_pred, 
-            # 'trajectories': self.trajectories,
+            'obs_features': nobs_features,
         }
         return result
 
-    def pgd_perturbed_obs(self, obs_dict: Dict[str, torch.Tensor], cfg):
+    @autocast_method
+    def pgd_perturbed_obs(self, obs_dict: Dict[str, torch.Tensor], cfg, epsilon=None,
+            telemetry=None):
         """
         This function uses pgd attack to generate adversarial perturbations.
         The main idea is to perturb the observation after certain timesteps when the 
@@ -300,8 +363,13 @@ class DiffusionUnetHybridImagePolicy(BaseImagePolicy):
         We will accumulate this perturbed_obs over the timesteps and return it.
         The main indication of the attack being successful is to have the loss go down over time
         for each timestep.
+        Which denoising steps are attacked is decided by AttackSchedule (cfg.attack_schedule),
+        the compute/strength stats of the call are left in self.attack_stats.
+        epsilon overrides cfg.epsilon, a (B,) tensor gives every sample its own budget.
         """
         assert 'past_action' not in obs_dict
+        if epsilon is None:
+            epsilon = cfg.epsilon
         view = cfg.view
         if view == 'both':
             views = ['agentview_image', 'robot0_eye_in_hand_image']                
@@ -324,7 +392,7 @@ class DiffusionUnetHybridImagePolicy(BaseImagePolicy):
         Do = self.obs_feature_dim
         To = self.n_obs_steps
         model = self.model
-        scheduler = self.noise_scheduler
+        scheduler, step_kwargs = self.get_sampling_scheduler()
         device = self.device
         dtype = self.dtype
         if self.obs_as_global_cond:
@@ -341,33 +409,43 @@ class DiffusionUnetHybridImagePolicy(BaseImagePolicy):
                 size=cond_data.shape,
                 dtype=cond_data.dtype,
                 device=cond_data.device,)
-        nobs_perturbed = nobs.copy()
-        nobs_perturbed = dict_apply(nobs_perturbed, lambda x: x.requires_grad_(True))
+        # only the attacked views are optimized, the rest is served from the feature cache
+        nobs_perturbed = {view: nobs[view].detach() for view in views}
         
-        # set step values
-        scheduler.set_timesteps(self.num_inference_steps)
-        self.trajectories = []
+        # set step values, the attack schedule may compress the inference schedule
+        schedule = AttackSchedule.from_cfg(cfg)
+        n_inference_steps = schedule.num_inference_steps(self.num_inference_steps)
+        scheduler.set_timesteps(n_inference_steps)
+        attack_mask = schedule.attack_mask(scheduler.timesteps, self.num_inference_steps)
+        n_attacked = 0
+        last_loss = None
+        recorder = self.trajectory_recorder
+        if recorder is not None:
+            recorder.reset()
         global_cond = None
         local_cond = None
         prev_trajectory = None
         if self.obs_as_global_cond:
             # condition through global feature
             this_nobs_pure = dict_apply(nobs, lambda x: x[:,:To,...].reshape(-1,*x.shape[2:]))
-            with torch.no_grad():
-                nobs_features_pure = self.obs_encoder(this_nobs_pure)
+            feature_cache = ObsFeatureCache(self.obs_encoder, this_nobs_pure, views)
+            nobs_features_pure = feature_cache.clean_features()
             # reshape back to B, Do
             global_cond_pure = nobs_features_pure.reshape(B, -1)
         else:
             # condition through impainting
             this_nobs_pure = dict_apply(nobs, lambda x: x[:,:To,...].reshape(-1,*x.shape[2:]))
-            with torch.no_grad():
-                nobs_features_pure = self.obs_encoder(this_nobs_pure)
+            feature_cache = ObsFeatureCache(self.obs_encoder, this_nobs_pure, views)
+            nobs_features_pure = feature_cache.clean_features()
             # reshape back to B, To, Do
             nobs_features_pure = nobs_features_pure.reshape(B, To, -1)
 
 
-        for t in scheduler.timesteps:
+        for i, t in enumerate(scheduler.timesteps):
             prev_trajectory = trajectory.detach().clone()
+            # the attack steps of this timestep start from the solver state before
+            # the sampling step, on a fork when the solver is multistep
+            attack_scheduler = fork_scheduler(scheduler) if attack_mask[i] else None
             # handle different ways of passing observation
             # 1. apply conditioning
             trajectory[cond_mask] = cond_data[cond_mask]
@@ -378,12 +456,14 @@ class DiffusionUnetHybridImagePolicy(BaseImagePolicy):
                 # 3. compute previous image: x_t -> x_t-1
                 trajectory = scheduler.step(
                     model_output, t, trajectory,
-                    **self.kwargs
+                    **step_kwargs
                 ).prev_sample
-            # if t is less than than 1 - cfg.attack_after_timesteps * self.num_inference_steps then
-            # perturb the observation
+            if recorder is not None:
+                recorder(i, len(scheduler.timesteps), t, trajectory)
+            # perturb the observation only at the denoising steps chosen by the attack schedule
             prev_obs = nobs.copy()
-            if t < (1 - cfg.attack_after_timesteps) * self.num_inference_steps:
+            if attack_mask[i]:
+                n_attacked += 1
                 if cfg.targeted:
                     target_trajectory = trajectory.detach() + torch.tensor(cfg.perturbations, device=trajectory.device).unsqueeze(0)
                 else:
@@ -396,13 +476,13 @@ class DiffusionUnetHybridImagePolicy(BaseImagePolicy):
                     if self.obs_as_global_cond:
                         # condition through global feature
                         this_nobs = dict_apply(nobs_perturbed, lambda x: x[:,:To,...].reshape(-1,*x.shape[2:]))
-                        nobs_features = self.obs_encoder(this_nobs)
+                        nobs_features = feature_cache(this_nobs)
                         # reshape back to B, Do
                         global_cond = nobs_features.reshape(B, -1)
                     else:
                         # condition through impainting
                         this_nobs = dict_apply(nobs_perturbed, lambda x: x[:,:To,...].reshape(-1,*x.shape[2:]))
-                        nobs_features = self.obs_encoder(this_nobs)
+                        nobs_features = feature_cache(this_nobs)
                         # reshape back to B, To, Do
                         nobs_features = nobs_features.reshape(B, To, -1)
                     
@@ -411,9 +491,9 @@ class DiffusionUnetHybridImagePolicy(BaseImagePolicy):
                     # 2. predict model output
                     model_output = model(predicted_trajectory, t, local_cond=local_cond, global_cond=global_cond)
                     # 3. compute previous image: x_t -> x_t-1
-                    predicted_trajectory = scheduler.step(
+                    predicted_trajectory = fork_scheduler(attack_scheduler).step(
                         model_output, t, predicted_trajectory,
-                        **self.kwargs
+                        **step_kwargs
                     ).prev_sample
                     
                     # compute loss
@@ -431,9 +511,15 @@ class DiffusionUnetHybridImagePolicy(BaseImagePolicy):
                     
                     # compute gradients
                     # print(f"Loss at timestep {t} and iteration {j} is {loss}")
-                    if cfg.log:
+                    if telemetry is not None:
+                        # stays on the device, no sync per iteration
+                        telemetry.record('dp_loss', loss)
+                        telemetry.record('dp_euc_dist', euc_dist)
+                        telemetry.record('dp_l1_dist', l1_dist)
+                    elif cfg.log:
                         wandb.log({f"loss": loss.item(), f"euc_dist": euc_dist.item(), f"l1_dist": l1_dist.item()})
                     loss.backward()
+                    last_loss = loss.detach()
                     
                     for view in views:
                         # update the observation
@@ -441,7 +527,8 @@ class DiffusionUnetHybridImagePolicy(BaseImagePolicy):
                         nobs_perturbed[view] = nobs_perturbed[view] + cfg.eps_iter * torch.sign(nobs_perturbed[view].grad)
                         perturbation = nobs_perturbed[view] - prev_obs[view]
                         # clip the perturbation
-                        perturbation = torch.clamp(perturbation, -cfg.epsilon, cfg.epsilon)
+                        view_epsilon = broadcast_epsilon(epsilon, perturbation)
+                        perturbation = torch.clamp(perturbation, -view_epsilon, view_epsilon)
                         nobs_perturbed[view] = prev_obs[view] + perturbation
                         # clamp the observation to be within the range
                         nobs_perturbed[view] = torch.clamp(nobs_perturbed[view], cfg.clip_min, cfg.clip_max)
@@ -458,7 +545,17 @@ class DiffusionUnetHybridImagePolicy(BaseImagePolicy):
         # perturbation = torch.abs(nobs_perturbed['robot0_eye_in_hand_image'].flatten() - prev_obs['robot0_eye_in_hand_image'].flatten())
         # ind_max = torch.argmax(perturbation)
         # print(f"The nobs and prev obs values at the index of maximum perturbation are {nobs_perturbed_flattend[ind_max]} and {prev_obs_flattend[ind_max]}")
-        nobs_perturbed = self.normalizer.unnormalize(nobs_perturbed)      
+        nobs_perturbed = self.normalizer.unnormalize(nobs_perturbed)
+        # non-attacked keys are passed through untouched
+        nobs_perturbed = dict(obs_dict, **nobs_perturbed)
+        self.attack_stats = {
+            'denoise_steps': n_inference_steps,
+            'attacked_steps': n_attacked,
+            'grad_evals': n_attacked * cfg.num_iter,
+            'full_grad_evals': self.num_inference_steps * cfg.num_iter,
+            # device tensor, AttackScheduleReport syncs once in summary()
+            'final_loss': last_loss,
+        }
         # nobs_perturbed_flattend = nobs_perturbed['robot0_eye_in_hand_image'].flatten()
         # obs_dict_flattend = obs_dict['robot0_eye_in_hand_image'].flatten()
         # print(f"The nobs and obs values at the index of maximum perturbation are {nobs_perturbed_flattend[ind_max]} and {obs_dict_flattend[ind_max]}")
@@ -476,7 +573,12 @@ class DiffusionUnetHybridImagePolicy(BaseImagePolicy):
     def set_normalizer(self, normalizer: LinearNormalizer):
         self.normalizer.load_state_dict(normalizer.state_dict())
 
-    def compute_loss(self, batch):
+    @autocast_method
+    def compute_loss(self, batch, nobs_features=None):
+        """
+        nobs_features: optional (B, To, Do) output of encode_obs(batch['obs']),
+        only used when conditioning through global features.
+        """
         # normalize input
         assert 'valid_mask' not in batch
         nobs = self.normalizer.normalize(batch['obs'])
@@ -492,10 +594,11 @@ class DiffusionUnetHybridImagePolicy(BaseImagePolicy):
         cond_data = trajectory
         if self.obs_as_global_cond:
             # reshape B, T, ... to B*T
-            this_nobs = dict_apply(nobs, 
-                lambda x: x[:,:self.n_obs_steps,...].reshape(-1,*x.shape[2:]))
-            this_nobs = dict_apply(this_nobs, lambda x: x.to(self.device))
-            nobs_features = self.obs_encoder(this_nobs)
+            if nobs_features is None:
+                this_nobs = dict_apply(nobs, 
+                    lambda x: x[:,:self.n_obs_steps,...].reshape(-1,*x.shape[2:]))
+                this_nobs = dict_apply(this_nobs, lambda x: x.to(self.device))
+                nobs_features = self.obs_encoder(this_nobs)
             # reshape back to B, Do
             global_cond = nobs_features.reshape(batch_size, -1)
         else:
@@ -695,10 +798,50 @@ class DiffusionUnetHybridImagePolicy_TH(BaseImagePolicy):
         if num_inference_steps is None:
             num_inference_steps = noise_scheduler.config.num_train_timesteps
         self.num_inference_steps = num_inference_steps
+        # optional sampler swapped in at load time, see set_inference_scheduler
+        self.inference_scheduler = None
+        self.inference_step_kwargs = dict()
+        # opt-in hook for intermediate denoising steps, see set_trajectory_recorder
+        self.trajectory_recorder = None
 
         print("Diffusion params: %e" % sum(p.numel() for p in self.model.parameters()))
         print("Vision params: %e" % sum(p.numel() for p in self.obs_encoder.parameters()))
 
+    def set_inference_scheduler(self, name=None, num_inference_steps=None,
+            step_kwargs=None, **scheduler_kwargs):
+        """
+        Sample with a different scheduler (e.g. name='ddim', num_inference_steps=16)
+        without retraining. name=None restores the training scheduler.
+        compute_loss always uses noise_scheduler.
+        """
+        if name is None:
+            self.inference_scheduler = None
+            self.inference_step_kwargs = dict()
+        else:
+            self.inference_scheduler = get_inference_scheduler(
+                self.noise_scheduler, name, **scheduler_kwargs)
+            self.inference_step_kwargs = dict() if step_kwargs is None else dict(step_kwargs)
+        if num_inference_steps is not None:
+            self.num_inference_steps = num_inference_steps
+        print(f"Inference scheduler: {type(self.get_sampling_scheduler()[0]).__name__}, "
+            f"{self.num_inference_steps} steps")
+
+    def set_trajectory_recorder(self, recorder: Optional[TrajectoryRecorder]):
+        """
+        Attach a TrajectoryRecorder to receive every denoising step of
+        conditional_sample and pgd_perturbed_obs, None detaches it.
+        """
+        self.trajectory_recorder = recorder
+        return recorder
+
+    def get_sampling_scheduler(self):
+        """
+        Scheduler and scheduler.step kwargs used for sampling.
+        """
+        if self.inference_scheduler is None:
+            return self.noise_scheduler, self.kwargs
+        return self.inference_scheduler, self.inference_step_kwargs
+
     # ========= inference  ============
     def conditional_sample(self,
                            condition_data, condition_mask,
@@ -708,7 +851,11 @@ class DiffusionUnetHybridImagePolicy_TH(BaseImagePolicy):
                            **kwargs
                            ):
         model = self.model
-        scheduler = self.noise_scheduler
+        scheduler, step_kwargs = self.get_sampling_scheduler()
+        if self.inference_scheduler is None:
+            step_kwargs = kwargs
+        if generator is not None:
+            step_kwargs = dict(step_kwargs, generator=generator)
 
         trajectory = torch.randn(
             size=condition_data.shape,
@@ -718,9 +865,12 @@ class DiffusionUnetHybridImagePolicy_TH(BaseImagePolicy):
 
         # set step values
         scheduler.set_timesteps(self.num_inference_steps)
-        self.trajectories = []
+        recorder = self.trajectory_recorder
+        if recorder is not None:
+            recorder.reset()
 
-        for t in scheduler.timesteps:
+        n_steps = len(scheduler.timesteps)
+        for i, t in enumerate(scheduler.timesteps):
             # 1. apply conditioning
             trajectory[condition_mask] = condition_data[condition_mask]
 
@@ -731,19 +881,34 @@ class DiffusionUnetHybridImagePolicy_TH(BaseImagePolicy):
             # 3. compute previous image: x_t -> x_t-1
             trajectory = scheduler.step(
                 model_output, t, trajectory,
-                generator=generator,
-                **kwargs
+                **step_kwargs
             ).prev_sample
-            self.trajectories.append(trajectory)
+            if recorder is not None:
+                recorder(i, n_steps, t, trajectory)
 
         # finally make sure conditioning is enforced
         trajectory[condition_mask] = condition_data[condition_mask]
 
         return trajectory
 
-    def predict_action(self, obs_dict: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+    @autocast_method
+    def encode_obs(self, obs_dict: Dict[str, torch.Tensor]) -> torch.Tensor:
+        """
+        Normalize and encode the first n_obs_steps of obs_dict.
+        result: (B, To, Do) observation features
+        """
+        nobs = self.normalizer.normalize(obs_dict)
+        B = next(iter(nobs.values())).shape[0]
+        To = self.n_obs_steps
+        this_nobs = dict_apply(nobs, lambda x: x[:,:To,...].reshape(-1,*x.shape[2:]).to(self.device))
+        nobs_features = self.obs_encoder(this_nobs)
+        return nobs_features.reshape(B, To, -1)
+
+    @autocast_method
+    def predict_action(self, obs_dict: Dict[str, torch.Tensor], nobs_features=None) -> Dict[str, torch.Tensor]:
         """
         obs_dict: must include "obs" key
+        nobs_features: optional (B, To, Do) output of encode_obs(obs_dict), skips the encoder
         result: must include "action" key
         """
         assert 'past_action' not in obs_dict  # not implemented yet
@@ -769,12 +934,8 @@ class DiffusionUnetHybridImagePolicy_TH(BaseImagePolicy):
         global_cond = None
         if self.obs_as_global_cond:
             # condition through global feature
-            for key in nobs.keys():
-                print(f"Key: {key} and shape: {nobs[key].shape}")
-            this_nobs = dict_apply(nobs, lambda x: x[:, :To, ...].reshape(-1, *x.shape[2:]))
-            this_nobs = dict_apply(this_nobs, lambda x: x.to(device))
-            print("This nobs shape: ", this_nobs['sideview_image'].shape)
-            nobs_features = self.obs_encoder(this_nobs)
+            if nobs_features is None:
+                nobs_features = self.encode_obs(obs_dict)
             # reshape back to B, Do
             global_cond = nobs_features.reshape(B, -1)
             # empty data for action
@@ -782,10 +943,8 @@ class DiffusionUnetHybridImagePolicy_TH(BaseImagePolicy):
             cond_mask = torch.zeros_like(cond_data, dtype=torch.bool)
         else:
             # condition through impainting
-            this_nobs = dict_apply(nobs, lambda x: x[:, :To, ...].reshape(-1, *x.shape[2:]))
-            nobs_features = self.obs_encoder(this_nobs)
-            # reshape back to B, To, Do
-            nobs_features = nobs_features.reshape(B, To, -1)
+            if nobs_features is None:
+                nobs_features = self.encode_obs(obs_dict)
             cond_data = torch.zeros(size=(B, T, Da + Do), device=device, dtype=dtype)
             cond_mask = torch.zeros_like(cond_data, dtype=torch.bool)
             cond_data[:, :To, Da:] = nobs_features
@@ -811,11 +970,13 @@ class DiffusionUnetHybridImagePolicy_TH(BaseImagePolicy):
         result = {
             'action': action,
             'action_pred': action_pred,
-            # 'trajectories': self.trajectories,
+            'obs_features': nobs_features,
         }
         return result
 
-    def pgd_perturbed_obs(self, obs_dict: Dict[str, torch.Tensor], cfg):
+    @autocast_method
+    def pgd_perturbed_obs(self, obs_dict: Dict[str, torch.Tensor], cfg, epsilon=None,
+            telemetry=None):
         """
         This function uses pgd attack to generate adversarial perturbations.
         The main idea is to perturb the observation after certain timesteps when the
@@ -826,8 +987,13 @@ class DiffusionUnetHybridImagePolicy_TH(BaseImagePolicy):
         We will accumulate this perturbed_obs over the timesteps and return it.
         The main indication of the attack being successful is to have the loss go down over time
         for each timestep.
+        Which denoising steps are attacked is decided by AttackSchedule (cfg.attack_schedule),
+        the compute/strength stats of the call are left in self.attack_stats.
+        epsilon overrides cfg.epsilon, a (B,) tensor gives every sample its own budget.
         """
         assert 'past_action' not in obs_dict
+        if epsilon is None:
+            epsilon = cfg.epsilon
         view = cfg.view
         if view == 'both':
             views = ['agentview_image', 'robot0_eye_in_hand_image']
@@ -850,7 +1016,7 @@ class DiffusionUnetHybridImagePolicy_TH(BaseImagePolicy):
         Do = self.obs_feature_dim
         To = self.n_obs_steps
         model = self.model
-        scheduler = self.noise_scheduler
+        scheduler, step_kwargs = self.get_sampling_scheduler()
         device = self.device
         dtype = self.dtype
         if self.obs_as_global_cond:
@@ -867,32 +1033,42 @@ class DiffusionUnetHybridImagePolicy_TH(BaseImagePolicy):
             size=cond_data.shape,
             dtype=cond_data.dtype,
             device=cond_data.device, )
-        nobs_perturbed = nobs.copy()
-        nobs_perturbed = dict_apply(nobs_perturbed, lambda x: x.requires_grad_(True))
-
-        # set step values
-        scheduler.set_timesteps(self.num_inference_steps)
-        self.trajectories = []
+        # only the attacked views are optimized, the rest is served from the feature cache
+        nobs_perturbed = {view: nobs[view].detach() for view in views}
+
+        # set step values, the attack schedule may compress the inference schedule
+        schedule = AttackSchedule.from_cfg(cfg)
+        n_inference_steps = schedule.num_inference_steps(self.num_inference_steps)
+        scheduler.set_timesteps(n_inference_steps)
+        attack_mask = schedule.attack_mask(scheduler.timesteps, self.num_inference_steps)
+        n_attacked = 0
+        last_loss = None
+        recorder = self.trajectory_recorder
+        if recorder is not None:
+            recorder.reset()
         global_cond = None
         local_cond = None
         prev_trajectory = None
         if self.obs_as_global_cond:
             # condition through global feature
             this_nobs_pure = dict_apply(nobs, lambda x: x[:, :To, ...].reshape(-1, *x.shape[2:]))
-            with torch.no_grad():
-                nobs_features_pure = self.obs_encoder(this_nobs_pure)
+            feature_cache = ObsFeatureCache(self.obs_encoder, this_nobs_pure, views)
+            nobs_features_pure = feature_cache.clean_features()
             # reshape back to B, Do
             global_cond_pure = nobs_features_pure.reshape(B, -1)
         else:
             # condition through impainting
             this_nobs_pure = dict_apply(nobs, lambda x: x[:, :To, ...].reshape(-1, *x.shape[2:]))
-            with torch.no_grad():
-                nobs_features_pure = self.obs_encoder(this_nobs_pure)
+            feature_cache = ObsFeatureCache(self.obs_encoder, this_nobs_pure, views)
+            nobs_features_pure = feature_cache.clean_features()
             # reshape back to B, To, Do
             nobs_features_pure = nobs_features_pure.reshape(B, To, -1)
 
-        for t in scheduler.timesteps:
+        for i, t in enumerate(scheduler.timesteps):
             prev_trajectory = trajectory.detach().clone()
+            # the attack steps of this timestep start from the solver state before
+            # the sampling step, on a fork when the solver is multistep
+            attack_scheduler = fork_scheduler(scheduler) if attack_mask[i] else None
             # handle different ways of passing observation
             # 1. apply conditioning
             trajectory[cond_mask] = cond_data[cond_mask]
@@ -903,12 +1079,14 @@ class DiffusionUnetHybridImagePolicy_TH(BaseImagePolicy):
                 # 3. compute previous image: x_t -> x_t-1
                 trajectory = scheduler.step(
                     model_output, t, trajectory,
-                    **self.kwargs
+                    **step_kwargs
                 ).prev_sample
-            # if t is less than than 1 - cfg.attack_after_timesteps * self.num_inference_steps then
-            # perturb the observation
+            if recorder is not None:
+                recorder(i, len(scheduler.timesteps), t, trajectory)
+            # perturb the observation only at the denoising steps chosen by the attack schedule
             prev_obs = nobs.copy()
-            if t < (1 - cfg.attack_after_timesteps) * self.num_inference_steps:
+            if attack_mask[i]:
+                n_attacked += 1
                 if cfg.targeted:
                     target_trajectory = trajectory.detach() + torch.tensor(cfg.perturbations,
                                                                            device=trajectory.device).unsqueeze(0)
@@ -922,13 +1100,13 @@ class DiffusionUnetHybridImagePolicy_TH(BaseImagePolicy):
                     if self.obs_as_global_cond:
                         # condition through global feature
                         this_nobs = dict_apply(nobs_perturbed, lambda x: x[:, :To, ...].reshape(-1, *x.shape[2:]))
-                        nobs_features = self.obs_encoder(this_nobs)
+                        nobs_features = feature_cache(this_nobs)
                         # reshape back to B, Do
                         global_cond = nobs_features.reshape(B, -1)
                     else:
                         # condition through impainting
                         this_nobs = dict_apply(nobs_perturbed, lambda x: x[:, :To, ...].reshape(-1, *x.shape[2:]))
-                        nobs_features = self.obs_encoder(this_nobs)
+                        nobs_features = feature_cache(this_nobs)
                         # reshape back to B, To, Do
                         nobs_features = nobs_features.reshape(B, To, -1)
 
@@ -937,9 +1115,9 @@ class DiffusionUnetHybridImagePolicy_TH(BaseImagePolicy):
                     # 2. predict model output
                     model_output = model(predicted_trajectory, t, local_cond=local_cond, global_cond=global_cond)
                     # 3. compute previous image: x_t -> x_t-1
-                    predicted_trajectory = scheduler.step(
+                    predicted_trajectory = fork_scheduler(attack_scheduler).step(
                         model_output, t, predicted_trajectory,
-                        **self.kwargs
+                        **step_kwargs
                     ).prev_sample
 
                     # compute loss
@@ -957,9 +1135,15 @@ class DiffusionUnetHybridImagePolicy_TH(BaseImagePolicy):
 
                     # compute gradients
                     # print(f"Loss at timestep {t} and iteration {j} is {loss}")
-                    if cfg.log:
+                    if telemetry is not None:
+                        # stays on the device, no sync per iteration
+                        telemetry.record('dp_loss', loss)
+                        telemetry.record('dp_euc_dist', euc_dist)
+                        telemetry.record('dp_l1_dist', l1_dist)
+                    elif cfg.log:
                         wandb.log({f"loss": loss.item(), f"euc_dist": euc_dist.item(), f"l1_dist": l1_dist.item()})
                     loss.backward()
+                    last_loss = loss.detach()
 
                     for view in views:
                         # update the observation
@@ -968,7 +1152,8 @@ class DiffusionUnetHybridImagePolicy_TH(BaseImagePolicy):
                             nobs_perturbed[view].grad)
                         perturbation = nobs_perturbed[view] - prev_obs[view]
                         # clip the perturbation
-                        perturbation = torch.clamp(perturbation, -cfg.epsilon, cfg.epsilon)
+                        view_epsilon = broadcast_epsilon(epsilon, perturbation)
+                        perturbation = torch.clamp(perturbation, -view_epsilon, view_epsilon)
                         nobs_perturbed[view] = prev_obs[view] + perturbation
                         # clamp the observation to be within the range
                         nobs_perturbed[view] = torch.clamp(nobs_perturbed[view], cfg.clip_min, cfg.clip_max)
@@ -986,6 +1171,16 @@ class DiffusionUnetHybridImagePolicy_TH(BaseImagePolicy):
         # ind_max = torch.argmax(perturbation)
         # print(f"The nobs and prev obs values at the index of maximum perturbation are {nobs_perturbed_flattend[ind_max]} and {prev_obs_flattend[ind_max]}")
         nobs_perturbed = self.normalizer.unnormalize(nobs_perturbed)
+        # non-attacked keys are passed through untouched
+        nobs_perturbed = dict(obs_dict, **nobs_perturbed)
+        self.attack_stats = {
+            'denoise_steps': n_inference_steps,
+            'attacked_steps': n_attacked,
+            'grad_evals': n_attacked * cfg.num_iter,
+            'full_grad_evals': self.num_inference_steps * cfg.num_iter,
+            # device tensor, AttackScheduleReport syncs once in summary()
+            'final_loss': last_loss,
+        }
         # nobs_perturbed_flattend = nobs_perturbed['robot0_eye_in_hand_image'].flatten()
         # obs_dict_flattend = obs_dict['robot0_eye_in_hand_image'].flatten()
         # print(f"The nobs and obs values at the index of maximum perturbation are {nobs_perturbed_flattend[ind_max]} and {obs_dict_flattend[ind_max]}")
@@ -1002,7 +1197,12 @@ class DiffusionUnetHybridImagePolicy_TH(BaseImagePolicy):
     def set_normalizer(self, normalizer: LinearNormalizer):
         self.normalizer.load_state_dict(normalizer.state_dict())
 
-    def compute_loss(self, batch):
+    @autocast_method
+    def compute_loss(self, batch, nobs_features=None):
+        """
+        nobs_features: optional (B, To, Do) output of encode_obs(batch['obs']),
+        only used when conditioning through global features.
+        """
         # normalize input
         assert 'valid_mask' not in batch
         nobs = self.normalizer.normalize(batch['obs'])
@@ -1018,10 +1218,11 @@ class DiffusionUnetHybridImagePolicy_TH(BaseImagePolicy):
         cond_data = trajectory
         if self.obs_as_global_cond:
             # reshape B, T, ... to B*T
-            this_nobs = dict_apply(nobs,
-                                   lambda x: x[:, :self.n_obs_steps, ...].reshape(-1, *x.shape[2:]))
-            this_nobs = dict_apply(this_nobs, lambda x: x.to(self.device))
-            nobs_features = self.obs_encoder(this_nobs)
+            if nobs_features is None:
+                this_nobs = dict_apply(nobs,
+                                       lambda x: x[:, :self.n_obs_steps, ...].reshape(-1, *x.shape[2:]))
+                this_nobs = dict_apply(this_nobs, lambda x: x.to(self.device))
+                nobs_features = self.obs_encoder(this_nobs)
             # reshape back to B, Do
             global_cond = nobs_features.reshape(batch_size, -1)
         else:
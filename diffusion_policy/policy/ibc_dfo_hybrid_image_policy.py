@@ -3,7 +3,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from diffusion_policy.model.common.normalizer import LinearNormalizer
-from diffusion_policy.policy.base_image_policy import BaseImagePolicy
+from diffusion_policy.policy.base_image_policy import BaseImagePolicy, autocast_method
 from diffusion_policy.common.robomimic_config_util import get_robomimic_config
 from robomimic.algo import algo_factory
 from robomimic.algo.algo import PolicyAlgo
@@ -164,6 +164,7 @@ class IbcDfoHybridImagePolicy(BaseImagePolicy):
         return x
 
     # ========= inference  ============
+    @autocast_method
     def predict_action(self, obs_dict: Dict[str, torch.Tensor], return_energy=False, adversarial_action=None) -> Dict[str, torch.Tensor]:
         """
         obs_dict: must include "obs" key
@@ -272,6 +273,7 @@ class IbcDfoHybridImagePolicy(BaseImagePolicy):
     def set_normalizer(self, normalizer: LinearNormalizer):
         self.normalizer.load_state_dict(normalizer.state_dict())
 
+    @autocast_method
     def compute_loss(self, batch):
         # normalize input
         assert 'valid_mask' not in batch
@@ -332,6 +334,7 @@ class IbcDfoHybridImagePolicy(BaseImagePolicy):
             loss = F.cross_entropy(logits, labels)
         return loss
 
+    @autocast_method
     def compute_loss_with_grad(self, obs_dict_copy, actions, action_samples = None, return_energy=False):
         """
         Similar to the compute_loss function, but does not create 
@@ -485,6 +488,7 @@ class IbcDfoHybridImagePolicy(BaseImagePolicy):
         adv_patch = torch.clamp(adv_patch, -cfg.eps, cfg.eps)
         return adv_patch, loss.item()
 
+    @autocast_method
     def action_dist(self, obs_dict: Dict[str, torch.Tensor]):
         """
         obs_dict: must include "obs" key
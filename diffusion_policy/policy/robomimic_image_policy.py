@@ -2,7 +2,7 @@ from typing import Dict
 import torch
 import torch.nn as nn
 from diffusion_policy.model.common.normalizer import LinearNormalizer
-from diffusion_policy.policy.base_image_policy import BaseImagePolicy
+from diffusion_policy.policy.base_image_policy import BaseImagePolicy, autocast_method
 from diffusion_policy.common.pytorch_util import dict_apply
 import wandb
 
@@ -12,6 +12,9 @@ import robomimic.utils.obs_utils as ObsUtils
 from diffusion_policy.common.robomimic_config_util import get_robomimic_config
 
 class RobomimicImagePolicy(BaseImagePolicy):
+    # rnn hidden state of the env batch
+    batch_stateful = True
+
     def __init__(self, 
             shape_meta: dict,
             algo_name='bc_rnn',
@@ -98,6 +101,7 @@ class RobomimicImagePolicy(BaseImagePolicy):
         super().to(*args,**kwargs)
     
     # =========== inference =============
+    @autocast_method
     def predict_action(self, obs_dict: Dict[str, torch.Tensor], cfg_activation=None) -> Dict[str, torch.Tensor]:
         nobs_dict = self.normalizer(obs_dict)
         robomimic_obs_dict = dict_apply(nobs_dict, lambda x: x[:,0,...])
@@ -111,6 +115,7 @@ class RobomimicImagePolicy(BaseImagePolicy):
         }
         return result
 
+    @autocast_method
     def action_dist(self, obs_dict: Dict[str, torch.Tensor]):
         nobs_dict = self.normalizer(obs_dict)
         robomimic_obs_dict = dict_apply(nobs_dict, lambda x: x[:,0,...])
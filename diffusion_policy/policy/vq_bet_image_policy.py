@@ -26,7 +26,7 @@ import numpy as np
 import torch
 import torch.nn as nn
 from diffusion_policy.model.common.normalizer import LinearNormalizer
-from diffusion_policy.policy.base_image_policy import BaseImagePolicy
+from diffusion_policy.policy.base_image_policy import BaseImagePolicy, autocast_method
 import wandb
 import torch.nn.functional as F  # noqa: N812
 import torchvision
@@ -47,6 +47,9 @@ from diffusion_policy.common.pytorch_util import dict_apply, replace_submodules
 # ruff: noqa: N806
 
 class VQBeTPolicy(BaseImagePolicy):
+    # obs and action queues of the env batch
+    batch_stateful = True
+
     def __init__(self,
                  shape_meta: dict,
                  algo_name: str,
@@ -107,6 +110,7 @@ class VQBeTPolicy(BaseImagePolicy):
         return super().to(*args, **kwargs)
 
     @torch.no_grad()
+    @autocast_method
     def predict_action(self, obs_dict: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
         nobs_dict = self.normalizer(obs_dict)
         try:
@@ -155,6 +159,7 @@ class VQBeTPolicy(BaseImagePolicy):
                 queue.append(batch[key])
         return queues
 
+    @autocast_method
     def action_dist(self, obs_dict: Dict[str, torch.Tensor]):
         nobs_dict = self.normalizer(obs_dict)
         nobs_dict = dict_apply(nobs_dict, lambda x: x[:, 0, ...])
@@ -166,6 +171,7 @@ class VQBeTPolicy(BaseImagePolicy):
     def set_normalizer(self, normalizer: LinearNormalizer):
         self.normalizer.load_state_dict(normalizer.state_dict())
 
+    @autocast_method
     def compute_loss(self, batch, epoch=None, validate=False):
         nobs = self.normalizer(batch['obs'])
         nactions = self.normalizer['action'].normalize(batch['action'])
@@ -25,7 +25,8 @@ from diffusion_policy.dataset.base_dataset import BaseImageDataset
 from diffusion_policy.env_runner.base_image_runner import BaseImageRunner
 from diffusion_policy.common.checkpoint_util import TopKCheckpointManager
 from diffusion_policy.common.json_logger import JsonLogger
-from diffusion_policy.common.pytorch_util import dict_apply, optimizer_to
+from diffusion_policy.adversarial_attacks.uap_trainer import UAPTrainer
+from diffusion_policy.common.pytorch_util import dict_apply, optimizer_to, to_device_float
 from diffusion_policy.model.diffusion.ema_model import EMAModel
 from diffusion_policy.model.common.lr_scheduler import get_scheduler
 from diffusion_policy.model.common.normalizer import (
@@ -295,6 +296,8 @@ class TrainBETImageWorkspace(BaseWorkspace):
                 self.epoch += 1
 import dill
 import pickle 
+from diffusion_policy.adversarial_attacks.perturbation_store import load_perturbation
+from diffusion_policy.env_runner.background_eval import BackgroundEvaluator, log_uap_rollout
 import torch.nn.functional as F
 from scipy.fft import fft2, ifft2
 import matplotlib.pyplot as plt
@@ -308,6 +311,20 @@ def differentiable_normalize(tensor, eps=1e-8):
     normalized = (reshaped - min_vals) / (max_vals - min_vals + eps)
     return normalized.reshape(B, C, H, W)
 
+
+def log_bet_uap_rollout(cfg, epoch, univ_pert, runner_log):
+    """
+    log_uap_rollout, targeted perturbations are saved with their action offsets.
+    """
+    if cfg.targeted and not cfg.retrain:
+        perturbations = cfg.perturbations.copy()
+        univ_pert['perturbations'] = torch.tensor(perturbations).cpu()
+    extra = dict()
+    if cfg.retrain:
+        extra['retrained_from'] = str(cfg.patch_path)
+    log_uap_rollout(cfg, epoch, univ_pert, runner_log, **extra)
+
+
 class TrainBETUniPertImageWorkspaceDP(BaseWorkspace):
     include_keys = ['global_step', 'epoch']
 
@@ -368,13 +385,15 @@ class TrainBETUniPertImageWorkspaceDP(BaseWorkspace):
             normalizer['action'].normalize(dataset.get_all_actions())
         )
         print("Configuring environment runner")
-        # configure env
+        # configure env, the background evaluator builds its own
         # cfg.task.env_runner.n_envs = 2
+        evaluator = BackgroundEvaluator.from_cfg(cfg, self.output_dir, normalizer=normalizer)
         env_runner: BaseImageRunner
-        env_runner = hydra.utils.instantiate(
-            cfg.task.env_runner,
-            output_dir=self.output_dir)
-        assert isinstance(env_runner, BaseImageRunner)
+        if evaluator is None:
+            env_runner = hydra.utils.instantiate(
+                cfg.task.env_runner,
+                output_dir=self.output_dir)
+            assert isinstance(env_runner, BaseImageRunner)
 
         if cfg.log:
             wandb.init(
@@ -412,8 +431,13 @@ class TrainBETUniPertImageWorkspaceDP(BaseWorkspace):
         # define the perturbation to be random noise within epsilon
         # self.univ_pert = torch.rand((1, 3, 84, 84)).to(device) * 2 * cfg.epsilon - cfg.epsilon
         if cfg.retrain:
-            self.univ_pert = pickle.load(open(cfg.patch_path, 'rb'))
-            print(f"Loaded perturbation with shape {self.univ_pert.shape}")
+            self.univ_pert = load_perturbation(cfg, device=device)
+            print(f"Loaded perturbation of views {list(self.univ_pert.keys())}")
+        uap_trainer = UAPTrainer.from_cfg(cfg, {view: self.univ_pert[view] for view in views},
+            num_training_steps=cfg.training.num_epochs * len(train_dataloader))
+        if uap_trainer is not None:
+            # updated after every minibatch, the views follow the trainer in place
+            self.univ_pert.update(uap_trainer.perturbation)
         # save batch for sampling
         train_sampling_batch = None
 
@@ -463,7 +487,7 @@ class TrainBETUniPertImageWorkspaceDP(BaseWorkspace):
                         torch.cuda.empty_cache()
                         self.model.zero_grad()
                         # device transfer
-                        batch = dict_apply(batch, lambda x: x.to(device, non_blocking=True))
+                        batch = dict_apply(batch, lambda x: to_device_float(x, device))
                         original_obs = batch['obs'].copy()
                         # with torch.no_grad():
                         #     nobs_clean = self.model.normalizer.normalize(batch['obs'])
@@ -556,6 +580,8 @@ class TrainBETUniPertImageWorkspaceDP(BaseWorkspace):
                                 total_grad[view] += obs[view].grad.sum(dim=0, keepdim=True)
                         else:
                             total_grad += obs[view].grad.sum(dim=0, keepdim=True)
+                        if uap_trainer is not None:
+                            uap_trainer.step({view: obs[view].grad for view in views})
                         # log the magnitude of the gradient
                         if cfg.log:
                             wandb.log({"gradient_magnitude": torch.norm(obs[view].grad).item()})
@@ -563,9 +589,10 @@ class TrainBETUniPertImageWorkspaceDP(BaseWorkspace):
                             for key, value in loss_components.items():
                                 wandb.log({key: value.item()})
                 # gradients[self.epoch] = total_grad
-                for view in views:
-                    self.univ_pert[view] = self.univ_pert[view] + cfg.epsilon_step * torch.sign(total_grad[view])
-                    self.univ_pert[view] = torch.clamp(self.univ_pert[view], -cfg.epsilon, cfg.epsilon)
+                if uap_trainer is None:
+                    for view in views:
+                        self.univ_pert[view] = self.univ_pert[view] + cfg.epsilon_step * torch.sign(total_grad[view])
+                        self.univ_pert[view] = torch.clamp(self.univ_pert[view], -cfg.epsilon, cfg.epsilon)
                 print(f"Loss per epoch: {loss_per_epoch}")
                 for view in views:
                     if cfg.log:
@@ -589,29 +616,24 @@ class TrainBETUniPertImageWorkspaceDP(BaseWorkspace):
 
                 # run rollout
                 if (self.epoch % cfg.training.rollout_every) == 0:
-                    runner_log = env_runner.run(self.model, self.univ_pert, cfg)
-                    # log all
-                    step_log.update(runner_log)
-                    test_mean_score= runner_log['test/mean_score']
-                    print(f"Test mean score: {test_mean_score}")
-                    save_name = f'pert_{cfg.epsilon}_epoch_{self.epoch}_mean_score_{test_mean_score}_{cfg.view}.pkl'
-                    if cfg.log:
-                        wandb.log({"test_mean_score": test_mean_score, "epoch": self.epoch})
-                    if cfg.retrain:
-                        patch_path = cfg.patch_path[:-4] + '_retrain.pkl'
-                    elif cfg.targeted:
-                        # patch_path = os.path.join(os.path.dirname(cfg.checkpoint), f'tar_pert_{cfg.epsilon}_epoch_{self.epoch}_mean_score_{test_mean_score}_{view}_ker_{cfg.kernel_size}_with_reg{cfg.eta}.pkl')
-                        patch_path = os.path.join(os.path.dirname(cfg.checkpoint), f'tar_{save_name}')
-                        perturbations = cfg.perturbations.copy()
-                        perturbations = torch.tensor(perturbations).cpu()
-                        self.univ_pert['perturbations'] = perturbations
+                    if evaluator is None:
+                        runner_log = env_runner.run(self.model, adversarial_patch=self.univ_pert, cfg=cfg)
+                        # log all
+                        step_log.update(runner_log)
+                        log_bet_uap_rollout(cfg, self.epoch, self.univ_pert, runner_log)
                     else:
-                        # patch_path = os.path.join(os.path.dirname(cfg.checkpoint), f'untar_pert_{cfg.epsilon}_epoch_{self.epoch}_mean_score_{test_mean_score}_{view}_ker_{cfg.kernel_size}_with_reg{cfg.eta}.pkl')
-                        patch_path = os.path.join(os.path.dirname(cfg.checkpoint), f'untar_{save_name}')
-                    pickle.dump(self.univ_pert, open(patch_path, 'wb'))
+                        # scored while the next epochs train
+                        evaluator.submit(self.epoch, self.univ_pert)
+                if evaluator is not None:
+                    for epoch, univ_pert, runner_log in evaluator.poll():
+                        log_bet_uap_rollout(cfg, epoch, univ_pert, runner_log)
                 self.epoch += 1
                 json_logger.log(step_log)
                 self.global_step += 1
+        if evaluator is not None:
+            for epoch, univ_pert, runner_log in evaluator.wait():
+                log_bet_uap_rollout(cfg, epoch, univ_pert, runner_log)
+            evaluator.close()
         # if cfg.targeted:
         #     gradients_path = os.path.join(os.path.dirname(cfg.checkpoint), f'gradients_tar_{save_name}')
         # else:
@@ -25,7 +25,8 @@ from diffusion_policy.dataset.base_dataset import BaseImageDataset
 from diffusion_policy.env_runner.base_image_runner import BaseImageRunner
 from diffusion_policy.common.checkpoint_util import TopKCheckpointManager
 from diffusion_policy.common.json_logger import JsonLogger
-from diffusion_policy.common.pytorch_util import dict_apply, optimizer_to
+from diffusion_policy.adversarial_attacks.uap_trainer import UAPTrainer
+from diffusion_policy.common.pytorch_util import dict_apply, optimizer_to, to_device_float
 from diffusion_policy.model.diffusion.ema_model import EMAModel
 from diffusion_policy.model.common.lr_scheduler import get_scheduler
 
@@ -292,6 +293,7 @@ class TrainDiffusionUnetHybridWorkspace(BaseWorkspace):
 import dill
 import pickle
 from diffusion_policy.common.robomimic_util import RobomimicAbsoluteActionConverter
+from diffusion_policy.env_runner.background_eval import BackgroundEvaluator, log_uap_rollout
 
 
 class TrainRobomimicUniPertImageWorkspaceDP(BaseWorkspace):
@@ -358,12 +360,14 @@ class TrainRobomimicUniPertImageWorkspaceDP(BaseWorkspace):
             cfg.task.env_runner['max_steps'] = 24
             cfg.policy.noise_scheduler.num_train_timesteps = 10
 
-        # configure env
+        # configure env, the background evaluator builds its own
+        evaluator = BackgroundEvaluator.from_cfg(cfg, self.output_dir, normalizer=normalizer)
         env_runner: BaseImageRunner
-        env_runner = hydra.utils.instantiate(
-            cfg.task.env_runner,
-            output_dir=self.output_dir)
-        assert isinstance(env_runner, BaseImageRunner)
+        if evaluator is None:
+            env_runner = hydra.utils.instantiate(
+                cfg.task.env_runner,
+                output_dir=self.output_dir)
+            assert isinstance(env_runner, BaseImageRunner)
 
         if cfg.log:
             wandb.init(
@@ -384,6 +388,11 @@ class TrainRobomimicUniPertImageWorkspaceDP(BaseWorkspace):
         for view in views:
             # self.univ_pert[view] = torch.zeros((3, 84, 84)).to(device)
             self.univ_pert[view] = torch.zeros((image_shape[0], image_shape[1], image_shape[2])).to(device)
+        uap_trainer = UAPTrainer.from_cfg(cfg, {view: self.univ_pert[view] for view in views},
+            num_training_steps=cfg.training.num_epochs * len(train_dataloader))
+        if uap_trainer is not None:
+            # updated after every minibatch, the views follow the trainer in place
+            self.univ_pert.update(uap_trainer.perturbation)
         log_path = os.path.join(self.output_dir, 'logs.json.txt')
         with JsonLogger(log_path) as json_logger:
             for local_epoch_idx in range(cfg.training.num_epochs):
@@ -400,7 +409,7 @@ class TrainRobomimicUniPertImageWorkspaceDP(BaseWorkspace):
                     for batch_idx, batch in enumerate(tepoch):
                         self.model.zero_grad()
                         # device transfer
-                        batch = dict_apply(batch, lambda x: x.to(device, non_blocking=True))
+                        batch = dict_apply(batch, lambda x: to_device_float(x, device))
                         obs = batch['obs']
                         obs = dict_apply(obs, lambda x: x.to(device, non_blocking=True))
                         # apply the patch the view
@@ -433,15 +442,18 @@ class TrainRobomimicUniPertImageWorkspaceDP(BaseWorkspace):
                         loss_per_epoch += loss.item()
                         for view in views:
                             total_grad[view] += obs[view].grad.sum(dim=0, keepdim=True)[:, :cfg.n_obs_steps, ...]
+                        if uap_trainer is not None:
+                            uap_trainer.step({view: obs[view].grad[:, :cfg.n_obs_steps] for view in views})
                             # grad = obs[view].grad.sum(dim=0, keepdim=True)
                             # check if any element of the gradient is non-zero
                             # for i in range(grad.shape[1]):
                             #     if torch.any(grad[0, i, ...] != 0):
                             #         print(f"Non-zero gradient for {view} at index {i}")
-                for view in views:
-                    # print(f"Total grad shape: {total_grad[view].shape}")
-                    self.univ_pert[view] = self.univ_pert[view] + cfg.epsilon_step * torch.sign(total_grad[view])
-                    self.univ_pert[view] = torch.clamp(self.univ_pert[view], -cfg.epsilon, cfg.epsilon)
+                if uap_trainer is None:
+                    for view in views:
+                        # print(f"Total grad shape: {total_grad[view].shape}")
+                        self.univ_pert[view] = self.univ_pert[view] + cfg.epsilon_step * torch.sign(total_grad[view])
+                        self.univ_pert[view] = torch.clamp(self.univ_pert[view], -cfg.epsilon, cfg.epsilon)
                 print(f"Loss for {self.epoch}: {loss_per_epoch}")
                 if cfg.log:
                     wandb.log({"loss": loss_per_epoch, "epoch": self.epoch})
@@ -450,22 +462,22 @@ class TrainRobomimicUniPertImageWorkspaceDP(BaseWorkspace):
                     print(f"L2 norm of the {view} perturbation: {torch.norm(self.univ_pert[view], p=2)}")
                 # run rollout
                 if (self.epoch % cfg.training.rollout_every) == 0:
-                    runner_log = env_runner.run(self.model, self.univ_pert, cfg)
-                    # log all
-                    step_log.update(runner_log)
-                    test_mean_score = runner_log['test/mean_score']
-                    print(f"Test mean score: {test_mean_score}")
-                    if cfg.log:
-                        wandb.log({"test_mean_score": test_mean_score, "epoch": self.epoch})
-                    # save the patch
-                    if cfg.targeted:
-                        patch_path = os.path.join(os.path.dirname(cfg.checkpoint),
-                                                  f'tar_pert_{cfg.epsilon}_epoch_{self.epoch}_mean_score_{test_mean_score}_{view}.pkl')
+                    if evaluator is None:
+                        runner_log = env_runner.run(self.model, adversarial_patch=self.univ_pert, cfg=cfg)
+                        # log all
+                        step_log.update(runner_log)
+                        log_uap_rollout(cfg, self.epoch, self.univ_pert, runner_log)
                     else:
-                        patch_path = os.path.join(os.path.dirname(cfg.checkpoint),
-                                                  f'untar_pert_{cfg.epsilon}_epoch_{self.epoch}_mean_score_{test_mean_score}_{view}.pkl')
-                    pickle.dump(self.univ_pert, open(patch_path, 'wb'))
+                        # scored while the next epochs train
+                        evaluator.submit(self.epoch, self.univ_pert)
+                if evaluator is not None:
+                    for epoch, univ_pert, runner_log in evaluator.poll():
+                        log_uap_rollout(cfg, epoch, univ_pert, runner_log)
                 self.epoch += 1
+        if evaluator is not None:
+            for epoch, univ_pert, runner_log in evaluator.wait():
+                log_uap_rollout(cfg, epoch, univ_pert, runner_log)
+            evaluator.close()
         wandb.finish()
 
 
@@ -537,12 +549,14 @@ class TrainRobomimicUniPertImageWorkspaceDP_TH(BaseWorkspace):
             cfg.task.env_runner['max_steps'] = 24
             cfg.policy.noise_scheduler.num_train_timesteps = 10
 
-        # configure env
+        # configure env, the background evaluator builds its own
+        evaluator = BackgroundEvaluator.from_cfg(cfg, self.output_dir, normalizer=normalizer)
         env_runner: BaseImageRunner
-        env_runner = hydra.utils.instantiate(
-            cfg.task.env_runner,
-            output_dir=self.output_dir)
-        assert isinstance(env_runner, BaseImageRunner)
+        if evaluator is None:
+            env_runner = hydra.utils.instantiate(
+                cfg.task.env_runner,
+                output_dir=self.output_dir)
+            assert isinstance(env_runner, BaseImageRunner)
 
         if cfg.log:
             wandb.init(
@@ -563,6 +577,11 @@ class TrainRobomimicUniPertImageWorkspaceDP_TH(BaseWorkspace):
         for view in views:
             # self.univ_pert[view] = torch.zeros((3, 84, 84)).to(device)
             self.univ_pert[view] = torch.zeros((image_shape[0], image_shape[1], image_shape[2])).to(device)
+        uap_trainer = UAPTrainer.from_cfg(cfg, {view: self.univ_pert[view] for view in views},
+            num_training_steps=cfg.training.num_epochs * len(train_dataloader))
+        if uap_trainer is not None:
+            # updated after every minibatch, the views follow the trainer in place
+            self.univ_pert.update(uap_trainer.perturbation)
         log_path = os.path.join(self.output_dir, 'logs.json.txt')
         with JsonLogger(log_path) as json_logger:
             for local_epoch_idx in range(cfg.training.num_epochs):
@@ -579,7 +598,7 @@ class TrainRobomimicUniPertImageWorkspaceDP_TH(BaseWorkspace):
                     for batch_idx, batch in enumerate(tepoch):
                         self.model.zero_grad()
                         # device transfer
-                        batch = dict_apply(batch, lambda x: x.to(device, non_blocking=True))
+                        batch = dict_apply(batch, lambda x: to_device_float(x, device))
                         obs = batch['obs']
                         obs = dict_apply(obs, lambda x: x.to(device, non_blocking=True))
                         # apply the patch the view
@@ -612,15 +631,18 @@ class TrainRobomimicUniPertImageWorkspaceDP_TH(BaseWorkspace):
                         loss_per_epoch += loss.item()
                         for view in views:
                             total_grad[view] += obs[view].grad.sum(dim=0, keepdim=True)[:, :cfg.n_obs_steps, ...]
+                        if uap_trainer is not None:
+                            uap_trainer.step({view: obs[view].grad[:, :cfg.n_obs_steps] for view in views})
                             # grad = obs[view].grad.sum(dim=0, keepdim=True)
                             # check if any element of the gradient is non-zero
                             # for i in range(grad.shape[1]):
                             #     if torch.any(grad[0, i, ...] != 0):
                             #         print(f"Non-zero gradient for {view} at index {i}")
-                for view in views:
-                    # print(f"Total grad shape: {total_grad[view].shape}")
-                    self.univ_pert[view] = self.univ_pert[view] + cfg.epsilon_step * torch.sign(total_grad[view])
-                    self.univ_pert[view] = torch.clamp(self.univ_pert[view], -cfg.epsilon, cfg.epsilon)
+                if uap_trainer is None:
+                    for view in views:
+                        # print(f"Total grad shape: {total_grad[view].shape}")
+                        self.univ_pert[view] = self.univ_pert[view] + cfg.epsilon_step * torch.sign(total_grad[view])
+                        self.univ_pert[view] = torch.clamp(self.univ_pert[view], -cfg.epsilon, cfg.epsilon)
                 print(f"Loss for {self.epoch}: {loss_per_epoch}")
                 if cfg.log:
                     wandb.log({"loss": loss_per_epoch, "epoch": self.epoch})
@@ -629,22 +651,22 @@ class TrainRobomimicUniPertImageWorkspaceDP_TH(BaseWorkspace):
                     print(f"L2 norm of the {view} perturbation: {torch.norm(self.univ_pert[view], p=2)}")
                 # run rollout
                 if (self.epoch % cfg.training.rollout_every) == 0:
-                    runner_log = env_runner.run(self.model, self.univ_pert, cfg=cfg)
-                    # log all
-                    step_log.update(runner_log)
-                    test_mean_score = runner_log['test/mean_score']
-                    print(f"Test mean score: {test_mean_score}")
-                    if cfg.log:
-                        wandb.log({"test_mean_score": test_mean_score, "epoch": self.epoch})
-                    # save the patch
-                    if cfg.targeted:
-                        patch_path = os.path.join(os.path.dirname(cfg.checkpoint),
-                                                  f'tar_pert_{cfg.epsilon}_epoch_{self.epoch}_mean_score_{test_mean_score}_{view}.pkl')
+                    if evaluator is None:
+                        runner_log = env_runner.run(self.model, adversarial_patch=self.univ_pert, cfg=cfg)
+                        # log all
+                        step_log.update(runner_log)
+                        log_uap_rollout(cfg, self.epoch, self.univ_pert, runner_log)
                     else:
-                        patch_path = os.path.join(os.path.dirname(cfg.checkpoint),
-                                                  f'untar_pert_{cfg.epsilon}_epoch_{self.epoch}_mean_score_{test_mean_score}_{view}.pkl')
-                    pickle.dump(self.univ_pert, open(patch_path, 'wb'))
+                        # scored while the next epochs train
+                        evaluator.submit(self.epoch, self.univ_pert)
+                if evaluator is not None:
+                    for epoch, univ_pert, runner_log in evaluator.poll():
+                        log_uap_rollout(cfg, epoch, univ_pert, runner_log)
                 self.epoch += 1
+        if evaluator is not None:
+            for epoch, univ_pert, runner_log in evaluator.wait():
+                log_uap_rollout(cfg, epoch, univ_pert, runner_log)
+            evaluator.close()
         wandb.finish()
 @hydra.main(
     version_base=None,
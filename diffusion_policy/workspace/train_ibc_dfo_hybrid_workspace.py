@@ -273,6 +273,7 @@ class TrainIbcDfoHybridWorkspace(BaseWorkspace):
 
 import dill
 import pickle
+from diffusion_policy.adversarial_attacks.perturbation_store import save_universal_perturbation
 class TrainUnivPertIbcDfoHybridWorkspace(BaseWorkspace):
     include_keys = ['global_step', 'epoch']
 
@@ -489,12 +490,10 @@ class TrainUnivPertIbcDfoHybridWorkspace(BaseWorkspace):
                     if cfg.log:
                         wandb.log({"test_mean_score": test_mean_score, "epoch": self.epoch})
                     if cfg.retrain:
-                        patch_path = cfg.patch_path[:-4] + '_retrain.pkl'
-                    elif cfg.targeted:
-                        patch_path = os.path.join(os.path.dirname(cfg.checkpoint), f'tar_pert_{cfg.epsilon}_epoch_{self.epoch}_mean_score_{test_mean_score}_{view}.pkl')
+                        save_universal_perturbation(cfg, self.univ_pert, self.epoch, test_mean_score,
+                            retrained_from=str(cfg.patch_path))
                     else:
-                        patch_path = os.path.join(os.path.dirname(cfg.checkpoint), f'untar_pert_{cfg.epsilon}_epoch_{self.epoch}_mean_score_{test_mean_score}_{view}.pkl')
-                    pickle.dump(self.univ_pert, open(patch_path, 'wb'))
+                        save_universal_perturbation(cfg, self.univ_pert, self.epoch, test_mean_score)
                 self.epoch += 1
                 json_logger.log(step_log)
                 self.global_step += 1
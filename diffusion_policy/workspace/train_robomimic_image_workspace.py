@@ -22,13 +22,16 @@ import tqdm
 import numpy as np
 import shutil
 import pickle
+from diffusion_policy.env_runner.background_eval import BackgroundEvaluator, log_uap_rollout
 from diffusion_policy.workspace.base_workspace import BaseWorkspace
 from diffusion_policy.policy.robomimic_image_policy import RobomimicImagePolicy
 from diffusion_policy.dataset.base_dataset import BaseImageDataset
 from diffusion_policy.env_runner.base_image_runner import BaseImageRunner
 from diffusion_policy.common.checkpoint_util import TopKCheckpointManager
 from diffusion_policy.common.json_logger import JsonLogger
-from diffusion_policy.common.pytorch_util import dict_apply, optimizer_to
+from diffusion_policy.adversarial_attacks.uap_trainer import UAPTrainer
+from diffusion_policy.common.pytorch_util import dict_apply, optimizer_to, to_device_float
+from diffusion_policy.adversarial_attacks.clean_target_cache import build_clean_targets, IndexedDataset
 
 
 OmegaConf.register_new_resolver("eval", eval, replace=True)
@@ -291,12 +294,14 @@ class TrainRobomimicUniPertImageWorkspace(BaseWorkspace):
 
         self.model.set_normalizer(normalizer)
 
-        # configure env
+        # configure env, the background evaluator builds its own
+        evaluator = BackgroundEvaluator.from_cfg(cfg, self.output_dir, normalizer=normalizer)
         env_runner: BaseImageRunner
-        env_runner = hydra.utils.instantiate(
-            cfg.task.env_runner,
-            output_dir=self.output_dir)
-        assert isinstance(env_runner, BaseImageRunner)
+        if evaluator is None:
+            env_runner = hydra.utils.instantiate(
+                cfg.task.env_runner,
+                output_dir=self.output_dir)
+            assert isinstance(env_runner, BaseImageRunner)
 
         # self.layers = ['0.nets.4.0.conv1']
         # self.layers = ['0.nets.1']
@@ -351,7 +356,7 @@ class TrainRobomimicUniPertImageWorkspace(BaseWorkspace):
                     for batch_idx, batch in enumerate(tepoch):
                         self.model.zero_grad()
                         # device transfer
-                        batch = dict_apply(batch, lambda x: x.to(device, non_blocking=True))
+                        batch = dict_apply(batch, lambda x: to_device_float(x, device))
                         orig_obs = batch['obs'].copy()
                         cfg_activation['modify_act'] = False
                         with torch.no_grad():
@@ -413,20 +418,22 @@ class TrainRobomimicUniPertImageWorkspace(BaseWorkspace):
                     print(f"L2 norm of the {view} perturbation: {torch.norm(self.univ_pert[view], p=2)}")
                 # run rollout
                 if (self.epoch % cfg.training.rollout_every) == 0 and self.epoch != 0:
-                    runner_log = env_runner.run(self.model, self.univ_pert, cfg)
-                    # log all
-                    step_log.update(runner_log)
-                    test_mean_score= runner_log['test/mean_score']
-                    print(f"Test mean score: {test_mean_score}")
-                    if cfg.log:
-                        wandb.log({"test_mean_score": test_mean_score, "epoch": self.epoch})
-                    # save the patch
-                    if cfg.targeted:
-                        patch_path = os.path.join(os.path.dirname(cfg.checkpoint), f'{cfg.exp_name}_tar_pert_{cfg.epsilon}_epoch_{self.epoch}_mean_score_{test_mean_score}_{cfg.view}.pkl')
+                    if evaluator is None:
+                        runner_log = env_runner.run(self.model, adversarial_patch=self.univ_pert, cfg=cfg)
+                        # log all
+                        step_log.update(runner_log)
+                        log_uap_rollout(cfg, self.epoch, self.univ_pert, runner_log)
                     else:
-                        patch_path = os.path.join(os.path.dirname(cfg.checkpoint), f'{cfg.exp_name}_untar_pert_{cfg.epsilon}_epoch_{self.epoch}_mean_score_{test_mean_score}_{cfg.view}.pkl')
-                    pickle.dump(self.univ_pert, open(patch_path, 'wb'))
+                        # scored while the next epochs train
+                        evaluator.submit(self.epoch, self.univ_pert)
+                if evaluator is not None:
+                    for epoch, univ_pert, runner_log in evaluator.poll():
+                        log_uap_rollout(cfg, epoch, univ_pert, runner_log)
                 self.epoch += 1
+        if evaluator is not None:
+            for epoch, univ_pert, runner_log in evaluator.wait():
+                log_uap_rollout(cfg, epoch, univ_pert, runner_log)
+            evaluator.close()
         # gradients_path = os.path.join(os.path.dirname(cfg.checkpoint), f'gradients_untar_pert_{cfg.epsilon}_{cfg.gamma}_feature_dist.pkl')
         # pickle.dump(gradients, open(gradients_path, 'wb'))
         wandb.finish()
@@ -479,12 +486,14 @@ class TrainRobomimicUniPertImageWorkspaceRNN(BaseWorkspace):
 
         self.model.set_normalizer(normalizer)
 
-        # configure env
+        # configure env, the background evaluator builds its own
+        evaluator = BackgroundEvaluator.from_cfg(cfg, self.output_dir, normalizer=normalizer)
         env_runner: BaseImageRunner
-        env_runner = hydra.utils.instantiate(
-            cfg.task.env_runner,
-            output_dir=self.output_dir)
-        assert isinstance(env_runner, BaseImageRunner)
+        if evaluator is None:
+            env_runner = hydra.utils.instantiate(
+                cfg.task.env_runner,
+                output_dir=self.output_dir)
+            assert isinstance(env_runner, BaseImageRunner)
 
 
         if cfg.training.debug:
@@ -504,6 +513,9 @@ class TrainRobomimicUniPertImageWorkspaceRNN(BaseWorkspace):
             wandb.log({"epsilon": cfg.epsilon, "epsilon_step": cfg.epsilon_step, "targeted": cfg.targeted, "view": view})
         # set the model in eval mode
         self.model.eval()
+        clean_targets = build_clean_targets(self.model, cfg, dataset, 'gmm_means')
+        if clean_targets is not None:
+            train_dataloader = DataLoader(IndexedDataset(dataset), **cfg.dataloader)
         image_shape = cfg.task['image_shape']
         # training loop for the universal perturbation
         self.univ_pert = {}
@@ -514,6 +526,11 @@ class TrainRobomimicUniPertImageWorkspaceRNN(BaseWorkspace):
         for view in views:
             # self.univ_pert[view] = torch.zeros((3, 84, 84)).to(device)
             self.univ_pert[view] = torch.zeros((image_shape[0], image_shape[1], image_shape[2])).to(device)
+        uap_trainer = UAPTrainer.from_cfg(cfg, {view: self.univ_pert[view] for view in views},
+            num_training_steps=cfg.training.num_epochs * len(train_dataloader))
+        if uap_trainer is not None:
+            # updated after every minibatch, the views follow the trainer in place
+            self.univ_pert.update(uap_trainer.perturbation)
         log_path = os.path.join(self.output_dir, 'logs.json.txt')
         gradients = {}
         with JsonLogger(log_path) as json_logger:
@@ -530,16 +547,21 @@ class TrainRobomimicUniPertImageWorkspaceRNN(BaseWorkspace):
                     for batch_idx, batch in enumerate(tepoch):
                         self.model.zero_grad()
                         # device transfer
-                        batch = dict_apply(batch, lambda x: x.to(device, non_blocking=True))
+                        batch = dict_apply(batch, lambda x: to_device_float(x, device))
                         obs = batch['obs']
                         if batch['obs'][view].shape[0] != cfg.dataloader.batch_size:
                             continue
+                        # fresh RNN state per batch, the cached clean targets are computed the same way
+                        self.model.reset()
                         for view in views:
                             print(f"obs shape: {obs[view].shape}, pert shape: {self.univ_pert[view].shape}")
                         obs = dict_apply(obs, lambda x: x.to(device, non_blocking=True))
-                        with torch.no_grad():
-                            action_dist_clean = self.model.action_dist(obs)
-                            action_means_clean = action_dist_clean.component_distribution.base_dist.loc
+                        if clean_targets is not None:
+                            action_means_clean = clean_targets.get(batch['idx'], device)
+                        else:
+                            with torch.no_grad():
+                                action_dist_clean = self.model.action_dist(obs)
+                                action_means_clean = action_dist_clean.component_distribution.base_dist.loc
                         for view in views:
                             # print(f"obs shape: {obs[view].shape}, pert shape: {self.univ_pert[view].shape}")
                             # print(f"obs shape: {obs[view].shape}, pert shape: {self.univ_pert[view].shape}")
@@ -550,6 +572,8 @@ class TrainRobomimicUniPertImageWorkspaceRNN(BaseWorkspace):
                             obs[view].requires_grad = True
 
                         obs = dict_apply(obs, lambda x: x.to(device, non_blocking=True))
+                        # same RNN state as the clean forward, which the cached path skips
+                        self.model.reset()
                         action_dist = self.model.action_dist(obs)
                         action_means = action_dist.component_distribution.base_dist.loc
                         if cfg.targeted:
@@ -564,15 +588,19 @@ class TrainRobomimicUniPertImageWorkspaceRNN(BaseWorkspace):
                         loss_per_epoch += loss.item()
                         for view in views:
                             total_grad[view] += obs[view].grad.sum(dim=0, keepdim=True)[:, :cfg.n_obs_steps, ...]
-                for view in views:
-                    # print(f"Total grad shape: {total_grad[view].shape}")
-                    self.univ_pert[view] = self.univ_pert[view] + cfg.epsilon_step * torch.sign(total_grad[view])
-                    self.univ_pert[view] = torch.clamp(self.univ_pert[view], -cfg.epsilon, cfg.epsilon)
+                        if uap_trainer is not None:
+                            uap_trainer.step({view: obs[view].grad[:, :cfg.n_obs_steps] for view in views})
+                if uap_trainer is None:
+                    for view in views:
+                        # print(f"Total grad shape: {total_grad[view].shape}")
+                        self.univ_pert[view] = self.univ_pert[view] + cfg.epsilon_step * torch.sign(total_grad[view])
+                        self.univ_pert[view] = torch.clamp(self.univ_pert[view], -cfg.epsilon, cfg.epsilon)
                 # gradients[self.epoch] = total_grad
-                for view in views:
-                    # print(f"Total grad shape: {total_grad[view].shape}")
-                    self.univ_pert[view] = self.univ_pert[view] + cfg.epsilon_step * torch.sign(total_grad[view])
-                    self.univ_pert[view] = torch.clamp(self.univ_pert[view], -cfg.epsilon, cfg.epsilon)
+                if uap_trainer is None:
+                    for view in views:
+                        # print(f"Total grad shape: {total_grad[view].shape}")
+                        self.univ_pert[view] = self.univ_pert[view] + cfg.epsilon_step * torch.sign(total_grad[view])
+                        self.univ_pert[view] = torch.clamp(self.univ_pert[view], -cfg.epsilon, cfg.epsilon)
 
                 print(f"Loss for {self.epoch}: {loss_per_epoch}")
                 if cfg.log:
@@ -582,20 +610,22 @@ class TrainRobomimicUniPertImageWorkspaceRNN(BaseWorkspace):
                     print(f"L2 norm of the {view} perturbation: {torch.norm(self.univ_pert[view], p=2)}")
                 # run rollout
                 if (self.epoch % cfg.training.rollout_every) == 0 and self.epoch != 0:
-                    runner_log = env_runner.run(self.model, self.univ_pert, cfg)
-                    # log all
-                    step_log.update(runner_log)
-                    test_mean_score= runner_log['test/mean_score']
-                    print(f"Test mean score: {test_mean_score}")
-                    if cfg.log:
-                        wandb.log({"test_mean_score": test_mean_score, "epoch": self.epoch})
-                    # save the patch
-                    if cfg.targeted:
-                        patch_path = os.path.join(os.path.dirname(cfg.checkpoint), f'{cfg.exp_name}_tar_pert_{cfg.epsilon}_epoch_{self.epoch}_mean_score_{test_mean_score}_{view}.pkl')
+                    if evaluator is None:
+                        runner_log = env_runner.run(self.model, adversarial_patch=self.univ_pert, cfg=cfg)
+                        # log all
+                        step_log.update(runner_log)
+                        log_uap_rollout(cfg, self.epoch, self.univ_pert, runner_log)
                     else:
-                        patch_path = os.path.join(os.path.dirname(cfg.checkpoint), f'{cfg.exp_name}_untar_pert_{cfg.epsilon}_epoch_{self.epoch}_mean_score_{test_mean_score}_{view}.pkl')
-                    pickle.dump(self.univ_pert, open(patch_path, 'wb'))
+                        # scored while the next epochs train
+                        evaluator.submit(self.epoch, self.univ_pert)
+                if evaluator is not None:
+                    for epoch, univ_pert, runner_log in evaluator.poll():
+                        log_uap_rollout(cfg, epoch, univ_pert, runner_log)
                 self.epoch += 1
+        if evaluator is not None:
+            for epoch, univ_pert, runner_log in evaluator.wait():
+                log_uap_rollout(cfg, epoch, univ_pert, runner_log)
+            evaluator.close()
         # gradients_path = os.path.join(os.path.dirname(cfg.checkpoint), f'gradients_untar_pert_{cfg.epsilon}.pkl')
         # pickle.dump(gradients, open(gradients_path, 'wb'))
         wandb.finish()
@@ -644,12 +674,14 @@ class TrainRobomimicUniPertImageWorkspaceIBC(BaseWorkspace):
 
         self.model.set_normalizer(normalizer)
 
-        # configure env
+        # configure env, the background evaluator builds its own
+        evaluator = BackgroundEvaluator.from_cfg(cfg, self.output_dir, normalizer=normalizer)
         env_runner: BaseImageRunner
-        env_runner = hydra.utils.instantiate(
-            cfg.task.env_runner,
-            output_dir=self.output_dir)
-        assert isinstance(env_runner, BaseImageRunner)
+        if evaluator is None:
+            env_runner = hydra.utils.instantiate(
+                cfg.task.env_runner,
+                output_dir=self.output_dir)
+            assert isinstance(env_runner, BaseImageRunner)
 
 
         if cfg.training.debug:
@@ -696,7 +728,7 @@ class TrainRobomimicUniPertImageWorkspaceIBC(BaseWorkspace):
                     for batch_idx, batch in enumerate(tepoch):
                         self.model.zero_grad()
                         # device transfer
-                        batch = dict_apply(batch, lambda x: x.to(device, non_blocking=True))
+                        batch = dict_apply(batch, lambda x: to_device_float(x, device))
                         obs = batch['obs'].copy()
                         for view in views:
                             obs[view] = obs[view] + self.univ_pert[view]
@@ -741,20 +773,22 @@ class TrainRobomimicUniPertImageWorkspaceIBC(BaseWorkspace):
                     print(f"L2 norm of the {view} perturbation: {torch.norm(self.univ_pert[view], p=2)}")
                 # run rollout
                 if (self.epoch % cfg.training.rollout_every) == 0 and self.epoch != 0:
-                    runner_log = env_runner.run(self.model, self.univ_pert, cfg)
-                    # log all
-                    step_log.update(runner_log)
-                    test_mean_score= runner_log['test/mean_score']
-                    print(f"Test mean score: {test_mean_score}")
-                    if cfg.log:
-                        wandb.log({"test_mean_score": test_mean_score, "epoch": self.epoch})
-                    # save the patch
-                    if cfg.targeted:
-                        patch_path = os.path.join(os.path.dirname(cfg.checkpoint), f'{cfg.exp_name}_tar_pert_{cfg.epsilon}_epoch_{self.epoch}_mean_score_{test_mean_score}_{view}_feature_std.pkl')
+                    if evaluator is None:
+                        runner_log = env_runner.run(self.model, adversarial_patch=self.univ_pert, cfg=cfg)
+                        # log all
+                        step_log.update(runner_log)
+                        log_uap_rollout(cfg, self.epoch, self.univ_pert, runner_log, loss='feature_std')
                     else:
-                        patch_path = os.path.join(os.path.dirname(cfg.checkpoint), f'{cfg.exp_name}_untar_pert_{cfg.epsilon}_epoch_{self.epoch}_mean_score_{test_mean_score}_{view}_feature_std.pkl')
-                    pickle.dump(self.univ_pert, open(patch_path, 'wb'))
+                        # scored while the next epochs train
+                        evaluator.submit(self.epoch, self.univ_pert)
+                if evaluator is not None:
+                    for epoch, univ_pert, runner_log in evaluator.poll():
+                        log_uap_rollout(cfg, epoch, univ_pert, runner_log, loss='feature_std')
                 self.epoch += 1
+        if evaluator is not None:
+            for epoch, univ_pert, runner_log in evaluator.wait():
+                log_uap_rollout(cfg, epoch, univ_pert, runner_log, loss='feature_std')
+            evaluator.close()
         gradients_path = os.path.join(os.path.dirname(cfg.checkpoint), f'{cfg.exp_name}_gradients_untar_pert_{cfg.epsilon}.pkl')
         pickle.dump(gradients, open(gradients_path, 'wb'))
         wandb.finish()
@@ -807,12 +841,14 @@ class TrainRobomimicUniPertImageWorkspaceRNN_TH(BaseWorkspace):
 
         self.model.set_normalizer(normalizer)
 
-        # configure env
+        # configure env, the background evaluator builds its own
+        evaluator = BackgroundEvaluator.from_cfg(cfg, self.output_dir, normalizer=normalizer)
         env_runner: BaseImageRunner
-        env_runner = hydra.utils.instantiate(
-            cfg.task.env_runner,
-            output_dir=self.output_dir)
-        assert isinstance(env_runner, BaseImageRunner)
+        if evaluator is None:
+            env_runner = hydra.utils.instantiate(
+                cfg.task.env_runner,
+                output_dir=self.output_dir)
+            assert isinstance(env_runner, BaseImageRunner)
 
 
         if cfg.training.debug:
@@ -832,6 +868,9 @@ class TrainRobomimicUniPertImageWorkspaceRNN_TH(BaseWorkspace):
             wandb.log({"epsilon": cfg.epsilon, "epsilon_step": cfg.epsilon_step, "targeted": cfg.targeted, "view": view})
         # set the model in eval mode
         self.model.eval()
+        clean_targets = build_clean_targets(self.model, cfg, dataset, 'gmm_means')
+        if clean_targets is not None:
+            train_dataloader = DataLoader(IndexedDataset(dataset), **cfg.dataloader)
         image_shape = cfg.task['image_shape']
         # training loop for the universal perturbation
         self.univ_pert = {}
@@ -842,6 +881,11 @@ class TrainRobomimicUniPertImageWorkspaceRNN_TH(BaseWorkspace):
         for view in views:
             # self.univ_pert[view] = torch.zeros((3, 84, 84)).to(device)
             self.univ_pert[view] = torch.zeros((image_shape[0], image_shape[1], image_shape[2])).to(device)
+        uap_trainer = UAPTrainer.from_cfg(cfg, {view: self.univ_pert[view] for view in views},
+            num_training_steps=cfg.training.num_epochs * len(train_dataloader))
+        if uap_trainer is not None:
+            # updated after every minibatch, the views follow the trainer in place
+            self.univ_pert.update(uap_trainer.perturbation)
         log_path = os.path.join(self.output_dir, 'logs.json.txt')
         gradients = {}
         with JsonLogger(log_path) as json_logger:
@@ -858,16 +902,21 @@ class TrainRobomimicUniPertImageWorkspaceRNN_TH(BaseWorkspace):
                     for batch_idx, batch in enumerate(tepoch):
                         self.model.zero_grad()
                         # device transfer
-                        batch = dict_apply(batch, lambda x: x.to(device, non_blocking=True))
+                        batch = dict_apply(batch, lambda x: to_device_float(x, device))
                         obs = batch['obs']
                         if batch['obs'][view].shape[0] != cfg.dataloader.batch_size:
                             continue
+                        # fresh RNN state per batch, the cached clean targets are computed the same way
+                        self.model.reset()
                         for view in views:
                             print(f"obs shape: {obs[view].shape}, pert shape: {self.univ_pert[view].shape}")
                         obs = dict_apply(obs, lambda x: x.to(device, non_blocking=True))
-                        with torch.no_grad():
-                            action_dist_clean = self.model.action_dist(obs)
-                            action_means_clean = action_dist_clean.component_distribution.base_dist.loc
+                        if clean_targets is not None:
+                            action_means_clean = clean_targets.get(batch['idx'], device)
+                        else:
+                            with torch.no_grad():
+                                action_dist_clean = self.model.action_dist(obs)
+                                action_means_clean = action_dist_clean.component_distribution.base_dist.loc
                         for view in views:
                             # print(f"obs shape: {obs[view].shape}, pert shape: {self.univ_pert[view].shape}")
                             # print(f"obs shape: {obs[view].shape}, pert shape: {self.univ_pert[view].shape}")
@@ -878,6 +927,8 @@ class TrainRobomimicUniPertImageWorkspaceRNN_TH(BaseWorkspace):
                             obs[view].requires_grad = True
 
                         obs = dict_apply(obs, lambda x: x.to(device, non_blocking=True))
+                        # same RNN state as the clean forward, which the cached path skips
+                        self.model.reset()
                         action_dist = self.model.action_dist(obs)
                         action_means = action_dist.component_distribution.base_dist.loc
                         if cfg.targeted:
@@ -892,15 +943,19 @@ class TrainRobomimicUniPertImageWorkspaceRNN_TH(BaseWorkspace):
                         loss_per_epoch += loss.item()
                         for view in views:
                             total_grad[view] += obs[view].grad.sum(dim=0, keepdim=True)[:, :cfg.n_obs_steps, ...]
-                for view in views:
-                    # print(f"Total grad shape: {total_grad[view].shape}")
-                    self.univ_pert[view] = self.univ_pert[view] + cfg.epsilon_step * torch.sign(total_grad[view])
-                    self.univ_pert[view] = torch.clamp(self.univ_pert[view], -cfg.epsilon, cfg.epsilon)
+                        if uap_trainer is not None:
+                            uap_trainer.step({view: obs[view].grad[:, :cfg.n_obs_steps] for view in views})
+                if uap_trainer is None:
+                    for view in views:
+                        # print(f"Total grad shape: {total_grad[view].shape}")
+                        self.univ_pert[view] = self.univ_pert[view] + cfg.epsilon_step * torch.sign(total_grad[view])
+                        self.univ_pert[view] = torch.clamp(self.univ_pert[view], -cfg.epsilon, cfg.epsilon)
                 # gradients[self.epoch] = total_grad
-                for view in views:
-                    # print(f"Total grad shape: {total_grad[view].shape}")
-                    self.univ_pert[view] = self.univ_pert[view] + cfg.epsilon_step * torch.sign(total_grad[view])
-                    self.univ_pert[view] = torch.clamp(self.univ_pert[view], -cfg.epsilon, cfg.epsilon)
+                if uap_trainer is None:
+                    for view in views:
+                        # print(f"Total grad shape: {total_grad[view].shape}")
+                        self.univ_pert[view] = self.univ_pert[view] + cfg.epsilon_step * torch.sign(total_grad[view])
+                        self.univ_pert[view] = torch.clamp(self.univ_pert[view], -cfg.epsilon, cfg.epsilon)
 
                 print(f"Loss for {self.epoch}: {loss_per_epoch}")
                 if cfg.log:
@@ -910,20 +965,22 @@ class TrainRobomimicUniPertImageWorkspaceRNN_TH(BaseWorkspace):
                     print(f"L2 norm of the {view} perturbation: {torch.norm(self.univ_pert[view], p=2)}")
                 # run rollout
                 if (self.epoch % cfg.training.rollout_every) == 0 and self.epoch != 0:
-                    runner_log = env_runner.run(self.model, self.univ_pert, cfg=cfg)
-                    # log all
-                    step_log.update(runner_log)
-                    test_mean_score= runner_log['test/mean_score']
-                    print(f"Test mean score: {test_mean_score}")
-                    if cfg.log:
-                        wandb.log({"test_mean_score": test_mean_score, "epoch": self.epoch})
-                    # save the patch
-                    if cfg.targeted:
-                        patch_path = os.path.join(os.path.dirname(cfg.checkpoint), f'{cfg.exp_name}_tar_pert_{cfg.epsilon}_epoch_{self.epoch}_mean_score_{test_mean_score}_{view}.pkl')
+                    if evaluator is None:
+                        runner_log = env_runner.run(self.model, adversarial_patch=self.univ_pert, cfg=cfg)
+                        # log all
+                        step_log.update(runner_log)
+                        log_uap_rollout(cfg, self.epoch, self.univ_pert, runner_log)
                     else:
-                        patch_path = os.path.join(os.path.dirname(cfg.checkpoint), f'{cfg.exp_name}_untar_pert_{cfg.epsilon}_epoch_{self.epoch}_mean_score_{test_mean_score}_{view}.pkl')
-                    pickle.dump(self.univ_pert, open(patch_path, 'wb'))
+                        # scored while the next epochs train
+                        evaluator.submit(self.epoch, self.univ_pert)
+                if evaluator is not None:
+                    for epoch, univ_pert, runner_log in evaluator.poll():
+                        log_uap_rollout(cfg, epoch, univ_pert, runner_log)
                 self.epoch += 1
+        if evaluator is not None:
+            for epoch, univ_pert, runner_log in evaluator.wait():
+                log_uap_rollout(cfg, epoch, univ_pert, runner_log)
+            evaluator.close()
         # gradients_path = os.path.join(os.path.dirname(cfg.checkpoint), f'gradients_untar_pert_{cfg.epsilon}.pkl')
         # pickle.dump(gradients, open(gradients_path, 'wb'))
         wandb.finish()
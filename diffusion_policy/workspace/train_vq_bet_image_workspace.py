@@ -22,13 +22,15 @@ import tqdm
 import numpy as np
 import shutil
 import pickle
+from diffusion_policy.env_runner.background_eval import BackgroundEvaluator, log_uap_rollout
 from diffusion_policy.workspace.base_workspace import BaseWorkspace
 from diffusion_policy.policy.robomimic_image_policy import RobomimicImagePolicy
 from diffusion_policy.dataset.base_dataset import BaseImageDataset
 from diffusion_policy.env_runner.base_image_runner import BaseImageRunner
 from diffusion_policy.common.checkpoint_util import TopKCheckpointManager
 from diffusion_policy.common.json_logger import JsonLogger
-from diffusion_policy.common.pytorch_util import dict_apply, optimizer_to
+from diffusion_policy.adversarial_attacks.uap_trainer import UAPTrainer
+from diffusion_policy.common.pytorch_util import dict_apply, optimizer_to, to_device_float
 from diffusion_policy.policy.vq_bet_image_policy import VQBeTPolicy
 from diffusion_policy.model.common.lr_scheduler import get_scheduler
 
@@ -374,12 +376,14 @@ class TrainUniPertVQBeTImageWorkspace(BaseWorkspace):
         val_dataloader = DataLoader(val_dataset, **cfg.val_dataloader)
         self.model.set_normalizer(normalizer)
 
-        # configure env
+        # configure env, the background evaluator builds its own
+        evaluator = BackgroundEvaluator.from_cfg(cfg, self.output_dir, normalizer=normalizer)
         env_runner: BaseImageRunner
-        env_runner = hydra.utils.instantiate(
-            cfg.task.env_runner,
-            output_dir=self.output_dir)
-        assert isinstance(env_runner, BaseImageRunner)
+        if evaluator is None:
+            env_runner = hydra.utils.instantiate(
+                cfg.task.env_runner,
+                output_dir=self.output_dir)
+            assert isinstance(env_runner, BaseImageRunner)
 
         # configure logging
         if cfg.log:
@@ -406,6 +410,11 @@ class TrainUniPertVQBeTImageWorkspace(BaseWorkspace):
 
         for view in views:
             self.univ_pert[view] = torch.zeros((image_shape[0], image_shape[1], image_shape[2])).to(device)
+        uap_trainer = UAPTrainer.from_cfg(cfg, {view: self.univ_pert[view] for view in views},
+            num_training_steps=cfg.training.num_epochs * len(train_dataloader))
+        if uap_trainer is not None:
+            # updated after every minibatch, the views follow the trainer in place
+            self.univ_pert.update(uap_trainer.perturbation)
         gradients = {}
 
         # save batch for sampling
@@ -440,7 +449,7 @@ class TrainUniPertVQBeTImageWorkspace(BaseWorkspace):
                                leave=False, mininterval=cfg.training.tqdm_interval_sec) as tepoch:
                     for batch_idx, batch in enumerate(tepoch):
                         # device transfer
-                        batch = dict_apply(batch, lambda x: x.to(device, non_blocking=True))
+                        batch = dict_apply(batch, lambda x: to_device_float(x, device))
                         obs = batch['obs'].copy()
                         for view in views:
                             obs[view] = obs[view] + self.univ_pert[view]
@@ -479,6 +488,12 @@ class TrainUniPertVQBeTImageWorkspace(BaseWorkspace):
                                 total_grad[views[i]] += batch_cp['observation.images'].grad.sum(dim=0)[:, i, ...]
                         else:
                             total_grad[view] += batch_cp['observation.images'].grad.sum(dim=0)
+                        if uap_trainer is not None:
+                            images_grad = batch_cp['observation.images'].grad
+                            if cfg.view == 'both':
+                                uap_trainer.step({views[i]: images_grad[:, :, i] for i in range(len(views))})
+                            else:
+                                uap_trainer.step({view: images_grad})
                         # log the magnitude of the gradient
                         if cfg.log:
                             if cfg.view == 'both':
@@ -503,9 +518,10 @@ class TrainUniPertVQBeTImageWorkspace(BaseWorkspace):
                                 and batch_idx >= (cfg.training.max_train_steps - 1):
                             break
 
-                for view in views:
-                    self.univ_pert[view] = self.univ_pert[view] + cfg.epsilon_step * torch.sign(total_grad[view])
-                    self.univ_pert[view] = torch.clamp(self.univ_pert[view], -cfg.epsilon, cfg.epsilon)
+                if uap_trainer is None:
+                    for view in views:
+                        self.univ_pert[view] = self.univ_pert[view] + cfg.epsilon_step * torch.sign(total_grad[view])
+                        self.univ_pert[view] = torch.clamp(self.univ_pert[view], -cfg.epsilon, cfg.epsilon)
                 print(f"Loss per epoch: {loss_per_epoch}")
                 for view in views:
                     if cfg.log:
@@ -522,21 +538,17 @@ class TrainUniPertVQBeTImageWorkspace(BaseWorkspace):
 
                 # run rollout
                 if (self.epoch % cfg.training.rollout_every) == 0 and self.epoch > 0:
-                    runner_log = env_runner.run(self.model, self.univ_pert, cfg=cfg, )
-                    # log all
-                    step_log.update(runner_log)
-                    test_mean_score = runner_log['test/mean_score']
-                    print(f"Test mean score: {test_mean_score}")
-                    if cfg.log:
-                        wandb.log({"test_mean_score": test_mean_score})
-                        wandb.log(runner_log, step=self.global_step)
-                    if cfg.targeted:
-                        patch_path = os.path.join(os.path.dirname(cfg.checkpoint),
-                                                  f'tar_pert_{cfg.epsilon}_epoch_{self.epoch}_mean_score_{test_mean_score}_{view}.pkl')
+                    if evaluator is None:
+                        runner_log = env_runner.run(self.model, adversarial_patch=self.univ_pert, cfg=cfg)
+                        # log all
+                        step_log.update(runner_log)
+                        log_uap_rollout(cfg, self.epoch, self.univ_pert, runner_log)
                     else:
-                        patch_path = os.path.join(os.path.dirname(cfg.checkpoint),
-                                                  f'untar_pert_{cfg.epsilon}_epoch_{self.epoch}_mean_score_{test_mean_score}_{view}.pkl')
-                    pickle.dump(self.univ_pert, open(patch_path, 'wb'))
+                        # scored while the next epochs train
+                        evaluator.submit(self.epoch, self.univ_pert)
+                if evaluator is not None:
+                    for epoch, univ_pert, runner_log in evaluator.poll():
+                        log_uap_rollout(cfg, epoch, univ_pert, runner_log)
 
                 # ========= eval end for this epoch ==========
                 self.model.train()
@@ -549,6 +561,10 @@ class TrainUniPertVQBeTImageWorkspace(BaseWorkspace):
                 json_logger.log(step_log)
                 self.global_step += 1
                 self.epoch += 1
+        if evaluator is not None:
+            for epoch, univ_pert, runner_log in evaluator.wait():
+                log_uap_rollout(cfg, epoch, univ_pert, runner_log)
+            evaluator.close()
 
     wandb.finish()
 
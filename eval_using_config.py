@@ -13,11 +13,13 @@ import wandb
 import json
 from diffusion_policy.workspace.base_workspace import BaseWorkspace
 from diffusion_policy.env_runner.robomimic_image_runner import AdversarialRobomimicImageRunner
+from diffusion_policy.adversarial_attacks.attack_sweep import AttackSweep
+from diffusion_policy.adversarial_attacks.perturbation_store import load_perturbation
 from omegaconf import OmegaConf
 from hydra.core.hydra_config import HydraConfig
 from hydra.utils import to_absolute_path, instantiate
 from hydra.core.global_hydra import GlobalHydra
-import pickle
+import copy
 
 torch.backends.cudnn.enabled = True
 
@@ -57,6 +59,54 @@ def init_wandb(checkpoint, cfg, attack, view):
     return wandb.init(project=project, name=run_name+"task-transfer")
 
 
+def check_precision(cfg, policy, env_runner, precision, tolerance, attack):
+    """
+    Clean rollouts in fp32 and in the reduced precision on the same seeds,
+    raise if the test success rate drops by more than tolerance.
+    """
+    clean_cfg = copy.deepcopy(cfg)
+    clean_cfg.attack_type = 'None'
+    scores = dict()
+    for this_precision in ('fp32', precision):
+        policy.set_precision(this_precision)
+        if attack and cfg.attack_type != 'patch':
+            # the adversarial runners take epsilon, the patch runners do not
+            runner_log = env_runner.run(policy, epsilon=0.0, cfg=clean_cfg)
+        else:
+            runner_log = env_runner.run(policy, cfg=clean_cfg)
+        scores[this_precision] = float(runner_log["test/mean_score"])
+    print(f"Clean test/mean_score fp32: {scores['fp32']}, {precision}: {scores[precision]}")
+    if cfg.log:
+        wandb.log({"precision_check/fp32_mean_score": scores['fp32'],
+                   f"precision_check/{precision}_mean_score": scores[precision]})
+    if scores['fp32'] - scores[precision] > tolerance:
+        raise RuntimeError(f"{precision} clean success rate {scores[precision]} is more than "
+                           f"{tolerance} below fp32 {scores['fp32']}")
+    return scores
+
+
+def run_sweep(cfg, policy, env_runner, output_dir):
+    """
+    Evaluate every point of cfg.sweep with the already loaded policy and
+    env runner, all points share the env seeds of env_runner.
+    """
+    sweep = AttackSweep(cfg)
+    print(f"Sweeping {len(sweep)} attack settings")
+    for point, run_cfg in sweep:
+        print(f"Sweep point: {point}")
+        runner_log = env_runner.run(policy, epsilon=run_cfg.epsilon, cfg=run_cfg)
+        for row in sweep.add(point, runner_log):
+            print(f"Epsilon {row['epsilon']} Test/mean_score: ", row.get("test/mean_score"))
+            if cfg.log:
+                wandb.log({"test/mean_score": row.get("test/mean_score"), "train/mean_score": row.get("train/mean_score"),
+                           "Epsilon": row["epsilon"], "attack_type": row["attack_type"], "view": row["view"]})
+    out_path = sweep.write(output_dir)
+    print(f"Sweep results written to {out_path}")
+    if cfg.log:
+        wandb.log({"sweep_results": wandb.Table(columns=sweep.columns(), data=sweep.table())})
+    return sweep
+
+
 # @hydra.main(config_path='diffusion_policy/eval_configs', config_name='diffusion_policy_image_ph_pick_pgd_adversarial')
 # @hydra.main(config_path='diffusion_policy/eval_configs', config_name='lstm_gmm_image_ph_pick_pgd_adversarial')
 # @hydra.main(config_path='diffusion_policy/eval_configs', config_name='lstm_gmm_image_ph_pick_adversarial')
@@ -92,7 +142,13 @@ def main(cfg):
     # the output directory should depend on the current directory and the checkpoint path and the attack type and epsilon
     # output_dir = os.path.join(os.getcwd(),
     #                           f"data/experiments/image/{task}/{algo}/eval_{checkpoint.split('/')[-3]}_{epsilon}_{view}_attack_{attack}_{cfg.attack_type}_targeted_{cfg.targeted}")
-    if cfg.attack_type=='patch':
+    sweep = cfg.get('sweep', None)
+    if sweep is not None:
+        if not attack:
+            raise ValueError("sweep requires attack=True")
+        output_dir = os.path.join(os.getcwd(),
+                                  f"data/experiments/image/{task}/{algo}/eval_{checkpoint.split('/')[-3]}_sweep_attack_{attack}_targeted_{cfg.targeted}_ts_attack{cfg.attack_after_timetseps}")
+    elif cfg.attack_type=='patch':
         output_dir = os.path.join(os.getcwd(),
                                   f"data/experiments/image/{task}/{algo}/eval_{checkpoint.split('/')[-3]}_{epsilon}_{view}_attack_{attack}_{cfg.attack_type}_targeted_{cfg.targeted}_patch_path{cfg.patch_path}_ts_attack{cfg.attack_after_timetseps}")
     else:
@@ -123,6 +179,28 @@ def main(cfg):
         cfg_loaded.task.env_runner['n_envs'] = n_envs
         if cfg.max_steps is not None:
             cfg_loaded.task.env_runner['max_steps'] = cfg.max_steps
+    # lease warmed envs from a shared env pool server instead of building them
+    env_pool = cfg.get('env_pool', None)
+    if env_pool:
+        cfg_loaded.task.env_runner['env_pool'] = env_pool
+    # step half of the envs while the attack runs on the other half
+    pipeline_groups = cfg.get('pipeline_groups', None)
+    if pipeline_groups:
+        cfg_loaded.task.env_runner['pipeline_groups'] = pipeline_groups
+    # stop envs at success and back-fill them with the next init condition
+    if cfg.get('early_exit', False):
+        cfg_loaded.task.env_runner['early_exit'] = True
+    # hand out init conditions to whichever env worker is free, without chunks
+    if cfg.get('work_stealing', False):
+        cfg_loaded.task.env_runner['work_stealing'] = True
+    # policy reads obs from the pinned shared worker buffer
+    if cfg.get('zero_copy_obs', False):
+        cfg_loaded.task.env_runner['zero_copy_obs'] = True
+    # env workers only buffer frames, videos are encoded in a background process
+    if cfg.get('deferred_video', False):
+        cfg_loaded.task.env_runner['deferred_video'] = True
+    if not cfg.get('log_videos', True):
+        cfg_loaded.task.env_runner['log_videos'] = False
     if cfg.n_test > 0:
         cfg_loaded.task.env_runner['n_test'] = cfg.n_test
     if cfg.n_train > 0:
@@ -172,21 +250,44 @@ def main(cfg):
     device = torch.device(device)
     policy.to(device)
     policy.eval()
+    # e.g. inference_scheduler: {name: ddim, num_inference_steps: 16}
+    inference_scheduler = cfg.get('inference_scheduler', None)
+    if inference_scheduler is not None:
+        if not hasattr(policy, 'set_inference_scheduler'):
+            raise ValueError(f"{type(policy).__name__} does not support inference_scheduler")
+        policy.set_inference_scheduler(**inference_scheduler)
     env_runner = hydra.utils.instantiate(
         cfg_loaded.task.env_runner,
         output_dir=output_dir)
-    if attack and cfg.attack_type == 'patch':
-        patch = pickle.load(open(cfg.patch_path, 'rb'))
-        # print("Shape of the patch: ", patch.shape)
-        # patch[0, :] = torch.ones_like(patch[0, :])
-        # patch[0, 0] = torch.ones_like(patch[0, 0])
-        # patch[0, 1] = torch.ones_like(patch[0, 1])
-        # print(patch[0])
-        runner_log = env_runner.run(policy, adversarial_patch=patch, cfg=cfg)
-    elif attack:
-        runner_log = env_runner.run(policy, epsilon=cfg.epsilon, cfg=cfg)
-    else:
-        runner_log = env_runner.run(policy, cfg=cfg)
+    # reduced precision forwards, normalizer and perturbations stay in fp32
+    precision = cfg.get('precision', None)
+    if precision is not None and precision != 'fp32':
+        tolerance = cfg.get('precision_check_tolerance', None)
+        if tolerance is not None:
+            check_precision(cfg, policy, env_runner, precision, tolerance, attack)
+        policy.set_precision(precision)
+    try:
+        if sweep is not None:
+            # policy and envs are loaded once for the whole grid
+            run_sweep(cfg, policy, env_runner, output_dir)
+            wandb.finish()
+            return
+        if attack and cfg.attack_type == 'patch':
+            patch = load_perturbation(cfg, device=policy.device)
+            # print("Shape of the patch: ", patch.shape)
+            # patch[0, :] = torch.ones_like(patch[0, :])
+            # patch[0, 0] = torch.ones_like(patch[0, 0])
+            # patch[0, 1] = torch.ones_like(patch[0, 1])
+            # print(patch[0])
+            runner_log = env_runner.run(policy, adversarial_patch=patch, cfg=cfg)
+        elif attack:
+            runner_log = env_runner.run(policy, epsilon=cfg.epsilon, cfg=cfg)
+        else:
+            runner_log = env_runner.run(policy, cfg=cfg)
+    finally:
+        # drains the video encoder and frees the frames of unfinished episodes
+        if hasattr(env_runner, 'close'):
+            env_runner.close()
     json_log = dict()
     for key, value in runner_log.items():
         if isinstance(value, wandb.sdk.data_types.video.Video):
@@ -203,7 +304,8 @@ def main(cfg):
                        "Epsilon": float(cfg.epsilon)})
     print("Test/mean_score: ", json_log["test/mean_score"])
     out_path = os.path.join(output_dir, 'eval_log.json')
-    json.dump(json_log, open(out_path, 'w'), indent=2, sort_keys=True)
+    with open(out_path, 'w') as f:
+        json.dump(json_log, f, indent=2, sort_keys=True)
     wandb.finish()
 
 
@@ -0,0 +1,35 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import torch
+from omegaconf import OmegaConf
+from diffusion_policy.adversarial_attacks.attack_engine import AttackEngine
+
+
+def test():
+    # the runners build a loss free engine for clean and patch rollouts
+    cfg = OmegaConf.create({'view': 'agentview_image', 'epsilon': 0.0625, 'log': False})
+    engine = AttackEngine(None, cfg)
+    assert engine.loss_adapter is None
+    assert engine.views == ['agentview_image']
+
+    obs = torch.rand(2, 2, 3, 8, 8)
+    patch = {'agentview_image': torch.full((3, 8, 8), 0.5)}
+    patched = engine.patch({'agentview_image': obs}, patch)
+    assert torch.allclose(patched['agentview_image'], obs + 0.5)
+
+    # attack clip bounds do not change patch rollouts
+    cfg.clip_min, cfg.clip_max = 0, 1
+    patched = AttackEngine(None, cfg).patch({'agentview_image': obs}, patch)
+    assert torch.allclose(patched['agentview_image'], obs + 0.5)
+    cfg.patch_clip_min, cfg.patch_clip_max = 0, 1
+    patched = AttackEngine(None, cfg).patch({'agentview_image': obs}, patch)
+    assert patched['agentview_image'].max() <= 1
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,70 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import torch
+from diffusion_policy.adversarial_attacks.attack_memory import AttackMemoryPlanner
+from diffusion_policy.adversarial_attacks.attack_telemetry import AttackTelemetry
+
+
+def test():
+    policy = torch.nn.Linear(2, 2)
+    planner = AttackMemoryPlanner(mode='auto')
+    calls = list()
+
+    def fn():
+        chunks = planner.chunks(8)
+        calls.append(len(chunks))
+        if len(chunks) < 4:
+            raise RuntimeError("CUDA out of memory. Tried to allocate 2.00 GiB")
+        return 'done'
+
+    # no encoder blocks to checkpoint, halves the micro batch 8 -> 4 -> 2
+    assert planner.run(policy, fn, 8) == 'done'
+    assert planner.checkpointing and planner.micro_batch_size == 2
+    assert calls == [1, 2, 4]
+
+    # other errors are not mistaken for OOM
+    def broken():
+        raise ValueError("shape mismatch")
+    try:
+        planner.run(policy, broken, 8)
+        assert False
+    except ValueError as e:
+        assert 'shape mismatch' in str(e)
+
+    # without 'auto' an OOM is raised as is
+    planner = AttackMemoryPlanner(mode='none')
+    try:
+        planner.run(policy, fn, 8)
+        assert False
+    except RuntimeError as e:
+        assert 'out of memory' in str(e)
+
+    # records of a failed attempt are rolled back before the retry
+    planner = AttackMemoryPlanner(mode='auto')
+    telemetry = AttackTelemetry()
+    telemetry.record('loss', torch.tensor(1.0))
+
+    def recording_fn():
+        chunks = planner.chunks(8)
+        for sl in chunks:
+            telemetry.record('loss', torch.ones(sl.stop - sl.start))
+        if len(chunks) < 2:
+            raise RuntimeError("CUDA out of memory. Tried to allocate 2.00 GiB")
+        return 'done'
+
+    assert planner.run(policy, recording_fn, 8, telemetry=telemetry) == 'done'
+    assert telemetry.counts['loss'] == 1 + 8
+    assert float(telemetry.sums['loss']) == 9.0
+    assert telemetry.n_calls['loss'] == 1 + 2
+
+    planner = AttackMemoryPlanner(mode='micro_batch', micro_batch_size=3)
+    assert planner.chunks(7) == [slice(0, 3), slice(3, 6), slice(6, 7)]
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,50 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+from diffusion_policy.adversarial_attacks.attack_schedule import AttackSchedule, AttackScheduleReport
+
+
+def test():
+    timesteps = list(reversed(range(100)))
+
+    # legacy: attack the last 10% of a 100 step schedule
+    schedule = AttackSchedule(mode='after', attack_after_timesteps=0.9)
+    mask = schedule.attack_mask(timesteps, 100)
+    assert sum(mask) == 10
+    assert all(mask[-10:])
+
+    schedule = AttackSchedule(mode='last_k', k=5)
+    mask = schedule.attack_mask(timesteps, 100)
+    assert sum(mask) == 5 and all(mask[-5:])
+
+    schedule = AttackSchedule(mode='strided', stride=10)
+    mask = schedule.attack_mask(timesteps, 100)
+    assert sum(mask) == 10 and mask[-1] and not mask[-2]
+
+    schedule = AttackSchedule(mode='compressed', num_inference_steps=10, k=3)
+    assert schedule.num_inference_steps(100) == 10
+    mask = schedule.attack_mask(list(range(90, -1, -10)), 100)
+    assert sum(mask) == 3
+
+    report = AttackScheduleReport()
+    report.add({'denoise_steps': 10, 'attacked_steps': 3, 'grad_evals': 15,
+        'full_grad_evals': 500, 'final_loss': 0.5})
+    summary = report.summary()
+    assert abs(summary['attack_compute_fraction'] - 0.03) < 1e-8
+    assert summary['attack_final_loss'] == 0.5
+
+    # micro batches of one attack step count as one step
+    report = AttackScheduleReport()
+    stats = {'denoise_steps': 10, 'attacked_steps': 3, 'grad_evals': 15, 'full_grad_evals': 500}
+    report.add_chunks([(3, dict(stats, final_loss=1.0)), (1, dict(stats, final_loss=3.0))])
+    assert len(report.stats) == 1
+    summary = report.summary()
+    assert summary['attack_grad_evals_per_step'] == 15
+    assert summary['attack_final_loss'] == 1.5
+
+if __name__ == '__main__':
+    test()
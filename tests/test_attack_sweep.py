@@ -0,0 +1,56 @@
+import sys
+import os
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+from omegaconf import OmegaConf
+from diffusion_policy.adversarial_attacks.attack_sweep import AttackSweep, stacked_log_prefix
+
+
+def test():
+    cfg = OmegaConf.create({
+        'epsilon': 0.03, 'attack_type': 'pgd', 'view': 'agentview_image',
+        'sweep': {'epsilons': [0.01, 0.03], 'attack_types': ['fgsm', 'pgd'],
+            'views': ['agentview_image', ['agentview_image', 'robot0_eye_in_hand_image']]}
+    })
+    sweep = AttackSweep(cfg)
+    assert len(sweep) == 8
+    for i, (point, run_cfg) in enumerate(sweep):
+        assert run_cfg.epsilon == point['epsilon']
+        assert run_cfg.attack_type == point['attack_type']
+        sweep.add(point, {'test/mean_score': i / 8, 'test/sim_video_0': 'not a scalar'})
+    # the original cfg is untouched
+    assert cfg.epsilon == 0.03
+    assert 'test/sim_video_0' not in sweep.columns()
+    assert sweep.columns()[:4] == ['epsilon', 'attack_type', 'view', 'test/mean_score']
+    assert sweep.table()[-1][2] == 'agentview_image+robot0_eye_in_hand_image'
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        path = sweep.write(output_dir)
+        assert len(open(path).readlines()) == 9
+
+    # stacked epsilons: one run per (attack_type, view), split into rows per epsilon
+    cfg.sweep.stack_epsilons = True
+    sweep = AttackSweep(cfg)
+    assert len(sweep) == 4
+    point, run_cfg = next(iter(sweep))
+    assert point['epsilon'] == [0.01, 0.03]
+    runner_log = {'attack_grad_evals_per_step': 4.0}
+    for eps, score in zip(point['epsilon'], [0.9, 0.5]):
+        runner_log[stacked_log_prefix(eps) + 'test/mean_score'] = score
+    rows = sweep.add(point, runner_log)
+    assert [row['epsilon'] for row in rows] == [0.01, 0.03]
+    assert [row['test/mean_score'] for row in rows] == [0.9, 0.5]
+    assert all(row['attack_grad_evals_per_step'] == 4.0 for row in rows)
+
+    # defaults to the single values in cfg
+    sweep = AttackSweep(OmegaConf.create(
+        {'epsilon': 0.1, 'attack_type': 'fgsm', 'view': 'both', 'sweep': {}}))
+    assert len(sweep) == 1
+
+
+if __name__ == '__main__':
+    test()
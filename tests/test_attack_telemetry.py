@@ -0,0 +1,46 @@
+import sys
+import os
+import json
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import torch
+from diffusion_policy.adversarial_attacks.attack_telemetry import AttackTelemetry
+
+
+def test():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        json_path = os.path.join(tmp_dir, 'telemetry.json')
+        telemetry = AttackTelemetry(sample_every=2, flush_every=2, json_path=json_path)
+        for i in range(4):
+            telemetry.record('loss', torch.tensor(float(i)))
+        telemetry.record_perturbation('pert', torch.full((3, 2, 4), -0.5))
+        telemetry.end_episode()
+        # waits for the second episode before syncing
+        assert len(telemetry.pending) == 1 and not os.path.exists(json_path)
+        telemetry.record('loss', torch.tensor([4.0, 6.0]))
+        telemetry.end_episode()
+        assert len(telemetry.pending) == 0
+
+        with open(json_path) as f:
+            rows = [json.loads(x) for x in f]
+        assert len(rows) == 2
+        # samples 0 and 2 of the first episode
+        assert rows[0]['attack/loss_mean'] == 1.0
+        assert rows[0]['attack/pert_linf_max'] == 0.5
+        assert abs(rows[0]['attack/pert_l2_mean'] - 8 ** 0.5 * 0.5) < 1e-6
+
+        summary = telemetry.summary()
+        assert summary['attack/loss_mean'] == 3.0
+        assert summary['attack/loss_max'] == 6.0
+
+    disabled = AttackTelemetry(enabled=False)
+    disabled.record('loss', torch.tensor(1.0))
+    assert disabled.summary() == dict()
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,86 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import numpy as np
+from diffusion_policy.env_runner.backfill_rollout import BackfillRollout, WorkStealingRollout
+
+
+class SuccessVectorEnv:
+    """
+    The init fn of an episode is its length, reward is 1 once it is reached.
+    """
+    def __init__(self, n_envs):
+        self.num_envs = n_envs
+        self.length = np.zeros(n_envs, dtype=np.int64)
+        self.steps = np.zeros(n_envs, dtype=np.int64)
+        self.pending = set()
+        self.n_stepped = 0
+
+    def call_each(self, name, args_list=None, kwargs_list=None, timeout=None, indices=None):
+        if name == 'run_dill_function':
+            for i, (length,) in zip(indices, args_list):
+                self.length[i] = length
+            return [None] * len(indices)
+        if name == 'render':
+            return [f'video_{self.length[i]}' for i in indices]
+        if name == 'get_attr':
+            return [[0.0] * (self.steps[i] - 1) + [1.0] for i in indices]
+        raise ValueError(name)
+
+    def reset_each(self, indices):
+        self.steps[indices] = 0
+        return {'step': self.steps[indices].copy()}
+
+    def step_each_async(self, actions, indices):
+        assert self.pending.isdisjoint(indices)
+        self.pending.update(indices)
+        self.steps[indices] += 1
+        self.n_stepped += len(indices)
+
+    def step_each_ready(self):
+        # one env at a time, the lowest index is the fastest
+        return [min(self.pending)]
+
+    def step_each_wait(self, indices):
+        assert self.pending.issuperset(indices)
+        self.pending.difference_update(indices)
+        reward = (self.steps[indices] >= self.length[indices]).astype(np.float64)
+        done = np.zeros(len(indices), dtype=bool)
+        return {'step': self.steps[indices].copy()}, reward, done, [dict()] * len(indices)
+
+
+def test():
+    lengths = [1, 5, 2, 2, 3]
+    env = SuccessVectorEnv(2)
+    batch_sizes = list()
+    def infer(env_indices, slot_indices, obs):
+        batch_sizes.append(len(env_indices))
+        assert np.all(env.length[env_indices] == np.array(lengths)[slot_indices])
+        return np.zeros((len(env_indices), 1))
+
+    progress = list()
+    video_paths, rewards = BackfillRollout(env).run(lengths, infer, progress_fn=progress.append)
+    assert video_paths == [f'video_{x}' for x in lengths]
+    assert [len(x) for x in rewards] == lengths
+    assert sum(progress) == len(lengths)
+    # only live episodes are stepped, no padding
+    assert env.n_stepped == sum(lengths)
+    assert max(batch_sizes) == 2
+
+    # envs step on their own, no padding and no common step
+    env = SuccessVectorEnv(2)
+    batch_sizes.clear()
+    video_paths, rewards = WorkStealingRollout(env).run(lengths, infer)
+    assert video_paths == [f'video_{x}' for x in lengths]
+    assert [len(x) for x in rewards] == lengths
+    assert env.n_stepped == sum(lengths)
+    assert len(env.pending) == 0
+    assert batch_sizes[0] == 2 and max(batch_sizes[1:]) == 1
+
+
+if __name__ == '__main__':
+    test()
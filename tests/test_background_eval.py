@@ -0,0 +1,78 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import torch
+from omegaconf import OmegaConf
+from diffusion_policy.env_runner.background_eval import BackgroundEvaluator, _loggable
+
+
+class Media:
+    _path = 'media/videos/test_0.mp4'
+
+
+def _sum_worker(cfg_container, output_dir, device, normalizer_state, job_queue, result_queue):
+    # stands in for the checkpoint + env runner of _eval_worker, the
+    # normalizer offset is added to every score
+    offset = 0.0 if normalizer_state is None else float(normalizer_state['offset'].sum())
+    while True:
+        job = job_queue.get()
+        if job is None:
+            break
+        epoch, univ_pert = job
+        if epoch < 0:
+            result_queue.put((epoch, None, 'Traceback: rollout failed'))
+            continue
+        score = float(sum(x.sum() for x in univ_pert.values())) + offset
+        result_queue.put((epoch, {'test/mean_score': score}, None))
+
+
+def test():
+    # rollouts stay synchronous without cfg.background_eval
+    cfg = OmegaConf.create({'training': {'device': 'cpu'}})
+    assert BackgroundEvaluator.from_cfg(cfg, 'outputs') is None
+    cfg.background_eval = False
+    assert BackgroundEvaluator.from_cfg(cfg, 'outputs') is None
+
+    log = _loggable({'test/mean_score': 0.5, 'test/sim_video_0': Media()})
+    assert log == {'test/mean_score': 0.5, 'test/sim_video_0': 'media/videos/test_0.mp4'}
+
+    evaluator = BackgroundEvaluator(cfg, 'outputs', max_pending=1,
+        context='fork', worker=_sum_worker)
+    univ_pert = {'agentview_image': torch.ones(3, 4, 4)}
+    evaluator.submit(0, univ_pert)
+    # the snapshot does not follow later in place updates
+    univ_pert['agentview_image'].mul_(2)
+    # max_pending=1, waits for epoch 0 before queuing epoch 1
+    evaluator.submit(1, univ_pert)
+    results = evaluator.poll() + evaluator.wait()
+    assert [x[0] for x in results] == [0, 1]
+    assert results[0][2]['test/mean_score'] == 48.0
+    assert results[1][2]['test/mean_score'] == 96.0
+    assert torch.equal(results[0][1]['agentview_image'], torch.ones(3, 4, 4))
+    assert len(evaluator.pending) == 0
+
+    evaluator.submit(-1, univ_pert)
+    try:
+        evaluator.wait()
+        assert False
+    except RuntimeError as e:
+        assert 'rollout failed' in str(e)
+    evaluator.close()
+    assert not evaluator.process.is_alive()
+
+    # the eval process gets the normalizer the workspace fit
+    normalizer = torch.nn.Module()
+    normalizer.register_buffer('offset', torch.full((2,), 0.25))
+    evaluator = BackgroundEvaluator(cfg, 'outputs', normalizer=normalizer,
+        context='fork', worker=_sum_worker)
+    evaluator.submit(0, {'agentview_image': torch.ones(2)})
+    assert evaluator.wait()[0][2]['test/mean_score'] == 2.5
+    evaluator.close()
+
+
+if __name__ == '__main__':
+    test()
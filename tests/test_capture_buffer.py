@@ -0,0 +1,39 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import numpy as np
+from diffusion_policy.common.capture_buffer import CaptureBuffer
+
+
+def test():
+    buffer = CaptureBuffer(max_frames=4, stride=2)
+    for i in range(12):
+        # 2 streams of CHW float frames
+        buffer.add(np.full((2, 3, 8, 6), i / 12, dtype=np.float32))
+    assert len(buffer) == 4
+    frames = buffer.frames()
+    assert frames.shape == (4, 2, 8, 6, 3) and frames.dtype == np.uint8
+    # oldest first, captured steps 4, 6, 8, 10
+    expected = [round(i / 12 * 255) for i in (4, 6, 8, 10)]
+    assert frames[:, 0, 0, 0, 0].tolist() == expected
+    assert buffer.stream(1).shape == (4, 8, 6, 3)
+    buffer.close()
+
+    frame_bytes = 8 * 6 * 3
+    buffer = CaptureBuffer(max_frames=None, max_bytes=frame_bytes * 3, storage='disk')
+    for i in range(5):
+        buffer.add(np.full((1, 8, 6, 3), i, dtype=np.uint8))
+    assert buffer.max_frames == 3
+    assert buffer.stream(0)[:, 0, 0, 0].tolist() == [2, 3, 4]
+    path = buffer.path
+    assert os.path.exists(path)
+    buffer.close()
+    assert not os.path.exists(path)
+
+
+if __name__ == '__main__':
+    test()
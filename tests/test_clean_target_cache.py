@@ -0,0 +1,127 @@
+import sys
+import os
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import torch
+import torch.distributions as D
+from diffusion_policy.adversarial_attacks.clean_target_cache import CleanTargetCache, IndexedDataset
+
+
+class FakeDataset(torch.utils.data.Dataset):
+    def __len__(self):
+        return 10
+
+    def __getitem__(self, idx):
+        return {'obs': {'image': torch.full((2, 3), float(idx))}, 'action': torch.zeros(4)}
+
+
+class FakePolicy:
+    def __init__(self):
+        self.n_calls = 0
+
+    def predict_action(self, obs_dict):
+        self.n_calls += 1
+        return {'action': obs_dict['image'][:, 0] * 2}
+
+
+class FakeGMMPolicy(torch.nn.Module):
+    """
+    LSTM-GMM stand in: the hidden state carries over between calls until
+    reset() and only fits the batch size it was created for.
+    """
+    batch_stateful = True
+
+    def __init__(self):
+        super().__init__()
+        self.rnn = torch.nn.LSTM(3, 8, batch_first=True)
+        self.head = torch.nn.Linear(8, 2 * 4)
+        self.hidden = None
+
+    def reset(self):
+        self.hidden = None
+
+    def action_dist(self, obs_dict):
+        x = obs_dict['image'][:, :1]
+        if self.hidden is not None:
+            assert self.hidden[0].shape[1] == x.shape[0]
+        out, self.hidden = self.rnn(x, self.hidden)
+        means = self.head(out[:, 0]).reshape(-1, 2, 4)
+        component = D.Independent(D.Normal(means, torch.ones_like(means)), 1)
+        return D.MixtureSameFamily(D.Categorical(logits=torch.zeros(means.shape[:2])), component)
+
+
+def _perturbed_grad(policy, obs, pert, action_means_clean=None):
+    # one step of the RNN UAP loop, the clean forward only runs without a cache
+    policy.reset()
+    if action_means_clean is None:
+        with torch.no_grad():
+            action_means_clean = policy.action_dist(obs).component_distribution.base_dist.loc
+    image = (obs['image'] + pert).detach().requires_grad_(True)
+    policy.reset()
+    action_means = policy.action_dist({'image': image}).component_distribution.base_dist.loc
+    torch.nn.functional.mse_loss(action_means, action_means_clean).backward()
+    return image.grad
+
+
+def _check_gmm_equivalence(tmp_dir, checkpoint):
+    torch.manual_seed(0)
+    dataset = FakeDataset()
+    policy = FakeGMMPolicy().eval()
+    batch_size = 4
+    cache = CleanTargetCache(checkpoint, 'gmm_means', cache_dir=tmp_dir)
+    cache.build(policy, dataset, 'cpu', batch_size=batch_size)
+    # the UAP loop: shuffled full batches, fresh state per batch
+    dataloader = torch.utils.data.DataLoader(IndexedDataset(dataset),
+        batch_size=batch_size, shuffle=True)
+    pert = 0.1 * torch.randn(2, 3)
+    n_batches = 0
+    for _ in range(3):
+        for batch in dataloader:
+            if batch['obs']['image'].shape[0] != batch_size:
+                continue
+            policy.reset()
+            with torch.no_grad():
+                live = policy.action_dist(batch['obs']).component_distribution.base_dist.loc
+            assert torch.allclose(cache.get(batch['idx'], 'cpu'), live, atol=1e-6)
+            # the perturbed loss sees the same RNN state with and without the cache
+            live_grad = _perturbed_grad(policy, batch['obs'], pert)
+            cached_grad = _perturbed_grad(policy, batch['obs'], pert,
+                action_means_clean=cache.get(batch['idx'], 'cpu'))
+            assert live_grad.abs().sum() > 0
+            assert torch.allclose(cached_grad, live_grad, atol=1e-6)
+            n_batches += 1
+    assert n_batches == 6
+
+
+def test():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        checkpoint = os.path.join(tmp_dir, 'latest.ckpt')
+        with open(checkpoint, 'wb') as f:
+            f.write(b'weights')
+        dataset = FakeDataset()
+        policy = FakePolicy()
+        cache = CleanTargetCache(checkpoint, 'action', extra={'horizon': 2}, cache_dir=tmp_dir)
+        assert not cache.ready()
+        cache.build(policy, dataset, 'cpu', batch_size=4)
+        assert cache.ready() and policy.n_calls == 3
+
+        # a second run with the same key only reads the memmap
+        cache = CleanTargetCache(checkpoint, 'action', extra={'horizon': 2}, cache_dir=tmp_dir)
+        cache.build(policy, dataset, 'cpu', batch_size=4)
+        assert policy.n_calls == 3
+        targets = cache.get(torch.tensor([7, 2]), 'cpu')
+        assert torch.equal(targets, torch.full((2, 3), 2.0) * torch.tensor([[7.0], [2.0]]))
+        assert int(IndexedDataset(dataset)[5]['idx']) == 5
+
+        other = CleanTargetCache(checkpoint, 'action', extra={'horizon': 4}, cache_dir=tmp_dir)
+        assert other.key != cache.key
+
+        _check_gmm_equivalence(tmp_dir, checkpoint)
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,75 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import pickle
+import subprocess
+import tempfile
+import numpy as np
+from diffusion_policy.gym_util.deferred_video import (
+    FrameRing, VideoEncoderProcess, cleanup_stale_frames, SHM_PREFIX)
+
+
+def test():
+    ring = FrameRing((4, 4, 3), max_frames=3)
+    for i in range(5):
+        ring.append(np.full((4, 4, 3), i, dtype=np.uint8))
+    video = pickle.loads(pickle.dumps(ring.detach('episode.mp4', fps=10)))
+    assert video.n_frames == 5
+
+    # the ring keeps the last max_frames frames, in recording order
+    shm, buffer = video.attach()
+    frames = video.frames(buffer)
+    assert frames[:, 0, 0, 0].tolist() == [2, 3, 4]
+    del frames, buffer
+    shm.close()
+
+    video.discard()
+    try:
+        video.attach()
+        assert False, "discarded frames are still attached"
+    except FileNotFoundError:
+        pass
+
+    # a ring dropped without detach is freed, discarding twice is a no-op
+    ring = FrameRing((4, 4, 3), max_frames=2)
+    name = ring.shm.name
+    ring.discard()
+    ring.discard()
+    assert not os.path.exists(os.path.join('/dev/shm', name))
+
+    # close frees the frames the encoder did not get to
+    encoder = VideoEncoderProcess(context='fork')
+    encoder.job_queue.put(None)
+    encoder.process.join()
+    ring = FrameRing((4, 4, 3), max_frames=2)
+    ring.append(np.zeros((4, 4, 3), dtype=np.uint8))
+    video = ring.detach('unused.mp4', fps=10)
+    encoder.submit(video)
+    assert encoder.n_pending == 1
+    encoder.close()
+    assert encoder.n_pending == 0
+    try:
+        video.attach()
+        assert False, "frames of an unencoded video are still attached"
+    except FileNotFoundError:
+        pass
+
+    # frames of a crashed process are found by its pid
+    with tempfile.TemporaryDirectory() as shm_dir:
+        dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+        dead.wait()
+        stale = os.path.join(shm_dir, f'{SHM_PREFIX}{dead.pid}_deadbeef')
+        live = os.path.join(shm_dir, f'{SHM_PREFIX}{os.getpid()}_cafebabe')
+        for path in [stale, live]:
+            open(path, 'wb').close()
+        assert cleanup_stale_frames(shm_dir) == 1
+        assert not os.path.exists(stale)
+        assert os.path.exists(live)
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,52 @@
+import sys
+import os
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import numpy as np
+from diffusion_policy.common.replay_buffer import ReplayBuffer
+from diffusion_policy.common.image_cache import decoded_image_cache
+
+
+def test():
+    buff = ReplayBuffer.create_empty_zarr()
+    for i in range(3):
+        buff.add_episode({
+            'image': np.full((20, 8, 8, 3), i, dtype=np.uint8),
+            'action': np.full((20, 2), i, dtype=np.float32)
+        }, chunks={'image': (7, 8, 8, 3)})
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        cached = decoded_image_cache(buff, ['image'], tmp_dir)
+        assert cached.backend == 'numpy'
+        assert isinstance(cached['image'], np.memmap)
+        assert np.array_equal(cached['image'][:], buff['image'][:])
+        assert np.array_equal(cached['action'], buff['action'][:])
+        assert cached.n_episodes == 3
+
+        # the second call only maps the decoded file
+        files = sorted(os.listdir(tmp_dir))
+        cached = decoded_image_cache(buff, ['image'], tmp_dir)
+        assert sorted(os.listdir(tmp_dir)) == files
+        assert cached['image'][45, 0, 0, 0] == 2
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # a regenerated dataset with the same shapes is decoded again
+        dataset_path = os.path.join(tmp_dir, 'image.hdf5')
+        cache_dir = os.path.join(tmp_dir, 'cache')
+        with open(dataset_path, 'wb') as f:
+            f.write(b'version 1')
+        decoded_image_cache(buff, ['image'], cache_dir, dataset_path=dataset_path)
+        n_files = len([x for x in os.listdir(cache_dir) if x.endswith('.npy')])
+        decoded_image_cache(buff, ['image'], cache_dir, dataset_path=dataset_path)
+        assert len([x for x in os.listdir(cache_dir) if x.endswith('.npy')]) == n_files
+        with open(dataset_path, 'wb') as f:
+            f.write(b'version 2')
+        decoded_image_cache(buff, ['image'], cache_dir, dataset_path=dataset_path)
+        assert len([x for x in os.listdir(cache_dir) if x.endswith('.npy')]) == n_files + 1
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,56 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import torch
+from diffusers.schedulers.scheduling_ddpm import DDPMScheduler
+from diffusion_policy.model.diffusion.inference_scheduler import (
+    get_inference_scheduler, fork_scheduler, is_multistep)
+
+
+def sample(scheduler, model, x, n_extra_steps=0):
+    for t in scheduler.timesteps:
+        fork = fork_scheduler(scheduler)
+        output = model(x)
+        x = scheduler.step(output, t, x).prev_sample
+        # extra steps at the same timestep, like the PGD iterations
+        for _ in range(n_extra_steps):
+            fork_scheduler(fork).step(model(x + 1), t, x)
+    return x
+
+
+def test():
+    noise_scheduler = DDPMScheduler(num_train_timesteps=100,
+        beta_schedule='squaredcos_cap_v2', clip_sample=True, prediction_type='epsilon')
+
+    ddim = get_inference_scheduler(noise_scheduler, 'ddim')
+    assert type(ddim).__name__ == 'DDIMScheduler' and not is_multistep(ddim)
+    assert ddim.config.num_train_timesteps == 100
+    assert ddim.config.beta_schedule == 'squaredcos_cap_v2'
+    assert ddim.config.prediction_type == 'epsilon'
+    # stateless schedulers are not copied
+    assert fork_scheduler(ddim) is ddim
+
+    try:
+        get_inference_scheduler(noise_scheduler, 'euler')
+        assert False
+    except ValueError:
+        pass
+
+    # extra attack steps must not change a multistep solver trajectory
+    model = lambda x: 0.1 * x
+    x = torch.randn(2, 16, 10)
+    results = list()
+    for n_extra_steps in (0, 3):
+        scheduler = get_inference_scheduler(noise_scheduler, 'dpm_solver')
+        assert is_multistep(scheduler)
+        scheduler.set_timesteps(10)
+        results.append(sample(scheduler, model, x.clone(), n_extra_steps))
+    assert torch.allclose(results[0], results[1])
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,73 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import tempfile
+import h5py
+import numpy as np
+from diffusion_policy.common.init_state_cache import InitStateCache
+
+
+def write_dataset(path, n_demos):
+    with h5py.File(path, 'w') as f:
+        for idx in range(n_demos):
+            f.create_dataset(f'data/demo_{idx}/states',
+                data=np.arange(10, dtype=np.float64).reshape(2, 5) + 100 * idx)
+
+
+def test():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dataset_path = os.path.join(tmp_dir, 'demo.hdf5')
+        cache_dir = os.path.join(tmp_dir, 'cache')
+        write_dataset(dataset_path, n_demos=3)
+        env_meta = {'env_name': 'Lift', 'env_kwargs': {'control_freq': 20}}
+
+        cache = InitStateCache(dataset_path, env_meta, cache_dir=cache_dir)
+        train_states = cache.train_states([0, 2])
+        assert np.array_equal(train_states[2], np.arange(5) + 200)
+        cache.add_seed_states({100000: np.ones(5), 100001: np.zeros(5)})
+        assert cache.dirty
+        cache.save()
+        assert not cache.dirty and cache.path.exists()
+
+        # round trip, cached states do not touch the dataset
+        loaded = InitStateCache(dataset_path, env_meta, cache_dir=cache_dir)
+        assert loaded.path == cache.path
+        assert np.array_equal(loaded.train_states([0, 2])[0], train_states[0])
+        assert not loaded.dirty
+        seed_states = loaded.seed_states()
+        assert sorted(seed_states.keys()) == [100000, 100001]
+        assert np.array_equal(seed_states[100000], np.ones(5))
+
+        # saves of other processes are merged, not overwritten
+        other = InitStateCache(dataset_path, env_meta, cache_dir=cache_dir)
+        other.add_seed_states({100002: np.full(5, 2.0)})
+        cache.train_states([1])
+        other.save()
+        cache.save()
+        merged = InitStateCache(dataset_path, env_meta, cache_dir=cache_dir)
+        assert sorted(merged.seed_states().keys()) == [100000, 100001, 100002]
+        assert 'train_1' in merged.states
+
+        # another env config gets its own file
+        other_meta = InitStateCache(dataset_path, dict(env_meta, env_name='Can'),
+            cache_dir=cache_dir)
+        assert other_meta.path != cache.path and len(other_meta.states) == 0
+
+        # a corrupt file is rebuilt
+        with open(cache.path, 'wb') as f:
+            f.write(b'not an npz')
+        assert len(InitStateCache(dataset_path, env_meta, cache_dir=cache_dir).states) == 0
+
+        # cache_dir=None stays in memory
+        memory = InitStateCache(dataset_path, env_meta, cache_dir=None)
+        memory.train_states([0])
+        memory.save()
+        assert memory.path is None and memory.dirty
+
+
+if __name__ == '__main__':
+    test()
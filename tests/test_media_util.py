@@ -0,0 +1,32 @@
+import sys
+import os
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import numpy as np
+from diffusion_policy.common.media_util import MediaWriter, side_by_side, to_uint8_image
+
+
+def test():
+    chw = np.ones((3, 8, 6), dtype=np.float32)
+    img = to_uint8_image(chw)
+    assert img.shape == (8, 6, 3) and img.dtype == np.uint8 and img.max() == 255
+
+    frame = side_by_side(chw, np.zeros((8, 6, 3), dtype=np.uint8), gap=2)
+    assert frame.shape == (8, 14, 3)
+    assert frame[:, 6:8].max() == 0
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = os.path.join(tmp_dir, 'clean_vs_perturbed.gif')
+        with MediaWriter(file_path, fps=10, stride=3) as writer:
+            for i in range(10):
+                writer.write(chw * (i / 10), chw)
+        assert writer.n_written == 4
+        assert os.path.getsize(file_path) > 0
+
+
+if __name__ == '__main__':
+    test()
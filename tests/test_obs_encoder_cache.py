@@ -0,0 +1,63 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import torch
+import torch.nn as nn
+from diffusion_policy.model.vision.multi_image_obs_encoder import MultiImageObsEncoder
+from diffusion_policy.model.vision.obs_encoder_cache import (
+    ObsFeatureCache, encode_obs_keys, get_obs_encoder_keys)
+
+
+def make_encoder(share_rgb_model):
+    shape_meta = {'obs': {
+        'agentview_image': {'shape': [3, 16, 16], 'type': 'rgb'},
+        'robot0_eye_in_hand_image': {'shape': [3, 16, 16], 'type': 'rgb'},
+        'robot0_eef_pos': {'shape': [3]},
+    }}
+    rgb_model = nn.Sequential(
+        nn.Conv2d(3, 4, kernel_size=3, stride=2),
+        nn.BatchNorm2d(4),
+        nn.ReLU(),
+        nn.Flatten())
+    encoder = MultiImageObsEncoder(shape_meta=shape_meta, rgb_model=rgb_model,
+        crop_shape=(12, 12), random_crop=True, share_rgb_model=share_rgb_model)
+    # random crop and batch norm statistics only agree in eval mode
+    return encoder.eval()
+
+
+def test():
+    torch.manual_seed(0)
+    for share_rgb_model in [False, True]:
+        encoder = make_encoder(share_rgb_model)
+        nobs = {
+            'agentview_image': torch.rand(6, 3, 16, 16),
+            'robot0_eye_in_hand_image': torch.rand(6, 3, 16, 16),
+            'robot0_eef_pos': torch.rand(6, 3),
+        }
+        keys = get_obs_encoder_keys(encoder)
+        assert keys == ['agentview_image', 'robot0_eye_in_hand_image', 'robot0_eef_pos']
+        with torch.no_grad():
+            full = encoder(nobs)
+            features = encode_obs_keys(encoder, nobs, keys)
+        assert torch.allclose(torch.cat([features[k] for k in keys], dim=-1), full, atol=1e-6)
+
+        cache = ObsFeatureCache(encoder, nobs, attacked_keys=['agentview_image'])
+        assert cache.attacked_keys == ['agentview_image']
+        assert torch.allclose(cache.clean_features(), full, atol=1e-6)
+
+        # only the attacked view is re-encoded, gradients reach it
+        adv = (nobs['agentview_image'] + 0.1 * torch.rand(6, 3, 16, 16)).requires_grad_(True)
+        cached = cache({'agentview_image': adv})
+        with torch.no_grad():
+            expected = encoder(dict(nobs, agentview_image=adv))
+        assert torch.allclose(cached, expected, atol=1e-6)
+        cached.sum().backward()
+        assert adv.grad is not None and adv.grad.abs().sum() > 0
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,57 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import pickle
+import tempfile
+import torch
+from diffusion_policy.adversarial_attacks.perturbation_store import (
+    PerturbationStore, load_tensors, save_tensors, tensor_hash)
+
+
+def test():
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        checkpoint = os.path.join(tmp_dir, 'latest.ckpt')
+        with open(checkpoint, 'wb') as f:
+            f.write(b'checkpoint')
+
+        tensors = {'agentview_image': torch.rand(3, 8, 8), 'step': torch.arange(4)}
+        path = os.path.join(tmp_dir, 'pert.safetensors')
+        save_tensors(path, tensors, metadata={'format': 'pt'})
+        loaded, metadata = load_tensors(path)
+        assert metadata == {'format': 'pt'}
+        for key, value in tensors.items():
+            assert torch.equal(loaded[key], value)
+        assert tensor_hash(loaded) == tensor_hash(tensors)
+
+        store = PerturbationStore(os.path.join(tmp_dir, 'perturbations'))
+        views = ['robot0_eye_in_hand_image']
+        for epoch, score in enumerate([0.8, 0.2, 0.5]):
+            pert = {views[0]: torch.full((3, 8, 8), epoch / 100)}
+            record = store.save(pert, checkpoint, epsilon=0.0625, view=views[0],
+                targeted=False, score=score, epoch=epoch)
+            assert record['version'] == epoch + 1
+        # same content is stored once
+        store.save(pert, checkpoint, epsilon=0.125, view=views[0], score=0.9, epoch=2)
+        assert len(list(store.root.glob('*.safetensors'))) == 3
+
+        assert len(store.records(checkpoint=checkpoint)) == 4
+        best = store.best(checkpoint, epsilon=0.0625, targeted=False)
+        assert best['epoch'] == 1 and best['score'] == 0.2
+        assert store.best(checkpoint, epsilon=0.0625, targeted=True) is None
+        pert = store.load(best, verify=True)
+        assert torch.allclose(pert[views[0]], torch.full((3, 8, 8), 0.01))
+
+        legacy_path = os.path.join(tmp_dir, 'untar_pert_0.03125_epoch_10_mean_score_0.1_agentview_image.pkl')
+        with open(legacy_path, 'wb') as f:
+            pickle.dump({'agentview_image': torch.zeros(3, 8, 8)}, f)
+        record = store.import_legacy(legacy_path, checkpoint)
+        assert record['epsilon'] == 0.03125 and record['epoch'] == 10
+        assert record['view'] == 'agentview_image' and not record['targeted']
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,60 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import numpy as np
+from diffusion_policy.env_runner.pipelined_rollout import PipelinedRollout, split_env_groups
+
+
+class CountingVectorEnv:
+    """
+    Env i is done after horizon[i] steps, obs is its step count.
+    """
+    def __init__(self, horizon):
+        self.horizon = np.array(horizon)
+        self.num_envs = len(horizon)
+        self.steps = np.zeros(self.num_envs, dtype=np.int64)
+        self.pending = set()
+        self.log = list()
+
+    def step_each_async(self, actions, indices):
+        assert self.pending.isdisjoint(indices)
+        self.pending.update(int(i) for i in indices)
+        self.log.append(('send', tuple(indices)))
+        for i in indices:
+            self.steps[i] = min(self.steps[i] + 1, self.horizon[i])
+
+    def step_each_wait(self, indices):
+        self.pending.difference_update(int(i) for i in indices)
+        self.log.append(('wait', tuple(indices)))
+        obs = {'step': self.steps[indices].copy()}
+        done = self.steps[indices] >= self.horizon[indices]
+        return obs, np.zeros(len(indices)), done, [dict()] * len(indices)
+
+
+def test():
+    groups = split_env_groups(5, 2)
+    assert [len(x) for x in groups] == [3, 2]
+    assert len(split_env_groups(1, 2)) == 1
+
+    env = CountingVectorEnv([3, 3, 3, 5, 5])
+    seen = list()
+    def infer(group_idx, indices, obs):
+        seen.append((group_idx, obs['step'].tolist()))
+        return np.zeros((len(indices), 1))
+
+    PipelinedRollout(env, 2).run({'step': np.zeros(5, dtype=np.int64)}, infer)
+    assert env.steps.tolist() == [3, 3, 3, 5, 5]
+    assert len(env.pending) == 0
+    # group 1 infers while group 0 steps
+    assert env.log[:3] == [('send', (0, 1, 2)), ('send', (3, 4)), ('wait', (0, 1, 2))]
+    # every group stops at its own horizon
+    assert sum(1 for g, _ in seen if g == 0) == 3
+    assert sum(1 for g, _ in seen if g == 1) == 5
+
+
+if __name__ == '__main__':
+    test()
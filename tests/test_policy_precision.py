@@ -0,0 +1,121 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import torch
+import torch.nn as nn
+import torch.distributions as D
+from omegaconf import OmegaConf
+from diffusion_policy.policy.base_image_policy import BaseImagePolicy, autocast_method
+from eval_using_config import check_precision
+
+
+class LinearPolicy(BaseImagePolicy):
+    def __init__(self):
+        super().__init__()
+        self.net = nn.Sequential(nn.Linear(16, 64), nn.ReLU(), nn.Linear(64, 4))
+
+    @autocast_method
+    def predict_action(self, obs_dict):
+        obs = obs_dict['obs'] * 2.0 - 1.0
+        return {'action': self.net(obs), 'obs': obs}
+
+    @autocast_method
+    def action_dist(self, obs_dict):
+        # GMM head like the robomimic LSTM-GMM policy, 2 modes
+        out = self.net(obs_dict['obs'] * 2.0 - 1.0)
+        means = torch.stack([out, -out], dim=1)
+        component = D.Independent(D.Normal(means, torch.ones_like(means)), 1)
+        mixture = D.Categorical(logits=out[:, :2])
+        return D.MixtureSameFamily(mixture, component)
+
+
+class ScoreRunner:
+    # clean success rate per precision, stands in for the env runner
+    def __init__(self, scores):
+        self.scores = scores
+
+    def run(self, policy, epsilon=None, cfg=None):
+        assert cfg.attack_type == 'None'
+        action = policy.predict_action({'obs': torch.rand(4, 16)})['action']
+        assert action.dtype == torch.float32
+        return {'test/mean_score': self.scores[policy.precision]}
+
+
+class PatchScoreRunner(ScoreRunner):
+    # signature of RobomimicImageRunner.run, used by patch evals
+    def run(self, policy, save_pkl=False, adversarial_patch=None, cfg=None):
+        assert adversarial_patch is None
+        return super().run(policy, cfg=cfg)
+
+
+def test():
+    torch.manual_seed(0)
+    policy = LinearPolicy().eval()
+    obs_dict = {'obs': torch.rand(8, 16)}
+    with torch.no_grad():
+        ref = policy.predict_action(obs_dict)
+
+    policy.set_precision('bf16')
+    with torch.no_grad():
+        result = policy.predict_action(obs_dict)
+    # outputs come back in fp32, the elementwise input math is untouched
+    assert result['action'].dtype == torch.float32
+    assert torch.equal(result['obs'], ref['obs'])
+    assert torch.allclose(result['action'], ref['action'], atol=5e-2)
+
+    # attack gradients w.r.t. the fp32 input stay fp32
+    obs = obs_dict['obs'].clone().requires_grad_(True)
+    loss = policy.predict_action({'obs': obs})['action'].square().mean()
+    loss.backward()
+    assert obs.grad.dtype == torch.float32
+
+    # distributions come back with fp32 parameters, close to the fp32 ones
+    policy.set_precision('fp32')
+    with torch.no_grad():
+        ref_means = policy.action_dist(obs_dict).component_distribution.base_dist.loc
+    # fp16 autocast is GPU only
+    devices = [('bf16', 'cpu')]
+    if torch.cuda.is_available():
+        devices.append(('fp16', 'cuda'))
+    for precision, device in devices:
+        policy.to(device).set_precision(precision)
+        with torch.no_grad():
+            dist = policy.action_dist({'obs': obs_dict['obs'].to(device)})
+        means = dist.component_distribution.base_dist.loc
+        assert means.dtype == torch.float32
+        assert dist.mixture_distribution.logits.dtype == torch.float32
+        assert torch.allclose(means.cpu(), ref_means, atol=5e-2)
+    policy.to('cpu')
+
+    # clean fp32 vs reduced precision rollouts
+    cfg = OmegaConf.create({'attack_type': 'pgd', 'log': False})
+    scores = check_precision(cfg, policy, ScoreRunner({'fp32': 0.9, 'bf16': 0.85}),
+        'bf16', tolerance=0.1, attack=False)
+    assert scores == {'fp32': 0.9, 'bf16': 0.85}
+    scores = check_precision(cfg, policy, ScoreRunner({'fp32': 0.9, 'bf16': 0.85}),
+        'bf16', tolerance=0.1, attack=True)
+    assert scores == {'fp32': 0.9, 'bf16': 0.85}
+    patch_cfg = OmegaConf.create({'attack_type': 'patch', 'log': False})
+    scores = check_precision(patch_cfg, policy, PatchScoreRunner({'fp32': 0.9, 'bf16': 0.85}),
+        'bf16', tolerance=0.1, attack=True)
+    assert scores == {'fp32': 0.9, 'bf16': 0.85}
+    try:
+        check_precision(cfg, policy, ScoreRunner({'fp32': 0.9, 'bf16': 0.5}),
+            'bf16', tolerance=0.1, attack=False)
+        assert False
+    except RuntimeError:
+        pass
+
+    try:
+        policy.set_precision('int8')
+        assert False
+    except ValueError:
+        pass
+
+
+if __name__ == '__main__':
+    test()
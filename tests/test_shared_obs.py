@@ -0,0 +1,67 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import numpy as np
+import torch
+from diffusion_policy.gym_util.shared_obs import make_obs_transport
+
+
+class FakeSharedEnv:
+    """
+    Stands in for the observations of a shared memory AsyncVectorEnv.
+    """
+    def __init__(self, n_envs):
+        self.observations = {
+            'agentview_image': np.zeros((n_envs, 2, 3, 4, 4), dtype=np.float32),
+            'robot0_eef_pos': np.zeros((n_envs, 2, 3), dtype=np.float32),
+        }
+
+    def step(self, value):
+        # workers write in place
+        for array in self.observations.values():
+            array[:] = value + np.arange(len(array)).reshape((-1,) + (1,) * (array.ndim - 1))
+
+
+def test():
+    env = FakeSharedEnv(n_envs=6)
+    transport = make_obs_transport(env, 'cpu')
+    env.step(10)
+
+    obs = transport()
+    assert obs['robot0_eef_pos'].shape == (6, 2, 3)
+    assert obs['robot0_eef_pos'][:, 0, 0].tolist() == [10, 11, 12, 13, 14, 15]
+
+    # a contiguous env group is a view of the buffer, read after the next step
+    group = transport([2, 3, 4])
+    assert group['agentview_image'][:, 0, 0, 0, 0].tolist() == [12, 13, 14]
+    env.step(20)
+    assert group['agentview_image'][:, 0, 0, 0, 0].tolist() == [22, 23, 24]
+
+    # other index sets are gathered copies in the given order
+    gathered = transport([5, 0, 3])
+    assert gathered['robot0_eef_pos'][:, 1, 2].tolist() == [25, 20, 23]
+    env.step(30)
+    assert gathered['robot0_eef_pos'][:, 1, 2].tolist() == [25, 20, 23]
+    assert transport(np.array([1]))['robot0_eef_pos'][:, 0, 0].tolist() == [31]
+
+    if torch.cuda.is_available():
+        cuda_transport = make_obs_transport(env, 'cuda')
+        for indices in [None, [1, 2], [4, 1]]:
+            expected = transport(indices)
+            result = cuda_transport(indices)
+            for key, value in result.items():
+                assert value.device.type == 'cuda'
+                assert torch.equal(value.cpu(), expected[key])
+        cuda_transport.close()
+        assert len(cuda_transport.registered) == 0
+
+    # envs without a local dict buffer, e.g. leased from the env pool
+    assert make_obs_transport(object(), 'cpu') is None
+
+
+if __name__ == '__main__':
+    test()
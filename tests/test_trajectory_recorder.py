@@ -0,0 +1,64 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import torch
+from diffusion_policy.model.diffusion.trajectory_recorder import TrajectoryRecorder
+
+
+def run_steps(recorder, n_steps, device='cpu'):
+    recorder.reset()
+    trajectory = torch.zeros(2, 4, 3, device=device)
+    for step_idx in range(n_steps):
+        # timesteps count down like a scheduler
+        trajectory.fill_(step_idx)
+        recorder(step_idx, n_steps, n_steps - 1 - step_idx, trajectory)
+    return trajectory
+
+
+def test():
+    # every 2nd step plus the final one, the ring keeps the last 3
+    recorder = TrajectoryRecorder(max_steps=3, every=2)
+    run_steps(recorder, 10)
+    assert len(recorder) == 3
+    assert [int(x[0, 0, 0]) for x in recorder.trajectories] == [6, 8, 9]
+    assert list(recorder.timesteps) == [3, 1, 0]
+
+    # records are copies, not views of the in-place updated sample
+    recorder = TrajectoryRecorder(offload=None)
+    trajectory = run_steps(recorder, 4)
+    assert [int(x[0, 0, 0]) for x in recorder.trajectories] == [0, 1, 2, 3]
+    trajectory.fill_(-1)
+    assert int(recorder.trajectories[0][0, 0, 0]) == 0
+
+    # the default offload snapshots samples that are already on the host
+    recorder = TrajectoryRecorder()
+    trajectory = run_steps(recorder, 4)
+    trajectory.fill_(-1)
+    assert [int(x[0, 0, 0]) for x in recorder.trajectories] == [0, 1, 2, 3]
+
+    # offload moves every record to the host
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    recorder = TrajectoryRecorder(offload='cpu')
+    # no explicit sync, trajectories waits for the copies
+    run_steps(recorder, 4, device=device)
+    assert all(x.device.type == 'cpu' for x in recorder.trajectories)
+    assert [int(x[0, 0, 0]) for x in recorder.trajectories] == [0, 1, 2, 3]
+
+    # every sampling loop starts empty
+    run_steps(recorder, 2)
+    assert len(recorder) == 2
+
+    for kwargs in [{'max_steps': 0}, {'every': 0}]:
+        try:
+            TrajectoryRecorder(**kwargs)
+            assert False, f"{kwargs} accepted"
+        except ValueError:
+            pass
+
+
+if __name__ == '__main__':
+    test()
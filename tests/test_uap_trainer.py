@@ -0,0 +1,36 @@
+import sys
+import os
+
+ROOT_DIR = os.path.dirname(os.path.dirname(__file__))
+sys.path.append(ROOT_DIR)
+os.chdir(ROOT_DIR)
+
+import torch
+from diffusion_policy.adversarial_attacks.uap_trainer import UAPTrainer
+
+
+def test():
+    target = torch.full((3, 4, 4), 0.05)
+    for optimizer in ('sign_sgd', 'adam', 'mi_fgsm'):
+        trainer = UAPTrainer({'image': torch.zeros(3, 4, 4)}, epsilon=0.1,
+            optimizer=optimizer, lr=0.01, momentum=0.5, lr_scheduler='cosine', num_training_steps=40)
+        univ_pert = trainer.perturbation
+        for _ in range(40):
+            # attack loss -||pert - target||^2 per sample of a (B,T,C,H,W) batch
+            obs = torch.zeros(8, 2, 3, 4, 4, requires_grad=True)
+            loss = -((obs + univ_pert['image'] - target) ** 2).sum()
+            loss.backward()
+            trainer.step({'image': obs.grad})
+        # the views follow the parameters in place
+        assert univ_pert['image'].data_ptr() == trainer.params['image'].data_ptr()
+        assert (univ_pert['image'] - target).abs().max() < 0.02, optimizer
+        assert trainer.n_steps == 40
+
+    # projection onto the epsilon ball
+    trainer = UAPTrainer({'image': torch.zeros(3, 4, 4)}, epsilon=0.03, lr=0.1)
+    trainer.step({'image': torch.ones(5, 3, 4, 4)})
+    assert torch.allclose(trainer.perturbation['image'], torch.full((3, 4, 4), 0.03))
+
+
+if __name__ == '__main__':
+    test()